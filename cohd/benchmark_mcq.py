@@ -0,0 +1,99 @@
+"""
+Benchmark of the multicurie query (MCQ) scoring
+
+Times query_cohd_mysql._mcq_scores on synthetic associations for increasing numbers of input concepts (member IDs).
+The scoring is vectorized, so the time should grow about linearly with the number of associations.
+
+Usage, from the cohd_api directory:
+    python -m cohd.benchmark_mcq --member-ids 10 25 50 100
+"""
+import argparse
+import time
+import numpy as np
+
+from .query_cohd_mysql import _mcq_scores
+
+
+def synthetic_mcq(n_member_ids, n_associations=2000, n_concepts=50000, pair_fraction=0.2, seed=0):
+    """ Generates synthetic inputs for _mcq_scores
+
+    Parameters
+    ----------
+    n_member_ids: number of input concepts
+    n_associations: number of associations per input concept
+    n_concepts: number of concepts the associated concepts are drawn from
+    pair_fraction: fraction of the pairs of input concepts that co-occur
+    seed: random seed
+
+    Returns
+    -------
+    (associations, pair_counts) like the query_trapi results and get_pair_concept_count rows
+    """
+    rng = np.random.default_rng(seed)
+    inputs = np.arange(1, n_member_ids + 1)
+    associations = list()
+    for concept_id_1 in inputs:
+        concept_ids_2 = rng.choice(np.arange(n_member_ids + 1, n_concepts), n_associations, replace=False)
+        ci_lo = rng.uniform(-3, 3, n_associations)
+        ci_hi = ci_lo + rng.uniform(0, 2, n_associations)
+        for concept_id_2, lo, hi in zip(concept_ids_2.tolist(), ci_lo.tolist(), ci_hi.tolist()):
+            associations.append({
+                'dataset_id': 1,
+                'concept_id_1': int(concept_id_1),
+                'concept_id_2': concept_id_2,
+                'concept_2_name': f'Concept {concept_id_2}',
+                'concept_2_domain': 'Condition',
+                'concept_2_class_id': 'Clinical Finding',
+                'ln_ratio': (lo + hi) / 2,
+                'ln_ratio_ci': (lo, hi),
+            })
+
+    pair_counts = list()
+    for i in inputs.tolist():
+        for j in inputs.tolist():
+            if i < j and rng.random() < pair_fraction:
+                count_1, count_2 = rng.integers(100, 1000, 2).tolist()
+                pair_count = int(rng.integers(1, min(count_1, count_2)))
+                pair_counts.append({'concept_id_1': i, 'concept_id_2': j, 'concept_count_1': count_1,
+                                    'concept_count_2': count_2, 'concept_pair_count': pair_count})
+                pair_counts.append({'concept_id_1': j, 'concept_id_2': i, 'concept_count_1': count_2,
+                                    'concept_count_2': count_1, 'concept_pair_count': pair_count})
+    return associations, pair_counts
+
+
+def benchmark(member_ids, n_associations=2000, repeat=3):
+    """ Times _mcq_scores for each number of member IDs
+
+    Parameters
+    ----------
+    member_ids: list of numbers of input concepts
+    n_associations: number of associations per input concept
+    repeat: number of timed runs. The best run is reported.
+
+    Returns
+    -------
+    list of (number of member IDs, number of associations, best time in seconds)
+    """
+    results = list()
+    for n_member_ids in member_ids:
+        associations, pair_counts = synthetic_mcq(n_member_ids, n_associations)
+        times = list()
+        for _ in range(repeat):
+            start = time.perf_counter()
+            _mcq_scores(associations, pair_counts, n_member_ids)
+            times.append(time.perf_counter() - start)
+        results.append((n_member_ids, len(associations), min(times)))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the multicurie query scoring')
+    parser.add_argument('--member-ids', type=int, nargs='+', default=[10, 25, 50, 100],
+                        help='Numbers of input concepts')
+    parser.add_argument('--associations', type=int, default=2000, help='Associations per input concept')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per size')
+    a = parser.parse_args()
+
+    print(f'{"member IDs":>10} {"associations":>12} {"seconds":>8} {"us/assoc":>8}')
+    for n_member_ids, n, seconds in benchmark(a.member_ids, a.associations, a.repeat):
+        print(f'{n_member_ids:>10} {n:>12} {seconds:>8.3f} {seconds / n * 1e6:>8.2f}')
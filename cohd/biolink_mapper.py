@@ -8,7 +8,7 @@ from datetime import datetime
 
 from .cohd_utilities import DomainClass
 from .app import app, cache
-from .query_cohd_mysql import sql_connection
+from .query_cohd_mysql import sql_connection, storage
 from .translator.sri_node_normalizer import SriNodeNormalizer, NormalizedNode
 from .translator.sri_name_resolution import SriNameResolution
 from .translator import bm_toolkit
@@ -141,13 +141,7 @@ class BiolinkConceptMapper:
     # Pre-fetch mappings from SQL database
     @staticmethod
     def prefetch_mappings():
-        sql = """SELECT m.*, c.concept_name
-        FROM biolink.mappings m
-        JOIN concept c ON m.omop_id = c.concept_id"""
-        conn = sql_connection()
-        cur = conn.cursor()
-        cur.execute(sql)
-        mapping_rows = cur.fetchall()
+        mapping_rows = storage.biolink_mappings()
         BiolinkConceptMapper._map_omop = {r['omop_id']:r for r in mapping_rows}
         BiolinkConceptMapper._map_biolink = {r['biolink_id']:r for r in mapping_rows if r['preferred']}
         logging.info('Biolink mappings prefetch completed')
@@ -247,8 +241,8 @@ class BiolinkConceptMapper:
         # Get list of deployed database schemas for environment (default to only if not in config file `cohd`)
         databases = app.config.get('DATABASES', ['cohd'])
 
-        # COHD MySQL database
-        conn = sql_connection()
+        # COHD MySQL database. Mappings are written, so use the primary server
+        conn = sql_connection(primary=True)
         cur = conn.cursor()
 
         # Get current number of mappings that weren't from string searches
@@ -569,6 +563,8 @@ class BiolinkConceptMapper:
             New mapped mappings: {mapping_count}
             Retained old mappings"""
             logging.info(status_message)
+            cur.close()
+            conn.close()
             return status_message, 200
         else:
             logging.info('Updating biolink.mappings database')
@@ -768,7 +764,7 @@ class BiolinkConceptMapper:
                 tries += 1
 
         # Name lookup can take a while, reconnect to SQL server
-        conn = sql_connection()
+        conn = sql_connection(primary=True)
         cur = conn.cursor()
 
         # Insert new string-based mappings
@@ -866,6 +862,8 @@ class BiolinkConceptMapper:
         params = [datetime.now(), mapping_count + string_match_count]
         cur.execute(sql, params)
         conn.commit()
+        cur.close()
+        conn.close()
 
         status_message = f"""Current number of mapped mappings: {current_count}
                 Current number of string mappings: {current_count_string}
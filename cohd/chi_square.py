@@ -0,0 +1,117 @@
+"""
+Vectorized 2x2 chi-square test between pairs of concepts
+
+Computes the contingency table, chi-square statistic, p-value, and Bonferroni-adjusted p-value for whole columns of
+concept counts at once. The results are the same as building the observed and expected tables of each pair and calling
+scipy.stats.chisquare(observed, expected, 2) per pair (1 degree of freedom, no continuity correction), which is what
+the association/chiSquare endpoint, the TRAPI queries, kgx/kgx_cohd.py, and db/precompute_stats/precompute.py did.
+"""
+import numpy as np
+from scipy.stats import chi2
+
+# Names of the contingency table cells in the association/chiSquare results
+CELL_NAMES = ('n_~c1_~c2', 'n_c1_~c2', 'n_~c1_c2', 'n_c1_c2')
+
+
+def columns(rows, names, dtype=np.float64):
+    """ Gets columns of the rows returned by a dict cursor as arrays
+
+    Parameters
+    ----------
+    rows: list of dicts
+    names: column names
+    dtype: array type
+
+    Returns
+    -------
+    list of arrays, one per name
+    """
+    return [np.fromiter((r[name] for r in rows), dtype=dtype, count=len(rows)) for name in names]
+
+
+def contingency(pair_count, count_1, count_2, patient_count):
+    """ Observed 2x2 contingency tables
+
+    Parameters
+    ----------
+    pair_count: array of concept pair counts
+    count_1: array of concept 1 counts
+    count_2: array of concept 2 counts
+    patient_count: number of patients (scalar or array)
+
+    Returns
+    -------
+    (n_~c1_~c2, n_c1_~c2, n_~c1_c2, n_c1_c2) arrays
+    """
+    cpc = np.asarray(pair_count, dtype=np.float64)
+    c1 = np.asarray(count_1, dtype=np.float64)
+    c2 = np.asarray(count_2, dtype=np.float64)
+    pts = np.asarray(patient_count, dtype=np.float64)
+    return pts - c1 - c2 + cpc, c1 - cpc, c2 - cpc, cpc
+
+
+def expected(count_1, count_2, patient_count):
+    """ Expected 2x2 contingency tables if the concepts were independent
+
+    Parameters
+    ----------
+    count_1: array of concept 1 counts
+    count_2: array of concept 2 counts
+    patient_count: number of patients (scalar or array)
+
+    Returns
+    -------
+    (n_~c1_~c2, n_c1_~c2, n_~c1_c2, n_c1_c2) arrays
+    """
+    c1 = np.asarray(count_1, dtype=np.float64)
+    c2 = np.asarray(count_2, dtype=np.float64)
+    pts = np.asarray(patient_count, dtype=np.float64)
+    return (pts - c1) * (pts - c2) / pts, c1 * (pts - c2) / pts, c2 * (pts - c1) / pts, c1 * c2 / pts
+
+
+def chi_square(pair_count, count_1, count_2, patient_count, n_concept_pairs=1, min_p=0):
+    """ Chi-square test of independence of the concepts in each pair
+
+    Parameters
+    ----------
+    pair_count: array of concept pair counts
+    count_1: array of concept 1 counts
+    count_2: array of concept 2 counts
+    patient_count: number of patients (scalar or array)
+    n_concept_pairs: number of pairs of concepts in the dataset, for the Bonferroni adjustment
+    min_p: minimum p-value to return (ARAX displays p-values of 0 as None)
+
+    Returns
+    -------
+    (chi-square statistic, p-value, Bonferroni-adjusted p-value) arrays
+    """
+    observed = contingency(pair_count, count_1, count_2, patient_count)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        statistic = sum((o - e) ** 2 / e for o, e in zip(observed, expected(count_1, count_2, patient_count)))
+    p = chi2.sf(statistic, 1)
+    p_adjusted = np.maximum(np.minimum(p * n_concept_pairs, 1.0), min_p)
+    return statistic, np.maximum(p, min_p), p_adjusted
+
+
+def chi_square_rows(rows, n_concept_pairs=1, min_p=0, pair_count='concept_pair_count', count_1='concept_count_1',
+                    count_2='concept_count_2', patient_count='patient_count'):
+    """ Chi-square test on the rows returned by a dict cursor
+
+    Parameters
+    ----------
+    rows: list of dicts with the pair count, concept counts, and patient count
+    n_concept_pairs: number of pairs of concepts in the dataset, for the Bonferroni adjustment
+    min_p: minimum p-value to return
+    pair_count: name of the pair count column
+    count_1: name of the concept 1 count column
+    count_2: name of the concept 2 count column
+    patient_count: name of the patient count column
+
+    Returns
+    -------
+    (contingency cells, chi-square statistic, p-value, Bonferroni-adjusted p-value) where the contingency cells are
+    the arrays of contingency()
+    """
+    cpc, c1, c2, pts = columns(rows, [pair_count, count_1, count_2, patient_count])
+    statistic, p, p_adjusted = chi_square(cpc, c1, c2, pts, n_concept_pairs, min_p)
+    return contingency(cpc, c1, c2, pts), statistic, p, p_adjusted
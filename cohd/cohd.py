@@ -27,8 +27,13 @@ from . import cohd_translator
 from . import cohd_trapi
 from . import scheduled_tasks
 from . import biolink_mapper
+from . import preload
 from .cohd_utilities import read_log
 
+# Build the read-only data used by every request at startup. Under uWSGI, this runs in the master so that the workers
+# share the data after forking.
+preload.preload_shared_data()
+
 
 ##########
 # ROUTES #
@@ -174,6 +179,11 @@ def api_association_mcq():
     return api_call('association', 'mcq')
 
 
+@app.route('/api/association/pairs', methods=['POST'])
+def api_association_pairs():
+    return api_call('association', 'pairs')
+
+
 @app.route('/api/temporal/conceptAgeCounts')
 def api_temporal_conceptAgeCounts():
     return api_call('temporal', 'conceptAgeCounts')
@@ -323,6 +333,8 @@ def api_call(service=None, meta=None, query=None, version=None):
                 meta == 'relativeFrequency' or \
                 meta == 'mcq':
             result = query_cohd_mysql.query_db(service, meta, request.args)
+        elif meta == 'pairs':
+            result = query_cohd_mysql.query_db_association_pairs(request.get_json(silent=True))
         else:
             result = 'meta not recognized', 400
     elif service == 'temporal':
@@ -1,9 +1,13 @@
 from collections import defaultdict
-import random
+import functools
+import logging
+from typing import NamedTuple
 
 import numpy as np
+import pymysql
 from scipy.stats import poisson
 
+from .dataset_stats import VersionedIndex
 from .query_cohd_mysql import *
 
 
@@ -15,6 +19,9 @@ SUPPRESSION_MARKER = 1
 # Value used in place of suppressed numbers as an estimate
 SUPPRESSION_ESTIMATE = 5
 
+# Maximum number of simulated counts drawn at once by bootstrap_delta_distribution (8 MB of float64)
+BOOTSTRAP_CHUNK_ELEMENTS = 1 << 20
+
 
 class AgeCounts:
     def __init__(self, dataset_id, concept_id, concept_name, concept_count, counts, bin_width):
@@ -32,29 +39,27 @@ class AgeCounts:
 
         bin_ratio = int(new_bin_width / self.bin_width)
 
-        if new_bins is None:
-            new_bins = int(np.ceil(float(self.bins) / bin_ratio))
-
-        new_counts = np.zeros(new_bins, dtype=np.uint32)
-
         # Replace suppressed counts with estimated counts
-        estimated_counts = self.counts.copy()
-        estimated_counts[estimated_counts == SUPPRESSION_MARKER] = suppression_estimate
-
-        for i in range(new_bins - 1):
-            new_counts[i] = np.sum(estimated_counts[(i * bin_ratio):((i + 1) * bin_ratio)])
-        new_counts[new_bins - 1] = np.sum(estimated_counts[((new_bins - 1) * bin_ratio):])
+        estimated_counts = estimate_suppressed_counts(self.counts, suppression_estimate)
+        new_counts = rebin_age_counts(estimated_counts, bin_ratio, new_bins)
 
         return AgeCounts(self.dataset_id, self.concept_id, self.concept_name, self.concept_count,
                          new_counts, new_bin_width)
 
-    def convert_to_dict_results(self):
+    def convert_to_dict_results(self, confidence_intervals=None):
         """ Creates a dict results representation of this object for JSON returns
 
+        Parameters
+        ----------
+        confidence_intervals: (optional) confidence intervals of the counts, e.g., computed for a stack of counts with
+                              poisson_intervals. Computed if not given.
+
         Returns
         -------
         dict representation
         """
+        if confidence_intervals is None:
+            confidence_intervals = self.confidence_intervals()
         return {
             'dataset_id': self.dataset_id,
             'concept_id': self.concept_id,
@@ -62,7 +67,7 @@ class AgeCounts:
             'concept_count': self.concept_count,
             'bin_width': self.bin_width,
             'counts': [int(x) for x in self.counts],
-            'confidence_interval': [(int(x[0]), int(x[1])) for x in self.confidence_intervals()]
+            'confidence_interval': [(int(x[0]), int(x[1])) for x in confidence_intervals]
         }
 
     def confidence_intervals(self, alpha=0.99):
@@ -74,9 +79,9 @@ class AgeCounts:
 
         Returns
         -------
-        List of tuples with confidence intervals
+        numpy ndarray shape (bins, 2) with the confidence interval of each count
         """
-        return [poisson.interval(alpha, x) for x in self.counts]
+        return poisson_intervals(self.counts, alpha)
 
 
 class DeltaCounts:
@@ -104,39 +109,7 @@ class DeltaCounts:
         if new_n is None:
             new_n = int(np.ceil(float(self.n) / bin_ratio))
 
-        if new_bin_width == self.bin_width and self.n == new_n:
-            # No change in structure, just change from list to ndarray
-            new_counts = self.counts.copy()
-        else:
-            new_bins = new_n * 2 + 1
-            new_counts = np.zeros(new_bins, dtype=np.uint32)
-
-            # Make a new copy so we don't mess up the original
-            cnts = np.array(self.counts)
-
-            # No grouping for 0-day co-occurrence
-            new_counts[new_n] = cnts[self.n]
-
-            # If the binning stretches "beyond" the original counts array, pad the original counts array
-            reach = bin_ratio * new_n
-            if reach > self.n:
-                pad = np.zeros(reach - self.n, dtype=np.uint32)
-                cnts = np.concatenate((pad, cnts, pad))
-            center = int(np.floor(len(cnts) / 2))
-
-            # Fill in the positive deltas
-            upper = center + reach + 1
-            new_counts[(new_n + 1):new_bins] = cnts[(center + 1):upper].reshape(bin_ratio, new_n, order='F').sum(
-                axis=0)
-
-            # Fill in the negative deltas
-            lower = center - reach
-            new_counts[0:new_n] = cnts[lower:center].reshape(bin_ratio, new_n, order='F').sum(axis=0)
-
-            # Add the leftover bins
-            if reach < self.n:
-                new_counts[new_bins - 1] += cnts[upper:]
-                new_counts[0] += cnts[:lower]
+        new_counts = rebin_delta_counts(self.counts, self.n, bin_ratio, new_n)
 
         return DeltaCounts(self.dataset_id, self.source_concept_id, self.target_concept_id, self.source_concept_name,
                            self.target_concept_name, self.source_concept_count, self.target_concept_count,
@@ -153,13 +126,21 @@ class DeltaCounts:
                            self.source_concept_name, self.target_concept_count, self.source_concept_count,
                            self.concept_pair_count, np.flip(self.counts.copy()), self.bin_width, self.n)
 
-    def convert_to_dict_results(self):
+    def convert_to_dict_results(self, confidence_intervals=None):
         """ Creates a dict results representation of this object for JSON returns
 
+        Parameters
+        ----------
+        confidence_intervals: (optional) confidence intervals of the counts, e.g., computed for a stack of counts with
+                              poisson_intervals. Computed if not given.
+
         Returns
         -------
         dict representation
         """
+        if confidence_intervals is None:
+            confidence_intervals = self.confidence_intervals()
+
         # Make sure all counts are represented as ints (as opposed to numpy types) for JSON serialization
         return {
             'dataset_id': self.dataset_id,
@@ -173,7 +154,7 @@ class DeltaCounts:
             'bin_width': int(self.bin_width),
             'n': int(self.n),
             'counts': [int(x) for x in self.counts],
-            'confidence_interval': [(int(x[0]), int(x[1])) for x in self.confidence_intervals()]
+            'confidence_interval': [(int(x[0]), int(x[1])) for x in confidence_intervals]
         }
 
     def confidence_intervals(self, alpha=0.99):
@@ -185,9 +166,178 @@ class DeltaCounts:
 
         Returns
         -------
-        List of tuples with confidence intervals
+        numpy ndarray shape (bins, 2) with the confidence interval of each count
         """
-        return [poisson.interval(alpha, x) for x in self.counts]
+        return poisson_intervals(self.counts, alpha)
+
+
+def estimate_suppressed_counts(counts, suppression_estimate=SUPPRESSION_ESTIMATE):
+    """ Replaces suppressed counts with an estimate
+
+    Parameters
+    ----------
+    counts: array of counts, or 2-D stack of counts with one row per concept (pair)
+    suppression_estimate: estimated count for suppressed counts
+
+    Returns
+    -------
+    New array of counts with the suppressed counts replaced
+    """
+    counts = np.asarray(counts)
+    return np.where(counts == SUPPRESSION_MARKER, np.asarray(suppression_estimate, dtype=counts.dtype), counts)
+
+
+def rebin_age_counts(counts, bin_ratio, new_bins=None):
+    """ Sums consecutive age bins into bins bin_ratio times wider. The last new bin also includes any leftover bins.
+
+    Parameters
+    ----------
+    counts: array of age counts, or 2-D stack of age counts with one row per concept
+    bin_ratio: number of bins combined into each new bin
+    new_bins: (optional) number of new bins. Default: enough new bins to cover all bins
+
+    Returns
+    -------
+    numpy ndarray of the new counts (uint32), with the same number of rows as counts
+    """
+    counts = np.asarray(counts)
+    bins = counts.shape[-1]
+    if new_bins is None:
+        new_bins = int(np.ceil(float(bins) / bin_ratio))
+
+    new_counts = np.zeros(counts.shape[:-1] + (new_bins,), dtype=np.uint32)
+    starts = np.arange(0, min(new_bins * bin_ratio, bins), bin_ratio)
+    if starts.size > 0:
+        # Each segment ends at the next start. The last segment extends to the last bin.
+        new_counts[..., :starts.size] = np.add.reduceat(counts, starts, axis=-1)
+    return new_counts
+
+
+def rebin_delta_counts(counts, n, bin_ratio, new_n=None):
+    """ Sums delta bins into bins bin_ratio times wider on each side of the 0-day bin. The 0-day bin is not grouped,
+    and the outermost new bins also include any leftover bins.
+
+    Parameters
+    ----------
+    counts: array of 2 * n + 1 delta counts, or 2-D stack of delta counts with one row per concept pair
+    n: number of bins on each side of the 0-day bin
+    bin_ratio: number of bins combined into each new bin
+    new_n: (optional) number of new bins on each side. Default: enough new bins to cover all bins
+
+    Returns
+    -------
+    numpy ndarray of the new counts, with the same number of rows as counts
+    """
+    counts = np.asarray(counts)
+    if new_n is None:
+        new_n = int(np.ceil(float(n) / bin_ratio))
+
+    if bin_ratio == 1 and n == new_n:
+        # No change in structure
+        return counts.copy()
+
+    rows = counts.shape[:-1]
+    new_bins = new_n * 2 + 1
+    new_counts = np.zeros(rows + (new_bins,), dtype=np.uint32)
+
+    # No grouping for 0-day co-occurrence
+    new_counts[..., new_n] = counts[..., n]
+
+    # If the binning stretches "beyond" the original counts array, pad the original counts array
+    reach = bin_ratio * new_n
+    if reach > n:
+        pad = np.zeros(rows + (reach - n,), dtype=counts.dtype)
+        counts = np.concatenate((pad, counts, pad), axis=-1)
+    center = counts.shape[-1] // 2
+
+    # Fill in the positive deltas
+    upper = center + reach + 1
+    new_counts[..., (new_n + 1):new_bins] = counts[..., (center + 1):upper].reshape(rows + (new_n, bin_ratio)) \
+        .sum(axis=-1)
+
+    # Fill in the negative deltas
+    lower = center - reach
+    new_counts[..., 0:new_n] = counts[..., lower:center].reshape(rows + (new_n, bin_ratio)).sum(axis=-1)
+
+    # Add the leftover bins
+    if reach < n:
+        new_counts[..., new_bins - 1] += counts[..., upper:].sum(axis=-1, dtype=np.uint32)
+        new_counts[..., 0] += counts[..., :lower].sum(axis=-1, dtype=np.uint32)
+
+    return new_counts
+
+
+def convert_delta_bin_schemes(deltas, new_bin_width, new_n=None):
+    """ DeltaCounts.convert_bin_scheme for a list of DeltaCounts. The deltas with the same binning scheme are rebinned
+    together as a 2-D stack of counts.
+
+    Parameters
+    ----------
+    deltas: list of DeltaCounts
+    new_bin_width: new bin width, a multiple of the bin width of each delta
+    new_n: (optional) number of new bins on each side of the 0-day bin
+
+    Returns
+    -------
+    list of converted DeltaCounts in the same order as deltas
+    """
+    schemes = defaultdict(list)
+    for i, delta in enumerate(deltas):
+        schemes[(delta.bin_width, delta.n)].append(i)
+
+    converted = [None] * len(deltas)
+    for (bin_width, n), ix in schemes.items():
+        # Make sure the new bin width is a multiple of the current bin width
+        assert (new_bin_width % bin_width == 0)
+        bin_ratio = int(new_bin_width / bin_width)
+        scheme_n = int(np.ceil(float(n) / bin_ratio)) if new_n is None else new_n
+        stack = rebin_delta_counts(np.stack([deltas[i].counts for i in ix]), n, bin_ratio, scheme_n)
+        for i, new_counts in zip(ix, stack):
+            d = deltas[i]
+            converted[i] = DeltaCounts(d.dataset_id, d.source_concept_id, d.target_concept_id, d.source_concept_name,
+                                       d.target_concept_name, d.source_concept_count, d.target_concept_count,
+                                       d.concept_pair_count, new_counts, new_bin_width, scheme_n)
+    return converted
+
+
+def poisson_intervals(counts, alpha=0.99):
+    """ Poisson confidence intervals of counts, computed in a single vectorized call
+
+    Parameters
+    ----------
+    counts: array of counts, or 2-D stack of counts with one row per concept (pair)
+    alpha: confidence level
+
+    Returns
+    -------
+    numpy ndarray with shape counts.shape + (2,): the (lower bound, upper bound) of each count
+    """
+    lower, upper = poisson.interval(alpha, np.asarray(counts, dtype=np.float64))
+    return np.stack((lower, upper), axis=-1)
+
+
+def convert_to_dict_results(counts_list, alpha=0.99):
+    """ convert_to_dict_results of a list of AgeCounts or DeltaCounts. The confidence intervals of the counts with the
+    same number of bins are computed together as a 2-D stack.
+
+    Parameters
+    ----------
+    counts_list: list of AgeCounts or DeltaCounts
+    alpha: confidence level
+
+    Returns
+    -------
+    list of dict representations
+    """
+    lengths = defaultdict(list)
+    for i, c in enumerate(counts_list):
+        lengths[len(c.counts)].append(i)
+
+    cis = [None] * len(counts_list)
+    for ix in lengths.values():
+        for i, ci in zip(ix, poisson_intervals(np.stack([counts_list[i].counts for i in ix]), alpha)):
+            cis[i] = ci
+    return [c.convert_to_dict_results(ci) for c, ci in zip(counts_list, cis)]
 
 
 def _estimate_suppressed_percent(counts, total_count, suppression_estimate=SUPPRESSION_ESTIMATE):
@@ -214,43 +364,301 @@ def jaccard_similarity(d1, d2):
 
     Parameters
     ----------
-    d1: np.ndarray distribution 1
+    d1: np.ndarray distribution 1, or 2-D stack of distributions with one row per concept
     d2: np.ndarray distribution 2
 
     Returns
     -------
-    Jaccard similarity index
+    Jaccard similarity index, or array of Jaccard similarity indices for a stack of distributions
     """
-    return np.sum(np.minimum(d1, d2)) / np.sum(np.maximum(d1, d2))
+    return np.sum(np.minimum(d1, d2), axis=-1) / np.sum(np.maximum(d1, d2), axis=-1)
 
 
-def query_concept_age_counts(dataset_id, concept_id):
-    cur = sql_connection().cursor()
+class AgeMatrix(NamedTuple):
+    """ Age distributions of concepts at one bin width. Row i is the concept at position positions[i]. """
+    positions: np.ndarray  # positions of the concepts in AgeDistributions, ascending
+    counts: np.ndarray  # age counts (uint32). Suppressed counts are estimated if converted from a smaller bin width.
+    distributions: np.ndarray  # estimated age counts divided by the concept counts (float64)
+    lengths: np.ndarray  # number of bins of each row. Shorter rows are padded with 0.
 
-    # Get the concept-age counts binning scheme
-    sql = '''SELECT *
-        FROM cohd.concept_age_schemes
-        WHERE dataset_id = %s AND concept_id = %s;'''
-    params = [dataset_id, concept_id]
-    cur.execute(sql, params)
-    binning_scheme = cur.fetchall()
 
-    if len(binning_scheme) != 1:
+class AgeDistributions:
+    """
+    In-process matrices of the concept-age distributions of one dataset, one matrix per bin width with one row per
+    concept
+
+    Each concept is included at its own bin width and converted to every larger bin width in BIN_WIDTHS. Suppressed
+    counts are replaced with SUPPRESSION_ESTIMATE before the counts are converted and divided by the concept count.
+    Concepts whose estimated suppressed count is more than MAX_SUPPRESSED of their concept count are left out, since
+    they aren't used for comparisons. The similarities of all concepts to a concept of interest are then one vectorized
+    min/max reduction per bin width.
+    """
+
+    BIN_WIDTHS = (1, 2, 4, 8, 16, 32)
+
+    # Maximum estimated suppressed count, relative to the concept count, of the concepts compared
+    MAX_SUPPRESSED = 0.05
+
+    def __init__(self, dataset_id, concepts, version=None):
+        """ Constructor
+
+        Parameters
+        ----------
+        dataset_id: COHD dataset ID
+        concepts: list of (concept_id, concept_name, domain_id, concept_class_id, concept_count, bin_width, counts)
+                  sorted by concept_id
+        version: version of the data the matrices were loaded from
+        """
+        self.dataset_id = dataset_id
+        self.version = version
+        self.concept_ids = np.array([c[0] for c in concepts], dtype=np.int64)
+        self.concept_names = [c[1] for c in concepts]
+        self.domains, self.domain_codes = np.unique(np.array([str(c[2]) for c in concepts], dtype=object),
+                                                    return_inverse=True)
+        self.concept_classes, self.concept_class_codes = np.unique(
+            np.array([str(c[3]) for c in concepts], dtype=object), return_inverse=True)
+        self.concept_counts = np.array([c[4] for c in concepts], dtype=np.int64)
+        self.bin_widths = np.array([c[5] for c in concepts], dtype=np.int64)
+
+        # Group the concepts by binning scheme to estimate, filter, and convert their counts as 2-D stacks
+        schemes = defaultdict(list)
+        for i, c in enumerate(concepts):
+            schemes[(c[5], len(c[6]))].append(i)
+
+        parts = defaultdict(list)
+        for (bin_width, _), positions in schemes.items():
+            positions = np.array(positions, dtype=np.int64)
+            counts = np.array([concepts[i][6] for i in positions.tolist()], dtype=np.uint32)
+            concept_counts = self.concept_counts[positions].astype(np.float64)
+
+            suppressed_count = np.sum(counts == SUPPRESSION_MARKER, axis=-1) * SUPPRESSION_ESTIMATE
+            included = suppressed_count <= (concept_counts * AgeDistributions.MAX_SUPPRESSED)
+            positions, counts, concept_counts = positions[included], counts[included], concept_counts[included]
+            estimated_counts = estimate_suppressed_counts(counts)
+
+            for new_bin_width in AgeDistributions.BIN_WIDTHS:
+                if new_bin_width < bin_width or new_bin_width % bin_width != 0:
+                    continue
+                if new_bin_width == bin_width:
+                    # Keep the original (suppressed) counts for the results
+                    new_counts, new_estimated_counts = counts, estimated_counts
+                else:
+                    new_counts = new_estimated_counts = rebin_age_counts(estimated_counts, new_bin_width // bin_width)
+                parts[new_bin_width].append((positions, new_counts,
+                                             new_estimated_counts / concept_counts[:, np.newaxis]))
+
+        self._matrices = dict()
+        for bin_width, matrix_parts in parts.items():
+            positions = np.concatenate([p[0] for p in matrix_parts])
+            lengths = np.concatenate([np.full(len(p[0]), p[1].shape[1], dtype=np.int64) for p in matrix_parts])
+            n_bins = int(lengths.max()) if lengths.size else 0
+            counts = np.zeros((len(positions), n_bins), dtype=np.uint32)
+            distributions = np.zeros((len(positions), n_bins), dtype=np.float64)
+            start = 0
+            for p, c, d in matrix_parts:
+                counts[start:start + len(p), :c.shape[1]] = c
+                distributions[start:start + len(p), :d.shape[1]] = d
+                start += len(p)
+            order = np.argsort(positions, kind='stable')
+            self._matrices[bin_width] = AgeMatrix(positions[order], counts[order], distributions[order],
+                                                  lengths[order])
+
+    def __len__(self):
+        return len(self.concept_ids)
+
+    def matrix(self, bin_width):
+        """ AgeMatrix of a bin width, or None if no concepts can be compared at that bin width """
+        return self._matrices.get(bin_width)
+
+    def _code(self, values, value):
+        """ Interned code of a domain or concept class. Values that aren't in the dataset match no concepts. """
+        i = int(np.searchsorted(values, value))
+        return i if i < len(values) and values[i] == value else -1
+
+    def similar(self, concept_id, coi_bin_width, coi_distributions, threshold, domain_id=None, concept_class_id=None):
+        """ Finds the concepts with age distributions similar to a concept of interest
+
+        Comparison concepts with a bin width at least as large as the concept of interest's are compared at their own
+        bin width. Comparison concepts with a smaller bin width are converted to the concept of interest's bin width.
+
+        Parameters
+        ----------
+        concept_id: OMOP concept ID of the concept of interest, which is excluded from the results
+        coi_bin_width: bin width of the concept of interest
+        coi_distributions: dict[bin_width] -> age distribution of the concept of interest at that bin width
+        threshold: minimum Jaccard similarity
+        domain_id: (optional) only compare concepts from this domain
+        concept_class_id: (optional) only compare concepts of this concept class
+
+        Returns
+        -------
+        dict[bin_width] -> (rows of the AgeMatrix, Jaccard similarities) of the concepts with similarity >= threshold
+        """
+        similar = dict()
+        for bin_width, coi_distribution in coi_distributions.items():
+            m = self._matrices.get(bin_width)
+            if m is None:
+                continue
+
+            source_bin_widths = self.bin_widths[m.positions]
+            compared = source_bin_widths == bin_width if bin_width > coi_bin_width else source_bin_widths <= bin_width
+            compared &= (m.lengths == len(coi_distribution)) & (self.concept_ids[m.positions] != concept_id)
+            if domain_id is not None:
+                compared &= self.domain_codes[m.positions] == self._code(self.domains, domain_id)
+            if concept_class_id is not None:
+                compared &= self.concept_class_codes[m.positions] == self._code(self.concept_classes,
+                                                                                concept_class_id)
+            rows = np.flatnonzero(compared)
+            if rows.size == 0 or len(coi_distribution) > m.distributions.shape[1]:
+                continue
+
+            similarities = jaccard_similarity(m.distributions[rows, :len(coi_distribution)], coi_distribution)
+            passed = similarities >= threshold
+            if passed.any():
+                similar[bin_width] = (rows[passed], similarities[passed])
+        return similar
+
+    def age_counts(self, bin_width, row):
+        """ AgeCounts of a row of the AgeMatrix of a bin width """
+        m = self._matrices[bin_width]
+        i = int(m.positions[row])
+        return AgeCounts(self.dataset_id, int(self.concept_ids[i]), self.concept_names[i], int(self.concept_counts[i]),
+                         m.counts[row, :m.lengths[row]], bin_width)
+
+
+def load_age_distributions(conn, dataset_id, version=None, domain_id=None, concept_class_id=None, batch_size=100000):
+    """ Loads the concept-age counts of a dataset into AgeDistributions
+
+    Parameters
+    ----------
+    conn: connection to the COHD database
+    dataset_id: COHD dataset ID
+    version: version of the data
+    domain_id: (optional) only load concepts from this domain
+    concept_class_id: (optional) only load concepts of this concept class
+    batch_size: number of rows read at a time
+
+    Returns
+    -------
+    AgeDistributions
+    """
+    sql = '''SELECT
+                cac.concept_id, cac.count,
+                cas.bin_width,
+                cc.concept_count,
+                c.concept_name, c.domain_id, c.concept_class_id
+            FROM cohd.concept_age_counts cac
+            JOIN cohd.concept_age_schemes cas ON cac.concept_id = cas.concept_id AND cac.dataset_id = cas.dataset_id
+            JOIN cohd.concept_counts cc ON cac.concept_id = cc.concept_id AND cac.dataset_id = cc.dataset_id
+            JOIN cohd.concept c ON cac.concept_id = c.concept_id
+            WHERE cac.dataset_id = %(dataset_id)s
+                {domain_filter}
+                {class_filter}
+            ORDER BY cac.concept_id ASC, cac.bin ASC;'''
+    params = {'dataset_id': dataset_id}
+    domain_filter = ''
+    if domain_id is not None:
+        domain_filter = 'AND c.domain_id = %(domain_id)s'
+        params['domain_id'] = domain_id
+    class_filter = ''
+    if concept_class_id is not None:
+        class_filter = 'AND c.concept_class_id = %(concept_class_id)s'
+        params['concept_class_id'] = concept_class_id
+    sql = sql.format(domain_filter=domain_filter, class_filter=class_filter)
+
+    concepts = list()
+    with conn.cursor(pymysql.cursors.SSDictCursor) as cur:
+        cur.execute(sql, params)
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            for r in rows:
+                if not concepts or concepts[-1][0] != r['concept_id']:
+                    # This row starts a new concept
+                    concepts.append((r['concept_id'], r['concept_name'], r['domain_id'], r['concept_class_id'],
+                                     r['concept_count'], r['bin_width'], list()))
+                concepts[-1][6].append(r['count'])
+
+    age_distributions = AgeDistributions(dataset_id, concepts, version)
+    logging.info(f'Loaded the age distributions of {len(age_distributions)} concepts in dataset {dataset_id} '
+                 f'(version {version})')
+    return age_distributions
+
+
+def _load_dataset_age_distributions(dataset_id, version):
+    """ Loads the age distribution matrices of a dataset from the database """
+    with sql_connection(dataset_id) as conn:
+        return load_age_distributions(conn, dataset_id, version)
+
+
+# In-process age distribution matrices by dataset (VersionedIndex of AgeDistributions). Reloaded when the dataset stats
+# version changes.
+_age_distributions = dict()
+
+
+def age_distributions(dataset_id):
+    """ Gets the in-process age distribution matrices of a dataset, loading them on first use and reloading them when
+    the dataset stats version changes. While the matrices are reloaded, other threads keep using the previous ones. If
+    a load fails, the previous matrices (if any) are used until the load is retried after INDEX_LOAD_RETRY_INTERVAL
+    seconds.
+
+    Parameters
+    ----------
+    dataset_id: COHD dataset ID
+
+    Returns
+    -------
+    AgeDistributions, or None if AGE_DISTRIBUTIONS_IN_MEMORY is off or the matrices could not be loaded
+    """
+    if not app.config.get('AGE_DISTRIBUTIONS_IN_MEMORY', True):
+        return None
+
+    index = _age_distributions.get(dataset_id)
+    if index is None:
+        index = VersionedIndex(f'age distributions of dataset {dataset_id}',
+                               functools.partial(_load_dataset_age_distributions, dataset_id),
+                               lambda: dataset_stats.version,
+                               retry_interval=app.config.get('INDEX_LOAD_RETRY_INTERVAL', 300))
+        # Keep the index of another thread that got here first
+        index = _age_distributions.setdefault(dataset_id, index)
+    return index.get()
+
+
+def _descending_order(values, batch_size):
+    """ Yields the indices of values in descending order of value (ties by index). Each batch is selected with a
+    partial sort, so taking the first k indices doesn't sort all values.
+
+    Parameters
+    ----------
+    values: array
+    batch_size: size of the first batch. Later batches double in size.
+
+    Returns
+    -------
+    Generator of indices
+    """
+    remaining = np.arange(len(values))
+    batch_size = max(1, batch_size)
+    while remaining.size > 0:
+        if batch_size < remaining.size:
+            part = np.argpartition(-values[remaining], batch_size - 1)
+            top, remaining = remaining[part[:batch_size]], remaining[part[batch_size:]]
+        else:
+            top, remaining = remaining, remaining[:0]
+        yield from top[np.lexsort((top, -values[top]))].tolist()
+        batch_size *= 2
+
+
+def query_concept_age_counts(dataset_id, concept_id):
+    # Get the concept-age counts binning scheme and the concept-age distribution
+    age_counts = storage.age_counts(dataset_id, concept_id)
+
+    if age_counts is None:
         # No binning scheme found, meaning no concept-age distributions found
         cads = []
     else:
-        binning_scheme = binning_scheme[0]
-
-        # Retrieve the concept-age distributions along with some basic info about the concept
-        sql = '''SELECT count
-            FROM cohd.concept_age_counts             
-            WHERE dataset_id = %s AND concept_id = %s
-            ORDER BY bin ASC;'''
-        params = [dataset_id, concept_id]
-        cur.execute(sql, params)
-
-        # Create a list for the concept-age distribution
-        counts = [x['count'] for x in cur.fetchall()]
+        binning_scheme, counts = age_counts
 
         # Retrieve the concept name as well
         concept_def = omop_concept_definition(concept_id)
@@ -314,7 +722,8 @@ def query_delta_counts(dataset_id, concept_pairs):
                              binning_scheme['bin_width'], binning_scheme['n'])
             deltas_dict[current_pair] = dc
 
-    cur = sql_connection().cursor()
+    conn = sql_connection(dataset_id)
+    cur = conn.cursor()
 
     # Database always stores the deltas with the smaller concept ID as concept_id_1
     database_pairs = list()
@@ -334,6 +743,8 @@ def query_delta_counts(dataset_id, concept_pairs):
 
     if len(database_pairs) == 0:
         # No pairs in the expected format. Return a list of None
+        cur.close()
+        conn.close()
         return [None] * len(concept_pairs)
 
     # Get the concept-pair delta binning scheme
@@ -354,6 +765,8 @@ def query_delta_counts(dataset_id, concept_pairs):
 
     # If no binning schemes were found, that means no deltas will be found for the requested pair(s). Return empty
     if len(binning_scheme_rows) == 0:
+        cur.close()
+        conn.close()
         return [None for _ in concept_pairs]
 
     # Get rid of any database pairs that were not found in the binning schemes since they shouldn't be found in deltas
@@ -397,7 +810,11 @@ def query_delta_counts(dataset_id, concept_pairs):
     current_concept_id_2 = -1
     current_counts = list()
 
-    for r in cur.fetchall():
+    delta_rows = cur.fetchall()
+    cur.close()
+    conn.close()
+
+    for r in delta_rows:
         concept_id_1 = r['concept_id_1']
         concept_id_2 = r['concept_id_2']
         if (current_concept_id_1 != concept_id_1) or (current_concept_id_2 != concept_id_2):
@@ -464,8 +881,6 @@ def concepts_cooccur(concept_id_1, concept_id_2, dataset_id=DATASET_ID_DEFAULT_T
         concept_id_1 = concept_id_2
         concept_id_2 = temp
 
-    cur = sql_connection().cursor()
-
     if concept_pair_count is None:
         # Get the concept_pair_count
         json_result = query_concept_pair_count(concept_id_1, concept_id_2, dataset_id)
@@ -487,10 +902,12 @@ def concepts_cooccur(concept_id_1, concept_id_2, dataset_id=DATASET_ID_DEFAULT_T
         'concept_id_2': concept_id_2,
         'dataset_id': dataset_id
     }
-    cur.execute(sql, params)
+    with sql_connection(dataset_id) as conn:
+        with conn.cursor() as cur:
+            cur.execute(sql, params)
+            r = cur.fetchone()
 
     related = False
-    r = cur.fetchone()
     if r is not None:
         cooccurrence_count = r['cooccurrence_count']
         if cooccurrence_count == SUPPRESSION_MARKER:
@@ -523,44 +940,6 @@ def query_similar_age_distributions(concept_id, dataset_id=DATASET_ID_DEFAULT_TE
     cacs_binned: defaultdict[bin_width] -> list of concept age counts of similar concepts
     similarities_binned: defaultdict[bin_width] -> list of similarity scores of similar concepts
     """
-    def _process_comparison_concept():
-        """ This inner function helps add similar concepts to the lists
-
-        Returns
-        -------
-        Nothing
-        """
-        if current_concept_id > 0 and len(current_counts) > 0 and current_concept_id != concept_id:
-            # Check for suppressed bins. If the estimated suppressed count > 5% of the estimated total count,
-            # then don't include this concept for analysis
-            estimated_counts = np.array(current_counts)
-            suppressed_bin_mask = estimated_counts == SUPPRESSION_MARKER
-            suppressed_count = np.sum(suppressed_bin_mask) * SUPPRESSION_ESTIMATE
-            estimated_counts[suppressed_bin_mask] = SUPPRESSION_ESTIMATE
-
-            if suppressed_count <= (current_concept_count * 0.05):
-                # Create an AgeCount with the estimated counts
-                estimated_cac = AgeCounts(dataset_id, current_concept_id, current_concept_name,
-                                          current_concept_count, estimated_counts, current_bin_width)
-
-                # Convert the current CAC's bin_width to the larger bin_width
-                if estimated_cac.bin_width < coi_cac.bin_width:
-                    estimated_cac = estimated_cac.convert_bin_scheme(coi_cac.bin_width)
-
-                # Calculate current concept's age distribution
-                distribution = estimated_cac.counts / float(current_concept_count)
-
-                # Calculate Jaccard similarity
-                j = jaccard_similarity(distribution, coi_cads[estimated_cac.bin_width])
-                if j >= threshold:
-                    # Save the CAC of the current concept with the original (suppressed) counts
-                    cac = AgeCounts(dataset_id, current_concept_id, current_concept_name,
-                                    current_concept_count, current_counts, current_bin_width)
-                    if cac.bin_width < coi_cac.bin_width:
-                        cac = cac.convert_bin_scheme(coi_cac.bin_width)
-                    cacs_binned[estimated_cac.bin_width].append(cac)
-                    similarities_binned[estimated_cac.bin_width].append(j)
-
     # Get the AgeCounts for the concept of interest (COI)
     coi_cac = query_concept_age_counts(dataset_id, concept_id)
     if len(coi_cac) != 1:
@@ -597,146 +976,67 @@ def query_similar_age_distributions(concept_id, dataset_id=DATASET_ID_DEFAULT_TE
         domain = None
         concept_class = None
 
-    cur = sql_connection().cursor()
-    sql = '''SELECT
-                cac.concept_id, cac.count,                
-                cas.bin_width,
-                cc.concept_count,
-                c.concept_name
-            FROM cohd.concept_age_counts cac
-            JOIN cohd.concept_age_schemes cas ON cac.concept_id = cas.concept_id AND cac.dataset_id = cas.dataset_id 
-            JOIN cohd.concept_counts cc ON cac.concept_id = cc.concept_id AND cac.dataset_id = cc.dataset_id
-            JOIN cohd.concept c ON cac.concept_id = c.concept_id
-            WHERE cac.dataset_id = %(dataset_id)s                
-                {domain_filter}
-                {class_filter}
-            ORDER BY cac.concept_id ASC, cac.bin ASC;'''
-    params = {
-        'dataset_id': dataset_id,
-        'concept_id': concept_id,
-    }
-
-    # Filter concepts by domain
-    if domain is not None and domain != ['']:
-        # Restrict the concepts by domain
-        domain_filter = 'AND c.domain_id = %(domain_id)s'
-        params['domain_id'] = domain
-    else:
-        # Unrestricted domain
-        domain_filter = ''
-
-    # Filter concepts by concept_class
-    if concept_class is not None and concept_class != ['']:
-        # Restrict the concepts by domain
-        class_filter = 'AND c.concept_class_id = %(concept_class_id)s'
-        params['concept_class_id'] = concept_class
-    else:
-        # Unrestricted domain
-        class_filter = ''
-
-    sql = sql.format(domain_filter=domain_filter, class_filter=class_filter)
-    cur.execute(sql, params)
+    # Compare against the in-process age distribution matrices of the dataset. If they aren't available, load the
+    # matrices of the concepts of this domain (and class) from the database for this query.
+    distributions = age_distributions(dataset_id)
+    if distributions is None:
+        with sql_connection(dataset_id) as conn:
+            distributions = load_age_distributions(conn, dataset_id, domain_id=domain, concept_class_id=concept_class)
+    similar = distributions.similar(concept_id, coi_cac.bin_width, coi_cads, threshold, domain, concept_class)
 
     cacs_binned = defaultdict(list)
-    current_concept_id = -1
-    current_counts = list()
     similarities_binned = defaultdict(list)
-
-    for r in cur.fetchall():
-        if r['concept_id'] != current_concept_id:
-            # This row starts a new concept. Add the current concept to the lists
-            _process_comparison_concept()
-
-            # Start tracking a new concept
-            current_concept_id = r['concept_id']
-            current_counts = list()
-            current_concept_name = r['concept_name']
-            current_concept_count = r['concept_count']
-            current_bin_width = r['bin_width']
-
-        # Build a list of counts for this comparison concept
-        current_counts.append(r['count'])
-
-    # Finished reading the table, still need to process the current concept
-    _process_comparison_concept()
-
-    # Sort the concepts in descending order of similarity for results at each bin width and keep a limited number
     for bin_width in bin_widths:
-        if bin_width not in similarities_binned:
+        if bin_width not in similar:
             continue
-
-        # Check lists are same size
-        sms = similarities_binned[bin_width]
-        cacs = cacs_binned[bin_width]
-        assert len(sms) == len(cacs)
-
-        # Get sort order by descending similarity metric
-        sort_ix = np.flipud(np.argsort(sms))
-
-        # Sort the similarity and cac lists
-        similarities_binned[bin_width] = [sms[x] for x in sort_ix]
-        cacs_binned[bin_width] = [cacs[x] for x in sort_ix]
-
-    if exclude_related:
-        # Go through the lists again and remove any concepts that are related
-        for bin_width in bin_widths:
-            if bin_width not in cacs_binned:
-                continue
-
-            unrelated_cacs = list()
-            unrelated_similarities = list()
-            cac_list = cacs_binned[bin_width]
-            similarity_list = similarities_binned[bin_width]
-
-            for i, cac in enumerate(cac_list):
-                # First check the ln_ratio of the concepts
-                concept_pair_count = None
+        rows, similarities = similar[bin_width]
+        cacs_binned[bin_width] = list()
+        similarities_binned[bin_width] = list()
+
+        # Go through the concepts in descending order of similarity, partially sorting only as many as needed, and
+        # keep a limited number of results per bin
+        for i in _descending_order(similarities, limit):
+            if len(cacs_binned[bin_width]) >= limit:
+                break
+            cac = distributions.age_counts(bin_width, rows[i])
+
+            if exclude_related:
+                # Remove any concepts that are related. First check the ln_ratio of the concepts
                 assoc_results = query_association('obsExpRatio', concept_id, cac.concept_id, dataset_id)
-                if assoc_results is not None and 'results' in assoc_results and len(assoc_results['results']) == 1:
-                    assoc_result = assoc_results['results'][0]
-                    ln_ratio = assoc_result['ln_ratio']
-                    if ln_ratio > 2.0:
-                        # This pair is related. Onto the next one
-                        continue
-
-                    # Grab the concept pair count for use in the co-occurrence check
-                    concept_pair_count = assoc_result['observed_count']
-
-                    # Next, check the co-occurrence
-                    related = concepts_cooccur(concept_id, cac.concept_id, dataset_id,
-                                               concept_pair_count=concept_pair_count, threshold=0.05)
-                    if not related:
-                        unrelated_cacs.append(cac)
-                        unrelated_similarities.append(similarity_list[i])
-
-                        # Keep a limited number of results per bin
-                        if len(unrelated_cacs) >= limit:
-                            break
-
-            cacs_binned[bin_width] = unrelated_cacs
-            similarities_binned[bin_width] = unrelated_similarities
-    else:
-        # Keep a limited number of results per bin
-        for bin_width in bin_widths:
-            if bin_width not in similarities_binned:
-                continue
-
-            l = min(limit, len(similarities_binned[bin_width]))
-            similarities_binned[bin_width] = similarities_binned[bin_width][:l]
-            cacs_binned[bin_width] = cacs_binned[bin_width][:l]
+                if assoc_results is None or 'results' not in assoc_results or len(assoc_results['results']) != 1:
+                    continue
+                assoc_result = assoc_results['results'][0]
+                if assoc_result['ln_ratio'] > 2.0:
+                    # This pair is related. Onto the next one
+                    continue
+
+                # Next, check the co-occurrence, using the concept pair count
+                related = concepts_cooccur(concept_id, cac.concept_id, dataset_id,
+                                           concept_pair_count=assoc_result['observed_count'], threshold=0.05)
+                if related:
+                    continue
+
+            cacs_binned[bin_width].append(cac)
+            similarities_binned[bin_width].append(similarities[i])
 
     return coi_cacs, cacs_binned, similarities_binned
 
 
-def bootstrap_delta_distribution(deltas, mode='relative_source', iterations=10000):
+def bootstrap_delta_distribution(deltas, mode='relative_source', iterations=10000, seed=None,
+                                 chunk_elements=BOOTSTRAP_CHUNK_ELEMENTS):
     """ Estimates the distributions of the deltas by bootstrap
     Deltas will be sampled with replacement. Poisson randomization will be called on each count.
 
+    The resampled deltas and their Poisson variates are drawn from a numpy Generator in chunks of at most
+    chunk_elements counts. The draws don't depend on the chunk size, so a seed gives reproducible results.
+
     Parameters
     ----------
-    deltas: List of DeltaCounts
+    deltas: List of DeltaCounts with the same number of bins
     mode: 'counts', 'relative_source', or 'relative_target'
     iterations: number of iterations to simulate
+    seed: (optional) seed or numpy Generator for reproducible results. Default: fresh entropy
+    chunk_elements: maximum number of counts simulated at once, to bound memory
 
     Returns
     -------
@@ -747,22 +1047,76 @@ def bootstrap_delta_distribution(deltas, mode='relative_source', iterations=1000
 
     mode = mode.strip().lower()
 
-    n_deltas = len(deltas)
-    simulated_frequencies = list()
-    for i in range(iterations):
-        randi = random.randint(0, n_deltas - 1)
-        sim = np.random.poisson(deltas[randi].counts)
-        if mode == 'relative_source':
-            sim = sim / float(deltas[randi].source_concept_count)
-        elif mode == 'relative_target':
-            sim = sim / float(deltas[randi].target_concept_count)
-        simulated_frequencies.append(sim)
-
-    simulated_frequencies = np.array(simulated_frequencies)
+    counts = np.stack([np.asarray(d.counts, dtype=np.float64) for d in deltas])
+    if mode == 'relative_source':
+        scale = 1.0 / np.array([d.source_concept_count for d in deltas], dtype=np.float64)
+    elif mode == 'relative_target':
+        scale = 1.0 / np.array([d.target_concept_count for d in deltas], dtype=np.float64)
+    else:
+        scale = np.ones(len(deltas))
+
+    rng = np.random.default_rng(seed)
+    resampled = rng.integers(0, len(deltas), size=iterations)
+    simulated_frequencies = np.empty((iterations, counts.shape[1]), dtype=np.float64)
+    chunk = max(1, chunk_elements // max(1, counts.shape[1]))
+    for start in range(0, iterations, chunk):
+        ix = resampled[start:start + chunk]
+        simulated_frequencies[start:start + chunk] = rng.poisson(counts[ix]) * scale[ix, np.newaxis]
+
     return np.percentile(simulated_frequencies, q=[2.5, 25, 50, 75, 97.5], axis=0)
 
 
-def query_source_to_target(dataset_id, source_concept_id, target_concept_id, exclude_related=False):
+def _bin_comparison_deltas(deltas, similarities, results_binned, settings):
+    """ Groups comparison deltas by bin width. Each delta is added at its own bin width, and converted to each larger
+    bin width in results_binned. The deltas converted to a bin width are rebinned together.
+
+    Parameters
+    ----------
+    deltas: list of DeltaCounts (or None if not found)
+    similarities: list of the age distribution similarities of the comparison concepts
+    results_binned: dict[bin_width] -> results with 'deltas' and 'cad_similarities' lists to add to
+    settings: list of (bin_width, n) binning schemes
+
+    Returns
+    -------
+    Nothing
+    """
+    found = [(sim, delta) for sim, delta in zip(similarities, deltas) if delta is not None]
+    for bin_width, n in settings:
+        if bin_width not in results_binned:
+            continue
+
+        # Add the deltas with this bin_width unaltered and convert the deltas with smaller bin widths
+        binned = [(sim, delta) for sim, delta in found if delta.bin_width <= bin_width]
+        smaller = [i for i, (_, delta) in enumerate(binned) if delta.bin_width < bin_width]
+        converted = convert_delta_bin_schemes([binned[i][1] for i in smaller], bin_width, n)
+        binned_deltas = [delta for _, delta in binned]
+        for i, delta in zip(smaller, converted):
+            binned_deltas[i] = delta
+
+        results_binned[bin_width]['cad_similarities'].extend(sim for sim, _ in binned)
+        results_binned[bin_width]['deltas'].extend(binned_deltas)
+
+
+def _significance(delta, distribution):
+    """ Compares the confidence intervals of the delta counts, relative to the source concept count, to the
+    distribution of the comparison deltas
+
+    Parameters
+    ----------
+    delta: DeltaCounts
+    distribution: numpy ndarray shape (5, bins) from bootstrap_delta_distribution
+
+    Returns
+    -------
+    list of bool: True for bins where the confidence interval is outside the 2.5 - 97.5 percentile range
+    """
+    cis = delta.confidence_intervals().T / float(delta.source_concept_count)
+    # note: tolist converts numpy.bool to normal bool for json
+    return ((cis[0] > distribution[4]) | (cis[1] < distribution[0])).tolist()
+
+
+def query_source_to_target(dataset_id, source_concept_id, target_concept_id, exclude_related=False, seed=None):
     """ Analyzes the temporal relationship between source_concept_id and target_concept_id
 
     Parameters
@@ -771,6 +1125,7 @@ def query_source_to_target(dataset_id, source_concept_id, target_concept_id, exc
     source_concept_id (int) - OMOP concept ID of the source concept (effector)
     target_concept_id (int) - OMOP concept ID of the target concept (effected)
     exclude_related (bool) - True to exclude concepts "related" to the concepts of interest from the comparison concepts
+    seed - (optional) seed of the bootstrap simulations for reproducible results
 
     Returns
     -------
@@ -837,25 +1192,9 @@ def query_source_to_target(dataset_id, source_concept_id, target_concept_id, exc
         similar_source_pairs += [(x.concept_id, target_concept_id) for x in cacs]
         similarity_source_list += similarity_to_source[bin_width]
 
-    # Get delta comparisons with similar source concepts
+    # Get delta comparisons with similar source concepts and group them by bin_width
     deltas_source = query_delta_counts(dataset_id, similar_source_pairs)
-
-    # Group the comparison deltas by bin_width
-    for sim, delta in zip(similarity_source_list, deltas_source):
-        if delta is None:
-            continue
-
-        # Add the delta unaltered if its bin_width is at least as large as the delta_primary's bin_width
-        if delta.bin_width >= delta_primary.bin_width:
-            source_results_binned[delta.bin_width]['cad_similarities'].append(sim)
-            source_results_binned[delta.bin_width]['deltas'].append(delta)
-
-        # Also convert the delta to larger bin_widths to add them to the comparison in the larger bin_width groups
-        for bin_width, n in settings:
-            if bin_width > delta.bin_width and bin_width >= delta_primary.bin_width:
-                delta_downconverted = delta.convert_bin_scheme(bin_width, n)
-                source_results_binned[bin_width]['cad_similarities'].append(sim)
-                source_results_binned[bin_width]['deltas'].append(delta_downconverted)
+    _bin_comparison_deltas(deltas_source, similarity_source_list, source_results_binned, settings)
 
     # Build a list of concept pairs between source_concept_id -> [concepts similar to target]
     similar_target_pairs = []
@@ -864,26 +1203,12 @@ def query_source_to_target(dataset_id, source_concept_id, target_concept_id, exc
         similar_target_pairs += [(source_concept_id, x.concept_id) for x in cacs]
         similarity_target_list += similarity_to_target[bin_width]
 
-    # Get delta comparisons with similar target concepts
+    # Get delta comparisons with similar target concepts and group them by bin_width
     deltas_target = query_delta_counts(dataset_id, similar_target_pairs)
+    _bin_comparison_deltas(deltas_target, similarity_target_list, target_results_binned, settings)
 
-    # Group the comparison deltas by bin_width
-    for sim, delta in zip(similarity_target_list, deltas_target):
-        # Check that the delta bin_width isn't a higher resolution than the bin width captured by the delta_primary
-        if delta is None:
-            continue
-
-        # Add the delta unaltered if its bin_width is at least as large as the delta_primary's bin_width
-        if delta.bin_width >= delta_primary.bin_width:
-            target_results_binned[delta.bin_width]['cad_similarities'].append(sim)
-            target_results_binned[delta.bin_width]['deltas'].append(delta)
-
-        # Also convert the delta to larger bin_widths to add them to the comparison in the larger bin_width groups
-        for bin_width, n in settings:
-            if bin_width > delta.bin_width and bin_width >= delta_primary.bin_width:
-                delta_downconverted = delta.convert_bin_scheme(bin_width, n)
-                target_results_binned[bin_width]['cad_similarities'].append(sim)
-                target_results_binned[bin_width]['deltas'].append(delta_downconverted)
+    # One random generator for all the bootstrap simulations
+    rng = np.random.default_rng(seed)
 
     # Run simulations on the source comparisons to generate a distribution
     for bin_width, srb in list(source_results_binned.items()):
@@ -893,14 +1218,11 @@ def query_source_to_target(dataset_id, source_concept_id, target_concept_id, exc
             continue
 
         # Estimate distributions of the comparison concepts
-        dist = bootstrap_delta_distribution(srb_deltas, mode='relative_source', iterations=1000)
+        dist = bootstrap_delta_distribution(srb_deltas, mode='relative_source', iterations=1000, seed=rng)
         srb['distribution'] = dist.tolist()
 
         # Compare the distributions to the confidence interval of the primary delta
-        dp = delta_primary_downconverted[bin_width]
-        cis = np.array(dp.confidence_intervals()).T / float(dp.source_concept_count)
-        # note: need to convert numpy.bool to normal bool for json
-        sig = [bool((cis[0, i] > dist[4, i]) or (cis[1, i] < dist[0, i])) for i in range(cis.shape[1])]
+        sig = _significance(delta_primary_downconverted[bin_width], dist)
         srb['significance'] = sig
 
     # Run simulations on the target comparisons to generate a distribution
@@ -911,14 +1233,11 @@ def query_source_to_target(dataset_id, source_concept_id, target_concept_id, exc
             continue
 
         # Estimate distributions of the comparison concepts
-        dist = bootstrap_delta_distribution(trb_deltas, mode='relative_source', iterations=1000)
+        dist = bootstrap_delta_distribution(trb_deltas, mode='relative_source', iterations=1000, seed=rng)
         trb['distribution'] = dist.tolist()
 
         # Compare the distributions to the confidence interval of the primary delta
-        dp = delta_primary_downconverted[bin_width]
-        cis = np.array(dp.confidence_intervals()).T / float(dp.source_concept_count)
-        # note: need to convert numpy.bool to normal bool for json
-        sig = [bool((cis[0, i] > dist[4, i]) or (cis[1, i] < dist[0, i])) for i in range(cis.shape[1])]
+        sig = _significance(delta_primary_downconverted[bin_width], dist)
         trb['significance'] = sig
 
     # Run simulations on the combined source and target comparisons to generate a distribution
@@ -936,14 +1255,11 @@ def query_source_to_target(dataset_id, source_concept_id, target_concept_id, exc
         crb = combined_results_binned[bin_width]
 
         # Estimate distributions of the comparison concepts
-        dist = bootstrap_delta_distribution(combined_deltas, mode='relative_source', iterations=1000)
+        dist = bootstrap_delta_distribution(combined_deltas, mode='relative_source', iterations=1000, seed=rng)
         crb['distribution'] = dist.tolist()
 
         # Compare the distributions to the confidence interval of the primary delta
-        dp = delta_primary_downconverted[bin_width]
-        cis = np.array(dp.confidence_intervals()).T / float(dp.source_concept_count)
-        # note: need to convert numpy.bool to normal bool for json
-        sig = [bool((cis[0, i] > dist[4, i]) or (cis[1, i] < dist[0, i])) for i in range(cis.shape[1])]
+        sig = _significance(delta_primary_downconverted[bin_width], dist)
         crb['significance'] = sig
 
     # Create the result structure
@@ -951,13 +1267,13 @@ def query_source_to_target(dataset_id, source_concept_id, target_concept_id, exc
                      'delta': d.convert_to_dict_results()}
                     for bw, d in list(delta_primary_downconverted.items())]
     source_comparison = [{'bin_width': bw,
-                          'deltas': [d.convert_to_dict_results() for d in x['deltas']],
+                          'deltas': convert_to_dict_results(x['deltas']),
                           'cad_similarities': [float(s) for s in x['cad_similarities']],
                           'distribution': x['distribution'],
                           'significance': x['significance']}
                          for bw, x in list(source_results_binned.items())]
     target_comparison = [{'bin_width': bw,
-                          'deltas': [d.convert_to_dict_results() for d in x['deltas']],
+                          'deltas': convert_to_dict_results(x['deltas']),
                           'cad_similarities': [float(s) for s in x['cad_similarities']],
                           'distribution': x['distribution'],
                           'significance': x['significance']}
@@ -983,7 +1299,7 @@ def query_cohd_temporal(service, method, args):
     assert service == 'temporal'
 
     # Connect to MYSQL database
-    conn = sql_connection()
+    conn = sql_connection(get_arg_dataset_id(args, DATASET_ID_DEFAULT_TEMPORAL))
     cur = conn.cursor()
 
     json_return = []
@@ -1003,7 +1319,7 @@ def query_cohd_temporal(service, method, args):
             return 'concept_id parameter is missing', 400
 
         cads = query_concept_age_counts(dataset_id, concept_id)
-        json_return = [cad.convert_to_dict_results() for cad in cads]
+        json_return = convert_to_dict_results(cads)
 
     # Finds concepts with a similar concept-age distribution to the concept of interest
     # e.g. /api/temporal/conceptAgeCounts?dataset_id=4&concept_id=313217
@@ -1039,16 +1355,9 @@ def query_cohd_temporal(service, method, args):
                 continue
 
             # Insert the concept of interest as the first concept in the array
-            coi_cac = coi_cacs[bin_width]
-            cac_result = coi_cac.convert_to_dict_results()
-            cac_result['similarity'] = 1.0
-            cac_results = [cac_result]
-
-            sm = similarities[bin_width]
-            for i, cac in enumerate(cacs[bin_width]):
-                cac_result = cac.convert_to_dict_results()
-                cac_result['similarity'] = float(sm[i])
-                cac_results.append(cac_result)
+            cac_results = convert_to_dict_results([coi_cacs[bin_width]] + cacs[bin_width])
+            for cac_result, similarity in zip(cac_results, [1.0] + similarities[bin_width]):
+                cac_result['similarity'] = float(similarity)
 
             # Create a result set for the results in this bin width
             result_set = {
@@ -1071,7 +1380,7 @@ def query_cohd_temporal(service, method, args):
             return 'target_concept_id parameter is missing', 400
 
         deltas = query_delta_counts(dataset_id, [(source_concept_id, target_concept_id)])
-        json_return = [delta.convert_to_dict_results() for delta in deltas if delta is not None]
+        json_return = convert_to_dict_results([delta for delta in deltas if delta is not None])
 
     # Returns ratio of observed to expected frequency between pairs of concepts
     # e.g. /api/temporal/sourceToTarget?dataset_id=4&source_concept_id=312327&target_concept_id=313217
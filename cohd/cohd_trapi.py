@@ -67,6 +67,7 @@ class CohdTrapi(ABC):
     default_log_level = logging.INFO
     default_time_limit = 20  # seconds
     batch_size_limit = 100  # max length of any IDs list
+    batch_query_size = 25  # number of IDs whose associations are retrieved per database query
     limit_max_results = 500
     json_inf_replacement = 999  # value to replace +/-Infinity with in JSON
     mcq_score_scaling = 0.75  # magic number to adjust normalized MCQ score
@@ -924,60 +924,99 @@ class CohdTrapi150(CohdTrapi):
             return self._valid_query, self._invalid_query_response
 
     def operate_batch(self):
+        # Associations for upcoming concept_1 IDs, retrieved a chunk of IDs at a time
+        batch_results = dict()
+        # False for concept_1 IDs whose batch results only have their top associations
+        batch_complete = dict()
+        # Associations left out of the batch results of each concept_1 ID, or None if they were not fetched (i.e., only
+        # the precomputed top associations were read)
+        batch_remainders = dict()
+        if self._domain_class_pairs:
+            domain_class_pairs = tuple(sorted(self._domain_class_pairs,
+                                              key=lambda x: (x.domain_id, x.concept_class_id or '')))
+        else:
+            domain_class_pairs = None
+
         for i, concept_1_omop_id in enumerate(self._concept_1_omop_ids):
             # Limit the amount of time the TRAPI query runs for
             ellapsed_time = (datetime.now() - self._start_time).total_seconds()
             if ellapsed_time > self._time_limit:
-                skipped_curies = [self._kg_omop_curie_map[x] for x in self._concept_1_omop_ids[i:]]
-                description = f'Maximum time limit {self._time_limit} sec reached before all input IDs processed. '\
-                                f'Skipped IDs: {skipped_curies}'
-                self.log(description, level=logging.WARNING)
+                self._log_time_limit_reached(self._concept_1_omop_ids[i:])
                 break
 
-            new_cohd_results = list()
-            if self._concept_2_omop_ids is None:
-                # Node 2's IDs were not specified
-                if self._domain_class_pairs:
-                    # Node 2's category was specified. Query associations between Node 1 and the requested
-                    # categories (domains)
-                    for domain_id, concept_class_id in self._domain_class_pairs:
-                        json_results = query_cohd_mysql.query_trapi(concept_id_1=concept_1_omop_id,
-                                                                    concept_id_2=None,
-                                                                    dataset_id=self._dataset_id,
-                                                                    domain_id=domain_id,
-                                                                    concept_class_id=concept_class_id,
-                                                                    ln_ratio_sign=self._association_direction,
-                                                                    confidence=self._confidence_interval,
-                                                                    bypass=self._bypass_cache)
-                        if json_results:
-                            new_cohd_results.extend(json_results['results'])
-                else:
-                    # No category (domain) was specified for Node 2. Query the associations between Node 1 and all
-                    # domains
-                    json_results = query_cohd_mysql.query_trapi(concept_id_1=concept_1_omop_id, concept_id_2=None,
-                                                                dataset_id=self._dataset_id, domain_id=None,
-                                                                ln_ratio_sign=self._association_direction,
-                                                                confidence=self._confidence_interval,
-                                                                bypass=self._bypass_cache)
-                    if json_results:
-                        new_cohd_results.extend(json_results['results'])
+            try:
+                new_cohd_results = list()
+                n_prior_results = len(self._results)
+                if self._concept_2_omop_ids is None:
+                    # Node 2's IDs were not specified. Query associations between Node 1 and the requested categories
+                    # (domains), or all domains if no category was specified. Fetch the associations for the next
+                    # chunk of IDs in one query, starting with the precomputed top associations if available
+                    if concept_1_omop_id not in batch_results:
+                        chunk = self._concept_1_omop_ids[i:i + CohdTrapi.batch_query_size]
+                        top_results = query_cohd_mysql.query_trapi_top(concept_ids=chunk,
+                                                                       dataset_id=self._dataset_id,
+                                                                       domain_class_pairs=domain_class_pairs,
+                                                                       ln_ratio_sign=self._association_direction,
+                                                                       confidence=self._confidence_interval,
+                                                                       bypass=self._bypass_cache)
+                        if top_results is not None:
+                            batch_results = {k: v[0] for k, v in top_results.items()}
+                            batch_complete = {k: v[1] for k, v in top_results.items()}
+                            batch_remainders = dict()
+                        else:
+                            # Only the top results of each concept are post-processed
+                            many_results = query_cohd_mysql.query_trapi_many(concept_ids=chunk,
+                                                                             dataset_id=self._dataset_id,
+                                                                             domain_class_pairs=domain_class_pairs,
+                                                                             ln_ratio_sign=self._association_direction,
+                                                                             confidence=self._confidence_interval,
+                                                                             bypass=self._bypass_cache,
+                                                                             max_results=self._max_results_per_input)
+                            batch_results = {k: v[0] for k, v in many_results.items()}
+                            batch_complete = {k: v[1] for k, v in many_results.items()}
+                            batch_remainders = {k: v[2] for k, v in many_results.items()}
+                    new_cohd_results.extend(batch_results.get(concept_1_omop_id, []))
 
-            else:
-                # Concept 2's IDs were specified. Query Concept 1 against all IDs for Concept 2
-                for concept_2_id in self._concept_2_omop_ids:
-                    json_results = query_cohd_mysql.query_trapi(concept_id_1=concept_1_omop_id,
-                                                                concept_id_2=concept_2_id,
-                                                                dataset_id=self._dataset_id, domain_id=None,
-                                                                confidence=self._confidence_interval,
-                                                                bypass=self._bypass_cache)
-                    if json_results:
-                        new_cohd_results.extend(json_results['results'])
-
-            # Results within each query call should be sorted, but still need to be sorted across query calls
-            new_cohd_results = sort_cohd_results(new_cohd_results)
-
-            # Convert results from COHD format to Translator Reasoner standard
-            results_limit_reached = self._add_results_to_trapi(new_cohd_results)
+                else:
+                    # Concept 2's IDs were specified. Query all IDs for Concept 1 against all IDs for Concept 2 at once
+                    if concept_1_omop_id not in batch_results:
+                        batch_results = query_cohd_mysql.query_trapi_pairs(concept_ids_1=self._concept_1_omop_ids[i:],
+                                                                           concept_ids_2=self._concept_2_omop_ids,
+                                                                           dataset_id=self._dataset_id,
+                                                                           confidence=self._confidence_interval,
+                                                                           bypass=self._bypass_cache)
+                    new_cohd_results.extend(batch_results.get(concept_1_omop_id, []))
+
+                # Results within each query call should be sorted, but still need to be sorted across query calls
+                new_cohd_results = sort_cohd_results(new_cohd_results)
+
+                # Convert results from COHD format to Translator Reasoner standard
+                results_limit_reached = self._add_results_to_trapi(new_cohd_results)
+
+                if not results_limit_reached and not batch_complete.get(concept_1_omop_id, True):
+                    # The top associations ran out before the results limit was reached (e.g., results were filtered
+                    # out). Continue with the remaining associations.
+                    remainder = batch_remainders.get(concept_1_omop_id)
+                    if remainder is not None:
+                        # Post-process the associations that the batch query already fetched
+                        remaining_cohd_results = remainder.results()
+                    else:
+                        # Only the precomputed top associations were read. Get the rest from the full query.
+                        all_cohd_results = query_cohd_mysql.query_trapi_many(concept_ids=[concept_1_omop_id],
+                                                                             dataset_id=self._dataset_id,
+                                                                             domain_class_pairs=domain_class_pairs,
+                                                                             ln_ratio_sign=self._association_direction,
+                                                                             confidence=self._confidence_interval,
+                                                                             bypass=self._bypass_cache)
+                        added_ids = {r['concept_id_2'] for r in new_cohd_results}
+                        remaining_cohd_results = [r for r in all_cohd_results.get(concept_1_omop_id, [])
+                                                  if r['concept_id_2'] not in added_ids]
+                    results_limit_reached = self._add_results_to_trapi(sort_cohd_results(remaining_cohd_results),
+                                                                       n_prior_results)
+            except query_cohd_mysql.QueryTimeoutError:
+                # A statement ran into the execution deadline
+                self._log_time_limit_reached(self._concept_1_omop_ids[i:])
+                break
 
             # Log warnings and stop when results limits reached
             if results_limit_reached:
@@ -991,6 +1030,18 @@ class CohdTrapi150(CohdTrapi):
                                 level=logging.WARNING)
                     break
 
+    def _log_time_limit_reached(self, skipped_omop_ids):
+        """ Logs a TRAPI warning that the time limit was reached
+
+        Parameters
+        ----------
+        skipped_omop_ids: OMOP concept IDs of the input IDs that were not processed
+        """
+        skipped_curies = [self._kg_omop_curie_map[x] for x in skipped_omop_ids]
+        description = f'Maximum time limit {self._time_limit} sec reached before all input IDs processed. '\
+                      f'Skipped IDs: {skipped_curies}'
+        self.log(description, level=logging.WARNING)
+
     def operate_mcq(self):
         set_results = list()
         single_results = dict()
@@ -1045,10 +1096,16 @@ class CohdTrapi150(CohdTrapi):
             self._cohd_results = []
             self._initialize_trapi_response()
 
-            if self._concept_1_set_interpretation == 'BATCH':
-                self.operate_batch()
-            elif self._concept_1_set_interpretation == 'MANY':
-                self.operate_mcq()
+            # SQL statements issued while gathering results may only use the remaining time budget
+            remaining_time = self._time_limit - (datetime.now() - self._start_time).total_seconds()
+            with query_cohd_mysql.execution_deadline(remaining_time):
+                if self._concept_1_set_interpretation == 'BATCH':
+                    self.operate_batch()
+                elif self._concept_1_set_interpretation == 'MANY':
+                    try:
+                        self.operate_mcq()
+                    except query_cohd_mysql.QueryTimeoutError:
+                        self._log_time_limit_reached(self._concept_1_omop_ids)
 
             return self._finalize_trapi_response()
         else:
@@ -2024,16 +2081,23 @@ class CohdTrapi150(CohdTrapi):
             'query_options': self._query_options,
         }
 
-    def _add_results_to_trapi(self, new_cohd_results):
+    def _add_results_to_trapi(self, new_cohd_results, n_prior_results=None):
         """ Add results
 
+        Parameters
+        ----------
+        new_cohd_results: COHD results for one input ID
+        n_prior_results: number of results before any results were added for the input ID. Defaults to the current
+                         number of results.
+
         Returns
         -------
         boolean: True if results limit reached, otherwise False
         """
         if self._cohd_results is not None:
             self._cohd_results.extend(new_cohd_results)
-            n_prior_results = len(self._results)
+            if n_prior_results is None:
+                n_prior_results = len(self._results)
             for i, result in enumerate(new_cohd_results):
                 # Don't add more than the maximum number of results per input ID
                 if len(self._results) - n_prior_results >= self._max_results_per_input:
@@ -1,7 +1,135 @@
+import argparse
+import logging
+import threading
 from typing import NamedTuple, Optional
 import numpy as np
 from scipy.stats import poisson
 
+# Size of the Poisson CI lookup tables. Counts 0 to POISSON_CI_TABLE_SIZE - 1 cover 99% of co-occurrence counts in COHD.
+# Larger counts are computed with scipy in a single vectorized call.
+POISSON_CI_TABLE_SIZE = 10000
+
+# Maximum number of confidence levels with a lookup table. The confidence is a request parameter, so this bounds the
+# memory used by unusual confidence levels, which are computed with scipy instead.
+POISSON_CI_MAX_TABLES = 16
+
+
+class PoissonCiTables:
+    """
+    Dense lookup tables of the Poisson confidence intervals of counts, one (2, size) array of (lower bound, upper bound)
+    per confidence level. A table is built with one vectorized scipy call the first time its confidence level is used,
+    or loaded from a file saved with save(), e.g., with the default levels before the uWSGI workers are forked.
+    """
+
+    def __init__(self, size=POISSON_CI_TABLE_SIZE, max_tables=POISSON_CI_MAX_TABLES):
+        """ Constructor
+
+        Parameters
+        ----------
+        size: number of counts in each table
+        max_tables: maximum number of confidence levels with a table
+        """
+        self.size = size
+        self.max_tables = max_tables
+        self._tables = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _interval(counts, confidence):
+        """ Poisson CI of counts with scipy. Same result as poisson.interval, but much faster calculation. """
+        alpha = 1 - confidence
+        lo, hi = poisson.ppf([[alpha / 2], [1 - alpha / 2]], np.asarray(counts, dtype=np.float64).reshape(1, -1))
+        return np.maximum(lo, 1), hi  # min possible count is 1
+
+    def table(self, confidence):
+        """ Gets the table of a confidence level
+
+        Parameters
+        ----------
+        confidence: float - desired confidence. range: [0, 1]
+
+        Returns
+        -------
+        (2, size) array of lower and upper bounds, or None if the maximum number of tables has been reached
+        """
+        confidence = float(confidence)
+        table = self._tables.get(confidence)
+        if table is None:
+            with self._lock:
+                table = self._tables.get(confidence)
+                if table is None:
+                    if len(self._tables) >= self.max_tables:
+                        return None
+                    table = np.stack(self._interval(np.arange(self.size), confidence))
+                    table.flags.writeable = False
+                    self._tables[confidence] = table
+        return table
+
+    def interval(self, counts, confidence):
+        """ Poisson CIs of an array of counts
+
+        Parameters
+        ----------
+        counts: array of counts
+        confidence: float - desired confidence. range: [0, 1]
+
+        Returns
+        -------
+        (lower bounds, upper bounds) arrays with the shape of counts
+        """
+        counts = np.asarray(counts, dtype=np.float64)
+        table = self.table(confidence)
+        if table is None:
+            lo, hi = self._interval(counts.ravel(), confidence)
+            return lo.reshape(counts.shape), hi.reshape(counts.shape)
+
+        # Look up the integer counts within the table and compute the rest
+        shape = counts.shape
+        counts = counts.ravel()
+        index = np.where((counts >= 0) & (counts < self.size) & (counts == np.floor(counts)), counts, -1)
+        index = index.astype(np.int64)
+        lo = table[0].take(index, mode='clip')
+        hi = table[1].take(index, mode='clip')
+        missing = index < 0
+        if missing.any():
+            lo[missing], hi[missing] = self._interval(counts[missing], confidence)
+        return lo.reshape(shape), hi.reshape(shape)
+
+    def save(self, path, confidences):
+        """ Saves the tables of the confidence levels to an .npz file
+
+        Parameters
+        ----------
+        path: file path
+        confidences: list of confidence levels
+        """
+        np.savez(path, confidences=np.asarray(confidences, dtype=np.float64),
+                 tables=np.stack([self.table(c) for c in confidences]))
+
+    def load(self, path):
+        """ Loads tables saved with save(). The tables replace the existing tables of the same size.
+
+        Parameters
+        ----------
+        path: file path
+        """
+        with np.load(path) as f:
+            confidences = f['confidences'].tolist()
+            tables = f['tables']
+        if tables.shape[2] != self.size:
+            logging.warning(f'Ignoring Poisson CI tables in {path} with size {tables.shape[2]} != {self.size}')
+            return
+        with self._lock:
+            for confidence, table in zip(confidences, tables):
+                table = np.array(table)
+                table.flags.writeable = False
+                self._tables[confidence] = table
+        logging.info(f'Loaded Poisson CI tables for confidence levels {confidences} from {path}')
+
+
+# Shared Poisson CI tables. Built on first use or loaded with poisson_ci_tables.load()
+poisson_ci_tables = PoissonCiTables()
+
 
 def poisson_ci(freq, confidence=0.99):
     """ Assuming two Poisson processes (1 for the event rate and 1 for randomization), calculate the confidence interval
@@ -19,35 +147,35 @@ def poisson_ci(freq, confidence=0.99):
     # # Adjust the interval for each individual poisson to achieve overall confidence interval
     # return poisson.interval(confidence, freq)
 
-    # COHD defaults to confidence values of 0.99 and 0.999 (double poisson), so cache these values to save compute time
-    use_cache = (confidence == 0.99 or confidence == 0.999)
-    if use_cache:
-        cache = _poisson_ci_cache[confidence]
-        if freq in cache:
-            return cache[freq]
-
-    # Same result as using poisson.interval, but much faster calculation
-    alpha = 1 - confidence
-    ci = poisson.ppf([alpha / 2, 1 - alpha / 2], freq)
-    ci[0] = max(ci[0], 1)  # min possible count is 1
-    ci = tuple(ci)
-
-    if use_cache:
-        # Only cache results for 99% and 99.9% CI
-        cache[freq] = ci
-    return ci
+    # Scalar lookup in the tables without creating arrays
+    if 0 <= freq < poisson_ci_tables.size and freq == int(freq):
+        table = poisson_ci_tables.table(confidence)
+        if table is not None:
+            i = int(freq)
+            return table[0, i], table[1, i]
+
+    lo, hi = poisson_ci_tables.interval(freq, confidence)
+    return lo[()], hi[()]
+
+
+def poisson_ci_array(freq, confidence=0.99):
+    """ Array version of poisson_ci
+
+    Parameters
+    ----------
+    freq: array of co-occurrence frequencies
+    confidence: float - desired confidence. range: [0, 1]
+
+    Returns
+    -------
+    (lower bounds, upper bounds) arrays
+    """
+    return poisson_ci_tables.interval(freq, confidence)
 
 
-# Pre-cache values for poisson_ci. Confidence values of 0.99 and 0.999 are commonly used. Caching up to a freq of 10000
-# covers 99% of co-occurrence counts in COHD and takes up < 1MB RAM for both confidence levels.
-# Note: also evaluated a hybrid implementation using both lists and dicts, but had exact same performance
-_poisson_ci_cache = {
-    0.99: dict(),
-    0.999: dict()
-}
-for i in range(10000):
-    poisson_ci(i, confidence=0.99)
-    poisson_ci(i, confidence=0.999)
+def double_poisson_confidence(confidence):
+    """ Adjusts the interval for each individual poisson to achieve overall confidence interval """
+    return 1 - ((1 - confidence) ** 1.5)
 
 
 def double_poisson_ci(freq, confidence=0.99):
@@ -69,9 +197,22 @@ def double_poisson_ci(freq, confidence=0.99):
     #         poisson.interval(confidence_adjusted, poisson.interval(confidence_adjusted, freq)[1])[1])
 
     # More efficient calculation using a single call to poisson.interval with similar results as above
-    # Adjust the interval for each individual poisson to achieve overall confidence interval
-    confidence_adjusted = 1 - ((1 - confidence) ** 1.5)
-    return poisson_ci(freq, confidence_adjusted)
+    return poisson_ci(freq, double_poisson_confidence(confidence))
+
+
+def double_poisson_ci_array(freq, confidence=0.99):
+    """ Array version of double_poisson_ci
+
+    Parameters
+    ----------
+    freq: array of co-occurrence frequencies
+    confidence: float - desired confidence. range: [0, 1]
+
+    Returns
+    -------
+    (lower bounds, upper bounds) arrays
+    """
+    return poisson_ci_array(freq, double_poisson_confidence(confidence))
 
 
 def ln_ratio_ci(freq, ln_ratio, confidence=0.99, replace_inf=None):
@@ -96,6 +237,32 @@ def ln_ratio_ci(freq, ln_ratio, confidence=0.99, replace_inf=None):
     return ci
 
 
+def ln_ratio_ci_array(freq, ln_ratio, confidence=0.99, replace_inf=None):
+    """ Array version of ln_ratio_ci
+
+    Parameters
+    ----------
+    freq: array of co-occurrence counts
+    ln_ratio: array of log ratios
+    confidence: float - desired confidence. range: [0, 1]
+    replace_inf: (Optional) If specified, replaces +Inf or -Inf with +replace_inf or -replace_inf
+
+    Returns
+    -------
+    (lower bounds, upper bounds) arrays
+    """
+    freq = np.asarray(freq, dtype=np.float64)
+    ratio = np.exp(np.asarray(ln_ratio, dtype=np.float64)) / freq
+    lo, hi = double_poisson_ci_array(freq, confidence)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lo = np.log(lo * ratio)
+        hi = np.log(hi * ratio)
+    if replace_inf:
+        lo = np.maximum(lo, -replace_inf)
+        hi = np.minimum(hi, replace_inf)
+    return lo, hi
+
+
 def rel_freq_ci(pair_count, base_count, confidence=0.99, replace_inf=None):
     """ Estimates the confidence interval of the relative frequency using the double poisson method
 
@@ -119,6 +286,30 @@ def rel_freq_ci(pair_count, base_count, confidence=0.99, replace_inf=None):
     return ci
 
 
+def rel_freq_ci_array(pair_count, base_count, confidence=0.99, replace_inf=None):
+    """ Array version of rel_freq_ci
+
+    Parameters
+    ----------
+    pair_count: array of co-occurrence counts
+    base_count: array of base concept counts
+    confidence: float - desired confidence. range: [0, 1]
+    replace_inf: (Optional) If specified, replaces +Inf with replace_inf
+
+    Returns
+    -------
+    (lower bounds, upper bounds) arrays
+    """
+    pair_lo, pair_hi = poisson_ci_array(pair_count, confidence)
+    base_lo, base_hi = poisson_ci_array(base_count, confidence)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lo = pair_lo / base_hi
+        hi = pair_hi / base_lo
+    if replace_inf:
+        hi = np.minimum(hi, replace_inf)
+    return lo, hi
+
+
 def ci_significance(ci1, ci2=None):
     """ Checks for significance between either 1) a single confidence interval and 0 or 2) two confidence intervals
 
@@ -231,3 +422,13 @@ def read_log():
         log = '\n'.join(lines[-1000:])
     return log
 
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Builds the Poisson CI lookup tables (set POISSON_CI_TABLE_FILE in '
+                                                 'cohd_flask.conf to the output file)')
+    parser.add_argument('--out', required=True, help='Output .npz file')
+    parser.add_argument('--confidence', type=float, nargs='+', default=[0.95, 0.99, 0.999],
+                        help='Confidence levels. The double poisson CIs use the adjusted levels, which are included.')
+    a = parser.parse_args()
+    levels = sorted(set(a.confidence) | {double_poisson_confidence(c) for c in a.confidence})
+    poisson_ci_tables.save(a.out, levels)
@@ -0,0 +1,115 @@
+import numpy as np
+
+
+class ConceptDictionary:
+    """
+    Compact in-process dictionary of OMOP concept definitions
+
+    Concept IDs are kept in a sorted int64 array. Domains, concept classes, and vocabularies are interned and stored as
+    int16 codes. Names and concept codes are each concatenated into a single string with an int64 offset array, so a
+    dictionary of all active concepts takes a few MB and is looked up without SQL queries or per-concept objects.
+    """
+
+    # Columns of the concept definitions, same as query_db_concepts
+    COLUMNS = ('concept_id', 'concept_name', 'domain_id', 'vocabulary_id', 'concept_class_id', 'concept_code')
+
+    def __init__(self, rows, version=None):
+        """ Constructor
+
+        Parameters
+        ----------
+        rows: iterable of concept definition rows (dicts with COLUMNS)
+        version: version of the data the dictionary was loaded from
+        """
+        rows = sorted(rows, key=lambda r: r['concept_id'])
+        self.version = version
+        self.concept_ids = np.array([r['concept_id'] for r in rows], dtype=np.int64)
+        self.domains, self.domain_codes = ConceptDictionary._intern([r['domain_id'] for r in rows])
+        self.concept_classes, self.concept_class_codes = ConceptDictionary._intern(
+            [r['concept_class_id'] for r in rows])
+        self.vocabularies, self.vocabulary_codes = ConceptDictionary._intern([r['vocabulary_id'] for r in rows])
+        self._names, self._name_offsets = ConceptDictionary._buffer([r['concept_name'] for r in rows])
+        self._codes, self._code_offsets = ConceptDictionary._buffer([r['concept_code'] for r in rows])
+
+    @staticmethod
+    def _intern(values):
+        """ Interns strings as int16 codes into a sorted list of unique values. None is coded as -1. """
+        unique = sorted({v for v in values if v is not None})
+        codes = {v: i for i, v in enumerate(unique)}
+        return unique, np.array([codes.get(v, -1) for v in values], dtype=np.int16)
+
+    @staticmethod
+    def _buffer(values):
+        """ Concatenates strings into one buffer. Returns the buffer and the offsets of each string. """
+        values = [v or '' for v in values]
+        offsets = np.zeros(len(values) + 1, dtype=np.int64)
+        np.cumsum([len(v) for v in values], out=offsets[1:])
+        return ''.join(values), offsets
+
+    def __len__(self):
+        return len(self.concept_ids)
+
+    def __contains__(self, concept_id):
+        return self.index([concept_id])[0] >= 0
+
+    def index(self, concept_ids):
+        """ Positions of concepts in the dictionary
+
+        Parameters
+        ----------
+        concept_ids: sequence of OMOP concept IDs (int)
+
+        Returns
+        -------
+        numpy array of positions, -1 for concepts not in the dictionary
+        """
+        concept_ids = np.asarray(concept_ids, dtype=np.int64)
+        if len(self.concept_ids) == 0:
+            return np.full(len(concept_ids), -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.concept_ids, concept_ids), len(self.concept_ids) - 1)
+        return np.where(self.concept_ids[pos] == concept_ids, pos, -1)
+
+    def _row(self, i):
+        """ Concept definition at position i """
+        domain = self.domain_codes[i]
+        concept_class = self.concept_class_codes[i]
+        vocabulary = self.vocabulary_codes[i]
+        return {
+            'concept_id': int(self.concept_ids[i]),
+            'concept_name': self._names[self._name_offsets[i]:self._name_offsets[i + 1]],
+            'domain_id': self.domains[domain] if domain >= 0 else None,
+            'vocabulary_id': self.vocabularies[vocabulary] if vocabulary >= 0 else None,
+            'concept_class_id': self.concept_classes[concept_class] if concept_class >= 0 else None,
+            'concept_code': self._codes[self._code_offsets[i]:self._code_offsets[i + 1]],
+        }
+
+    def get(self, concept_id):
+        """ Gets a concept definition
+
+        Parameters
+        ----------
+        concept_id: OMOP concept ID (int)
+
+        Returns
+        -------
+        Concept definition (dict with COLUMNS), or None if the concept is not in the dictionary
+        """
+        i = int(self.index([concept_id])[0])
+        return self._row(i) if i >= 0 else None
+
+    def get_many(self, concept_ids):
+        """ Gets the definitions of several concepts
+
+        Parameters
+        ----------
+        concept_ids: iterable of OMOP concept IDs (int)
+
+        Returns
+        -------
+        dict[concept_id] = concept definition. Concepts not in the dictionary are omitted.
+        """
+        concept_ids = list(concept_ids)
+        if not concept_ids:
+            return dict()
+        positions = self.index(concept_ids).tolist()
+        return {c: self._row(i) for c, i in zip(concept_ids, positions) if i >= 0}
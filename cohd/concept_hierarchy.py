@@ -0,0 +1,229 @@
+import logging
+
+import numpy as np
+import pymysql
+
+from .concept_dictionary import ConceptDictionary
+
+
+class ConceptHierarchy:
+    """
+    In-process index of the concept_ancestor table
+
+    The ancestors and descendants of each concept are stored in compressed sparse row (CSR) form: the related concepts
+    of the concept at position i are at positions idx[indptr[i]:indptr[i + 1]] with their min and max levels of
+    separation in the same order. Positions refer to a ConceptDictionary of the concepts in the hierarchy, whose
+    interned vocabulary and concept class codes are used for filtering. Concept counts are stored per dataset as
+    arrays aligned with the positions, so conceptAncestors and conceptDescendants are answered without SQL.
+    """
+
+    # Maximum number of results returned by conceptAncestors and conceptDescendants
+    MAX_RESULTS = 1000
+
+    def __init__(self, ancestor_ids, descendant_ids, min_levels, max_levels, concept_rows, concept_counts,
+                 version=None):
+        """ Constructor
+
+        Parameters
+        ----------
+        ancestor_ids: sequence of ancestor_concept_id from concept_ancestor
+        descendant_ids: sequence of descendant_concept_id, same length
+        min_levels: sequence of min_levels_of_separation, same length
+        max_levels: sequence of max_levels_of_separation, same length
+        concept_rows: concept definitions (ConceptDictionary.COLUMNS and standard_concept) of the concepts in the
+                      hierarchy. Relationships with concepts missing from concept_rows are dropped.
+        concept_counts: dict[dataset_id] = (sequence of concept_id, sequence of concept_count)
+        version: version of the data the index was loaded from
+        """
+        concept_rows = list(concept_rows)
+        self.version = version
+        self.concepts = ConceptDictionary(concept_rows, version)
+        standard = {r['concept_id']: r.get('standard_concept') for r in concept_rows}
+        self.standard_concepts, self.standard_concept_codes = ConceptDictionary._intern(
+            [standard[c] for c in self.concepts.concept_ids.tolist()])
+
+        ancestor_pos = self.concepts.index(np.asarray(ancestor_ids, dtype=np.int64))
+        descendant_pos = self.concepts.index(np.asarray(descendant_ids, dtype=np.int64))
+        keep = (ancestor_pos >= 0) & (descendant_pos >= 0)
+        ancestor_pos = ancestor_pos[keep].astype(np.int32)
+        descendant_pos = descendant_pos[keep].astype(np.int32)
+        min_levels = np.asarray(min_levels, dtype=np.int16)[keep]
+        max_levels = np.asarray(max_levels, dtype=np.int16)[keep]
+
+        n = len(self.concepts)
+        self._ancestors = ConceptHierarchy._csr(n, descendant_pos, ancestor_pos, min_levels, max_levels)
+        self._descendants = ConceptHierarchy._csr(n, ancestor_pos, descendant_pos, min_levels, max_levels)
+
+        # Counts by dataset, -1 where the concept has no count in the dataset
+        self._counts = dict()
+        has_counts = np.zeros(n, dtype=bool)
+        for dataset_id, (ids, counts) in concept_counts.items():
+            positions = self.concepts.index(np.asarray(ids, dtype=np.int64))
+            found = positions >= 0
+            dataset_counts = np.full(n, -1, dtype=np.int64)
+            dataset_counts[positions[found]] = np.asarray(counts, dtype=np.int64)[found]
+            self._counts[dataset_id] = dataset_counts
+            has_counts |= dataset_counts >= 0
+        self._has_counts = has_counts
+
+    @staticmethod
+    def _csr(n, rows, columns, min_levels, max_levels):
+        """ Builds (indptr, idx, min_levels, max_levels) with the columns of each row sorted by position """
+        order = np.lexsort((columns, rows))
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+        return indptr, columns[order], min_levels[order], max_levels[order]
+
+    def __len__(self):
+        return len(self.concepts)
+
+    def _related(self, csr, concept_id):
+        i = int(self.concepts.index([concept_id])[0])
+        if i < 0:
+            empty = np.zeros(0, dtype=np.int32)
+            return empty, empty.astype(np.int16), empty.astype(np.int16)
+        indptr, idx, min_levels, max_levels = csr
+        s = slice(indptr[i], indptr[i + 1])
+        return idx[s], min_levels[s], max_levels[s]
+
+    def ancestor_ids(self, concept_id):
+        """ Concept IDs of the ancestors of a concept (int array) """
+        return self.concepts.concept_ids[self._related(self._ancestors, concept_id)[0]]
+
+    def descendant_ids(self, concept_id):
+        """ Concept IDs of the descendants of a concept (int array) """
+        return self.concepts.concept_ids[self._related(self._descendants, concept_id)[0]]
+
+    def _query(self, csr, concept_id, id_column, dataset_id, vocabulary_id, concept_class_id, descending):
+        positions, min_levels, max_levels = self._related(csr, concept_id)
+
+        # Filter by the interned codes. A vocabulary or class that isn't in the hierarchy matches no concepts.
+        keep = np.ones(len(positions), dtype=bool)
+        if vocabulary_id is not None:
+            codes = self.concepts.vocabulary_codes[positions]
+            vocabularies = self.concepts.vocabularies
+            keep &= codes == (vocabularies.index(vocabulary_id) if vocabulary_id in vocabularies else -2)
+        if concept_class_id is not None:
+            codes = self.concepts.concept_class_codes[positions]
+            classes = self.concepts.concept_classes
+            keep &= codes == (classes.index(concept_class_id) if concept_class_id in classes else -2)
+
+        # Like the LEFT JOIN on concept_counts, concepts with counts only in other datasets are excluded, and
+        # concepts without counts in any dataset are included with a count of 0
+        dataset_counts = self._counts.get(dataset_id)
+        if dataset_counts is None:
+            counts = np.full(len(positions), -1, dtype=np.int64)
+        else:
+            counts = dataset_counts[positions]
+        keep &= (counts >= 0) | ~self._has_counts[positions]
+        positions, min_levels, max_levels = positions[keep], min_levels[keep], max_levels[keep]
+        counts = np.maximum(counts[keep], 0)
+
+        order = np.lexsort((self.concepts.concept_ids[positions], -counts if descending else counts))
+        order = order[:ConceptHierarchy.MAX_RESULTS]
+
+        results = list()
+        for j in order.tolist():
+            i = int(positions[j])
+            concept = self.concepts._row(i)
+            standard = self.standard_concept_codes[i]
+            results.append({
+                id_column: concept['concept_id'],
+                'min_levels_of_separation': int(min_levels[j]),
+                'max_levels_of_separation': int(max_levels[j]),
+                'concept_name': concept['concept_name'],
+                'domain_id': concept['domain_id'],
+                'vocabulary_id': concept['vocabulary_id'],
+                'concept_class_id': concept['concept_class_id'],
+                'standard_concept': self.standard_concepts[standard] if standard >= 0 else None,
+                'concept_code': concept['concept_code'],
+                'concept_count': int(counts[j]),
+            })
+        return results
+
+    def ancestors(self, concept_id, dataset_id, vocabulary_id=None, concept_class_id=None):
+        """ Ancestors of a concept, same as the conceptAncestors SQL query
+
+        Parameters
+        ----------
+        concept_id: OMOP concept ID (int)
+        dataset_id: COHD dataset ID of the counts
+        vocabulary_id: (optional) only return ancestors from this vocabulary
+        concept_class_id: (optional) only return ancestors of this concept class
+
+        Returns
+        -------
+        List of up to MAX_RESULTS ancestors, sorted by concept_count ascending
+        """
+        return self._query(self._ancestors, concept_id, 'ancestor_concept_id', dataset_id, vocabulary_id,
+                           concept_class_id, descending=False)
+
+    def descendants(self, concept_id, dataset_id, vocabulary_id=None, concept_class_id=None):
+        """ Descendants of a concept, same as the conceptDescendants SQL query
+
+        Parameters
+        ----------
+        concept_id: OMOP concept ID (int)
+        dataset_id: COHD dataset ID of the counts
+        vocabulary_id: (optional) only return descendants from this vocabulary
+        concept_class_id: (optional) only return descendants of this concept class
+
+        Returns
+        -------
+        List of up to MAX_RESULTS descendants, sorted by concept_count descending
+        """
+        return self._query(self._descendants, concept_id, 'descendant_concept_id', dataset_id, vocabulary_id,
+                           concept_class_id, descending=True)
+
+
+def _stream(conn, sql, batch_size):
+    """ Yields the rows (dicts) of a query in batches without buffering the full result """
+    with conn.cursor(pymysql.cursors.SSDictCursor) as cur:
+        cur.execute(sql)
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+
+
+def load_hierarchy(conn, concept_counts, version=None, batch_size=100000):
+    """ Loads the concept_ancestor table and the definitions of its concepts into a ConceptHierarchy
+
+    Parameters
+    ----------
+    conn: connection to the COHD database
+    concept_counts: dict[dataset_id] = (sequence of concept_id, sequence of concept_count)
+    version: version of the data
+    batch_size: number of rows read at a time
+
+    Returns
+    -------
+    ConceptHierarchy
+    """
+    columns = [list(), list(), list(), list()]
+    for rows in _stream(conn, '''SELECT ancestor_concept_id, descendant_concept_id, min_levels_of_separation,
+                max_levels_of_separation
+            FROM concept_ancestor;''', batch_size):
+        columns[0].append(np.array([r['ancestor_concept_id'] for r in rows], dtype=np.int64))
+        columns[1].append(np.array([r['descendant_concept_id'] for r in rows], dtype=np.int64))
+        columns[2].append(np.array([r['min_levels_of_separation'] for r in rows], dtype=np.int16))
+        columns[3].append(np.array([r['max_levels_of_separation'] for r in rows], dtype=np.int16))
+    ancestor_ids, descendant_ids, min_levels, max_levels = [np.concatenate(c) if c else np.zeros(0, dtype=np.int64)
+                                                            for c in columns]
+
+    # Only keep the definitions of the concepts in the hierarchy
+    hierarchy_ids = np.union1d(ancestor_ids, descendant_ids)
+    concept_rows = list()
+    for rows in _stream(conn, '''SELECT concept_id, concept_name, domain_id, vocabulary_id, concept_class_id,
+                concept_code, standard_concept
+            FROM concept;''', batch_size):
+        ids = np.array([r['concept_id'] for r in rows], dtype=np.int64)
+        keep = np.isin(ids, hierarchy_ids)
+        concept_rows.extend(r for r, k in zip(rows, keep.tolist()) if k)
+
+    hierarchy = ConceptHierarchy(ancestor_ids, descendant_ids, min_levels, max_levels, concept_rows, concept_counts,
+                                 version)
+    logging.info(f'Loaded concept hierarchy with {len(ancestor_ids)} relationships between {len(hierarchy)} concepts '
+                 f'(version {version})')
+    return hierarchy
@@ -0,0 +1,176 @@
+import logging
+import os
+import queue
+import threading
+import time
+
+import pymysql
+
+
+class PooledConnection:
+    """
+    Thin proxy around a pymysql connection that belongs to a ConnectionPool. Attribute access is forwarded to the
+    underlying connection. close() hands the connection back to the pool instead of closing the socket, so existing
+    code that follows the conn = sql_connection() ... conn.close() pattern is pooled without changes. The proxy can
+    also be used as a context manager.
+    """
+
+    def __init__(self, pool, conn):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name):
+        conn = self.__dict__.get('_conn')
+        if conn is None:
+            raise pymysql.err.InterfaceError('Connection has already been returned to the pool')
+        return getattr(conn, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """ Returns the connection to the pool. Calling close() more than once is a no-op. """
+        conn = self.__dict__.get('_conn')
+        if conn is not None:
+            self._conn = None
+            self._pool.release(conn)
+
+    def __del__(self):
+        # Safety net for call sites that forget to close
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class ConnectionPool:
+    """
+    Per-process pool of pymysql connections
+
+    Connections are created lazily on first use within each process, so a pool object inherited through fork (e.g.,
+    from the uWSGI master) never shares sockets between workers. Up to `size` idle connections are retained. When
+    the pool is empty, a new connection is opened instead of blocking, because some code paths hold one connection
+    while acquiring another (e.g., query_db -> query_trapi_mcq). Connections that have been idle longer than
+    `ping_interval` seconds are pinged (with reconnect) before being handed out, which recovers from MySQL's
+    wait_timeout closing the socket. Connections idle longer than `max_idle` seconds are discarded.
+    """
+
+    def __init__(self, connect, size=4, ping_interval=30, max_idle=3600):
+        """ Constructor
+
+        Parameters
+        ----------
+        connect: function with no parameters that returns a new pymysql connection
+        size: maximum number of idle connections kept in the pool
+        ping_interval: seconds a connection may sit idle before it is pinged on checkout
+        max_idle: seconds a connection may sit idle before it is closed and replaced
+        """
+        self._connect = connect
+        self.size = size
+        self.ping_interval = ping_interval
+        self.max_idle = max_idle
+        self._lock = threading.Lock()
+        self._pid = None
+        self._idle = None
+
+    def _check_pid(self):
+        """ Discards any connections inherited from a parent process. Must be called with self._lock held. """
+        pid = os.getpid()
+        if self._pid != pid:
+            # Don't close inherited sockets, the parent process may still be using them
+            self._pid = pid
+            self._idle = queue.LifoQueue()
+
+    def acquire(self):
+        """ Checks out a connection, reusing an idle one when possible
+
+        Returns
+        -------
+        PooledConnection
+        """
+        with self._lock:
+            self._check_pid()
+            idle = self._idle
+
+        while True:
+            try:
+                conn, last_used = idle.get_nowait()
+            except queue.Empty:
+                break
+
+            idle_time = time.monotonic() - last_used
+            if idle_time > self.max_idle:
+                ConnectionPool._close_quietly(conn)
+                continue
+            if idle_time > self.ping_interval:
+                try:
+                    conn.ping(reconnect=True)
+                except pymysql.err.MySQLError:
+                    logging.info('Discarding pooled MySQL connection that failed health check')
+                    ConnectionPool._close_quietly(conn)
+                    continue
+            return PooledConnection(self, conn)
+
+        logging.debug(msg='Connecting to MySQL database')
+        return PooledConnection(self, self._connect())
+
+    def connection(self):
+        """ Checks out a connection for use in a with statement. The connection is returned to the pool on exit.
+
+        Returns
+        -------
+        PooledConnection
+        """
+        return self.acquire()
+
+    def release(self, conn):
+        """ Returns a connection to the pool
+
+        Any open transaction is rolled back so that the next user does not see a stale snapshot or uncommitted
+        writes, matching the behavior of closing the connection.
+
+        Parameters
+        ----------
+        conn: pymysql connection
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                # Connection was acquired in a different process
+                return
+            idle = self._idle
+
+        if not conn.open:
+            return
+
+        try:
+            conn.rollback()
+        except pymysql.err.MySQLError:
+            ConnectionPool._close_quietly(conn)
+            return
+
+        if idle.qsize() >= self.size:
+            ConnectionPool._close_quietly(conn)
+        else:
+            idle.put((conn, time.monotonic()))
+
+    def clear(self):
+        """ Closes all idle connections """
+        with self._lock:
+            self._check_pid()
+            idle = self._idle
+        while True:
+            try:
+                conn, _ = idle.get_nowait()
+            except queue.Empty:
+                break
+            ConnectionPool._close_quietly(conn)
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
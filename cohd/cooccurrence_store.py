@@ -0,0 +1,438 @@
+"""
+Memory-mapped compressed sparse row (CSR) store of the concept co-occurrence data of a COHD dataset
+
+The store answers "all associations of concept X" with a slice of the CSR arrays instead of a MySQL query. Each pair
+from concept_pair_counts is stored in both orientations: row i holds the neighbors of concept_ids[i] in
+neighbors[indptr[i]:indptr[i + 1]], sorted by neighbor. The per-pair statistics are stored in the same order as
+float32 columns. The relative frequency CIs are stored from the perspective of the row concept (rf1) and the neighbor
+(rf2). All arrays are .npy files opened with mmap_mode='r', so the uWSGI workers share the pages through the OS page
+cache.
+
+Build a store offline after the statistics have been precomputed (db/precompute_stats/precompute.py):
+    python -m cohd.cooccurrence_store --dataset_id 1 --out /data/cohd_store/1 --mysql_config database.cnf
+or from a snapshot of the database (see snapshot.py):
+    python -m cohd.cooccurrence_store --dataset_id 1 --out /data/cohd_store/1 --snapshot /data/cohd_snapshot/20241030
+and set COOCCURRENCE_STORE_DIR in cohd_flask.conf to /data/cohd_store. Rebuild the store whenever the database is
+reloaded.
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+from datetime import datetime
+
+import numpy as np
+import pymysql
+
+# Version of the file layout. Stores with a different version are ignored.
+FORMAT_VERSION = 1
+
+# Per-pair statistics stored as float32 columns
+STAT_COLUMNS = ['p_value', 'ln_ratio', 'ln_ratio_ci_lo', 'ln_ratio_ci_hi', 'log_odds', 'log_odds_ci_lo',
+                'log_odds_ci_hi', 'rf1_ci_lo', 'rf1_ci_hi', 'rf2_ci_lo', 'rf2_ci_hi']
+
+# Statistics read from concept_pair_counts (the relative frequency CIs are derived from the pair and concept CIs)
+_PAIR_STAT_COLUMNS = ['p_value', 'ln_ratio', 'ln_ratio_ci_lo', 'ln_ratio_ci_hi', 'log_odds', 'log_odds_ci_lo',
+                      'log_odds_ci_hi', 'pair_count_ci_lo', 'pair_count_ci_hi']
+
+
+class CooccurrenceStore:
+    """ Read-only view of a co-occurrence store directory """
+
+    def __init__(self, path):
+        """ Constructor
+
+        Parameters
+        ----------
+        path: directory created by build_store
+        """
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta.get('format_version') != FORMAT_VERSION:
+            raise ValueError(f'Unsupported co-occurrence store format in {path}: {self.meta.get("format_version")}')
+        self.dataset_id = self.meta['dataset_id']
+        self.patient_count = self.meta['patient_count']
+        self.total_pair_count = self.meta['total_pair_count']
+        self.domains = self.meta['domains']
+        self.concept_classes = self.meta['concept_classes']
+
+        def _load(name):
+            return np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+
+        # Per-concept arrays
+        self.concept_ids = _load('concept_ids')
+        self.concept_counts = _load('concept_counts')
+        self.concept_domains = _load('concept_domains')
+        self.concept_classes_idx = _load('concept_classes')
+        self.concept_name_offsets = _load('concept_name_offsets')
+        self.concept_names = _load('concept_names')
+
+        # CSR arrays
+        self.indptr = _load('indptr')
+        self.neighbors = _load('neighbors')
+        self.pair_counts = _load('pair_counts')
+        self.stats = {c: _load(c) for c in STAT_COLUMNS}
+
+    def concept_index(self, concept_id):
+        """ Row of a concept in the store, or None if the concept has no counts in the dataset """
+        i = int(np.searchsorted(self.concept_ids, concept_id))
+        if i < len(self.concept_ids) and self.concept_ids[i] == concept_id:
+            return i
+        return None
+
+    def concept_name(self, i):
+        """ Name of the concept in row i """
+        start, end = self.concept_name_offsets[i], self.concept_name_offsets[i + 1]
+        return bytes(self.concept_names[start:end]).decode('utf-8')
+
+    def _code(self, values, value):
+        # Index of a domain or concept class in the store's vocabulary, or -2 (never matches) if absent
+        try:
+            return values.index(value)
+        except ValueError:
+            return -2
+
+    def associations(self, concept_id, neighbor_ids=None, domain_class_pairs=None, ln_ratio_sign=0,
+                     include_concept_2=True):
+        """ Gets the associations of a concept as query_trapi result rows
+
+        Parameters
+        ----------
+        concept_id: OMOP concept ID
+        neighbor_ids: (optional) restrict the associated concepts to these OMOP concept IDs
+        domain_class_pairs: (optional) list of (domain_id, concept_class_id). The associated concept must match at
+                            least one pair. None in either position matches any value.
+        ln_ratio_sign: 1: positive ln_ratio only; -1: negative ln_ratio only; 0: any ln_ratio
+        include_concept_2: True to include the name, domain, and class of the associated concept
+
+        Returns
+        -------
+        List of result rows (dicts) sorted by ABS(ln_ratio) descending
+        """
+        i = self.concept_index(concept_id)
+        if i is None:
+            return list()
+        start, end = int(self.indptr[i]), int(self.indptr[i + 1])
+        nbr = np.asarray(self.neighbors[start:end])
+        mask = np.ones(len(nbr), dtype=bool)
+
+        if neighbor_ids is not None:
+            # Neighbors are sorted within the row, so look up the requested concepts by binary search
+            mask[:] = False
+            nbr_ids = self.concept_ids[nbr]
+            wanted = np.unique(np.asarray(neighbor_ids, dtype=np.int64))
+            pos = np.searchsorted(nbr_ids, wanted)
+            pos = pos[pos < len(nbr_ids)]
+            mask[pos[np.isin(nbr_ids[pos], wanted)]] = True
+
+        if include_concept_2:
+            # Associated concepts missing from the concept table are excluded (as in the MySQL queries)
+            mask &= self.concept_domains[nbr] >= 0
+
+        if domain_class_pairs:
+            domains = self.concept_domains[nbr]
+            classes = self.concept_classes_idx[nbr]
+            dc_mask = np.zeros(len(nbr), dtype=bool)
+            for domain_id, concept_class_id in domain_class_pairs:
+                m = np.ones(len(nbr), dtype=bool)
+                if domain_id is not None:
+                    m &= domains == self._code(self.domains, domain_id)
+                if concept_class_id is not None:
+                    m &= classes == self._code(self.concept_classes, concept_class_id)
+                dc_mask |= m
+            mask &= dc_mask
+
+        ln_ratio = np.asarray(self.stats['ln_ratio'][start:end], dtype=np.float64)
+        if ln_ratio_sign > 0:
+            mask &= ln_ratio > 0
+        elif ln_ratio_sign < 0:
+            mask &= ln_ratio < 0
+
+        sel = np.flatnonzero(mask)
+        if len(sel) == 0:
+            return list()
+        sel = sel[np.argsort(-np.abs(ln_ratio[sel]), kind='stable')]
+        idx = start + sel
+        nbr = nbr[sel]
+
+        c1 = float(self.concept_counts[i])
+        c2 = self.concept_counts[nbr].astype(np.float64)
+        pair = self.pair_counts[idx].astype(np.float64)
+        columns = {
+            'concept_id_2': self.concept_ids[nbr].tolist(),
+            'concept_2_count': self.concept_counts[nbr].tolist(),
+            'concept_pair_count': self.pair_counts[idx].tolist(),
+            'expected_count': (c1 * c2 / self.patient_count).tolist(),
+            'relative_frequency_1': (pair / c1).tolist(),
+            'relative_frequency_2': (pair / c2).tolist(),
+        }
+        for c in STAT_COLUMNS:
+            columns[c] = self.stats[c][idx].astype(np.float64).tolist()
+        if include_concept_2:
+            columns['concept_2_name'] = [self.concept_name(j) for j in nbr.tolist()]
+            columns['concept_2_domain'] = [self.domains[j] for j in self.concept_domains[nbr].tolist()]
+            columns['concept_2_class_id'] = [self.concept_classes[j] if j >= 0 else None
+                                             for j in self.concept_classes_idx[nbr].tolist()]
+
+        constant = {
+            'dataset_id': self.dataset_id,
+            'concept_id_1': int(concept_id),
+            'concept_1_count': int(self.concept_counts[i]),
+            'patient_count': self.patient_count,
+        }
+        names = list(columns.keys())
+        return [dict(constant, **dict(zip(names, values))) for values in zip(*columns.values())]
+
+
+def open_store(root, dataset_id):
+    """ Opens the store of a dataset
+
+    Parameters
+    ----------
+    root: directory with one store subdirectory per dataset_id
+    dataset_id: COHD dataset ID
+
+    Returns
+    -------
+    CooccurrenceStore, or None if the dataset has no (valid) store
+    """
+    path = os.path.join(root, str(dataset_id))
+    if not os.path.isfile(os.path.join(path, 'meta.json')):
+        return None
+    try:
+        return CooccurrenceStore(path)
+    except (OSError, ValueError, KeyError) as e:
+        logging.warning(f'Unable to open co-occurrence store {path}: {e}')
+        return None
+
+
+def _fetch_columns(conn, sql, params, dtypes, batch_size=100000):
+    """ Streams a query into numpy arrays
+
+    Parameters
+    ----------
+    conn: pymysql connection
+    sql: SQL query
+    params: SQL parameters
+    dtypes: numpy dtype of each selected column
+
+    Returns
+    -------
+    List of numpy arrays, one per column
+    """
+    chunks = [list() for _ in dtypes]
+    with conn.cursor(pymysql.cursors.SSCursor) as cur:
+        cur.execute(sql, params)
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            for j, column in enumerate(zip(*rows)):
+                chunks[j].append(np.array([np.nan if v is None and np.dtype(dtypes[j]).kind == 'f' else v
+                                           for v in column], dtype=dtypes[j]))
+    return [np.concatenate(c) if c else np.zeros(0, dtype=t) for c, t in zip(chunks, dtypes)]
+
+
+def build_store(conn, dataset_id, path):
+    """ Exports the co-occurrence data of a dataset from MySQL into a store directory
+
+    Parameters
+    ----------
+    conn: pymysql connection to the COHD database
+    dataset_id: COHD dataset ID
+    path: store directory
+    """
+    params = {'dataset_id': dataset_id}
+
+    with conn.cursor(pymysql.cursors.Cursor) as cur:
+        cur.execute('SELECT count FROM cohd.patient_count WHERE dataset_id = %(dataset_id)s;', params)
+        patient_count = int(cur.fetchone()[0])
+        cur.execute('SELECT SUM(count) FROM cohd.domain_pair_concept_counts WHERE dataset_id = %(dataset_id)s;',
+                    params)
+        total_pair_count = int(cur.fetchone()[0])
+
+    logging.info(f'Exporting the concepts of dataset {dataset_id}')
+    sql = '''SELECT cc.concept_id, cc.concept_count, cc.ci_lo, cc.ci_hi, c.domain_id, c.concept_class_id,
+            c.concept_name
+        FROM cohd.concept_counts cc
+        LEFT JOIN cohd.concept c ON cc.concept_id = c.concept_id
+        WHERE cc.dataset_id = %(dataset_id)s;'''
+    concept_columns = ['concept_id', 'concept_count', 'ci_lo', 'ci_hi', 'domain_id', 'concept_class_id',
+                       'concept_name']
+    concepts = dict(zip(concept_columns, _fetch_columns(
+        conn, sql, params, [np.int64, np.int64, np.float64, np.float64, object, object, object])))
+
+    logging.info(f'Exporting the concept pairs of dataset {dataset_id}')
+    sql = '''SELECT concept_id_1, concept_id_2, concept_count, {stats}
+        FROM cohd.concept_pair_counts
+        WHERE dataset_id = %(dataset_id)s;'''.format(stats=', '.join(_PAIR_STAT_COLUMNS))
+    pair_columns = ['concept_id_1', 'concept_id_2', 'concept_count'] + _PAIR_STAT_COLUMNS
+    pairs = dict(zip(pair_columns, _fetch_columns(
+        conn, sql, params, [np.int64, np.int64, np.int64] + [np.float64] * len(_PAIR_STAT_COLUMNS))))
+
+    write_store(path, dataset_id, patient_count, total_pair_count, concepts, pairs)
+
+
+def build_store_from_snapshot(snapshot, dataset_id, path):
+    """ Builds the store of a dataset from a snapshot of the database
+
+    Parameters
+    ----------
+    snapshot: snapshot.Snapshot
+    dataset_id: COHD dataset ID
+    path: store directory
+    """
+    concepts = snapshot.columns('concept_counts', dataset_id)
+    definitions = snapshot.columns('concept', columns=['concept_id', 'domain_id', 'concept_class_id', 'concept_name'])
+
+    # Left join the concept definitions
+    definition_ids = definitions['concept_id']
+    order = np.argsort(definition_ids, kind='stable')
+    rows = order[np.minimum(np.searchsorted(definition_ids, concepts['concept_id'], sorter=order), len(order) - 1)]
+    found = (definition_ids[rows] == concepts['concept_id']).tolist()
+    for c in ['domain_id', 'concept_class_id', 'concept_name']:
+        concepts[c] = [v if f else None for v, f in zip(definitions[c][rows].tolist(), found)]
+
+    pairs = snapshot.columns('concept_pair_counts', dataset_id)
+    write_store(path, dataset_id, snapshot.patient_count(dataset_id), snapshot.total_pair_count(dataset_id),
+                concepts, pairs)
+
+
+def write_store(path, dataset_id, patient_count, total_pair_count, concepts, pairs):
+    """ Writes a store directory
+
+    The store is written to a temporary directory, which then replaces path, so a running API never sees a partially
+    written store.
+
+    Parameters
+    ----------
+    path: store directory
+    dataset_id: COHD dataset ID
+    patient_count: number of patients in the dataset
+    total_pair_count: number of concept pairs in the dataset (Bonferroni denominator)
+    concepts: dict of equal length sequences with the columns concept_id, concept_count, ci_lo, ci_hi, domain_id,
+              concept_class_id, and concept_name (None for concepts missing from the concept table)
+    pairs: dict of equal length sequences with the columns concept_id_1, concept_id_2, concept_count, and the
+           statistics in _PAIR_STAT_COLUMNS. Each pair is listed once.
+    """
+    # Concepts, sorted by concept_id
+    concept_order = np.argsort(np.asarray(concepts['concept_id'], dtype=np.int64), kind='stable')
+    concept_ids = np.asarray(concepts['concept_id'], dtype=np.int64)[concept_order]
+    concept_counts = np.asarray(concepts['concept_count'], dtype=np.int64)[concept_order]
+    ci_lo = np.asarray(concepts['ci_lo'], dtype=np.float64)[concept_order]
+    ci_hi = np.asarray(concepts['ci_hi'], dtype=np.float64)[concept_order]
+    domain_ids = [concepts['domain_id'][j] for j in concept_order]
+    class_ids = [concepts['concept_class_id'][j] for j in concept_order]
+    names = [concepts['concept_name'][j] for j in concept_order]
+
+    domains = sorted({d for d in domain_ids if d is not None})
+    concept_classes = sorted({c for c in class_ids if c is not None})
+    domain_codes = {d: i for i, d in enumerate(domains)}
+    class_codes = {c: i for i, c in enumerate(concept_classes)}
+    concept_domains = np.array([domain_codes.get(d, -1) for d in domain_ids], dtype=np.int16)
+    concept_classes_idx = np.array([class_codes.get(c, -1) for c in class_ids], dtype=np.int16)
+    encoded_names = [(n or '').encode('utf-8') for n in names]
+    concept_name_offsets = np.zeros(len(encoded_names) + 1, dtype=np.int64)
+    np.cumsum([len(n) for n in encoded_names], out=concept_name_offsets[1:])
+    concept_names = np.frombuffer(b''.join(encoded_names), dtype=np.uint8)
+
+    # Map concept IDs to rows. Pairs with a concept missing from concept_counts are dropped (as in the MySQL joins).
+    id_1 = np.asarray(pairs['concept_id_1'], dtype=np.int64)
+    id_2 = np.asarray(pairs['concept_id_2'], dtype=np.int64)
+    n_concepts = len(concept_ids)
+    if n_concepts:
+        row_1 = np.minimum(np.searchsorted(concept_ids, id_1), n_concepts - 1)
+        row_2 = np.minimum(np.searchsorted(concept_ids, id_2), n_concepts - 1)
+        keep = (concept_ids[row_1] == id_1) & (concept_ids[row_2] == id_2)
+    else:
+        row_1 = row_2 = np.zeros(len(id_1), dtype=np.int64)
+        keep = np.zeros(len(id_1), dtype=bool)
+    if not keep.all():
+        logging.warning(f'Dropping {np.count_nonzero(~keep)} pairs with concepts missing from concept_counts')
+    row_1, row_2 = row_1[keep], row_2[keep]
+    pair_counts = np.asarray(pairs['concept_count'], dtype=np.int64)[keep]
+    pair_stats = {c: np.asarray(pairs[c], dtype=np.float64)[keep] for c in _PAIR_STAT_COLUMNS}
+
+    # Both orientations, sorted by (row, neighbor)
+    rows = np.concatenate([row_1, row_2])
+    neighbors = np.concatenate([row_2, row_1])
+    order = np.lexsort((neighbors, rows))
+    rows = rows[order]
+    neighbors = neighbors[order]
+    indptr = np.zeros(n_concepts + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n_concepts), out=indptr[1:])
+
+    tmp_path = f'{path}.building'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    def _save(name, array):
+        np.save(os.path.join(tmp_path, f'{name}.npy'), array)
+
+    def _both(values):
+        # Values of each entry of the CSR arrays, given the values of each pair
+        return np.concatenate([values, values])[order]
+
+    _save('concept_ids', concept_ids)
+    _save('concept_counts', concept_counts)
+    _save('concept_domains', concept_domains)
+    _save('concept_classes', concept_classes_idx)
+    _save('concept_name_offsets', concept_name_offsets)
+    _save('concept_names', concept_names)
+    _save('indptr', indptr)
+    _save('neighbors', neighbors.astype(np.int32))
+    _save('pair_counts', _both(pair_counts).astype(np.int32))
+
+    # The statistics are symmetric in the two concepts. The relative frequency CIs divide the pair count CI by the
+    # concept count CI of the row concept (rf1) or the neighbor (rf2).
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for c in _PAIR_STAT_COLUMNS[:7]:
+            _save(c, _both(pair_stats[c]).astype(np.float32))
+        pair_ci_lo = _both(pair_stats['pair_count_ci_lo'])
+        pair_ci_hi = _both(pair_stats['pair_count_ci_hi'])
+        _save('rf1_ci_lo', (pair_ci_lo / ci_hi[rows]).astype(np.float32))
+        _save('rf1_ci_hi', (pair_ci_hi / ci_lo[rows]).astype(np.float32))
+        _save('rf2_ci_lo', (pair_ci_lo / ci_hi[neighbors]).astype(np.float32))
+        _save('rf2_ci_hi', (pair_ci_hi / ci_lo[neighbors]).astype(np.float32))
+
+    meta = {
+        'format_version': FORMAT_VERSION,
+        'dataset_id': int(dataset_id),
+        'patient_count': int(patient_count),
+        'total_pair_count': int(total_pair_count),
+        'n_concepts': int(n_concepts),
+        'n_entries': int(len(neighbors)),
+        'domains': domains,
+        'concept_classes': concept_classes,
+        'built': datetime.now().isoformat(),
+    }
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    # Swap in the new store
+    old_path = f'{path}.old'
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(path):
+        os.rename(path, old_path)
+    os.rename(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    logging.info(f'Wrote co-occurrence store for dataset {dataset_id} to {path}: {n_concepts} concepts, '
+                 f'{len(neighbors)} entries')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Builds the co-occurrence store of a COHD dataset')
+    parser.add_argument('--dataset_id', type=int, required=True)
+    parser.add_argument('--out', required=True, help='Store directory, e.g., /data/cohd_store/1')
+    parser.add_argument('--mysql_config', default='database.cnf', help='MySQL option file')
+    parser.add_argument('--snapshot', help='Build from this snapshot directory (see snapshot.py) instead of MySQL')
+    a = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if a.snapshot:
+        from .snapshot import Snapshot
+        build_store_from_snapshot(Snapshot(a.snapshot), a.dataset_id, a.out)
+    else:
+        with pymysql.connect(read_default_file=a.mysql_config, charset='utf8mb4') as connection:
+            build_store(connection, a.dataset_id, a.out)
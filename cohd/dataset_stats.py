@@ -0,0 +1,195 @@
+import logging
+import threading
+import time
+from typing import NamedTuple
+
+
+class DatasetStatsSnapshot(NamedTuple):
+    """ Immutable set of per-dataset constants. Dicts are keyed by dataset_id. """
+    version: int
+    patient_counts: dict  # dataset_id -> number of patients
+    total_pair_counts: dict  # dataset_id -> number of concept pairs (Bonferroni denominator)
+    domain_counts: dict  # dataset_id -> tuple of (domain_id, number of concepts)
+    domain_pair_counts: dict  # dataset_id -> tuple of (domain_id_1, domain_id_2, number of concept pairs)
+
+
+class DatasetStats:
+    """
+    Per-process cache of the per-dataset constants used by every query: patient counts, total concept pair counts,
+    and the domain and domain pair concept counts
+
+    The constants are loaded together into an immutable snapshot. Readers use the current snapshot without locking.
+    After `refresh_interval` seconds, the next reader reloads the constants while concurrent readers keep using the
+    previous snapshot. The snapshot's version is incremented whenever the reloaded constants differ, so that callers
+    can tell when the database has been reloaded. If a reload fails, the previous snapshot is kept and the reload is
+    retried after another interval.
+    """
+
+    def __init__(self, load, refresh_interval=3600):
+        """ Constructor
+
+        Parameters
+        ----------
+        load: function with no parameters that returns a dict with keys patient_counts, total_pair_counts,
+              domain_counts, and domain_pair_counts (see DatasetStatsSnapshot)
+        refresh_interval: seconds before the constants are reloaded. None to never reload automatically.
+        """
+        self._load = load
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._expires = 0.0
+
+    def snapshot(self):
+        """ Gets the current constants, loading them on first use and reloading them when they have expired
+
+        Returns
+        -------
+        DatasetStatsSnapshot
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            # Nothing to serve yet, wait for the first load
+            with self._lock:
+                if self._snapshot is None:
+                    self._reload()
+                return self._snapshot
+
+        if self.refresh_interval is not None and time.monotonic() > self._expires:
+            # Only one thread reloads, the others keep using the current snapshot
+            if self._lock.acquire(blocking=False):
+                try:
+                    if time.monotonic() > self._expires:
+                        self._reload()
+                except Exception:
+                    logging.exception('Failed to reload dataset stats. Using the previous values.')
+                    self._expires = time.monotonic() + self.refresh_interval
+                finally:
+                    self._lock.release()
+            return self._snapshot
+
+        return snapshot
+
+    def refresh(self):
+        """ Reloads the constants now
+
+        Returns
+        -------
+        DatasetStatsSnapshot
+        """
+        with self._lock:
+            self._reload()
+            return self._snapshot
+
+    def _reload(self):
+        """ Loads the constants. Must be called with self._lock held. """
+        stats = self._load()
+        previous = self._snapshot
+        if previous is None:
+            snapshot = DatasetStatsSnapshot(version=1, **stats)
+        else:
+            snapshot = DatasetStatsSnapshot(version=previous.version, **stats)
+            if snapshot != previous:
+                snapshot = snapshot._replace(version=previous.version + 1)
+                logging.info(f'Dataset stats changed (version {snapshot.version})')
+            else:
+                # Keep the previous snapshot so that readers holding it see identical objects
+                snapshot = previous
+        self._snapshot = snapshot
+        if self.refresh_interval is not None:
+            self._expires = time.monotonic() + self.refresh_interval
+
+    @property
+    def version(self):
+        """ Version of the current constants """
+        return self.snapshot().version
+
+    def patient_count(self, dataset_id):
+        """ Number of patients in the dataset, or None if the dataset is unknown """
+        return self.snapshot().patient_counts.get(dataset_id)
+
+    def total_pair_count(self, dataset_id):
+        """ Number of concept pairs in the dataset, or None if the dataset is unknown """
+        return self.snapshot().total_pair_counts.get(dataset_id)
+
+    def domain_counts(self, dataset_id):
+        """ Tuple of (domain_id, number of concepts) in the dataset """
+        return self.snapshot().domain_counts.get(dataset_id, ())
+
+    def domain_pair_counts(self, dataset_id):
+        """ Tuple of (domain_id_1, domain_id_2, number of concept pairs) in the dataset """
+        return self.snapshot().domain_pair_counts.get(dataset_id, ())
+
+    def clear(self):
+        """ Discards the cached constants. They are loaded again on next use. """
+        with self._lock:
+            self._snapshot = None
+            self._expires = 0.0
+
+
+class VersionedIndex:
+    """
+    In-process index built from the database (e.g., the concept dictionary) that is reloaded when its version, usually
+    the dataset stats version, changes
+
+    Readers use the current index without locking. The first reader waits for the index to load. After the version
+    changes, the next reader reloads the index while concurrent readers keep using the previous one. If a load fails,
+    the previous index (if any) is kept and the load is not retried for `retry_interval` seconds, so that readers go
+    straight to their fallback instead of each waiting for another failed load.
+    """
+
+    def __init__(self, name, load, version, retry_interval=300):
+        """ Constructor
+
+        Parameters
+        ----------
+        name: name of the index in log messages
+        load: function with a version parameter that returns the index. The index must have a version attribute.
+        version: function with no parameters that returns the current version
+        retry_interval: seconds before a failed load is retried
+        """
+        self.name = name
+        self._load = load
+        self._version = version
+        self.retry_interval = retry_interval
+        self._lock = threading.Lock()
+        self._index = None
+        self._retry_after = 0.0
+
+    def get(self):
+        """ Gets the index, loading it on first use and reloading it when the version changes
+
+        Returns
+        -------
+        The index, or None if it could not be loaded
+        """
+        index = self._index
+        try:
+            version = self._version()
+        except Exception:
+            logging.exception(f'Unable to check the version of the {self.name}')
+            return index
+
+        if index is not None and index.version == version:
+            return index
+        if time.monotonic() < self._retry_after:
+            return index
+
+        # Wait for the first load. Later reloads are done by one thread while the others use the previous index.
+        if not self._lock.acquire(blocking=index is None):
+            return index
+        try:
+            if (self._index is None or self._index.version != version) and time.monotonic() >= self._retry_after:
+                self._index = self._load(version)
+        except Exception:
+            logging.exception(f'Unable to load the {self.name}')
+            self._retry_after = time.monotonic() + self.retry_interval
+        finally:
+            self._lock.release()
+        return self._index
+
+    def clear(self):
+        """ Discards the index and any pending retry interval. The index is loaded again on next use. """
+        with self._lock:
+            self._index = None
+            self._retry_after = 0.0
@@ -0,0 +1,295 @@
+"""
+Bloom filter over the concept pairs of a COHD dataset
+
+COHD only stores pairs above the count threshold, so most pairwise probes (pairedConceptFreq, TRAPI queries with IDs on
+both nodes) are for pairs that don't exist. The filter answers "may this pair exist?" without a SQL query: a negative
+answer is always correct, and a positive answer is wrong with probability close to the false positive rate chosen
+when the filter was built. Pairs are canonicalized as (min, max), so the order of the concepts doesn't matter.
+
+The bits are stored as an .npy file opened with mmap_mode='r', so the uWSGI workers share the pages through the OS page
+cache. Build a filter offline for each dataset:
+    python -m cohd.pair_filter --dataset_id 1 --out /data/cohd_pair_filter --mysql_config database.cnf
+and set PAIR_FILTER_DIR in cohd_flask.conf to /data/cohd_pair_filter. A filter records the patient and pair counts of
+the dataset it was built from. The API doesn't use a filter whose counts differ from the database's, since pairs
+missing from a stale filter would be reported as absent, so rebuild the filters whenever the database is reloaded.
+"""
+import argparse
+import json
+import logging
+import math
+import os
+
+import numpy as np
+import pymysql
+
+# Version of the file layout. Filters with a different version are ignored.
+FORMAT_VERSION = 2
+
+_MASK_32 = np.uint64(0xFFFFFFFF)
+_MASK_64 = 0xFFFFFFFFFFFFFFFF
+
+
+def _splitmix64(x):
+    """ SplitMix64 finalizer. Mixes each uint64 so that all bits of the output depend on all bits of the input. """
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+class PairFilter:
+    """
+    Bloom filter over canonical (min, max) concept pairs
+
+    Each pair is hashed once with SplitMix64. The k bit positions are derived from the two 32-bit halves of the hash
+    by double hashing (h1 + i * h2), so lookups are vectorized over both pairs and hash functions.
+    """
+
+    def __init__(self, bits, n_bits, n_hashes, n_items=0, false_positive_rate=None, patient_count=None,
+                 total_pair_count=None):
+        """ Constructor
+
+        Parameters
+        ----------
+        bits: uint8 array of ceil(n_bits / 8) bytes
+        n_bits: number of bits in the filter
+        n_hashes: number of bit positions per pair
+        n_items: number of pairs added
+        false_positive_rate: false positive rate the filter was sized for
+        patient_count: number of patients in the dataset the filter was built from
+        total_pair_count: number of concept pairs in the dataset the filter was built from (as in dataset_stats)
+        """
+        self.bits = bits
+        self.n_bits = int(n_bits)
+        self.n_hashes = int(n_hashes)
+        self.n_items = int(n_items)
+        self.false_positive_rate = false_positive_rate
+        self.patient_count = patient_count
+        self.total_pair_count = total_pair_count
+
+    @staticmethod
+    def parameters(n_items, false_positive_rate):
+        """ Optimal number of bits and hash functions for a Bloom filter
+
+        Parameters
+        ----------
+        n_items: expected number of pairs
+        false_positive_rate: target false positive rate, e.g., 0.01
+
+        Returns
+        -------
+        (n_bits, n_hashes)
+        """
+        n_items = max(int(n_items), 1)
+        n_bits = max(int(math.ceil(-n_items * math.log(false_positive_rate) / (math.log(2) ** 2))), 8)
+        n_hashes = max(int(round(n_bits / n_items * math.log(2))), 1)
+        return n_bits, n_hashes
+
+    @staticmethod
+    def create(n_items, false_positive_rate=0.01):
+        """ Creates an empty filter sized for n_items pairs at the false positive rate
+
+        Returns
+        -------
+        PairFilter
+        """
+        n_bits, n_hashes = PairFilter.parameters(n_items, false_positive_rate)
+        return PairFilter(np.zeros((n_bits + 7) // 8, dtype=np.uint8), n_bits, n_hashes,
+                          false_positive_rate=false_positive_rate)
+
+    def _positions(self, concept_ids_1, concept_ids_2):
+        """ Bit positions of each pair. Returns an (n_pairs, n_hashes) uint64 array. """
+        ids_1 = np.atleast_1d(np.asarray(concept_ids_1, dtype=np.int64))
+        ids_2 = np.atleast_1d(np.asarray(concept_ids_2, dtype=np.int64))
+        lo = np.minimum(ids_1, ids_2).astype(np.uint64)
+        hi = np.maximum(ids_1, ids_2).astype(np.uint64)
+        h = _splitmix64((lo << np.uint64(32)) ^ hi)
+        h1 = h & _MASK_32
+        h2 = (h >> np.uint64(32)) | np.uint64(1)
+        i = np.arange(self.n_hashes, dtype=np.uint64)
+        return (h1[:, None] + i[None, :] * h2[:, None]) % np.uint64(self.n_bits)
+
+    def add(self, concept_ids_1, concept_ids_2):
+        """ Adds pairs to the filter
+
+        Parameters
+        ----------
+        concept_ids_1: sequence of OMOP concept IDs
+        concept_ids_2: sequence of OMOP concept IDs, same length as concept_ids_1
+        """
+        positions = self._positions(concept_ids_1, concept_ids_2).ravel()
+        np.bitwise_or.at(self.bits, positions >> np.uint64(3),
+                         np.left_shift(1, positions & np.uint64(7)).astype(np.uint8))
+        self.n_items += len(np.atleast_1d(concept_ids_1))
+
+    def contains(self, concept_ids_1, concept_ids_2):
+        """ Checks which pairs may be in the filter
+
+        Parameters
+        ----------
+        concept_ids_1: sequence of OMOP concept IDs
+        concept_ids_2: sequence of OMOP concept IDs, same length as concept_ids_1
+
+        Returns
+        -------
+        bool array: False if the pair is definitely absent, True if it may be present
+        """
+        positions = self._positions(concept_ids_1, concept_ids_2)
+        set_bits = (self.bits[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1
+        return set_bits.all(axis=1)
+
+    def matches(self, patient_count, total_pair_count):
+        """ Checks if the filter was built from a dataset with these counts. A filter built before the dataset was
+        reloaded may be missing pairs, which it would report as absent.
+
+        Parameters
+        ----------
+        patient_count: current number of patients in the dataset
+        total_pair_count: current number of concept pairs in the dataset
+
+        Returns
+        -------
+        True if the counts are the ones the filter was built from
+        """
+        return self.patient_count == patient_count and self.total_pair_count == total_pair_count
+
+    def __contains__(self, pair):
+        # Single pair lookup in plain Python, which avoids the overhead of small numpy arrays. Same positions as
+        # _positions.
+        lo, hi = sorted((int(pair[0]), int(pair[1])))
+        h = ((lo << 32) ^ hi) & _MASK_64
+        h = (h + 0x9E3779B97F4A7C15) & _MASK_64
+        h = ((h ^ (h >> 30)) * 0xBF58476D1CE4E5B9) & _MASK_64
+        h = ((h ^ (h >> 27)) * 0x94D049BB133111EB) & _MASK_64
+        h ^= h >> 31
+        h1 = h & 0xFFFFFFFF
+        h2 = (h >> 32) | 1
+        bits = self.bits
+        for i in range(self.n_hashes):
+            position = ((h1 + i * h2) & _MASK_64) % self.n_bits
+            if not (bits[position >> 3] >> (position & 7)) & 1:
+                return False
+        return True
+
+    def save(self, root, dataset_id):
+        """ Saves the filter as <root>/<dataset_id>.npy with its parameters in <root>/<dataset_id>.json
+
+        Parameters
+        ----------
+        root: directory with one filter per dataset_id
+        dataset_id: COHD dataset ID
+        """
+        os.makedirs(root, exist_ok=True)
+        bits_file = os.path.join(root, f'{dataset_id}.npy')
+        meta_file = os.path.join(root, f'{dataset_id}.json')
+
+        # Write to temporary files and swap them in, since the workers may have the current bits memory-mapped
+        # (overwriting them in place can crash the workers with SIGBUS)
+        with open(f'{bits_file}.building', 'wb') as f:
+            np.save(f, np.asarray(self.bits))
+        meta = {
+            'format_version': FORMAT_VERSION,
+            'dataset_id': dataset_id,
+            'n_bits': self.n_bits,
+            'n_hashes': self.n_hashes,
+            'n_items': self.n_items,
+            'false_positive_rate': self.false_positive_rate,
+            'patient_count': self.patient_count,
+            'total_pair_count': self.total_pair_count,
+        }
+        with open(f'{meta_file}.building', 'w') as f:
+            json.dump(meta, f, indent=2)
+
+        # The filter is only opened when its parameters exist. Remove the current parameters before replacing the bits
+        # and swap in the new parameters last, so the bits are never opened with the parameters of another filter.
+        if os.path.exists(meta_file):
+            os.remove(meta_file)
+        os.replace(f'{bits_file}.building', bits_file)
+        os.replace(f'{meta_file}.building', meta_file)
+
+
+def open_filter(root, dataset_id):
+    """ Opens the pair filter of a dataset
+
+    Parameters
+    ----------
+    root: directory with one filter per dataset_id
+    dataset_id: COHD dataset ID
+
+    Returns
+    -------
+    PairFilter, or None if the dataset has no (valid) filter
+    """
+    meta_file = os.path.join(root, f'{dataset_id}.json')
+    if not os.path.isfile(meta_file):
+        return None
+    try:
+        with open(meta_file) as f:
+            meta = json.load(f)
+        if meta['format_version'] != FORMAT_VERSION:
+            raise ValueError(f'format version {meta["format_version"]} is not supported')
+        bits = np.load(os.path.join(root, f'{dataset_id}.npy'), mmap_mode='r')
+        if len(bits) * 8 < meta['n_bits']:
+            raise ValueError('bit array is too short')
+        return PairFilter(bits, meta['n_bits'], meta['n_hashes'], meta['n_items'], meta.get('false_positive_rate'),
+                          meta['patient_count'], meta['total_pair_count'])
+    except (OSError, ValueError, KeyError) as e:
+        logging.warning(f'Unable to open pair filter {meta_file}: {e}')
+        return None
+
+
+def build_filter(conn, dataset_id, false_positive_rate=0.01, batch_size=100000):
+    """ Builds the pair filter of a dataset from concept_pair_counts
+
+    Parameters
+    ----------
+    conn: pymysql connection to the COHD database
+    dataset_id: COHD dataset ID
+    false_positive_rate: target false positive rate
+    batch_size: number of pairs read at a time
+
+    Returns
+    -------
+    PairFilter
+    """
+    params = {'dataset_id': dataset_id}
+    with conn.cursor(pymysql.cursors.Cursor) as cur:
+        cur.execute('SELECT COUNT(*) FROM cohd.concept_pair_counts WHERE dataset_id = %(dataset_id)s;', params)
+        n_pairs = int(cur.fetchone()[0])
+
+        # The counts that the API checks the filter against (see query_cohd_mysql.dataset_stats)
+        cur.execute('SELECT count FROM cohd.patient_count WHERE dataset_id = %(dataset_id)s;', params)
+        row = cur.fetchone()
+        patient_count = int(row[0]) if row is not None else None
+        cur.execute('SELECT SUM(count) FROM cohd.domain_pair_concept_counts WHERE dataset_id = %(dataset_id)s;',
+                    params)
+        row = cur.fetchone()
+        total_pair_count = int(row[0]) if row is not None and row[0] is not None else None
+
+    logging.info(f'Building the pair filter of dataset {dataset_id} ({n_pairs} pairs)')
+    pair_filter = PairFilter.create(n_pairs, false_positive_rate)
+    pair_filter.patient_count = patient_count
+    pair_filter.total_pair_count = total_pair_count
+    with conn.cursor(pymysql.cursors.SSCursor) as cur:
+        cur.execute('''SELECT concept_id_1, concept_id_2
+            FROM cohd.concept_pair_counts
+            WHERE dataset_id = %(dataset_id)s;''', params)
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            pairs = np.array(rows, dtype=np.int64)
+            pair_filter.add(pairs[:, 0], pairs[:, 1])
+    return pair_filter
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Builds the pair filter of a COHD dataset')
+    parser.add_argument('--dataset_id', type=int, required=True)
+    parser.add_argument('--out', required=True, help='Filter directory, e.g., /data/cohd_pair_filter')
+    parser.add_argument('--false_positive_rate', type=float, default=0.01)
+    parser.add_argument('--mysql_config', default='database.cnf', help='MySQL option file')
+    a = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    with pymysql.connect(read_default_file=a.mysql_config, charset='utf8mb4') as connection:
+        build_filter(connection, a.dataset_id, a.false_positive_rate).save(a.out, a.dataset_id)
@@ -0,0 +1,97 @@
+import gc
+import logging
+
+from .app import app
+from .cohd_utilities import poisson_ci_tables, double_poisson_confidence
+
+try:
+    import uwsgi
+except ImportError:
+    # Not running under uWSGI, e.g., Flask development server or unit tests
+    uwsgi = None
+
+# Confidence levels whose Poisson CI tables are built before forking (the default confidence of the API and TRAPI)
+PRELOAD_CONFIDENCE_LEVELS = [0.99]
+
+
+def preforked():
+    """ Checks whether the app is loaded in the uWSGI master and then forked into the workers (i.e., lazy-apps is off)
+
+    Returns
+    -------
+    True if running under uWSGI in preforking mode, otherwise False
+    """
+    if uwsgi is None:
+        return False
+    return not (_uwsgi_flag('lazy-apps') or _uwsgi_flag('lazy'))
+
+
+def _uwsgi_flag(name):
+    """ Reads a boolean uWSGI option
+
+    uwsgi.opt holds the option values as byte strings (or True for flags given without a value), so 'lazy-apps = false'
+    is b'false', which is truthy.
+
+    Parameters
+    ----------
+    name: option name
+
+    Returns
+    -------
+    True if the option is set to a true value
+    """
+    value = uwsgi.opt.get(name)
+    if isinstance(value, bytes):
+        value = value.decode()
+    if isinstance(value, str):
+        return value.strip().lower() not in ('', 'false', '0', 'no', 'off')
+    return bool(value)
+
+
+def preload_shared_data():
+    """ Builds the large read-only structures used by every request before the uWSGI workers are forked
+
+    The Biolink mappings and Biolink Model toolkit are built when their modules are imported. This also loads the
+    Poisson CI tables, the dataset stats, the concept dictionary, the co-occurrence stores, the pair filters, the
+    concept hierarchy, and the age distribution matrices of the temporal dataset. In preforking mode, the objects are
+    then moved out of the garbage collector's tracked generations (gc.freeze) so that collections in the workers do not
+    write to them, and their pages stay shared copy-on-write between the workers.
+    """
+    # Imported here since query_cohd_mysql needs the app to be fully configured first
+    from . import cohd_temporal
+    from . import query_cohd_mysql
+
+    table_file = app.config.get('POISSON_CI_TABLE_FILE')
+    if table_file:
+        try:
+            poisson_ci_tables.load(table_file)
+        except Exception:
+            logging.exception(f'Unable to load the Poisson CI tables from {table_file}')
+    for confidence in PRELOAD_CONFIDENCE_LEVELS:
+        poisson_ci_tables.table(confidence)
+        poisson_ci_tables.table(double_poisson_confidence(confidence))
+
+    try:
+        dataset_ids = list(query_cohd_mysql.dataset_stats.snapshot().patient_counts)
+    except Exception:
+        logging.exception('Unable to preload the dataset stats')
+        dataset_ids = list()
+    query_cohd_mysql.concept_dictionary()
+    for dataset_id in dataset_ids:
+        query_cohd_mysql.cooccurrence_store(dataset_id)
+        query_cohd_mysql.pair_filter(dataset_id)
+    query_cohd_mysql.concept_hierarchy()
+    if cohd_temporal.DATASET_ID_DEFAULT_TEMPORAL in dataset_ids:
+        cohd_temporal.age_distributions(cohd_temporal.DATASET_ID_DEFAULT_TEMPORAL)
+
+    if preforked() and app.config.get('PRELOAD_FREEZE_GC', True):
+        freeze_gc()
+
+
+def freeze_gc():
+    """ Collects garbage, then moves all objects currently tracked by the garbage collector into the permanent
+    generation, which later collections ignore
+    """
+    gc.collect()
+    gc.freeze()
+    logging.info(f'Froze {gc.get_freeze_count()} objects before forking workers')
@@ -1,15 +1,29 @@
 import pymysql
-from flask import jsonify
-from scipy.stats import chisquare
+import contextvars
+import functools
+import random
+import re
+import time
+from contextlib import contextmanager
+from flask import jsonify, Response, stream_with_context
 import numpy as np
-from numpy import argsort
 import logging
 import pandas as pd
+from typing import NamedTuple, Optional, Tuple
 
 from .omop_xref import xref_to_omop_standard_concept, omop_map_to_standard, omop_map_from_standard, \
     xref_from_omop_standard_concept, xref_from_omop_local, xref_to_omop_local
-from .cohd_utilities import ln_ratio_ci, rel_freq_ci, log_odds, clip
-from .app import cache
+from .cohd_utilities import log_odds, clip, ln_ratio_ci_array, rel_freq_ci_array
+from . import chi_square
+from .concept_dictionary import ConceptDictionary
+from .concept_hierarchy import load_hierarchy
+from .connection_pool import ConnectionPool
+from .cooccurrence_store import open_store
+from .dataset_stats import DatasetStats, VersionedIndex
+from .pair_filter import open_filter
+from .storage_backend import MySqlBackend, SqliteBackend
+from . import sql_statements
+from .app import app, cache
 
 # Configuration
 CONFIG_FILE = "database.cnf"  # log-in credentials for database
@@ -29,13 +43,429 @@ JSON_INFINITY_REPLACEMENT = 999
 # ARAX displays p-value of 0 as None. Replace with a minimum p-value
 MIN_P = 1e-12
 
+# Maximum number of concept IDs in each list for pairwise association lookups
+PAIRS_MAX_CONCEPT_IDS = 100
 
-def sql_connection():
+# MySQL error code when a statement exceeds its MAX_EXECUTION_TIME
+MYSQL_ER_QUERY_TIMEOUT = 3024
+
+# Number of rows read from the server-side cursor at a time when streaming results
+STREAM_BATCH_SIZE = 1000
+
+# 2x2 chi-square statistic (no continuity correction) computed by the database so that chiSquare results can be
+# ordered and paginated in SQL. Same value as scipy.stats.chisquare on the observed and expected contingency tables.
+SQL_CHI_SQUARE = '''%(patient_count)s *
+    POW(cp.concept_count * %(patient_count)s - c1.concept_count * c2.concept_count, 2) /
+    ((c1.concept_count + 0E0) * (%(patient_count)s - c1.concept_count) *
+    c2.concept_count * (%(patient_count)s - c2.concept_count))'''
+
+# Observed-expected frequency ratio computed by the database. The patient count is bound from dataset_stats.
+SQL_LN_RATIO = 'log(cp.concept_count * %(patient_count)s / (c1.concept_count * c2.concept_count + 0E0))'
+
+
+class QueryTimeoutError(Exception):
+    """ A SQL statement could not complete before the execution deadline of the request """
+    pass
+
+
+# Deadline (time.monotonic() value) for SQL statements issued in the current context. See execution_deadline()
+_execution_deadline = contextvars.ContextVar('cohd_execution_deadline', default=None)
+
+_re_first_select = re.compile(r'\bSELECT\b', re.IGNORECASE)
+
+
+@contextmanager
+def execution_deadline(seconds):
+    """ Limits the server-side execution time of all SELECT statements issued within the with block
+
+    Each statement gets a MAX_EXECUTION_TIME optimizer hint for the time remaining until the deadline. Statements
+    that exceed it, or that start after the deadline has passed, raise QueryTimeoutError.
+
+    Parameters
+    ----------
+    seconds: time budget in seconds, measured from entering the with block
+    """
+    token = _execution_deadline.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _execution_deadline.reset(token)
+
+
+def apply_execution_deadline(sql):
+    """ Adds a MAX_EXECUTION_TIME hint for the remaining time of the current execution deadline
+
+    Parameters
+    ----------
+    sql: SQL statement
+
+    Returns
+    -------
+    SQL statement with the hint after the first SELECT. Unchanged when there is no deadline or no SELECT.
+    """
+    deadline = _execution_deadline.get()
+    if deadline is None or not isinstance(sql, str):
+        return sql
+
+    remaining_ms = int((deadline - time.monotonic()) * 1000)
+    if remaining_ms <= 0:
+        raise QueryTimeoutError('Execution deadline reached before the query started')
+
+    # For unions and subqueries, the hint must follow the first SELECT and applies to the whole statement
+    return _re_first_select.sub(f'SELECT /*+ MAX_EXECUTION_TIME({remaining_ms}) */', sql, count=1)
+
+
+class _DeadlineCursorMixin:
+    """ Applies the current execution deadline to each statement and raises QueryTimeoutError on timeout """
+    def execute(self, query, args=None):
+        try:
+            return super().execute(apply_execution_deadline(query), args)
+        except pymysql.err.OperationalError as e:
+            if e.args and e.args[0] == MYSQL_ER_QUERY_TIMEOUT:
+                raise QueryTimeoutError(str(e)) from e
+            raise
+
+
+class DeadlineDictCursor(_DeadlineCursorMixin, pymysql.cursors.DictCursor):
+    pass
+
+
+class DeadlineSSDictCursor(_DeadlineCursorMixin, pymysql.cursors.SSDictCursor):
+    pass
+
+
+def _mysql_connect(config_file=CONFIG_FILE):
     # Connect to MySQL database
-    logging.debug(msg='Connecting to MySQL database')
-    return pymysql.connect(read_default_file=CONFIG_FILE,
+    return pymysql.connect(read_default_file=config_file,
                            charset='utf8mb4',
-                           cursorclass=pymysql.cursors.DictCursor)
+                           cursorclass=DeadlineDictCursor)
+
+
+class ReadEndpoint:
+    """ A MySQL server (identified by its option file) with its own per-worker connection pool """
+
+    def __init__(self, config_file, weight=1):
+        """ Constructor
+
+        Parameters
+        ----------
+        config_file: MySQL option file with the host and credentials of the server
+        weight: relative share of reads sent to this endpoint
+        """
+        self.config_file = config_file
+        self.weight = weight
+        self.pool = ConnectionPool(lambda: _mysql_connect(config_file),
+                                   size=app.config.get('MYSQL_POOL_SIZE', 4),
+                                   ping_interval=app.config.get('MYSQL_POOL_PING_INTERVAL', 30),
+                                   max_idle=app.config.get('MYSQL_POOL_MAX_IDLE', 3600))
+        # Time (time.monotonic()) before which the endpoint is skipped after a failed connection attempt
+        self.retry_after = 0.0
+
+
+class ReadRouter:
+    """
+    Routes reads to weighted pools of MySQL endpoints by schema and dataset_id
+
+    Routes are looked up by (schema, dataset_id) first, then by schema. Reads without a matching route use the
+    primary endpoint. Within a route, endpoints are tried in a random order weighted by their weights. An endpoint
+    that fails to connect is skipped for retry_interval seconds while the others take its share of the load, and is
+    only tried again earlier if every endpoint of the route is failing.
+    """
+
+    def __init__(self, routes=None, primary_config_file=CONFIG_FILE, retry_interval=30):
+        """ Constructor
+
+        Parameters
+        ----------
+        routes: dict of schema or (schema, dataset_id) -> list of {'config_file': str, 'weight': number}
+        primary_config_file: MySQL option file of the primary server
+        retry_interval: seconds a failed endpoint is skipped
+        """
+        self.retry_interval = retry_interval
+        self._endpoints = dict()
+        self.primary = self._endpoint(primary_config_file)
+        self._routes = dict()
+        for key, endpoint_defs in (routes or dict()).items():
+            endpoints = [self._endpoint(e['config_file'], e.get('weight', 1)) for e in endpoint_defs]
+            self._routes[key] = [e for e in endpoints if e.weight > 0]
+
+    def _endpoint(self, config_file, weight=1):
+        # Endpoints that share an option file share a connection pool. The weight is set by the first route.
+        if config_file not in self._endpoints:
+            self._endpoints[config_file] = ReadEndpoint(config_file, weight)
+        return self._endpoints[config_file]
+
+    def route(self, schema='cohd', dataset_id=None):
+        """ Gets the endpoints that serve reads for the schema and dataset
+
+        Parameters
+        ----------
+        schema: database schema
+        dataset_id: COHD dataset ID, or None if the read is not specific to a dataset
+
+        Returns
+        -------
+        List of ReadEndpoint
+        """
+        if dataset_id is not None:
+            endpoints = self._routes.get((schema, dataset_id))
+            if endpoints:
+                return endpoints
+        return self._routes.get(schema) or [self.primary]
+
+    def connection(self, schema='cohd', dataset_id=None):
+        """ Gets a pooled connection to an endpoint of the route, failing over to the other endpoints
+
+        Parameters
+        ----------
+        schema: database schema
+        dataset_id: COHD dataset ID, or None if the read is not specific to a dataset
+
+        Returns
+        -------
+        PooledConnection
+        """
+        endpoints = self.route(schema, dataset_id)
+        now = time.monotonic()
+        available = [e for e in endpoints if e.retry_after <= now]
+        failing = [e for e in endpoints if e.retry_after > now]
+
+        # Weighted random order (Efraimidis-Spirakis): sort by u^(1/weight)
+        available.sort(key=lambda e: random.random() ** (1.0 / e.weight), reverse=True)
+
+        last_error = None
+        for endpoint in available + failing:
+            try:
+                conn = endpoint.pool.acquire()
+            except pymysql.err.OperationalError as e:
+                logging.warning(f'Unable to connect to MySQL endpoint {endpoint.config_file}: {e}')
+                endpoint.retry_after = time.monotonic() + self.retry_interval
+                last_error = e
+                continue
+            endpoint.retry_after = 0.0
+            return conn
+        raise last_error
+
+    def clear(self):
+        """ Closes the idle connections of all endpoints """
+        for endpoint in self._endpoints.values():
+            endpoint.pool.clear()
+
+
+# Per-worker read routing and connection pools (see cohd_flask.conf for settings)
+_read_router = ReadRouter(routes=app.config.get('MYSQL_READ_ROUTES'),
+                          primary_config_file=CONFIG_FILE,
+                          retry_interval=app.config.get('MYSQL_ENDPOINT_RETRY_INTERVAL', 30))
+
+
+def _create_storage():
+    """ Creates the storage backend selected by STORAGE_BACKEND (see cohd_flask.conf) """
+    backend = app.config.get('STORAGE_BACKEND', 'mysql').lower()
+    if backend == 'sqlite':
+        path = app.config.get('SQLITE_DATABASE_DIR')
+        logging.info(f'Using SQLite storage backend in {path}')
+        return SqliteBackend(path)
+    elif backend == 'mysql':
+        return MySqlBackend(_read_router)
+    raise ValueError(f'Unknown STORAGE_BACKEND: {backend}')
+
+
+# Per-worker storage backend
+storage = _create_storage()
+
+
+def sql_connection(dataset_id=None, schema='cohd', primary=False):
+    """ Gets a database connection from the storage backend
+
+    With MySQL, reads are routed by schema and dataset_id according to MYSQL_READ_ROUTES. Calling close() on the
+    returned connection (or leaving a with block) returns it to the pool.
+
+    Parameters
+    ----------
+    dataset_id: COHD dataset ID used for routing, or None if the query is not specific to a dataset
+    schema: database schema used for routing
+    primary: True to connect to the primary server, e.g., for writes
+
+    Returns
+    -------
+    PooledConnection (MySQL) or SqliteConnection
+    """
+    return storage.connection(dataset_id=dataset_id, schema=schema, primary=primary)
+
+
+def _table_exists(table_name, schema='cohd'):
+    """ Checks if a table exists in the database
+
+    Parameters
+    ----------
+    table_name: table name
+    schema: database schema
+
+    Returns
+    -------
+    True if the table exists
+    """
+    return storage.table_exists(table_name, schema)
+
+
+# Optional table that stores each pair in both orientations (see db/sql/create_concept_pair_counts_bidirectional.sql)
+PAIR_TABLE_BIDIRECTIONAL = 'concept_pair_counts_bidir'
+_bidirectional_pairs = None
+
+_re_union_second_branch = re.compile(r'\)\s*UNION(?:\s+ALL)?\s*\(\s*SELECT.*\)\) x\b', re.DOTALL)
+
+
+def bidirectional_pairs():
+    """ Checks if the database has the bidirectional pair table. The result is cached for the life of the process.
+
+    Returns
+    -------
+    True if cohd.concept_pair_counts_bidir exists
+    """
+    global _bidirectional_pairs
+    if _bidirectional_pairs is None:
+        _bidirectional_pairs = _table_exists(PAIR_TABLE_BIDIRECTIONAL)
+        if _bidirectional_pairs:
+            logging.info('Using bidirectional concept pair table')
+    return _bidirectional_pairs
+
+
+@functools.lru_cache(maxsize=128)
+def single_scan_sql(sql):
+    """ Rewrites an "all associations of a concept" query for the bidirectional pair table
+
+    The queries have the form SELECT * FROM ((first branch) UNION (second branch)) x ..., where the first branch finds
+    the concept as concept_id_1 and the second branch finds it as concept_id_2. In the bidirectional table, the first
+    branch alone finds every pair with a single index range scan, so the second branch is dropped.
+
+    Parameters
+    ----------
+    sql: SQL statement
+
+    Returns
+    -------
+    SQL statement using only the first branch against the bidirectional table
+    """
+    single_sql, n = _re_union_second_branch.subn(') x', sql, count=1)
+    assert n == 1, 'query_cohd_mysql.py::single_scan_sql() - SQL does not have the expected UNION form'
+    single_sql = single_sql.replace('((SELECT', '(SELECT', 1)
+    return single_sql.replace('cohd.concept_pair_counts ', f'cohd.{PAIR_TABLE_BIDIRECTIONAL} ')
+
+
+# Optional table with the precomputed top associations of each concept (see db/sql/create_top_associations.sql)
+TOP_ASSOCIATIONS_TABLE = 'concept_top_associations'
+_top_associations = None
+
+
+def top_associations():
+    """ Checks if the database has the precomputed top associations. The result is cached for the life of the process.
+
+    Returns
+    -------
+    True if cohd.concept_top_associations exists
+    """
+    global _top_associations
+    if _top_associations is None:
+        _top_associations = _table_exists(TOP_ASSOCIATIONS_TABLE)
+        if _top_associations:
+            logging.info('Using precomputed top associations')
+    return _top_associations
+
+
+def _association_sql(sql):
+    """ Uses the single scan form of an "all associations of a concept" query when the layout supports it """
+    return single_scan_sql(sql) if bidirectional_pairs() else sql
+
+
+# Memory-mapped co-occurrence stores by dataset_id (see cooccurrence_store.py). None if the dataset has no store.
+_cooccurrence_stores = dict()
+
+
+def cooccurrence_store(dataset_id):
+    """ Gets the co-occurrence store of a dataset. Stores are opened once per process.
+
+    Parameters
+    ----------
+    dataset_id: COHD dataset ID
+
+    Returns
+    -------
+    CooccurrenceStore, or None if COOCCURRENCE_STORE_DIR is not set or the dataset has no store
+    """
+    if dataset_id is None:
+        return None
+    dataset_id = int(dataset_id)
+    if dataset_id not in _cooccurrence_stores:
+        root = app.config.get('COOCCURRENCE_STORE_DIR')
+        store = open_store(root, dataset_id) if root else None
+        if store is not None:
+            logging.info(f'Using co-occurrence store {store.path} for dataset {dataset_id}')
+        _cooccurrence_stores[dataset_id] = store
+    return _cooccurrence_stores[dataset_id]
+
+
+# Bloom filters over the concept pairs by dataset_id (see pair_filter.py), as (dataset stats version, filter). The filter
+# is None if the dataset has no filter or the filter doesn't match the dataset stats.
+_pair_filters = dict()
+
+
+def pair_filter(dataset_id):
+    """ Gets the pair filter of a dataset. Filters are opened once per process, and opened again when the dataset stats
+    version changes. A filter is only used if it was built from a dataset with the current patient and pair counts: a
+    filter built before the database was reloaded may be missing pairs, which it would report as absent.
+
+    Parameters
+    ----------
+    dataset_id: COHD dataset ID
+
+    Returns
+    -------
+    PairFilter, or None if PAIR_FILTER_DIR is not set, the dataset has no filter, or the filter doesn't match the
+    dataset
+    """
+    root = app.config.get('PAIR_FILTER_DIR')
+    if dataset_id is None or not root:
+        return None
+    dataset_id = int(dataset_id)
+    try:
+        stats = dataset_stats.snapshot()
+    except Exception:
+        # Without the dataset stats, the filter can't be checked against the dataset
+        logging.exception('Unable to check the pair filter against the dataset stats')
+        return None
+
+    version, f = _pair_filters.get(dataset_id, (None, None))
+    if version != stats.version:
+        f = open_filter(root, dataset_id)
+        if f is not None:
+            patient_count = stats.patient_counts.get(dataset_id)
+            total_pair_count = stats.total_pair_counts.get(dataset_id)
+            if f.matches(patient_count, total_pair_count):
+                logging.info(f'Using pair filter with {f.n_items} pairs for dataset {dataset_id}')
+            else:
+                logging.warning(f'Not using the pair filter of dataset {dataset_id}: it was built from '
+                                f'{f.patient_count} patients and {f.total_pair_count} pairs, but the dataset has '
+                                f'{patient_count} patients and {total_pair_count} pairs')
+                f = None
+        _pair_filters[dataset_id] = (stats.version, f)
+    return f
+
+
+def pair_may_exist(dataset_id, concept_id_1, concept_id_2):
+    """ Checks the pair filter before looking up a pair
+
+    Parameters
+    ----------
+    dataset_id: COHD dataset ID
+    concept_id_1: OMOP concept ID (int)
+    concept_id_2: OMOP concept ID (int)
+
+    Returns
+    -------
+    False if the pair is definitely not in the dataset, True if it may be (or the dataset has no filter)
+    """
+    f = pair_filter(dataset_id)
+    return f is None or (concept_id_1, concept_id_2) in f
 
 
 def get_arg_dataset_id(args, default_dataset_id=DATASET_ID_DEFAULT):
@@ -90,6 +520,254 @@ def get_arg_boolean(args, param_name):
     return None
 
 
+def get_arg_stream(args):
+    """ Gets the streaming mode requested by the stream parameter
+
+    Parameters
+    ----------
+    args: request args
+
+    Returns
+    -------
+    'json' to stream a JSON object, 'ndjson' to stream newline-delimited JSON, or None to not stream
+    """
+    param = args.get('stream')
+    if param is None or param == [''] or not isinstance(param, str):
+        return None
+    param = param.strip().lower()
+    if param == 'ndjson':
+        return 'ndjson'
+    elif param in ['json', 'true', '1', 't']:
+        return 'json'
+    return None
+
+
+def _stream_query(conn, sql, params, stream_format, row_function=None, page=None, cursor_columns=None,
+                  rows_function=None):
+    """ Executes the query with an unbuffered server-side cursor and streams the results as they are read
+
+    Only STREAM_BATCH_SIZE rows are held in memory at a time regardless of the size of the result set. The connection
+    is returned to the pool when the response finishes.
+
+    Parameters
+    ----------
+    conn: database connection. Ownership passes to the streamed response.
+    sql: SQL statement
+    params: SQL parameters
+    stream_format: 'json' to stream {"results": [...]}, 'ndjson' to stream one JSON result per line
+    row_function: (optional) function applied to each row before serialization. Returns the row to output.
+    page: (optional) PageArgs. When a full page is returned, the JSON stream ends with next_cursor.
+    cursor_columns: (optional) (score column, concept ID column) of the database rows used to build next_cursor
+    rows_function: (optional) function applied to each batch of rows before serialization, e.g., for vectorized
+                   calculations. Returns the rows to output.
+
+    Returns
+    -------
+    Flask streaming response
+    """
+    cur = conn.cursor(DeadlineSSDictCursor)
+    try:
+        cur.execute(sql, params)
+    except Exception:
+        cur.close()
+        conn.close()
+        raise
+
+    def _generate():
+        try:
+            if stream_format == 'json':
+                separator = ','
+                yield '{"results": ['
+            else:
+                separator = '\n'
+
+            first = True
+            n_rows = 0
+            last_row = None
+            while True:
+                rows = cur.fetchmany(STREAM_BATCH_SIZE)
+                if not rows:
+                    break
+
+                n_rows += len(rows)
+                last_row = rows[-1]
+                if cursor_columns is not None:
+                    # Keep only the keyset values, row_function may replace the row
+                    last_row = {c: last_row[c] for c in cursor_columns}
+                if row_function is not None:
+                    rows = [row_function(row) for row in rows]
+                if rows_function is not None:
+                    rows = rows_function(rows)
+                chunk = separator.join(app.json.dumps(row) for row in rows)
+                yield chunk if first else separator + chunk
+                first = False
+
+            if stream_format == 'json':
+                next_cursor = None
+                if page is not None and cursor_columns is not None:
+                    next_cursor = _next_page_cursor(page, n_rows, last_row, *cursor_columns)
+                if next_cursor is None:
+                    yield ']}'
+                else:
+                    yield '], "next_cursor": ' + app.json.dumps(next_cursor) + '}'
+            elif not first:
+                yield '\n'
+        finally:
+            cur.close()
+            conn.close()
+
+    mimetype = 'application/json' if stream_format == 'json' else 'application/x-ndjson'
+    return Response(stream_with_context(_generate()), mimetype=mimetype)
+
+
+class PageArgs(NamedTuple):
+    """ Top-K and keyset pagination parameters of the association and frequency list methods """
+    limit: Optional[int]
+    min_count: Optional[int]
+    cursor: Optional[Tuple[float, int]]
+
+
+def format_page_cursor(score, concept_id):
+    """ Formats the keyset cursor that continues after a result
+
+    Parameters
+    ----------
+    score: score (sort key) of the last result on the page
+    concept_id: associated concept ID of the last result on the page
+
+    Returns
+    -------
+    Cursor string "score,concept_id"
+    """
+    return '{score},{concept_id}'.format(score=repr(score), concept_id=int(concept_id))
+
+
+def parse_page_cursor(cursor):
+    """ Parses a keyset cursor created by format_page_cursor
+
+    Parameters
+    ----------
+    cursor: cursor string "score,concept_id"
+
+    Returns
+    -------
+    (score, concept_id), or None if the cursor is malformed
+    """
+    if not isinstance(cursor, str):
+        return None
+    parts = cursor.strip().split(',')
+    if len(parts) != 2:
+        return None
+    try:
+        score = float(parts[0])
+        concept_id = int(parts[1])
+    except ValueError:
+        return None
+    if not np.isfinite(score):
+        return None
+    return score, concept_id
+
+
+def get_arg_page(args):
+    """ Gets the limit, min_count, and cursor parameters
+
+    Parameters
+    ----------
+    args: request args
+
+    Returns
+    -------
+    (PageArgs, None) or (None, error message)
+    """
+    limit = args.get('limit')
+    if limit is not None and limit.strip() != '':
+        limit = get_arg_int(args, 'limit')
+        if limit is None or limit <= 0:
+            return None, 'limit should be a positive integer'
+    else:
+        limit = None
+
+    min_count = args.get('min_count')
+    if min_count is not None and min_count.strip() != '':
+        min_count = get_arg_int(args, 'min_count')
+        if min_count is None:
+            return None, 'min_count should be a non-negative integer'
+    else:
+        min_count = None
+
+    cursor = args.get('cursor')
+    if cursor is not None and cursor.strip() != '':
+        cursor = parse_page_cursor(cursor)
+        if cursor is None:
+            return None, 'Malformed cursor. Use the next_cursor value returned with the previous page.'
+    else:
+        cursor = None
+
+    return PageArgs(limit, min_count, cursor), None
+
+
+def _page_branch_sql(page, score_expr, id_expr, count_expr, params):
+    """ Builds the SQL that applies the pagination parameters to one branch of a UNION
+
+    Results are ordered by score descending, then by the associated concept ID ascending. The cursor continues after
+    the (score, concept ID) of the last result on the previous page. With a limit, each branch stops after limit rows
+    so the database doesn't materialize and sort every pair of the concept.
+
+    Parameters
+    ----------
+    page: PageArgs
+    score_expr: SQL expression of the sort score in this branch
+    id_expr: SQL expression of the associated concept ID in this branch
+    count_expr: SQL expression of the count filtered by min_count
+    params: SQL parameters. Pagination parameters are added.
+
+    Returns
+    -------
+    (filter, order_limit): SQL to append to the branch's WHERE clause, ORDER BY and LIMIT clauses of the branch
+    """
+    page_filter = ''
+    if page.min_count is not None:
+        page_filter += ' AND {count} >= %(page_min_count)s'.format(count=count_expr)
+        params['page_min_count'] = page.min_count
+    if page.cursor is not None:
+        page_filter += (' AND ({score} < %(page_cursor_score)s OR '
+                        '({score} = %(page_cursor_score)s AND {id} > %(page_cursor_id)s))').format(score=score_expr,
+                                                                                                id=id_expr)
+        params['page_cursor_score'], params['page_cursor_id'] = page.cursor
+
+    order_limit = ''
+    if page.limit is not None:
+        order_limit = 'ORDER BY {score} DESC, {id} ASC LIMIT %(page_limit)s'.format(score=score_expr, id=id_expr)
+        params['page_limit'] = page.limit
+
+    return page_filter, order_limit
+
+
+def _page_limit_sql(page):
+    """ LIMIT clause for the outer query of a paginated UNION """
+    return 'LIMIT %(page_limit)s' if page.limit is not None else ''
+
+
+def _next_page_cursor(page, n_rows, last_row, score_column, id_column):
+    """ Gets the cursor for the next page, or None if there are no more results
+
+    Parameters
+    ----------
+    page: PageArgs
+    n_rows: number of results in the current page
+    last_row: last database row of the current page
+    score_column: name of the sort score column
+    id_column: name of the associated concept ID column
+
+    Returns
+    -------
+    Cursor string or None
+    """
+    if page.limit is None or last_row is None or n_rows < page.limit or last_row[score_column] is None:
+        return None
+    return format_page_cursor(last_row[score_column], last_row[id_column])
+
+
 def query_db_finalize(conn, cursor, json_return):
     logging.debug(cursor._executed)
     logging.debug(json_return)
@@ -114,48 +792,26 @@ def query_db_datasets():
 
 def query_db_domain_counts(dataset_id):
     # The number of concepts in each domain
-    conn = sql_connection()
-    cur = conn.cursor()
-    sql = '''SELECT *
-        FROM cohd.domain_concept_counts
-        WHERE dataset_id=%(dataset_id)s;'''
-    params = {'dataset_id': dataset_id}
-    cur.execute(sql, params)
-    json_return = cur.fetchall()
-    return query_db_finalize(conn, cur, json_return)
+    json_return = [{'dataset_id': dataset_id, 'domain_id': domain_id, 'count': count}
+                   for domain_id, count in dataset_stats.domain_counts(dataset_id)]
+    return {'results': json_return}
 
 
 def query_db_domain_pair_counts(dataset_id):
     # The number of pairs of concepts in each pair of domains
-    conn = sql_connection()
-    cur = conn.cursor()
-    sql = '''SELECT *
-        FROM cohd.domain_pair_concept_counts
-        WHERE dataset_id=%(dataset_id)s;'''
-    params = {'dataset_id': dataset_id}
-    cur.execute(sql, params)
-    json_return = cur.fetchall()
-    return query_db_finalize(conn, cur, json_return)
+    json_return = [{'dataset_id': dataset_id, 'domain_id_1': domain_id_1, 'domain_id_2': domain_id_2, 'count': count}
+                   for domain_id_1, domain_id_2, count in dataset_stats.domain_pair_counts(dataset_id)]
+    return {'results': json_return}
 
 
 def query_db_patient_count(dataset_id):
     # The number of patients in the dataset
-    conn = sql_connection()
-    cur = conn.cursor()
-    sql = '''SELECT *
-        FROM cohd.patient_count
-        WHERE dataset_id=%(dataset_id)s;'''
-    params = {'dataset_id': dataset_id}
-    cur = sql_connection().cursor()
-    cur.execute(sql, params)
-    json_return = cur.fetchall()    
-    return query_db_finalize(conn, cur, json_return)
+    patient_count = dataset_stats.patient_count(dataset_id)
+    json_return = [] if patient_count is None else [{'dataset_id': dataset_id, 'count': patient_count}]
+    return {'results': json_return}
 
 
 def query_db_find_concept_ids(dataset_id, query, domain_id=None, min_count=None):
-    conn = sql_connection()
-    cur = conn.cursor()
-    
     # Check query parameter
     if query is None or query == [''] or query.isspace():
         return 'q parameter is missing', 400
@@ -200,16 +856,14 @@ def query_db_find_concept_ids(dataset_id, query, domain_id=None, min_count=None)
 
     sql = sql.format(domain_filter=domain_filter, count_filter=count_filter)
 
-    cur = sql_connection().cursor()
+    conn = sql_connection(dataset_id)
+    cur = conn.cursor()
     cur.execute(sql, params)
     json_return = cur.fetchall()
     return query_db_finalize(conn, cur, json_return)
 
 
 def query_db_concepts(query):
-    conn = sql_connection()
-    cur = conn.cursor()
-
     # Check query parameter
     if query is None or query == [''] or query.isspace():
         return 'q parameter is missing', 400
@@ -224,20 +878,74 @@ def query_db_concepts(query):
         FROM cohd.concept
         WHERE concept_id IN (%s);''' % ','.join(['%s' for _ in concept_ids])
 
-    cur.execute(sql, concept_ids)
+    conn = sql_connection()
+    cur = conn.cursor()
+    cur.execute(sql, concept_ids)
     json_return = cur.fetchall()
     return query_db_finalize(conn, cur, json_return)
 
 
+def _chi_square_rows(rows, pair_count, include_concept_2=True):
+    """ Performs the chi-square analysis for the chiSquare result rows
+
+    Parameters
+    ----------
+    rows: rows with concept_pair_count, concept_count_1, concept_count_2, and patient_count
+    pair_count: total number of concept pairs in the dataset (for Bonferroni adjustment)
+    include_concept_2: include the concept_2_name and concept_2_domain
+
+    Returns
+    -------
+    List of chiSquare results
+    """
+    if not rows:
+        return []
+
+    cells, statistic, p, p_adjusted = chi_square.chi_square_rows(rows, pair_count)
+    n, c1, c2 = chi_square.columns(rows, ['patient_count', 'concept_count_1', 'concept_count_2'], dtype=np.int64)
+    cells = [c.astype(np.int64).tolist() for c in cells]
+    results = list()
+    for i, (r, n_i, c1_i, c2_i, cs, p_i, p_adj_i) in enumerate(zip(rows, n.tolist(), c1.tolist(), c2.tolist(),
+                                                                   statistic.tolist(), p.tolist(),
+                                                                   p_adjusted.tolist())):
+        new_r = {
+            'dataset_id': r['dataset_id'],
+            'concept_id_1': r['concept_id_1'],
+            'concept_id_2': r['concept_id_2'],
+            'n': n_i,
+            'n_c1': c1_i,
+            'n_c2': c2_i,
+        }
+        for name, cell in zip(chi_square.CELL_NAMES, cells):
+            new_r[name] = cell[i]
+        new_r['chi_square'] = cs
+        new_r['p-value'] = p_i
+        new_r['adj_p-value'] = p_adj_i
+        if include_concept_2:
+            new_r['concept_2_name'] = r['concept_2_name']
+            new_r['concept_2_domain'] = r['concept_2_domain']
+        results.append(new_r)
+    return results
+
+
 def query_db(service, method, args):
-    # Connect to MYSQL database
-    conn = sql_connection()
+    # Connect to MYSQL database, routed by the requested dataset (the hierarchy methods default to dataset 3)
+    if method in ['conceptAncestors', 'conceptDescendants']:
+        conn = sql_connection(get_arg_dataset_id(args, DATASET_ID_DEFAULT_HIER))
+    else:
+        conn = sql_connection(get_arg_dataset_id(args))
     cur = conn.cursor()
 
     json_return = []
 
     query = args.get('q')
 
+    # Optionally stream the results of the list methods instead of building the full response in memory
+    stream_format = get_arg_stream(args)
+
+    # Cursor for the next page of results from the paginated list methods
+    next_cursor = None
+
     logging.debug(msg=f"Service: {service}; Method: {method}, Query: {query}")
 
     if service == 'omop':
@@ -285,11 +993,17 @@ def query_db(service, method, args):
                 concept_class_filter = 'AND concept_class_id = %(concept_class_id)s'
                 params['concept_class_id'] = concept_class_id
 
-            # Add filter code to SQL
-            sql = sql.format(vocabulary_filter=vocabulary_filter, concept_class_filter=concept_class_filter)
+            hierarchy = concept_hierarchy()
+            if hierarchy is not None:
+                # Served from the in-process hierarchy index
+                json_return = hierarchy.ancestors(concept_id, dataset_id, params.get('vocabulary_id'),
+                                                  params.get('concept_class_id'))
+            else:
+                # Add filter code to SQL
+                sql = sql.format(vocabulary_filter=vocabulary_filter, concept_class_filter=concept_class_filter)
 
-            cur.execute(sql, params)
-            json_return = cur.fetchall()
+                cur.execute(sql, params)
+                json_return = cur.fetchall()
 
         # Looks up descendants of a given concept
         # e.g. /api/query?service=omop&meta=conceptDescendants&concept_id=313217
@@ -337,11 +1051,17 @@ def query_db(service, method, args):
                 concept_class_filter = 'AND concept_class_id = %(concept_class_id)s'
                 params['concept_class_id'] = concept_class_id
 
-            # Add filter code to SQL
-            sql = sql.format(vocabulary_filter=vocabulary_filter, concept_class_filter=concept_class_filter)
+            hierarchy = concept_hierarchy()
+            if hierarchy is not None:
+                # Served from the in-process hierarchy index
+                json_return = hierarchy.descendants(concept_id, dataset_id, params.get('vocabulary_id'),
+                                                    params.get('concept_class_id'))
+            else:
+                # Add filter code to SQL
+                sql = sql.format(vocabulary_filter=vocabulary_filter, concept_class_filter=concept_class_filter)
 
-            cur.execute(sql, params)
-            json_return = cur.fetchall()
+                cur.execute(sql, params)
+                json_return = cur.fetchall()
 
         # Find concept_ids and concept_names that are similar to the query
         # e.g. /api/v1/query?service=omop&meta=mapToStandardConceptID&concept_code=715.3&vocabulary_id=ICD9CM
@@ -471,12 +1191,11 @@ def query_db(service, method, args):
                     cc.dataset_id,
                     cc.concept_id,
                     cc.concept_count,
-                    cc.concept_count / (pc.count + 0E0) AS concept_frequency
+                    cc.concept_count / (%s + 0E0) AS concept_frequency
                 FROM cohd.concept_counts cc
-                JOIN cohd.patient_count pc ON cc.dataset_id = pc.dataset_id
                 WHERE cc.dataset_id = %s AND concept_id IN ({concepts});'''.format(
                 concepts=','.join(['%s' for _ in concept_ids]))
-            params = [dataset_id] + concept_ids
+            params = [dataset_stats.patient_count(dataset_id), dataset_id] + concept_ids
 
             cur.execute(sql, params)
             json_return = cur.fetchall()
@@ -502,20 +1221,23 @@ def query_db(service, method, args):
                     cpc.concept_id_1,
                     cpc.concept_id_2,
                     cpc.concept_count,
-                    cpc.concept_count / (pc.count + 0E0) AS concept_frequency
+                    cpc.concept_count / (%(patient_count)s + 0E0) AS concept_frequency
                 FROM cohd.concept_pair_counts cpc
-                JOIN cohd.patient_count pc ON pc.dataset_id = cpc.dataset_id
                 WHERE cpc.dataset_id = %(dataset_id)s AND
                     ((concept_id_1 = %(concept_id_1)s AND concept_id_2 = %(concept_id_2)s) OR
                     (concept_id_1 = %(concept_id_2)s AND concept_id_2 = %(concept_id_1)s));'''
             params = {
                 'dataset_id': dataset_id,
+                'patient_count': dataset_stats.patient_count(dataset_id),
                 'concept_id_1': concept_id_1,
                 'concept_id_2': concept_id_2
             }
 
-            cur.execute(sql, params)
-            json_return = cur.fetchall()
+            if pair_may_exist(dataset_id, concept_id_1, concept_id_2):
+                cur.execute(sql, params)
+                json_return = cur.fetchall()
+            else:
+                json_return = []
 
         # Looks up observed clinical frequencies of all pairs of concepts given a concept id
         # e.g. /api/v1/query?service=frequencies&meta=associatedConceptFreq&dataset_id=1&q=4196636
@@ -531,6 +1253,10 @@ def query_db(service, method, args):
 
             concept_id = int(query)
 
+            page, error = get_arg_page(args)
+            if error is not None:
+                return error, 400
+
             sql = '''SELECT *
                 FROM
                     ((SELECT
@@ -538,34 +1264,52 @@ def query_db(service, method, args):
                         cpc.concept_id_1 AS concept_id,
                         cpc.concept_id_2 AS associated_concept_id,
                         cpc.concept_count,
-                        cpc.concept_count / (pc.count + 0E0) AS concept_frequency,
+                        cpc.concept_count / (%(patient_count)s + 0E0) AS concept_frequency,
                         c.concept_name AS associated_concept_name,
                         c.domain_id AS associated_domain_id
                     FROM cohd.concept_pair_counts cpc
                     JOIN cohd.concept c ON concept_id_2 = c.concept_id
-                    JOIN cohd.patient_count pc ON cpc.dataset_id = pc.dataset_id
-                    WHERE cpc.dataset_id = %(dataset_id)s AND concept_id_1 = %(concept_id)s)
+                    WHERE cpc.dataset_id = %(dataset_id)s AND concept_id_1 = %(concept_id)s
+                        {page_filter_1}
+                        {page_order_1})
                     UNION
                     (SELECT
                         cpc.dataset_id,
                         cpc.concept_id_2 AS concept_id,
                         cpc.concept_id_1 AS associated_concept_id,
                         cpc.concept_count,
-                        cpc.concept_count / (pc.count + 0E0) AS concept_frequency,
+                        cpc.concept_count / (%(patient_count)s + 0E0) AS concept_frequency,
                         c.concept_name AS associated_concept_name,
                         c.domain_id AS associated_domain_id
                     FROM cohd.concept_pair_counts cpc
                     JOIN cohd.concept c ON concept_id_1 = c.concept_id
-                    JOIN cohd.patient_count pc ON cpc.dataset_id = pc.dataset_id
-                    WHERE cpc.dataset_id = %(dataset_id)s AND concept_id_2 = %(concept_id)s)) x
-                ORDER BY concept_count DESC;'''
+                    WHERE cpc.dataset_id = %(dataset_id)s AND concept_id_2 = %(concept_id)s
+                        {page_filter_2}
+                        {page_order_2})) x
+                ORDER BY concept_count DESC, associated_concept_id ASC
+                {page_limit};'''
             params = {
                 'dataset_id': dataset_id,
+                'patient_count': dataset_stats.patient_count(dataset_id),
                 'concept_id': concept_id
             }
+            page_filter_1, page_order_1 = _page_branch_sql(page, 'cpc.concept_count', 'cpc.concept_id_2',
+                                                           'cpc.concept_count', params)
+            page_filter_2, page_order_2 = _page_branch_sql(page, 'cpc.concept_count', 'cpc.concept_id_1',
+                                                           'cpc.concept_count', params)
+            sql = sql.format(page_filter_1=page_filter_1, page_order_1=page_order_1, page_filter_2=page_filter_2,
+                             page_order_2=page_order_2, page_limit=_page_limit_sql(page))
+            sql = _association_sql(sql)
+            cursor_columns = ('concept_count', 'associated_concept_id')
+
+            if stream_format is not None:
+                cur.close()
+                return _stream_query(conn, sql, params, stream_format, page=page, cursor_columns=cursor_columns)
 
             cur.execute(sql, params)
             json_return = cur.fetchall()
+            next_cursor = _next_page_cursor(page, len(json_return), json_return[-1] if json_return else None,
+                                            *cursor_columns)
 
         # Looks up observed clinical frequencies of all pairs of concepts given a concept id restricted by domain of the
         # associated concept_id
@@ -586,6 +1330,10 @@ def query_db(service, method, args):
 
             concept_id = int(concept_id)
 
+            page, error = get_arg_page(args)
+            if error is not None:
+                return error, 400
+
             sql = '''SELECT *
                 FROM
                     ((SELECT
@@ -593,37 +1341,55 @@ def query_db(service, method, args):
                         cpc.concept_id_1 AS concept_id,
                         cpc.concept_id_2 AS associated_concept_id,
                         cpc.concept_count,
-                        cpc.concept_count / (pc.count + 0E0) AS concept_frequency,
+                        cpc.concept_count / (%(patient_count)s + 0E0) AS concept_frequency,
                         c.concept_name AS associated_concept_name,
                         c.domain_id AS associated_domain_id
                     FROM cohd.concept_pair_counts cpc
                     JOIN cohd.concept c ON concept_id_2 = c.concept_id
-                    JOIN cohd.patient_count pc ON cpc.dataset_id = pc.dataset_id
                     WHERE cpc.dataset_id = %(dataset_id)s AND concept_id_1 = %(concept_id)s
-                        AND c.domain_id = %(domain_id)s)
+                        AND c.domain_id = %(domain_id)s
+                        {page_filter_1}
+                        {page_order_1})
                     UNION
                     (SELECT
                         cpc.dataset_id,
                         cpc.concept_id_2 AS concept_id,
                         cpc.concept_id_1 AS associated_concept_id,
                         cpc.concept_count,
-                        cpc.concept_count / (pc.count + 0E0) AS concept_frequency,
+                        cpc.concept_count / (%(patient_count)s + 0E0) AS concept_frequency,
                         c.concept_name AS associated_concept_name,
                         c.domain_id AS associated_domain_id
                     FROM cohd.concept_pair_counts cpc
                     JOIN cohd.concept c ON concept_id_1 = c.concept_id
-                    JOIN cohd.patient_count pc ON cpc.dataset_id = pc.dataset_id
                     WHERE cpc.dataset_id = %(dataset_id)s AND concept_id_2 = %(concept_id)s
-                        AND c.domain_id = %(domain_id)s)) x
-                ORDER BY concept_count DESC;'''
+                        AND c.domain_id = %(domain_id)s
+                        {page_filter_2}
+                        {page_order_2})) x
+                ORDER BY concept_count DESC, associated_concept_id ASC
+                {page_limit};'''
             params = {
                 'dataset_id': dataset_id,
+                'patient_count': dataset_stats.patient_count(dataset_id),
                 'concept_id': concept_id,
                 'domain_id': domain_id
             }
+            page_filter_1, page_order_1 = _page_branch_sql(page, 'cpc.concept_count', 'cpc.concept_id_2',
+                                                           'cpc.concept_count', params)
+            page_filter_2, page_order_2 = _page_branch_sql(page, 'cpc.concept_count', 'cpc.concept_id_1',
+                                                           'cpc.concept_count', params)
+            sql = sql.format(page_filter_1=page_filter_1, page_order_1=page_order_1, page_filter_2=page_filter_2,
+                             page_order_2=page_order_2, page_limit=_page_limit_sql(page))
+            sql = _association_sql(sql)
+            cursor_columns = ('concept_count', 'associated_concept_id')
+
+            if stream_format is not None:
+                cur.close()
+                return _stream_query(conn, sql, params, stream_format, page=page, cursor_columns=cursor_columns)
 
             cur.execute(sql, params)
             json_return = cur.fetchall()
+            next_cursor = _next_page_cursor(page, len(json_return), json_return[-1] if json_return else None,
+                                            *cursor_columns)
 
         # Returns most common single concept frequencies
         # e.g. /api/v1/query?service=frequencies&meta=mostFrequentConcept&dataset_id=1&q=100
@@ -631,11 +1397,10 @@ def query_db(service, method, args):
             sql = '''SELECT cc.dataset_id,
                         cc.concept_id,
                         cc.concept_count,
-                        cc.concept_count / (pc.count + 0E0) AS concept_frequency,
+                        cc.concept_count / (%(patient_count)s + 0E0) AS concept_frequency,
                         c.domain_id, c.concept_name, c.vocabulary_id, c.concept_class_id
                     FROM cohd.concept_counts cc
                     JOIN cohd.concept c ON cc.concept_id = c.concept_id
-                    JOIN cohd.patient_count pc ON cc.dataset_id = pc.dataset_id
                     WHERE cc.dataset_id = %(dataset_id)s
                         {domain_filter}
                         {vocabulary_filter}
@@ -648,7 +1413,8 @@ def query_db(service, method, args):
             # Get dataset_id
             dataset_id = get_arg_dataset_id(args)
             params = {
-                'dataset_id': dataset_id
+                'dataset_id': dataset_id,
+                'patient_count': dataset_stats.patient_count(dataset_id)
             }
 
             # Check q parameter (limit)
@@ -716,14 +1482,12 @@ def query_db(service, method, args):
                 return 'No concept_id_1 selected', 400
             concept_id_1 = int(concept_id_1)
 
+            page, error = get_arg_page(args)
+            if error is not None:
+                return error, 400
+
             # Get the total number of pairs for Bonferonni adjustment
-            sql = '''SELECT SUM(count) AS pair_count
-                FROM domain_pair_concept_counts
-                WHERE dataset_id = %(dataset_id)s;'''
-            params = {'dataset_id': dataset_id}
-            cur.execute(sql, params)
-            results = cur.fetchall()
-            pair_count = int(results[0]['pair_count'])
+            pair_count = get_total_pair_counts(dataset_id)
 
             if concept_id_2 is not None and concept_id_2.strip().isdigit():
                 # concept_id_2 is specified, only return the chi-square for the pair (concept_id_1, concept_id_2)
@@ -735,11 +1499,10 @@ def query_db(service, method, args):
                         cp.concept_count AS concept_pair_count,
                         c1.concept_count AS concept_count_1,
                         c2.concept_count AS concept_count_2,
-                        pc.count AS patient_count
+                        %(patient_count)s AS patient_count
                     FROM cohd.concept_pair_counts cp
                     JOIN cohd.concept_counts c1 ON cp.concept_id_1 = c1.concept_id
                     JOIN cohd.concept_counts c2 ON cp.concept_id_2 = c2.concept_id
-                    JOIN cohd.patient_count pc ON cp.dataset_id = pc.dataset_id
                     WHERE cp.dataset_id = %(dataset_id)s
                         AND c1.dataset_id = %(dataset_id)s
                         AND c2.dataset_id = %(dataset_id)s
@@ -747,6 +1510,7 @@ def query_db(service, method, args):
                         AND cp.concept_id_2 IN (%(concept_id_1)s, %(concept_id_2)s);'''
                 params = {
                     'dataset_id': dataset_id,
+                    'patient_count': dataset_stats.patient_count(dataset_id),
                     'concept_id_1': concept_id_1,
                     'concept_id_2': concept_id_2
                 }
@@ -763,20 +1527,22 @@ def query_db(service, method, args):
                             cp.concept_count AS concept_pair_count,
                             c1.concept_count AS concept_count_1,
                             c2.concept_count AS concept_count_2,
-                            pc.count AS patient_count,
+                            %(patient_count)s AS patient_count,
+                            {chi_square} AS chi_square,
                             c.concept_name AS concept_2_name,
                             c.domain_id AS concept_2_domain
                         FROM cohd.concept_pair_counts cp
                         JOIN cohd.concept_counts c1 ON cp.concept_id_1 = c1.concept_id
                         JOIN cohd.concept_counts c2 ON cp.concept_id_2 = c2.concept_id
-                        JOIN cohd.patient_count pc ON cp.dataset_id = pc.dataset_id
                         JOIN cohd.concept c ON cp.concept_id_2 = c.concept_id
                         WHERE cp.dataset_id = %(dataset_id)s
                             AND c1.dataset_id = %(dataset_id)s
                             AND c2.dataset_id = %(dataset_id)s
                             AND cp.concept_id_1 = %(concept_id_1)s
                             {domain_filter}
-                            {concept_class_filter})
+                            {concept_class_filter}
+                            {page_filter_1}
+                            {page_order_1})
                         UNION
                         (SELECT
                             cp.dataset_id,
@@ -785,22 +1551,27 @@ def query_db(service, method, args):
                             cp.concept_count AS concept_pair_count,
                             c2.concept_count AS concept_count_1,
                             c1.concept_count AS concept_count_2,
-                            pc.count AS patient_count,
+                            %(patient_count)s AS patient_count,
+                            {chi_square} AS chi_square,
                             c.concept_name AS concept_2_name,
                             c.domain_id AS concept_2_domain
                         FROM cohd.concept_pair_counts cp
                         JOIN cohd.concept_counts c1 ON cp.concept_id_1 = c1.concept_id
                         JOIN cohd.concept_counts c2 ON cp.concept_id_2 = c2.concept_id
-                        JOIN cohd.patient_count pc ON cp.dataset_id = pc.dataset_id
                         JOIN cohd.concept c ON cp.concept_id_1 = c.concept_id
                         WHERE cp.dataset_id = %(dataset_id)s
                             AND c1.dataset_id = %(dataset_id)s
                             AND c2.dataset_id = %(dataset_id)s
                             AND cp.concept_id_2 = %(concept_id_1)s
                             {domain_filter}
-                            {concept_class_filter})) x;'''
+                            {concept_class_filter}
+                            {page_filter_2}
+                            {page_order_2})) x
+                    ORDER BY chi_square DESC, concept_id_2 ASC
+                    {page_limit};'''
                 params = {
                     'dataset_id': dataset_id,
+                    'patient_count': dataset_stats.patient_count(dataset_id),
                     'concept_id_1': concept_id_1
                 }
 
@@ -819,49 +1590,34 @@ def query_db(service, method, args):
                     concept_class_filter = 'AND concept_class_id = %(concept_class_id)s'
                     params['concept_class_id'] = concept_class_id
 
-                sql = sql.format(domain_filter=domain_filter, concept_class_filter=concept_class_filter)
+                # Results are sorted by the chi-square statistic computed in SQL
+                page_filter_1, page_order_1 = _page_branch_sql(page, SQL_CHI_SQUARE, 'cp.concept_id_2',
+                                                               'cp.concept_count', params)
+                page_filter_2, page_order_2 = _page_branch_sql(page, SQL_CHI_SQUARE, 'cp.concept_id_1',
+                                                               'cp.concept_count', params)
+                sql = sql.format(domain_filter=domain_filter, concept_class_filter=concept_class_filter,
+                                 chi_square=SQL_CHI_SQUARE, page_filter_1=page_filter_1, page_order_1=page_order_1,
+                                 page_filter_2=page_filter_2, page_order_2=page_order_2,
+                                 page_limit=_page_limit_sql(page))
+                sql = _association_sql(sql)
+
+            include_concept_2 = concept_id_2 is None
+            cursor_columns = ('chi_square', 'concept_id_2')
+            if stream_format is not None and include_concept_2:
+                cur.close()
+                return _stream_query(conn, sql, params, stream_format,
+                                     rows_function=lambda rows: _chi_square_rows(rows, pair_count, include_concept_2),
+                                     page=page, cursor_columns=cursor_columns)
 
             cur.execute(sql, params)
             results = cur.fetchall()
 
             # Calculate the p-value using chi-square distribution with 1 degree of freedom
-            chi_squares = []
-            for r in results:
-                # Get observed counts
-                cpc = float(r['concept_pair_count'])
-                c1 = float(r['concept_count_1'])
-                c2 = float(r['concept_count_2'])
-                pts = float(r['patient_count'])
-                neg = pts - c1 - c2 + cpc
-
-                # Create the observed and expected RxC tables and perform chi-square
-                o = [neg, c1 - cpc, c2 - cpc, cpc]
-                e = [(pts - c1) * (pts - c2) / pts, c1 * (pts - c2) / pts, c2 * (pts - c1) / pts, c1 * c2 / pts]
-                cs = chisquare(o, e, 2)
-                new_r = {
-                    'dataset_id': r['dataset_id'],
-                    'concept_id_1': r['concept_id_1'],
-                    'concept_id_2': r['concept_id_2'],
-                    'n': int(pts),
-                    'n_c1': int(c1),
-                    'n_c2': int(c2),
-                    'n_~c1_~c2': int(neg),
-                    'n_c1_~c2': int(c1 - cpc),
-                    'n_~c1_c2': int(c2 - cpc),
-                    'n_c1_c2': int(cpc),
-                    'chi_square': cs.statistic,
-                    'p-value': cs.pvalue,
-                    'adj_p-value': min(cs.pvalue * pair_count, 1.0)
-                }
-                if concept_id_2 is None:
-                    new_r['concept_2_name'] = r['concept_2_name']
-                    new_r['concept_2_domain'] = r['concept_2_domain']
+            json_return = _chi_square_rows(results, pair_count, include_concept_2)
 
-                json_return.append(new_r)
-                chi_squares.append(cs.statistic)
-
-            # Sort results by chi-square
-            json_return = [json_return[i] for i in list(reversed(argsort(chi_squares)))]
+            if include_concept_2:
+                next_cursor = _next_page_cursor(page, len(results), results[-1] if results else None,
+                                                *cursor_columns)
 
         # Returns ratio of observed to expected frequency between pairs of concepts
         # e.g. /api/v1/query?service=association&meta=obsExpRatio&dataset_id=1&concept_id_1=192855&concept_id_2=2008271
@@ -875,6 +1631,10 @@ def query_db(service, method, args):
             if concept_id_1 is None:
                 return 'No concept_id_1 selected', 400
 
+            page, error = get_arg_page(args)
+            if error is not None:
+                return error, 400
+
             concept_id_2 = get_arg_concept_id(args, 'concept_id_2')
             if concept_id_2 is not None:
                 # concept_id_2 is specified, only return the results for the pair (concept_id_1, concept_id_2)
@@ -885,12 +1645,11 @@ def query_db(service, method, args):
                         cp.concept_id_1 AS {rename_1},
                         cp.concept_id_2 AS {rename_2},
                         cp.concept_count AS observed_count,
-                        c1.concept_count * c2.concept_count / (pc.count + 0E0) AS expected_count,
-                        log(cp.concept_count * pc.count / (c1.concept_count * c2.concept_count + 0E0)) AS ln_ratio
+                        c1.concept_count * c2.concept_count / (%(patient_count)s + 0E0) AS expected_count,
+                        log(cp.concept_count * %(patient_count)s / (c1.concept_count * c2.concept_count + 0E0)) AS ln_ratio
                     FROM cohd.concept_pair_counts cp
                     JOIN cohd.concept_counts c1 ON cp.concept_id_1 = c1.concept_id
                     JOIN cohd.concept_counts c2 ON cp.concept_id_2 = c2.concept_id
-                    JOIN cohd.patient_count pc ON cp.dataset_id = pc.dataset_id
                     WHERE cp.dataset_id = %(dataset_id)s
                         AND c1.dataset_id = %(dataset_id)s
                         AND c2.dataset_id = %(dataset_id)s
@@ -898,6 +1657,7 @@ def query_db(service, method, args):
                         AND cp.concept_id_2 = %(concept_id_2)s;'''
                 params = {
                     'dataset_id': dataset_id,
+                    'patient_count': dataset_stats.patient_count(dataset_id),
                     'concept_id_1': concept_id_1 if order else concept_id_2,
                     'concept_id_2': concept_id_2 if order else concept_id_1
                 }
@@ -917,45 +1677,51 @@ def query_db(service, method, args):
                             cp.concept_id_1,
                             cp.concept_id_2,
                             cp.concept_count AS observed_count,
-                            c1.concept_count * c2.concept_count / (pc.count + 0E0) AS expected_count,
-                            log(cp.concept_count * pc.count / (c1.concept_count * c2.concept_count + 0E0)) AS ln_ratio,
+                            c1.concept_count * c2.concept_count / (%(patient_count)s + 0E0) AS expected_count,
+                            log(cp.concept_count * %(patient_count)s /
+                                (c1.concept_count * c2.concept_count + 0E0)) AS ln_ratio,
                             c.concept_name AS concept_2_name,
                             c.domain_id AS concept_2_domain
                         FROM cohd.concept_pair_counts cp
                         JOIN cohd.concept_counts c1 ON cp.concept_id_1 = c1.concept_id
                         JOIN cohd.concept_counts c2 ON cp.concept_id_2 = c2.concept_id
-                        JOIN cohd.patient_count pc ON cp.dataset_id = pc.dataset_id
                         JOIN cohd.concept c ON cp.concept_id_2 = c.concept_id
                         WHERE cp.dataset_id = %(dataset_id)s
                             AND c1.dataset_id = %(dataset_id)s
                             AND c2.dataset_id = %(dataset_id)s
                             AND cp.concept_id_1 = %(concept_id_1)s
                             {domain_filter}
-                            {concept_class_filter})
+                            {concept_class_filter}
+                            {page_filter_1}
+                            {page_order_1})
                         UNION
                         (SELECT
                             cp.dataset_id,
                             cp.concept_id_2 AS concept_id_1,
                             cp.concept_id_1 AS concept_id_2,
                             cp.concept_count AS observed_count,
-                            c1.concept_count * c2.concept_count / (pc.count + 0E0) AS expected_count,
-                            log(cp.concept_count * pc.count / (c1.concept_count * c2.concept_count + 0E0)) AS ln_ratio,
+                            c1.concept_count * c2.concept_count / (%(patient_count)s + 0E0) AS expected_count,
+                            log(cp.concept_count * %(patient_count)s /
+                                (c1.concept_count * c2.concept_count + 0E0)) AS ln_ratio,
                             c.concept_name AS concept_2_name,
                             c.domain_id AS concept_2_domain
                         FROM cohd.concept_pair_counts cp
                         JOIN cohd.concept_counts c1 ON cp.concept_id_1 = c1.concept_id
                         JOIN cohd.concept_counts c2 ON cp.concept_id_2 = c2.concept_id
-                        JOIN cohd.patient_count pc ON cp.dataset_id = pc.dataset_id
                         JOIN cohd.concept c ON cp.concept_id_1 = c.concept_id
                         WHERE cp.dataset_id = %(dataset_id)s
                             AND c1.dataset_id = %(dataset_id)s
                             AND c2.dataset_id = %(dataset_id)s
                             AND cp.concept_id_2 = %(concept_id_1)s
                             {domain_filter}
-                            {concept_class_filter})) x
-                    ORDER BY ln_ratio DESC;'''
+                            {concept_class_filter}
+                            {page_filter_2}
+                            {page_order_2})) x
+                    ORDER BY ln_ratio DESC, concept_id_2 ASC
+                    {page_limit};'''
                 params = {
                     'dataset_id': dataset_id,
+                    'patient_count': dataset_stats.patient_count(dataset_id),
                     'concept_id_1': concept_id_1,
                 }
 
@@ -976,12 +1742,16 @@ def query_db(service, method, args):
                     concept_class_filter = 'AND concept_class_id = %(concept_class_id)s'
                     params['concept_class_id'] = concept_class_id
 
-                sql = sql.format(domain_filter=domain_filter, concept_class_filter=concept_class_filter)
+                page_filter_1, page_order_1 = _page_branch_sql(page, SQL_LN_RATIO, 'cp.concept_id_2',
+                                                               'cp.concept_count', params)
+                page_filter_2, page_order_2 = _page_branch_sql(page, SQL_LN_RATIO, 'cp.concept_id_1',
+                                                               'cp.concept_count', params)
+                sql = sql.format(domain_filter=domain_filter, concept_class_filter=concept_class_filter,
+                                 page_filter_1=page_filter_1, page_order_1=page_order_1, page_filter_2=page_filter_2,
+                                 page_order_2=page_order_2, page_limit=_page_limit_sql(page))
+                sql = _association_sql(sql)
 
-            cur.execute(sql, params)
-            json_return = cur.fetchall()
-
-            # Add confidence interval to results
+            # Confidence level for the confidence intervals
             confidence_level = args.get('confidence', DEFAULT_CONFIDENCE)
             try:
                 confidence_level = float(confidence_level)
@@ -989,10 +1759,29 @@ def query_db(service, method, args):
                 return 'Confidence is not a number 0-1', 400
             if confidence_level < 0 or confidence_level >= 1:
                 return 'Confidence should be a number between 0-1'
-            for row in json_return:
+
+            def _add_cis(rows):
                 # The CI bounds may hit Inf, which causes issues with JSON serialization. Limit it to 999
-                row['confidence_interval'] = ln_ratio_ci(row['observed_count'], row['ln_ratio'], confidence_level,
-                                                         JSON_INFINITY_REPLACEMENT)
+                observed_count, ln_ratio = chi_square.columns(rows, ['observed_count', 'ln_ratio'])
+                ci_lo, ci_hi = ln_ratio_ci_array(observed_count, ln_ratio, confidence_level, JSON_INFINITY_REPLACEMENT)
+                for row, ci in zip(rows, zip(ci_lo.tolist(), ci_hi.tolist())):
+                    row['confidence_interval'] = ci
+                return rows
+
+            cursor_columns = ('ln_ratio', 'concept_id_2')
+            if stream_format is not None and concept_id_2 is None:
+                cur.close()
+                return _stream_query(conn, sql, params, stream_format, rows_function=_add_cis, page=page,
+                                     cursor_columns=cursor_columns)
+
+            cur.execute(sql, params)
+            json_return = cur.fetchall()
+            if concept_id_2 is None:
+                next_cursor = _next_page_cursor(page, len(json_return), json_return[-1] if json_return else None,
+                                                *cursor_columns)
+
+            # Add confidence interval to results
+            _add_cis(json_return)
 
         # Returns relative frequency between pairs of concepts
         # e.g. /api/v1/query?service=association&meta=relativeFrequency&dataset_id=1&concept_id_1=192855&concept_id_2=2008271
@@ -1007,6 +1796,10 @@ def query_db(service, method, args):
             if concept_id_1 is None or concept_id_1 == [''] or not concept_id_1.strip().isdigit():
                 return 'No concept_id_1 selected', 400
 
+            page, error = get_arg_page(args)
+            if error is not None:
+                return error, 400
+
             if concept_id_2 is not None and concept_id_2.strip().isdigit():
                 # concept_id_2 is specified, only return the results for the pair (concept_id_1, concept_id_2)
                 sql = '''(SELECT
@@ -1062,7 +1855,9 @@ def query_db(service, method, args):
                             AND cc.dataset_id = %(dataset_id)s
                             AND cp.concept_id_1 = %(concept_id_1)s
                             {domain_filter}
-                            {concept_class_filter})
+                            {concept_class_filter}
+                            {page_filter_1}
+                            {page_order_1})
                         UNION
                         (SELECT
                             cp.dataset_id,
@@ -1080,8 +1875,11 @@ def query_db(service, method, args):
                             AND cc.dataset_id = %(dataset_id)s
                             AND cp.concept_id_2 = %(concept_id_1)s
                             {domain_filter}
-                            {concept_class_filter})) x
-                    ORDER BY relative_frequency DESC;'''
+                            {concept_class_filter}
+                            {page_filter_2}
+                            {page_order_2})) x
+                    ORDER BY relative_frequency DESC, concept_id_2 ASC
+                    {page_limit};'''
                 params = {
                     'dataset_id': dataset_id,
                     'concept_id_1': concept_id_1,
@@ -1104,12 +1902,17 @@ def query_db(service, method, args):
                     concept_class_filter = 'AND concept_class_id = %(concept_class_id)s'
                     params['concept_class_id'] = concept_class_id
 
-                sql = sql.format(domain_filter=domain_filter, concept_class_filter=concept_class_filter)
-
-            cur.execute(sql, params)
-            json_return = cur.fetchall()
-
-            # Add confidence interval to results
+                relative_frequency = 'cp.concept_count / (cc.concept_count + 0E0)'
+                page_filter_1, page_order_1 = _page_branch_sql(page, relative_frequency, 'cp.concept_id_2',
+                                                               'cp.concept_count', params)
+                page_filter_2, page_order_2 = _page_branch_sql(page, relative_frequency, 'cp.concept_id_1',
+                                                               'cp.concept_count', params)
+                sql = sql.format(domain_filter=domain_filter, concept_class_filter=concept_class_filter,
+                                 page_filter_1=page_filter_1, page_order_1=page_order_1, page_filter_2=page_filter_2,
+                                 page_order_2=page_order_2, page_limit=_page_limit_sql(page))
+                sql = _association_sql(sql)
+
+            # Confidence level for the confidence intervals
             confidence_level = args.get('confidence', DEFAULT_CONFIDENCE)
             try:
                 confidence_level = float(confidence_level)
@@ -1117,9 +1920,29 @@ def query_db(service, method, args):
                 return 'Confidence is not a number 0-1', 400
             if confidence_level < 0 or confidence_level >= 1:
                 return 'Confidence should be a number between 0-1'
-            for row in json_return:
-                row['confidence_interval'] = rel_freq_ci(row['concept_pair_count'], row['concept_2_count'],
-                                                          confidence_level)
+
+            def _add_cis(rows):
+                pair_count, base_count = chi_square.columns(rows, ['concept_pair_count', 'concept_2_count'])
+                ci_lo, ci_hi = rel_freq_ci_array(pair_count, base_count, confidence_level)
+                for row, ci in zip(rows, zip(ci_lo.tolist(), ci_hi.tolist())):
+                    row['confidence_interval'] = ci
+                return rows
+
+            list_results = not (concept_id_2 is not None and concept_id_2.strip().isdigit())
+            cursor_columns = ('relative_frequency', 'concept_id_2')
+            if stream_format is not None and list_results:
+                cur.close()
+                return _stream_query(conn, sql, params, stream_format, rows_function=_add_cis, page=page,
+                                     cursor_columns=cursor_columns)
+
+            cur.execute(sql, params)
+            json_return = cur.fetchall()
+            if list_results:
+                next_cursor = _next_page_cursor(page, len(json_return), json_return[-1] if json_return else None,
+                                                *cursor_columns)
+
+            # Add confidence interval to results
+            _add_cis(json_return)
         elif method == 'mcq':
             # Get non-required parameters
             dataset_id = get_arg_dataset_id(args)
@@ -1151,6 +1974,8 @@ def query_db(service, method, args):
     conn.close()
 
     json_return = {"results": json_return}
+    if next_cursor is not None:
+        json_return['next_cursor'] = next_cursor
     json_return = jsonify(json_return)
 
     return json_return
@@ -1277,25 +2102,19 @@ def query_trapi_old(concept_id_1, concept_id_2=None, dataset_id=None, domain_id=
         )
 
     # Connect to MYSQL database
-    conn = sql_connection()
+    conn = sql_connection(dataset_id)
     cur = conn.cursor()
 
     # Get the total number of pairs for Bonferonni adjustment
-    sql = '''SELECT SUM(count) AS pair_count
-        FROM domain_pair_concept_counts
-        WHERE dataset_id = %(dataset_id)s;'''
-    params = {'dataset_id': dataset_id}
-    cur.execute(sql, params)
-    results = cur.fetchall()
-    pair_count = int(results[0]['pair_count'])
+    pair_count = get_total_pair_counts(dataset_id)
 
     # Filter ln ratio
     if ln_ratio_sign == 0:
         ln_ratio_filter = ''
     elif ln_ratio_sign > 0:
-        ln_ratio_filter = 'AND log(cp.concept_count * pc.count / (c1.concept_count * c2.concept_count + 0E0)) > 0'
+        ln_ratio_filter = 'AND {ln_ratio} > 0'.format(ln_ratio=SQL_LN_RATIO)
     elif ln_ratio_sign < 0:
-        ln_ratio_filter = 'AND log(cp.concept_count * pc.count / (c1.concept_count * c2.concept_count + 0E0)) < 0'
+        ln_ratio_filter = 'AND {ln_ratio} < 0'.format(ln_ratio=SQL_LN_RATIO)
 
     if concept_id_2 is not None:
         # concept_id_2 is specified, only return the results for the pair (concept_id_1, concept_id_2)
@@ -1308,15 +2127,14 @@ def query_trapi_old(concept_id_1, concept_id_2=None, dataset_id=None, domain_id=
                 c1.concept_count AS {rename_count_1},
                 c2.concept_count AS {rename_count_2},
                 cp.concept_count AS concept_pair_count,
-                c1.concept_count * c2.concept_count / (pc.count + 0E0) AS expected_count,
-                log(cp.concept_count * pc.count / (c1.concept_count * c2.concept_count + 0E0)) AS ln_ratio,
+                c1.concept_count * c2.concept_count / (%(patient_count)s + 0E0) AS expected_count,
+                log(cp.concept_count * %(patient_count)s / (c1.concept_count * c2.concept_count + 0E0)) AS ln_ratio,
                 cp.concept_count / (c1.concept_count + 0E0) AS {rename_rf1},
                 cp.concept_count / (c2.concept_count + 0E0) AS {rename_rf2},
-                pc.count AS patient_count
+                %(patient_count)s AS patient_count
             FROM cohd.concept_pair_counts cp
             JOIN cohd.concept_counts c1 ON cp.concept_id_1 = c1.concept_id
             JOIN cohd.concept_counts c2 ON cp.concept_id_2 = c2.concept_id
-            JOIN cohd.patient_count pc ON cp.dataset_id = pc.dataset_id
             WHERE cp.dataset_id = %(dataset_id)s
                 AND c1.dataset_id = %(dataset_id)s
                 AND c2.dataset_id = %(dataset_id)s
@@ -1326,6 +2144,7 @@ def query_trapi_old(concept_id_1, concept_id_2=None, dataset_id=None, domain_id=
                 ;'''
         params = {
             'dataset_id': dataset_id,
+            'patient_count': dataset_stats.patient_count(dataset_id),
             'concept_id_1': concept_id_1 if order else concept_id_2,
             'concept_id_2': concept_id_2 if order else concept_id_1
         }
@@ -1357,18 +2176,17 @@ def query_trapi_old(concept_id_1, concept_id_2=None, dataset_id=None, domain_id=
                     c1.concept_count AS concept_1_count,
                     c2.concept_count AS concept_2_count,
                     cp.concept_count AS concept_pair_count,
-                    c1.concept_count * c2.concept_count / (pc.count + 0E0) AS expected_count,
-                    log(cp.concept_count * pc.count / (c1.concept_count * c2.concept_count + 0E0)) AS ln_ratio,
+                    c1.concept_count * c2.concept_count / (%(patient_count)s + 0E0) AS expected_count,
+                    log(cp.concept_count * %(patient_count)s / (c1.concept_count * c2.concept_count + 0E0)) AS ln_ratio,
                     cp.concept_count / (c1.concept_count + 0E0) AS relative_frequency_1,
                     cp.concept_count / (c2.concept_count + 0E0) AS relative_frequency_2,
                     c.concept_name AS concept_2_name,
                     c.domain_id AS concept_2_domain,
                     c.concept_class_id AS concept_2_class_id,
-                    pc.count AS patient_count
+                    %(patient_count)s AS patient_count
                 FROM cohd.concept_pair_counts cp
                 JOIN cohd.concept_counts c1 ON cp.concept_id_1 = c1.concept_id
                 JOIN cohd.concept_counts c2 ON cp.concept_id_2 = c2.concept_id
-                JOIN cohd.patient_count pc ON cp.dataset_id = pc.dataset_id
                 JOIN cohd.concept c ON cp.concept_id_2 = c.concept_id
                 WHERE cp.dataset_id = %(dataset_id)s
                     AND c1.dataset_id = %(dataset_id)s
@@ -1385,18 +2203,17 @@ def query_trapi_old(concept_id_1, concept_id_2=None, dataset_id=None, domain_id=
                     c2.concept_count AS concept_1_count,
                     c1.concept_count AS concept_2_count,
                     cp.concept_count AS concept_pair_count,
-                    c1.concept_count * c2.concept_count / (pc.count + 0E0) AS expected_count,
-                    log(cp.concept_count * pc.count / (c1.concept_count * c2.concept_count + 0E0)) AS ln_ratio,
+                    c1.concept_count * c2.concept_count / (%(patient_count)s + 0E0) AS expected_count,
+                    log(cp.concept_count * %(patient_count)s / (c1.concept_count * c2.concept_count + 0E0)) AS ln_ratio,
                     cp.concept_count / (c2.concept_count + 0E0) AS relative_frequency_1,
                     cp.concept_count / (c1.concept_count + 0E0) AS relative_frequency_2,
                     c.concept_name AS concept_2_name,
                     c.domain_id AS concept_2_domain,
                     c.concept_class_id AS concept_2_class_id,
-                    pc.count AS patient_count
+                    %(patient_count)s AS patient_count
                 FROM cohd.concept_pair_counts cp
                 JOIN cohd.concept_counts c1 ON cp.concept_id_1 = c1.concept_id
                 JOIN cohd.concept_counts c2 ON cp.concept_id_2 = c2.concept_id
-                JOIN cohd.patient_count pc ON cp.dataset_id = pc.dataset_id
                 JOIN cohd.concept c ON cp.concept_id_1 = c.concept_id
                 WHERE cp.dataset_id = %(dataset_id)s
                     AND c1.dataset_id = %(dataset_id)s
@@ -1408,6 +2225,7 @@ def query_trapi_old(concept_id_1, concept_id_2=None, dataset_id=None, domain_id=
             ORDER BY ABS(ln_ratio) DESC;'''
         params = {
             'dataset_id': dataset_id,
+            'patient_count': dataset_stats.patient_count(dataset_id),
             'concept_id_1': concept_id_1,
         }
 
@@ -1434,34 +2252,33 @@ def query_trapi_old(concept_id_1, concept_id_2=None, dataset_id=None, domain_id=
     json_return = cur.fetchall()
 
     # Perform calculations for results
-    for row in json_return:
+    _, _, p_values, p_values_adjusted = chi_square.chi_square_rows(json_return, pair_count, MIN_P,
+                                                                   count_1='concept_1_count',
+                                                                   count_2='concept_2_count')
+    cpcs, c1s, c2s, ln_ratios = chi_square.columns(json_return, ['concept_pair_count', 'concept_1_count',
+                                                                 'concept_2_count', 'ln_ratio'])
+    # Confidence interval for obsExpRatio
+    # The CI bounds may hit Inf, which causes issues with JSON serialization. Limit it to 999
+    ln_ratio_cis = zip(*(x.tolist() for x in ln_ratio_ci_array(cpcs, ln_ratios, confidence,
+                                                              JSON_INFINITY_REPLACEMENT)))
+    # Confidence intervals for relative frequencies
+    rf1_cis = zip(*(x.tolist() for x in rel_freq_ci_array(cpcs, c1s, confidence, JSON_INFINITY_REPLACEMENT)))
+    rf2_cis = zip(*(x.tolist() for x in rel_freq_ci_array(cpcs, c2s, confidence, JSON_INFINITY_REPLACEMENT)))
+    for row, p, p_adjusted, lr_ci, rf1_ci, rf2_ci in zip(json_return, p_values.tolist(), p_values_adjusted.tolist(),
+                                                         ln_ratio_cis, rf1_cis, rf2_cis):
         cpc = row['concept_pair_count']
         c1 = row['concept_1_count']
         c2 = row['concept_2_count']
-
-        # Confidence interval for obsExpRatio
-        # The CI bounds may hit Inf, which causes issues with JSON serialization. Limit it to 999
-        row['ln_ratio_ci'] = ln_ratio_ci(cpc, row['ln_ratio'], confidence, JSON_INFINITY_REPLACEMENT)
-
-        # Confidence intervals for relative frequencies
-        row['relative_frequency_1_ci'] = rel_freq_ci(cpc, c1, confidence, JSON_INFINITY_REPLACEMENT)
-        row['relative_frequency_2_ci'] = rel_freq_ci(cpc, c2, confidence, JSON_INFINITY_REPLACEMENT)
+        row['ln_ratio_ci'] = lr_ci
+        row['relative_frequency_1_ci'] = rf1_ci
+        row['relative_frequency_2_ci'] = rf2_ci
 
         # Chi-square
-        cpc = float(cpc)
-        c1 = float(c1)
-        c2 = float(c2)
-        pts = float(row['patient_count'])
-        neg = pts - c1 - c2 + cpc
-        # Create the observed and expected RxC tables and perform chi-square
-        o = [neg, c1 - cpc, c2 - cpc, cpc]
-        e = [(pts - c1) * (pts - c2) / pts, c1 * (pts - c2) / pts, c2 * (pts - c1) / pts, c1 * c2 / pts]
-        cs = chisquare(o, e, 2)
-        row['chi_square_p-value'] = max(cs.pvalue, MIN_P)
-        row['chi_square_p-value_adjusted'] = max(min(cs.pvalue * pair_count, 1.0), MIN_P)  # Bonferonni adjustment
+        row['chi_square_p-value'] = p
+        row['chi_square_p-value_adjusted'] = p_adjusted  # Bonferonni adjustment
 
         # Log-odds
-        lo, lo_ci = log_odds(c1, c2, cpc, pts, JSON_INFINITY_REPLACEMENT)
+        lo, lo_ci = log_odds(float(c1), float(c2), float(cpc), float(row['patient_count']), JSON_INFINITY_REPLACEMENT)
         row['log_odds'] = lo
         row['log_odds_ci'] = lo_ci
 
@@ -1472,6 +2289,51 @@ def query_trapi_old(concept_id_1, concept_id_2=None, dataset_id=None, domain_id=
     return json_return
 
 
+def _load_dataset_stats():
+    """ Loads the per-dataset constants cached by dataset_stats
+
+    Returns
+    -------
+    dict with patient_counts, total_pair_counts, domain_counts, and domain_pair_counts (see DatasetStatsSnapshot)
+    """
+    patient_counts = dict()
+    total_pair_counts = dict()
+    domain_counts = dict()
+    domain_pair_counts = dict()
+    with sql_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute('SELECT dataset_id, count FROM cohd.patient_count;')
+            for r in cur.fetchall():
+                patient_counts[r['dataset_id']] = int(r['count'])
+
+            cur.execute('''SELECT dataset_id, domain_id, count
+                FROM cohd.domain_concept_counts
+                ORDER BY dataset_id, domain_id;''')
+            for r in cur.fetchall():
+                domain_counts.setdefault(r['dataset_id'], []).append((r['domain_id'], int(r['count'])))
+
+            cur.execute('''SELECT dataset_id, domain_id_1, domain_id_2, count
+                FROM cohd.domain_pair_concept_counts
+                ORDER BY dataset_id, domain_id_1, domain_id_2;''')
+            for r in cur.fetchall():
+                dataset_id = r['dataset_id']
+                domain_pair_counts.setdefault(dataset_id, []).append((r['domain_id_1'], r['domain_id_2'],
+                                                                      int(r['count'])))
+                total_pair_counts[dataset_id] = total_pair_counts.get(dataset_id, 0) + int(r['count'])
+
+    return {
+        'patient_counts': patient_counts,
+        'total_pair_counts': total_pair_counts,
+        'domain_counts': {k: tuple(v) for k, v in domain_counts.items()},
+        'domain_pair_counts': {k: tuple(v) for k, v in domain_pair_counts.items()},
+    }
+
+
+# Per-worker cache of patient counts, total pair counts, and domain counts (see cohd_flask.conf for settings)
+dataset_stats = DatasetStats(_load_dataset_stats,
+                             refresh_interval=app.config.get('DATASET_STATS_REFRESH_INTERVAL', 3600))
+
+
 def get_total_pair_counts(dataset_id: int) -> int:
     """ Returns total number of pairs of concepts in the given dataset
 
@@ -1483,27 +2345,193 @@ def get_total_pair_counts(dataset_id: int) -> int:
     -------
     (int) total number of pairs of concepts
     """
-    if not get_total_pair_counts.total_pair_counts:
-        # Get the total pair counts and store locally for faster future retrieval
-        get_total_pair_counts.total_pair_counts = dict()
-        conn = sql_connection()
-        cur = conn.cursor()
-        sql = '''SELECT dataset_id, SUM(count) AS pair_count
-            FROM domain_pair_concept_counts
-            GROUP BY dataset_id;'''
-        cur.execute(sql)
-        results = cur.fetchall()
-        for result in results:
-            get_total_pair_counts.total_pair_counts[result['dataset_id']] = int(result['pair_count'])
-
-    return get_total_pair_counts.total_pair_counts[dataset_id]
-get_total_pair_counts.total_pair_counts = None
+    return dataset_stats.total_pair_count(dataset_id)
 
 
 def _bypass_cache(f, *args, **kwargs):
     return kwargs.get('bypass', False)
 
 
+def _ln_ratio_filter(ln_ratio_sign):
+    """ SQL filter on the sign of the ln_ratio computed from the joined counts
+
+    Parameters
+    ----------
+    ln_ratio_sign: Int - 1: positive ln_ratio only; -1: negative ln_ratio only; 0: any ln_ratio
+
+    Returns
+    -------
+    SQL filter
+    """
+    if ln_ratio_sign > 0:
+        return 'AND {ln_ratio} > 0'.format(ln_ratio=SQL_LN_RATIO)
+    elif ln_ratio_sign < 0:
+        return 'AND {ln_ratio} < 0'.format(ln_ratio=SQL_LN_RATIO)
+    return ''
+
+
+@sql_statements.statement('trapi_pair')
+def _sql_trapi_pair(order, ln_ratio_sign):
+    """ query_trapi statement for a single pair
+
+    Parameters
+    ----------
+    order: True if concept_id_1 < concept_id_2 (the order the pair is stored in)
+    ln_ratio_sign: 1, -1, or 0
+    """
+    sql = '''SELECT
+            cp.dataset_id,
+            cp.concept_id_1 AS {rename_id_1},
+            cp.concept_id_2 AS {rename_id_2},
+            c1.concept_count AS {rename_count_1},
+            c2.concept_count AS {rename_count_2},
+            cp.concept_count AS concept_pair_count,
+            c1.concept_count * c2.concept_count / (%(patient_count)s + 0E0) AS expected_count,
+            p_value,
+            ln_ratio,
+            ln_ratio_ci_lo,
+            ln_ratio_ci_hi,
+            cp.concept_count / (c1.concept_count + 0E0) AS {rename_rf1},
+            cp.pair_count_ci_lo / (c1.ci_hi + 0E0) AS {rename_rf1_ci_lo},
+            cp.pair_count_ci_hi / (c1.ci_lo + 0E0) AS {rename_rf1_ci_hi},
+            cp.concept_count / (c2.concept_count + 0E0) AS {rename_rf2},
+            cp.pair_count_ci_lo / (c2.ci_hi + 0E0) AS {rename_rf2_ci_lo},
+            cp.pair_count_ci_hi / (c2.ci_lo + 0E0) AS {rename_rf2_ci_hi},
+            log_odds,
+            log_odds_ci_lo,
+            log_odds_ci_hi,
+            %(patient_count)s AS patient_count
+        FROM cohd.concept_pair_counts cp
+        JOIN cohd.concept_counts c1 ON cp.concept_id_1 = c1.concept_id
+        JOIN cohd.concept_counts c2 ON cp.concept_id_2 = c2.concept_id
+        WHERE cp.dataset_id = %(dataset_id)s
+            AND c1.dataset_id = %(dataset_id)s
+            AND c2.dataset_id = %(dataset_id)s
+            AND cp.concept_id_1 = %(concept_id_1)s
+            AND cp.concept_id_2 = %(concept_id_2)s
+            {ln_ratio_filter}
+            ;'''
+    rename_id_1 = 'concept_id_1'
+    rename_id_2 = 'concept_id_2'
+    rename_count_1 = 'concept_1_count'
+    rename_count_2 = 'concept_2_count'
+    rename_rf1 = 'relative_frequency_1'
+    rename_rf2 = 'relative_frequency_2'
+    rename_rf1_ci_lo = 'rf1_ci_lo'
+    rename_rf1_ci_hi = 'rf1_ci_hi'
+    rename_rf2_ci_lo = 'rf2_ci_lo'
+    rename_rf2_ci_hi = 'rf2_ci_hi'
+
+    if not order:
+        rename_id_1 = 'concept_id_2'
+        rename_id_2 = 'concept_id_1'
+        rename_count_1 = 'concept_2_count'
+        rename_count_2 = 'concept_1_count'
+        rename_rf1 = 'relative_frequency_2'
+        rename_rf2 = 'relative_frequency_1'
+        rename_rf1_ci_lo = 'rf2_ci_lo'
+        rename_rf1_ci_hi = 'rf2_ci_hi'
+        rename_rf2_ci_lo = 'rf1_ci_lo'
+        rename_rf2_ci_hi = 'rf1_ci_hi'
+    return sql.format(rename_id_1=rename_id_1, rename_id_2=rename_id_2, rename_count_1=rename_count_1,
+                      rename_count_2=rename_count_2, rename_rf1=rename_rf1, rename_rf2=rename_rf2,
+                      ln_ratio_filter=_ln_ratio_filter(ln_ratio_sign),
+                      rename_rf1_ci_lo=rename_rf1_ci_lo, rename_rf1_ci_hi=rename_rf1_ci_hi,
+                      rename_rf2_ci_lo=rename_rf2_ci_lo, rename_rf2_ci_hi=rename_rf2_ci_hi)
+
+
+@sql_statements.statement('trapi_associations')
+def _sql_trapi_associations(domain, concept_class, ln_ratio_sign):
+    """ query_trapi statement for all associations of a concept
+
+    Parameters
+    ----------
+    domain: True to filter the associated concepts by %(domain_id)s
+    concept_class: True to filter the associated concepts by %(concept_class_id)s
+    ln_ratio_sign: 1, -1, or 0
+    """
+    sql = '''SELECT *
+        FROM
+            ((SELECT
+                cp.dataset_id,
+                cp.concept_id_1,
+                cp.concept_id_2,
+                c1.concept_count AS concept_1_count,
+                c2.concept_count AS concept_2_count,
+                cp.concept_count AS concept_pair_count,
+                c1.concept_count * c2.concept_count / (%(patient_count)s + 0E0) AS expected_count,
+                p_value,
+                ln_ratio,
+                ln_ratio_ci_lo,
+                ln_ratio_ci_hi,
+                cp.concept_count / (c1.concept_count + 0E0) AS relative_frequency_1,
+                cp.pair_count_ci_lo / (c1.ci_hi + 0E0) AS rf1_ci_lo,
+                cp.pair_count_ci_hi / (c1.ci_lo + 0E0) AS rf1_ci_hi,
+                cp.concept_count / (c2.concept_count + 0E0) AS relative_frequency_2,
+                cp.pair_count_ci_lo / (c2.ci_hi + 0E0) AS rf2_ci_lo,
+                cp.pair_count_ci_hi / (c2.ci_lo + 0E0) AS rf2_ci_hi,                    
+                log_odds,
+                log_odds_ci_lo,
+                log_odds_ci_hi,
+                c.concept_name AS concept_2_name,
+                c.domain_id AS concept_2_domain,
+                c.concept_class_id AS concept_2_class_id,
+                %(patient_count)s AS patient_count
+            FROM cohd.concept_pair_counts cp
+            JOIN cohd.concept_counts c1 ON cp.concept_id_1 = c1.concept_id
+            JOIN cohd.concept_counts c2 ON cp.concept_id_2 = c2.concept_id
+            JOIN cohd.concept c ON cp.concept_id_2 = c.concept_id
+            WHERE cp.dataset_id = %(dataset_id)s
+                AND c1.dataset_id = %(dataset_id)s
+                AND c2.dataset_id = %(dataset_id)s
+                AND cp.concept_id_1 = %(concept_id_1)s
+                {domain_filter}
+                {concept_class_filter}
+                {ln_ratio_filter})
+            UNION
+            (SELECT
+                cp.dataset_id,
+                cp.concept_id_2 AS concept_id_1,
+                cp.concept_id_1 AS concept_id_2,
+                c2.concept_count AS concept_1_count,
+                c1.concept_count AS concept_2_count,
+                cp.concept_count AS concept_pair_count,
+                c1.concept_count * c2.concept_count / (%(patient_count)s + 0E0) AS expected_count,
+                p_value,
+                ln_ratio,                    
+                ln_ratio_ci_lo,
+                ln_ratio_ci_hi,
+                cp.concept_count / (c2.concept_count + 0E0) AS relative_frequency_1,
+                cp.pair_count_ci_lo / (c2.ci_hi + 0E0) AS rf1_ci_lo,
+                cp.pair_count_ci_hi / (c2.ci_lo + 0E0) AS rf1_ci_hi,    
+                cp.concept_count / (c1.concept_count + 0E0) AS relative_frequency_2,
+                cp.pair_count_ci_lo / (c1.ci_hi + 0E0) AS rf2_ci_lo,
+                cp.pair_count_ci_hi / (c1.ci_lo + 0E0) AS rf2_ci_hi,
+                log_odds,
+                log_odds_ci_lo,
+                log_odds_ci_hi,
+                c.concept_name AS concept_2_name,
+                c.domain_id AS concept_2_domain,
+                c.concept_class_id AS concept_2_class_id,
+                %(patient_count)s AS patient_count
+            FROM cohd.concept_pair_counts cp
+            JOIN cohd.concept_counts c1 ON cp.concept_id_1 = c1.concept_id
+            JOIN cohd.concept_counts c2 ON cp.concept_id_2 = c2.concept_id
+            JOIN cohd.concept c ON cp.concept_id_1 = c.concept_id
+            WHERE cp.dataset_id = %(dataset_id)s
+                AND c1.dataset_id = %(dataset_id)s
+                AND c2.dataset_id = %(dataset_id)s
+                AND cp.concept_id_2 = %(concept_id_1)s
+                {domain_filter}
+                {concept_class_filter}
+                {ln_ratio_filter})) x
+        ORDER BY ABS(ln_ratio) DESC;'''
+    domain_filter = 'AND c.domain_id = %(domain_id)s' if domain else ''
+    concept_class_filter = 'AND concept_class_id = %(concept_class_id)s' if concept_class else ''
+    return sql.format(domain_filter=domain_filter, concept_class_filter=concept_class_filter,
+                      ln_ratio_filter=_ln_ratio_filter(ln_ratio_sign))
+
+
 @cache.memoize(timeout=86400, unless=_bypass_cache)
 def query_trapi(concept_id_1, concept_id_2=None, dataset_id=None, domain_id=None, concept_class_id=None,
                 ln_ratio_sign=0, confidence=DEFAULT_CONFIDENCE, bypass=False):
@@ -1528,237 +2556,881 @@ def query_trapi(concept_id_1, concept_id_2=None, dataset_id=None, domain_id=None
             concept_id_1=str(concept_id_1)
         )
 
+    # Restrict the associated concept by domain and concept_class
+    domain = domain_id is not None and not domain_id == ['']
+    concept_class = not (concept_class_id is None or not concept_class_id or concept_class_id == [''] or
+                         concept_class_id.isspace())
+
+    store = cooccurrence_store(dataset_id)
+    if store is not None:
+        # Answer from the memory-mapped co-occurrence store without querying MySQL
+        if concept_id_2 is not None:
+            json_return = store.associations(int(concept_id_1), neighbor_ids=[int(concept_id_2)],
+                                             ln_ratio_sign=ln_ratio_sign, include_concept_2=False)
+        else:
+            domain_class_pairs = None
+            if domain or concept_class:
+                domain_class_pairs = [(domain_id if domain else None, concept_class_id if concept_class else None)]
+            json_return = store.associations(int(concept_id_1), domain_class_pairs=domain_class_pairs,
+                                             ln_ratio_sign=ln_ratio_sign)
+        _trapi_postprocess(json_return, store.total_pair_count)
+        return {"results": json_return}
+
+    if concept_id_2 is not None and not pair_may_exist(dataset_id, int(concept_id_1), int(concept_id_2)):
+        return {"results": []}
+
     # Connect to MYSQL database
-    conn = sql_connection()
+    conn = sql_connection(dataset_id)
     cur = conn.cursor()
 
     # Get the total number of pairs for Bonferonni adjustment
     pair_count = get_total_pair_counts(dataset_id)
 
-    # Filter ln ratio
-    if ln_ratio_sign == 0:
-        ln_ratio_filter = ''
-    elif ln_ratio_sign > 0:
-        ln_ratio_filter = 'AND log(cp.concept_count * pc.count / (c1.concept_count * c2.concept_count + 0E0)) > 0'
-    elif ln_ratio_sign < 0:
-        ln_ratio_filter = 'AND log(cp.concept_count * pc.count / (c1.concept_count * c2.concept_count + 0E0)) < 0'
+    if concept_id_2 is not None:
+        # concept_id_2 is specified, only return the results for the pair (concept_id_1, concept_id_2)
+        concept_id_2 = int(concept_id_2)
+        order = concept_id_1 < concept_id_2
+        sql = sql_statements.get_statement('trapi_pair', order=order, ln_ratio_sign=int(np.sign(ln_ratio_sign)))
+        params = {
+            'dataset_id': dataset_id,
+            'patient_count': dataset_stats.patient_count(dataset_id),
+            'concept_id_1': concept_id_1 if order else concept_id_2,
+            'concept_id_2': concept_id_2 if order else concept_id_1
+        }
+
+    else:
+        # If concept_id_2 is not specified, get results for all pairs that include concept_id_1
+        params = {
+            'dataset_id': dataset_id,
+            'patient_count': dataset_stats.patient_count(dataset_id),
+            'concept_id_1': concept_id_1,
+        }
+
+        if domain:
+            params['domain_id'] = domain_id
+        if concept_class:
+            params['concept_class_id'] = concept_class_id
+
+        sql = sql_statements.get_statement('trapi_associations', domain=domain, concept_class=concept_class,
+                                           ln_ratio_sign=int(np.sign(ln_ratio_sign)))
+        sql = _association_sql(sql)
+
+    cur.execute(sql, params)
+    json_return = cur.fetchall()
+
+    # Perform calculations for results
+    _trapi_postprocess(json_return, pair_count)
+
+    cur.close()
+    conn.close()
+
+    json_return = {"results": json_return}
+    return json_return     
+
+
+# Columns of the query_trapi result rows used to derive the TRAPI statistics
+_TRAPI_STAT_COLUMNS = ['ln_ratio_ci_lo', 'ln_ratio_ci_hi', 'rf1_ci_lo', 'rf1_ci_hi', 'rf2_ci_lo', 'rf2_ci_hi', 'p_value',
+                       'log_odds', 'log_odds_ci_lo', 'log_odds_ci_hi']
+
+
+def _trapi_statistics(columns, pair_count):
+    """ Derives the TRAPI statistics (clipped CIs, Bonferroni-adjusted p-values, etc) from result columns
+
+    Parameters
+    ----------
+    columns: dict of _TRAPI_STAT_COLUMNS -> arrays
+    pair_count: total number of concept pairs in the dataset (for Bonferonni adjustment)
+
+    Returns
+    -------
+    dict of result field -> list of values
+    """
+    # The CI bounds may hit Inf, which causes issues with JSON serialization. Limit it to 999
+    def _clip(x):
+        return np.clip(x, -JSON_INFINITY_REPLACEMENT, JSON_INFINITY_REPLACEMENT).tolist()
+
+    def _pairs(lo, hi, pair_type=tuple):
+        return [pair_type(x) for x in zip(lo, hi)]
+
+    p_value = columns['p_value']
+    return {
+        # Confidence interval for obsExpRatio
+        'ln_ratio_ci': _pairs(_clip(columns['ln_ratio_ci_lo']), _clip(columns['ln_ratio_ci_hi'])),
+        # Confidence intervals for relative frequencies
+        'relative_frequency_1_ci': _pairs(columns['rf1_ci_lo'].tolist(),
+                                          np.minimum(columns['rf1_ci_hi'], JSON_INFINITY_REPLACEMENT).tolist()),
+        'relative_frequency_2_ci': _pairs(columns['rf2_ci_lo'].tolist(),
+                                          np.minimum(columns['rf2_ci_hi'], JSON_INFINITY_REPLACEMENT).tolist()),
+        # Chi-square
+        'chi_square_p-value': np.maximum(p_value, MIN_P).tolist(),
+        'chi_square_p-value_adjusted': np.maximum(np.minimum(p_value * pair_count, 1.0), MIN_P).tolist(),
+        # Log-odds
+        'log_odds': _clip(columns['log_odds']),
+        'log_odds_ci': _pairs(_clip(columns['log_odds_ci_lo']), _clip(columns['log_odds_ci_hi']), list),
+    }
+
+
+def _trapi_postprocess(rows, pair_count):
+    """ Derives the TRAPI statistics (clipped CIs, Bonferroni-adjusted p-values, etc) for query_trapi result rows
+
+    Parameters
+    ----------
+    rows: list of result rows (dicts), modified in place
+    pair_count: total number of concept pairs in the dataset (for Bonferroni adjustment)
+    """
+    if not rows:
+        return
+    columns = dict(zip(_TRAPI_STAT_COLUMNS, chi_square.columns(rows, _TRAPI_STAT_COLUMNS)))
+    statistics = _trapi_statistics(columns, pair_count)
+    names = list(statistics)
+    for row, values in zip(rows, zip(*statistics.values())):
+        row.update(zip(names, values))
+
+
+def _trapi_scores(ln_ratio_ci_lo, ln_ratio_ci_hi):
+    """ Vectorized cohd_trapi.score_cohd_result: the bound of the clipped ln_ratio CI closest to 0, or 0 if the CI spans
+    0
+
+    Parameters
+    ----------
+    ln_ratio_ci_lo: array of ln_ratio CI lower bounds
+    ln_ratio_ci_hi: array of ln_ratio CI upper bounds
+
+    Returns
+    -------
+    array of scores
+    """
+    lo = np.minimum(ln_ratio_ci_lo, JSON_INFINITY_REPLACEMENT)
+    hi = np.maximum(ln_ratio_ci_hi, -JSON_INFINITY_REPLACEMENT)
+    return np.where(lo > 0, lo, np.where(hi < 0, -hi, 0.0))
+
+
+def _top_by_group(groups, scores, n):
+    """ Selects the rows that rank within the top n by score of their group. Rows tied with the n-th row are kept.
+
+    Parameters
+    ----------
+    groups: array of group IDs
+    scores: array of scores
+    n: number of rows to keep per group
+
+    Returns
+    -------
+    (keep, complete_groups): boolean mask of the rows to keep, and dict of group ID -> True if every row of the group
+    was kept
+    """
+    if len(groups) == 0:
+        return np.zeros(0, dtype=bool), dict()
+    order = np.lexsort((-scores, groups))
+    sorted_groups = groups[order]
+    sorted_scores = scores[order]
+    starts = np.flatnonzero(np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+    sizes = np.diff(np.r_[starts, len(order)])
+    thresholds = sorted_scores[starts + np.minimum(sizes, n) - 1]
+    keep_sorted = sorted_scores >= np.repeat(thresholds, sizes)
+    keep = np.empty(len(order), dtype=bool)
+    keep[order] = keep_sorted
+    complete = np.add.reduceat(keep_sorted, starts) == sizes
+    return keep, dict(zip(sorted_groups[starts].tolist(), complete.tolist()))
+
+
+@sql_statements.statement('trapi_many')
+def _sql_trapi_many(n_ids, domain_class_shape, ln_ratio_sign):
+    """ query_trapi_many statement
+
+    Parameters
+    ----------
+    n_ids: number of placeholders in the %(concept_id_i)s IN list
+    domain_class_shape: tuple with an entry for each domain-class pair filter. True if the pair
+                        (%(domain_id_i)s, %(concept_class_id_i)s) has a concept class, False if only the domain
+    ln_ratio_sign: 1, -1, or 0
+    """
+    domain_class_filters = list()
+    for i, has_class in enumerate(domain_class_shape):
+        if has_class:
+            domain_class_filters.append(f'(c.domain_id = %(domain_id_{i})s AND '
+                                        f'c.concept_class_id = %(concept_class_id_{i})s)')
+        else:
+            domain_class_filters.append(f'c.domain_id = %(domain_id_{i})s')
+    if domain_class_filters:
+        domain_class_filter = f'AND ({" OR ".join(domain_class_filters)})'
+    else:
+        domain_class_filter = ''
+
+    sql = '''SELECT *
+        FROM
+            ((SELECT
+                cp.dataset_id,
+                cp.concept_id_1,
+                cp.concept_id_2,
+                c1.concept_count AS concept_1_count,
+                c2.concept_count AS concept_2_count,
+                cp.concept_count AS concept_pair_count,
+                c1.concept_count * c2.concept_count / (%(patient_count)s + 0E0) AS expected_count,
+                p_value,
+                ln_ratio,
+                ln_ratio_ci_lo,
+                ln_ratio_ci_hi,
+                cp.concept_count / (c1.concept_count + 0E0) AS relative_frequency_1,
+                cp.pair_count_ci_lo / (c1.ci_hi + 0E0) AS rf1_ci_lo,
+                cp.pair_count_ci_hi / (c1.ci_lo + 0E0) AS rf1_ci_hi,
+                cp.concept_count / (c2.concept_count + 0E0) AS relative_frequency_2,
+                cp.pair_count_ci_lo / (c2.ci_hi + 0E0) AS rf2_ci_lo,
+                cp.pair_count_ci_hi / (c2.ci_lo + 0E0) AS rf2_ci_hi,
+                log_odds,
+                log_odds_ci_lo,
+                log_odds_ci_hi,
+                c.concept_name AS concept_2_name,
+                c.domain_id AS concept_2_domain,
+                c.concept_class_id AS concept_2_class_id,
+                %(patient_count)s AS patient_count
+            FROM cohd.concept_pair_counts cp
+            JOIN cohd.concept_counts c1 ON cp.concept_id_1 = c1.concept_id
+            JOIN cohd.concept_counts c2 ON cp.concept_id_2 = c2.concept_id
+            JOIN cohd.concept c ON cp.concept_id_2 = c.concept_id
+            WHERE cp.dataset_id = %(dataset_id)s
+                AND c1.dataset_id = %(dataset_id)s
+                AND c2.dataset_id = %(dataset_id)s
+                AND cp.concept_id_1 IN ({concept_ids_list})
+                {domain_class_filter}
+                {ln_ratio_filter})
+            UNION ALL
+            (SELECT
+                cp.dataset_id,
+                cp.concept_id_2 AS concept_id_1,
+                cp.concept_id_1 AS concept_id_2,
+                c2.concept_count AS concept_1_count,
+                c1.concept_count AS concept_2_count,
+                cp.concept_count AS concept_pair_count,
+                c1.concept_count * c2.concept_count / (%(patient_count)s + 0E0) AS expected_count,
+                p_value,
+                ln_ratio,
+                ln_ratio_ci_lo,
+                ln_ratio_ci_hi,
+                cp.concept_count / (c2.concept_count + 0E0) AS relative_frequency_1,
+                cp.pair_count_ci_lo / (c2.ci_hi + 0E0) AS rf1_ci_lo,
+                cp.pair_count_ci_hi / (c2.ci_lo + 0E0) AS rf1_ci_hi,
+                cp.concept_count / (c1.concept_count + 0E0) AS relative_frequency_2,
+                cp.pair_count_ci_lo / (c1.ci_hi + 0E0) AS rf2_ci_lo,
+                cp.pair_count_ci_hi / (c1.ci_lo + 0E0) AS rf2_ci_hi,
+                log_odds,
+                log_odds_ci_lo,
+                log_odds_ci_hi,
+                c.concept_name AS concept_2_name,
+                c.domain_id AS concept_2_domain,
+                c.concept_class_id AS concept_2_class_id,
+                %(patient_count)s AS patient_count
+            FROM cohd.concept_pair_counts cp
+            JOIN cohd.concept_counts c1 ON cp.concept_id_1 = c1.concept_id
+            JOIN cohd.concept_counts c2 ON cp.concept_id_2 = c2.concept_id
+            JOIN cohd.concept c ON cp.concept_id_1 = c.concept_id
+            WHERE cp.dataset_id = %(dataset_id)s
+                AND c1.dataset_id = %(dataset_id)s
+                AND c2.dataset_id = %(dataset_id)s
+                AND cp.concept_id_2 IN ({concept_ids_list})
+                {domain_class_filter}
+                {ln_ratio_filter})) x
+        ORDER BY concept_id_1 ASC, ABS(ln_ratio) DESC;'''
+    return sql.format(concept_ids_list=sql_statements.in_list('concept_id', n_ids),
+                      domain_class_filter=domain_class_filter, ln_ratio_filter=_ln_ratio_filter(ln_ratio_sign))
+
+
+@cache.memoize(timeout=86400, unless=_bypass_cache)
+def query_trapi_many(concept_ids, dataset_id=None, domain_class_pairs=None, ln_ratio_sign=0,
+                     confidence=DEFAULT_CONFIDENCE, bypass=False, max_results=None):
+    """ Query for TRAPI BATCH queries. Retrieves the associations for a set of concepts in a single statement.
+    Equivalent to calling query_trapi(concept_id_1=x, concept_id_2=None, ...) for each x in concept_ids and each
+    domain-class pair, except that an associated concept matching several domain-class pairs is only returned once.
+
+    Parameters
+    ----------
+    concept_ids: list of OMOP concept IDs
+    dataset_id: (optional) String - COHD dataset ID
+    domain_class_pairs: (optional) iterable of (domain_id, concept_class_id) pairs to restrict the associated concepts
+                        to. concept_class_id may be None to allow any class in the domain. None allows all domains.
+    ln_ratio_sign: (optional) Int - 1: positive ln_ratio only; -1: negative ln_ratio only; 0: any ln_ratio
+    confidence: (optional) Float - Confidence level
+    max_results: (optional) Int - Only return the top max_results associations of each concept by TRAPI score (ties
+                 included). The statistics are only derived for those associations.
+
+    Returns
+    -------
+    dict[concept_id] = list of results sorted by ABS(ln_ratio) descending. Concept IDs without associations are
+    mapped to an empty list. With max_results, dict[concept_id] = (results, complete, remainder), where results and
+    complete are as in query_trapi_top (complete is False if associations ranking after the results were left out),
+    and remainder is a TrapiRemainder with the associations that were left out.
+    """
+    assert concept_ids is not None and len(concept_ids) > 0, \
+        f'query_cohd_mysql.py::query_trapi_many() - Bad input. concept_ids={concept_ids}'
+
+    concept_ids = [int(x) for x in concept_ids]
+    results = {concept_id: list() for concept_id in concept_ids}
+
+    store = cooccurrence_store(dataset_id)
+    if store is not None:
+        # Answer from the memory-mapped co-occurrence store without querying MySQL
+        domain_class_pairs = [(d, None if c is None or not c or c.isspace() else c)
+                              for d, c in (domain_class_pairs or []) if d is not None and d]
+        rows = list()
+        for concept_id in results:
+            rows.extend(store.associations(concept_id, domain_class_pairs=domain_class_pairs or None,
+                                           ln_ratio_sign=ln_ratio_sign))
+        return _trapi_many_results(results, rows, store.total_pair_count, max_results)
+
+    # Get the total number of pairs for Bonferonni adjustment
+    pair_count = get_total_pair_counts(dataset_id)
+
+    params = {
+        'dataset_id': dataset_id,
+        'patient_count': dataset_stats.patient_count(dataset_id),
+    }
+
+    # Bind the input concept IDs as parameters
+    n_ids = sql_statements.bind_in_list(params, 'concept_id', concept_ids)
+
+    # Restrict the associated concepts to any of the domain-class pairs
+    domain_class_shape = list()
+    for domain_id, concept_class_id in (domain_class_pairs or []):
+        if domain_id is None or not domain_id:
+            continue
+        i = len(domain_class_shape)
+        params[f'domain_id_{i}'] = domain_id
+        if concept_class_id is None or not concept_class_id or concept_class_id.isspace():
+            domain_class_shape.append(False)
+        else:
+            params[f'concept_class_id_{i}'] = concept_class_id
+            domain_class_shape.append(True)
+
+    sql = sql_statements.get_statement('trapi_many', n_ids=n_ids, domain_class_shape=tuple(domain_class_shape),
+                                       ln_ratio_sign=int(np.sign(ln_ratio_sign)))
+    sql = _association_sql(sql)
+
+    with sql_connection(dataset_id) as conn:
+        with conn.cursor() as cur:
+            cur.execute(sql, params)
+            rows = cur.fetchall()
+
+    return _trapi_many_results(results, rows, pair_count, max_results)
+
+
+def _trapi_many_results(results, rows, pair_count, max_results=None):
+    """ Performs the calculations for query_trapi_many rows and groups them by input concept
+
+    Parameters
+    ----------
+    results: dict[concept_id] = empty list, for each input concept
+    rows: result rows sorted by concept_id_1
+    pair_count: total number of concept pairs in the dataset (for Bonferroni adjustment)
+    max_results: (optional) number of results to keep per input concept by TRAPI score
+
+    Returns
+    -------
+    results, see query_trapi_many
+    """
+    if max_results is None:
+        _trapi_postprocess(rows, pair_count)
+        for row in rows:
+            results[row['concept_id_1']].append(row)
+        return results
+
+    # Rank the associations of each concept by score with column arrays, and only derive the statistics of the rows
+    # that are kept. The rows that are cut off are kept as they are for TrapiRemainder.
+    concept_ids_1, = chi_square.columns(rows, ['concept_id_1'], dtype=np.int64)
+    ci_lo, ci_hi = chi_square.columns(rows, ['ln_ratio_ci_lo', 'ln_ratio_ci_hi'])
+    keep, complete = _top_by_group(concept_ids_1, _trapi_scores(ci_lo, ci_hi), max_results)
+    remaining = {concept_id: list() for concept_id in results}
+    for row, k in zip(rows, keep.tolist()):
+        if k:
+            results[row['concept_id_1']].append(row)
+        else:
+            remaining[row['concept_id_1']].append(row)
+    _trapi_postprocess([row for concept_rows in results.values() for row in concept_rows], pair_count)
+    return {concept_id: (concept_rows, complete.get(concept_id, True),
+                         TrapiRemainder(remaining[concept_id], pair_count))
+            for concept_id, concept_rows in results.items()}
+
+
+class TrapiRemainder:
+    """ Associations of a concept that query_trapi_many left out of the top results. The statistics are only derived
+    when the results are requested, so associations that are never used are not post-processed.
+    """
+    def __init__(self, rows, pair_count):
+        """ Constructor
+
+        Parameters
+        ----------
+        rows: query_trapi_many result rows without the derived statistics
+        pair_count: total number of concept pairs in the dataset (for Bonferroni adjustment)
+        """
+        self._rows = rows
+        self._pair_count = pair_count
+        self._postprocessed = False
+
+    def __len__(self):
+        return len(self._rows)
+
+    def results(self):
+        """ Gets the associations with the TRAPI statistics
+
+        Returns
+        -------
+        list of results sorted by ABS(ln_ratio) descending
+        """
+        if not self._postprocessed:
+            _trapi_postprocess(self._rows, self._pair_count)
+            self._postprocessed = True
+        return self._rows
+
+
+@sql_statements.statement('trapi_top')
+def _sql_trapi_top(n_ids, domain_class_shape, ln_ratio_sign):
+    """ query_trapi_top statement
+
+    Parameters
+    ----------
+    n_ids: number of placeholders in the %(concept_id_i)s IN list
+    domain_class_shape: tuple with an entry for each domain-class pair filter. True if the pair
+                        (%(domain_id_i)s, %(concept_class_id_i)s) has a concept class, False if only the domain
+    ln_ratio_sign: 1, -1, or 0
+    """
+    domain_class_filters = list()
+    for i, has_class in enumerate(domain_class_shape):
+        if has_class:
+            domain_class_filters.append(f'(t.domain_id = %(domain_id_{i})s AND '
+                                        f't.concept_class_id = %(concept_class_id_{i})s)')
+        else:
+            domain_class_filters.append(f't.domain_id = %(domain_id_{i})s')
+    if domain_class_filters:
+        domain_class_filter = f'AND ({" OR ".join(domain_class_filters)})'
+    else:
+        domain_class_filter = ''
+
+    if ln_ratio_sign > 0:
+        ln_ratio_filter = 'AND t.ln_ratio_sign = 1'
+    elif ln_ratio_sign < 0:
+        ln_ratio_filter = 'AND t.ln_ratio_sign = -1'
+    else:
+        ln_ratio_filter = ''
+
+    sql = '''SELECT
+            cp.dataset_id,
+            t.concept_id_1,
+            t.concept_id_2,
+            c1.concept_count AS concept_1_count,
+            c2.concept_count AS concept_2_count,
+            cp.concept_count AS concept_pair_count,
+            c1.concept_count * c2.concept_count / (%(patient_count)s + 0E0) AS expected_count,
+            p_value,
+            ln_ratio,
+            ln_ratio_ci_lo,
+            ln_ratio_ci_hi,
+            cp.concept_count / (c1.concept_count + 0E0) AS relative_frequency_1,
+            cp.pair_count_ci_lo / (c1.ci_hi + 0E0) AS rf1_ci_lo,
+            cp.pair_count_ci_hi / (c1.ci_lo + 0E0) AS rf1_ci_hi,
+            cp.concept_count / (c2.concept_count + 0E0) AS relative_frequency_2,
+            cp.pair_count_ci_lo / (c2.ci_hi + 0E0) AS rf2_ci_lo,
+            cp.pair_count_ci_hi / (c2.ci_lo + 0E0) AS rf2_ci_hi,
+            log_odds,
+            log_odds_ci_lo,
+            log_odds_ci_hi,
+            c.concept_name AS concept_2_name,
+            c.domain_id AS concept_2_domain,
+            c.concept_class_id AS concept_2_class_id,
+            %(patient_count)s AS patient_count,
+            t.domain_id AS top_domain_id,
+            t.concept_class_id AS top_concept_class_id,
+            t.ln_ratio_sign AS top_ln_ratio_sign,
+            t.score AS top_score,
+            t.group_size AS top_group_size
+        FROM cohd.concept_top_associations t
+        JOIN cohd.concept_pair_counts cp ON cp.dataset_id = t.dataset_id
+            AND cp.concept_id_1 = LEAST(t.concept_id_1, t.concept_id_2)
+            AND cp.concept_id_2 = GREATEST(t.concept_id_1, t.concept_id_2)
+        JOIN cohd.concept_counts c1 ON c1.dataset_id = t.dataset_id AND c1.concept_id = t.concept_id_1
+        JOIN cohd.concept_counts c2 ON c2.dataset_id = t.dataset_id AND c2.concept_id = t.concept_id_2
+        JOIN cohd.concept c ON t.concept_id_2 = c.concept_id
+        WHERE t.dataset_id = %(dataset_id)s
+            AND t.concept_id_1 IN ({ids_list})
+            {domain_class_filter}
+            {ln_ratio_filter}
+        ORDER BY t.score DESC;'''
+    return sql.format(ids_list=sql_statements.in_list('concept_id', n_ids), domain_class_filter=domain_class_filter,
+                      ln_ratio_filter=ln_ratio_filter)
+
+
+# Columns of query_trapi_top rows that describe the precomputed group the row came from
+_TOP_COLUMNS = ['top_domain_id', 'top_concept_class_id', 'top_ln_ratio_sign', 'top_score', 'top_group_size']
+
+
+def _top_prefix(rows):
+    """ Gets the rows of a concept's merged top association lists that are certain to rank ahead of every association
+    left out of the lists
+
+    Each group keeps its top associations by score. An association left out of a truncated group scores at most as
+    high as the lowest score kept for that group, so the merged rows scoring at least the highest such bound are the
+    true top associations.
+
+    Parameters
+    ----------
+    rows: query_trapi_top rows of one concept sorted by top_score descending
+
+    Returns
+    -------
+    (prefix rows, complete): complete is True if no group was truncated, i.e., the rows are all of the associations
+    """
+    group_rows = dict()
+    group_min_score = dict()
+    group_size = dict()
+    for row in rows:
+        group = (row['top_domain_id'], row['top_concept_class_id'], row['top_ln_ratio_sign'])
+        group_rows[group] = group_rows.get(group, 0) + 1
+        group_min_score[group] = min(group_min_score.get(group, row['top_score']), row['top_score'])
+        group_size[group] = row['top_group_size']
+
+    truncated = [g for g in group_rows if group_size[g] > group_rows[g]]
+    if not truncated:
+        return rows, True
+    threshold = max(group_min_score[g] for g in truncated)
+    return [row for row in rows if row['top_score'] >= threshold], False
+
+
+@cache.memoize(timeout=86400, unless=_bypass_cache)
+def query_trapi_top(concept_ids, dataset_id=None, domain_class_pairs=None, ln_ratio_sign=0,
+                    confidence=DEFAULT_CONFIDENCE, bypass=False):
+    """ Query for TRAPI using the precomputed top associations of each concept (see
+    db/sql/create_top_associations.sql). Like query_trapi_many, but only reads the top associations by TRAPI score
+    instead of every association of the concepts.
+
+    Parameters
+    ----------
+    concept_ids: list of OMOP concept IDs
+    dataset_id: (optional) String - COHD dataset ID
+    domain_class_pairs: (optional) list of (domain_id, concept_class_id) pairs. concept_class_id may be None
+    ln_ratio_sign: (optional) Int - 1: positive ln_ratio only; -1: negative ln_ratio only; 0: any ln_ratio
+    confidence: (optional) Float - Confidence level
+
+    Returns
+    -------
+    None if the top associations have not been precomputed. Otherwise, dict[concept_id] = (results, complete), where
+    results are the top associations sorted by TRAPI score descending, and complete is False if the concept has more
+    associations, which only rank after the results (use query_trapi_many to get them).
+    """
+    if not top_associations():
+        return None
+
+    concept_ids = [int(x) for x in concept_ids]
+    rows_by_concept = {concept_id: list() for concept_id in concept_ids}
+    if not concept_ids:
+        return dict()
+
+    # Get the total number of pairs for Bonferonni adjustment
+    pair_count = get_total_pair_counts(dataset_id)
+
+    params = {
+        'dataset_id': dataset_id,
+        'patient_count': dataset_stats.patient_count(dataset_id),
+    }
+    n_ids = sql_statements.bind_in_list(params, 'concept_id', concept_ids)
+
+    # Restrict the associated concepts to any of the domain-class pairs
+    domain_class_shape = list()
+    for domain_id, concept_class_id in (domain_class_pairs or []):
+        if domain_id is None or not domain_id:
+            continue
+        i = len(domain_class_shape)
+        params[f'domain_id_{i}'] = domain_id
+        if concept_class_id is None or not concept_class_id or concept_class_id.isspace():
+            domain_class_shape.append(False)
+        else:
+            params[f'concept_class_id_{i}'] = concept_class_id
+            domain_class_shape.append(True)
+
+    sql = sql_statements.get_statement('trapi_top', n_ids=n_ids, domain_class_shape=tuple(domain_class_shape),
+                                       ln_ratio_sign=int(np.sign(ln_ratio_sign)))
+
+    with sql_connection(dataset_id) as conn:
+        with conn.cursor() as cur:
+            cur.execute(sql, params)
+            rows = cur.fetchall()
+
+    for row in rows:
+        rows_by_concept[row['concept_id_1']].append(row)
+
+    results = dict()
+    for concept_id, concept_rows in rows_by_concept.items():
+        concept_rows, complete = _top_prefix(concept_rows)
+        for row in concept_rows:
+            for col in _TOP_COLUMNS:
+                del row[col]
+        _trapi_postprocess(concept_rows, pair_count)
+        results[concept_id] = (concept_rows, complete)
+
+    return results
+
+
+# Columns of query_trapi_pairs results that are swapped when orienting a pair stored as (concept_id_1, concept_id_2)
+_TRAPI_PAIR_SWAP_COLUMNS = [
+    ('concept_id_1', 'concept_id_2'),
+    ('concept_1_count', 'concept_2_count'),
+    ('relative_frequency_1', 'relative_frequency_2'),
+    ('rf1_ci_lo', 'rf2_ci_lo'),
+    ('rf1_ci_hi', 'rf2_ci_hi'),
+    ('concept_1_name', 'concept_2_name'),
+    ('concept_1_domain', 'concept_2_domain'),
+    ('concept_1_class_id', 'concept_2_class_id'),
+]
+
+
+def _orient_trapi_pair_row(row, swap):
+    """ Orients a concept pair row from the database (smaller concept ID first) as (source, target)
+
+    Parameters
+    ----------
+    row: result row with the columns in _TRAPI_PAIR_SWAP_COLUMNS
+    swap: True to swap the concept_1 and concept_2 columns
+
+    Returns
+    -------
+    New result row in query_trapi format
+    """
+    row = dict(row)
+    if swap:
+        for col_1, col_2 in _TRAPI_PAIR_SWAP_COLUMNS:
+            row[col_1], row[col_2] = row[col_2], row[col_1]
+
+    # Only the target concept's definition is included in query_trapi results
+    del row['concept_1_name']
+    del row['concept_1_domain']
+    del row['concept_1_class_id']
+    return row
+
+
+@sql_statements.statement('trapi_pairs')
+def _sql_trapi_pairs(n_ids_1, n_ids_2, ln_ratio_sign):
+    """ query_trapi_pairs statement
+
+    Parameters
+    ----------
+    n_ids_1: number of placeholders in the %(id_1_i)s IN list
+    n_ids_2: number of placeholders in the %(id_2_i)s IN list
+    ln_ratio_sign: 1, -1, or 0
+    """
+    if ln_ratio_sign > 0:
+        ln_ratio_filter = 'AND ln_ratio > 0'
+    elif ln_ratio_sign < 0:
+        ln_ratio_filter = 'AND ln_ratio < 0'
+    else:
+        ln_ratio_filter = ''
+
+    # The database stores each pair once with the smaller concept ID as concept_id_1, so check both orientations
+    sql = '''SELECT
+            cp.dataset_id,
+            cp.concept_id_1,
+            cp.concept_id_2,
+            c1.concept_count AS concept_1_count,
+            c2.concept_count AS concept_2_count,
+            cp.concept_count AS concept_pair_count,
+            c1.concept_count * c2.concept_count / (%(patient_count)s + 0E0) AS expected_count,
+            p_value,
+            ln_ratio,
+            ln_ratio_ci_lo,
+            ln_ratio_ci_hi,
+            cp.concept_count / (c1.concept_count + 0E0) AS relative_frequency_1,
+            cp.pair_count_ci_lo / (c1.ci_hi + 0E0) AS rf1_ci_lo,
+            cp.pair_count_ci_hi / (c1.ci_lo + 0E0) AS rf1_ci_hi,
+            cp.concept_count / (c2.concept_count + 0E0) AS relative_frequency_2,
+            cp.pair_count_ci_lo / (c2.ci_hi + 0E0) AS rf2_ci_lo,
+            cp.pair_count_ci_hi / (c2.ci_lo + 0E0) AS rf2_ci_hi,
+            log_odds,
+            log_odds_ci_lo,
+            log_odds_ci_hi,
+            con1.concept_name AS concept_1_name,
+            con1.domain_id AS concept_1_domain,
+            con1.concept_class_id AS concept_1_class_id,
+            con2.concept_name AS concept_2_name,
+            con2.domain_id AS concept_2_domain,
+            con2.concept_class_id AS concept_2_class_id,
+            %(patient_count)s AS patient_count
+        FROM cohd.concept_pair_counts cp
+        JOIN cohd.concept_counts c1 ON cp.concept_id_1 = c1.concept_id
+        JOIN cohd.concept_counts c2 ON cp.concept_id_2 = c2.concept_id
+        JOIN cohd.concept con1 ON cp.concept_id_1 = con1.concept_id
+        JOIN cohd.concept con2 ON cp.concept_id_2 = con2.concept_id
+        WHERE cp.dataset_id = %(dataset_id)s
+            AND c1.dataset_id = %(dataset_id)s
+            AND c2.dataset_id = %(dataset_id)s
+            AND ((cp.concept_id_1 IN ({ids_1_list}) AND cp.concept_id_2 IN ({ids_2_list}))
+                OR (cp.concept_id_1 IN ({ids_2_list}) AND cp.concept_id_2 IN ({ids_1_list})))
+            {ln_ratio_filter}
+        ORDER BY ABS(ln_ratio) DESC;'''
+    return sql.format(ids_1_list=sql_statements.in_list('id_1', n_ids_1),
+                      ids_2_list=sql_statements.in_list('id_2', n_ids_2), ln_ratio_filter=ln_ratio_filter)
+
+
+@cache.memoize(timeout=86400, unless=_bypass_cache)
+def query_trapi_pairs(concept_ids_1, concept_ids_2, dataset_id=None, ln_ratio_sign=0, confidence=DEFAULT_CONFIDENCE,
+                      bypass=False):
+    """ Query for TRAPI when both query nodes have IDs. Retrieves the associations between every pair (a, b) with a in
+    concept_ids_1 and b in concept_ids_2 in a single statement. Equivalent to calling
+    query_trapi(concept_id_1=a, concept_id_2=b, ...) for each pair.
+
+    Parameters
+    ----------
+    concept_ids_1: list of OMOP concept IDs
+    concept_ids_2: list of OMOP concept IDs
+    dataset_id: (optional) String - COHD dataset ID
+    ln_ratio_sign: (optional) Int - 1: positive ln_ratio only; -1: negative ln_ratio only; 0: any ln_ratio
+    confidence: (optional) Float - Confidence level
+
+    Returns
+    -------
+    dict[concept_id_1] = list of results sorted by ABS(ln_ratio) descending. IDs from concept_ids_1 without any
+    associations are mapped to an empty list.
+    """
+    concept_ids_1 = [int(x) for x in concept_ids_1]
+    concept_ids_2 = [int(x) for x in concept_ids_2]
+    results = {concept_id: list() for concept_id in concept_ids_1}
+    if not concept_ids_1 or not concept_ids_2:
+        return results
+
+    store = cooccurrence_store(dataset_id)
+    if store is not None:
+        # Answer from the memory-mapped co-occurrence store without querying MySQL
+        for concept_id in results:
+            rows = store.associations(concept_id, neighbor_ids=concept_ids_2, ln_ratio_sign=ln_ratio_sign)
+            _trapi_postprocess(rows, store.total_pair_count)
+            results[concept_id] = rows
+        return results
+
+    f = pair_filter(dataset_id)
+    if f is not None:
+        # Only look up the concepts that may have a pair with a concept in the other list
+        grid_1, grid_2 = np.meshgrid(concept_ids_1, concept_ids_2, indexing='ij')
+        candidates = f.contains(grid_1.ravel(), grid_2.ravel()).reshape(grid_1.shape)
+        concept_ids_1 = [c for c, keep in zip(concept_ids_1, candidates.any(axis=1)) if keep]
+        concept_ids_2 = [c for c, keep in zip(concept_ids_2, candidates.any(axis=0)) if keep]
+        if not concept_ids_1:
+            return results
+
+    # Get the total number of pairs for Bonferonni adjustment
+    pair_count = get_total_pair_counts(dataset_id)
+
+    params = {
+        'dataset_id': dataset_id,
+        'patient_count': dataset_stats.patient_count(dataset_id),
+    }
+    n_ids_1 = sql_statements.bind_in_list(params, 'id_1', concept_ids_1)
+    n_ids_2 = sql_statements.bind_in_list(params, 'id_2', concept_ids_2)
+    sql = sql_statements.get_statement('trapi_pairs', n_ids_1=n_ids_1, n_ids_2=n_ids_2,
+                                       ln_ratio_sign=int(np.sign(ln_ratio_sign)))
 
-    if concept_id_2 is not None:
-        # concept_id_2 is specified, only return the results for the pair (concept_id_1, concept_id_2)
-        concept_id_2 = int(concept_id_2)
-        order = concept_id_1 < concept_id_2
-        sql = '''SELECT
-                cp.dataset_id,
-                cp.concept_id_1 AS {rename_id_1},
-                cp.concept_id_2 AS {rename_id_2},
-                c1.concept_count AS {rename_count_1},
-                c2.concept_count AS {rename_count_2},
-                cp.concept_count AS concept_pair_count,
-                c1.concept_count * c2.concept_count / (pc.count + 0E0) AS expected_count,
-                p_value,
-                ln_ratio,
-                ln_ratio_ci_lo,
-                ln_ratio_ci_hi,
-                cp.concept_count / (c1.concept_count + 0E0) AS {rename_rf1},
-                cp.pair_count_ci_lo / (c1.ci_hi + 0E0) AS {rename_rf1_ci_lo},
-                cp.pair_count_ci_hi / (c1.ci_lo + 0E0) AS {rename_rf1_ci_hi},
-                cp.concept_count / (c2.concept_count + 0E0) AS {rename_rf2},
-                cp.pair_count_ci_lo / (c2.ci_hi + 0E0) AS {rename_rf2_ci_lo},
-                cp.pair_count_ci_hi / (c2.ci_lo + 0E0) AS {rename_rf2_ci_hi},
-                log_odds,
-                log_odds_ci_lo,
-                log_odds_ci_hi,
-                pc.count AS patient_count
-            FROM cohd.concept_pair_counts cp
-            JOIN cohd.concept_counts c1 ON cp.concept_id_1 = c1.concept_id
-            JOIN cohd.concept_counts c2 ON cp.concept_id_2 = c2.concept_id
-            JOIN cohd.patient_count pc ON cp.dataset_id = pc.dataset_id
-            WHERE cp.dataset_id = %(dataset_id)s
-                AND c1.dataset_id = %(dataset_id)s
-                AND c2.dataset_id = %(dataset_id)s
-                AND cp.concept_id_1 = %(concept_id_1)s
-                AND cp.concept_id_2 = %(concept_id_2)s
-                {ln_ratio_filter}
-                ;'''
-        params = {
-            'dataset_id': dataset_id,
-            'concept_id_1': concept_id_1 if order else concept_id_2,
-            'concept_id_2': concept_id_2 if order else concept_id_1
-        }
-        rename_id_1 = 'concept_id_1'
-        rename_id_2 = 'concept_id_2'
-        rename_count_1 = 'concept_1_count'
-        rename_count_2 = 'concept_2_count'
-        rename_rf1 = 'relative_frequency_1'
-        rename_rf2 = 'relative_frequency_2'
-        rename_rf1_ci_lo = 'rf1_ci_lo'
-        rename_rf1_ci_hi = 'rf1_ci_hi'
-        rename_rf2_ci_lo = 'rf2_ci_lo'
-        rename_rf2_ci_hi = 'rf2_ci_hi'
-        
-        if not order:
-            rename_id_1 = 'concept_id_2'
-            rename_id_2 = 'concept_id_1'
-            rename_count_1 = 'concept_2_count'
-            rename_count_2 = 'concept_1_count'
-            rename_rf1 = 'relative_frequency_2'
-            rename_rf2 = 'relative_frequency_1'
-            rename_rf1_ci_lo = 'rf2_ci_lo'
-            rename_rf1_ci_hi = 'rf2_ci_hi'
-            rename_rf2_ci_lo = 'rf1_ci_lo'
-            rename_rf2_ci_hi = 'rf1_ci_hi'
-        sql = sql.format(rename_id_1=rename_id_1, rename_id_2=rename_id_2, rename_count_1=rename_count_1,
-                         rename_count_2=rename_count_2, rename_rf1=rename_rf1, rename_rf2=rename_rf2,
-                         ln_ratio_filter=ln_ratio_filter,
-                         rename_rf1_ci_lo=rename_rf1_ci_lo, rename_rf1_ci_hi=rename_rf1_ci_hi,
-                         rename_rf2_ci_lo=rename_rf2_ci_lo, rename_rf2_ci_hi=rename_rf2_ci_hi)
+    with sql_connection(dataset_id) as conn:
+        with conn.cursor() as cur:
+            cur.execute(sql, params)
+            rows = cur.fetchall()
+
+    # Orient each pair as (concept from concept_ids_1, concept from concept_ids_2). A pair can match in both
+    # orientations when both concepts are in both lists.
+    set_1 = set(concept_ids_1)
+    set_2 = set(concept_ids_2)
+    oriented_rows = list()
+    for row in rows:
+        if row['concept_id_1'] in set_1 and row['concept_id_2'] in set_2:
+            oriented_rows.append(_orient_trapi_pair_row(row, swap=False))
+        if row['concept_id_2'] in set_1 and row['concept_id_1'] in set_2:
+            oriented_rows.append(_orient_trapi_pair_row(row, swap=True))
+
+    # Perform calculations for results and group them by concept_id_1
+    _trapi_postprocess(oriented_rows, pair_count)
+    for row in oriented_rows:
+        results[row['concept_id_1']].append(row)
 
-    else:
-        # If concept_id_2 is not specified, get results for all pairs that include concept_id_1
-        sql = '''SELECT *
-            FROM
-                ((SELECT
-                    cp.dataset_id,
-                    cp.concept_id_1,
-                    cp.concept_id_2,
-                    c1.concept_count AS concept_1_count,
-                    c2.concept_count AS concept_2_count,
-                    cp.concept_count AS concept_pair_count,
-                    c1.concept_count * c2.concept_count / (pc.count + 0E0) AS expected_count,
-                    p_value,
-                    ln_ratio,
-                    ln_ratio_ci_lo,
-                    ln_ratio_ci_hi,
-                    cp.concept_count / (c1.concept_count + 0E0) AS relative_frequency_1,
-                    cp.pair_count_ci_lo / (c1.ci_hi + 0E0) AS rf1_ci_lo,
-                    cp.pair_count_ci_hi / (c1.ci_lo + 0E0) AS rf1_ci_hi,
-                    cp.concept_count / (c2.concept_count + 0E0) AS relative_frequency_2,
-                    cp.pair_count_ci_lo / (c2.ci_hi + 0E0) AS rf2_ci_lo,
-                    cp.pair_count_ci_hi / (c2.ci_lo + 0E0) AS rf2_ci_hi,                    
-                    log_odds,
-                    log_odds_ci_lo,
-                    log_odds_ci_hi,
-                    c.concept_name AS concept_2_name,
-                    c.domain_id AS concept_2_domain,
-                    c.concept_class_id AS concept_2_class_id,
-                    pc.count AS patient_count
-                FROM cohd.concept_pair_counts cp
-                JOIN cohd.concept_counts c1 ON cp.concept_id_1 = c1.concept_id
-                JOIN cohd.concept_counts c2 ON cp.concept_id_2 = c2.concept_id
-                JOIN cohd.patient_count pc ON cp.dataset_id = pc.dataset_id
-                JOIN cohd.concept c ON cp.concept_id_2 = c.concept_id
-                WHERE cp.dataset_id = %(dataset_id)s
-                    AND c1.dataset_id = %(dataset_id)s
-                    AND c2.dataset_id = %(dataset_id)s
-                    AND cp.concept_id_1 = %(concept_id_1)s
-                    {domain_filter}
-                    {concept_class_filter}
-                    {ln_ratio_filter})
-                UNION
-                (SELECT
-                    cp.dataset_id,
-                    cp.concept_id_2 AS concept_id_1,
-                    cp.concept_id_1 AS concept_id_2,
-                    c2.concept_count AS concept_1_count,
-                    c1.concept_count AS concept_2_count,
-                    cp.concept_count AS concept_pair_count,
-                    c1.concept_count * c2.concept_count / (pc.count + 0E0) AS expected_count,
-                    p_value,
-                    ln_ratio,                    
-                    ln_ratio_ci_lo,
-                    ln_ratio_ci_hi,
-                    cp.concept_count / (c2.concept_count + 0E0) AS relative_frequency_1,
-                    cp.pair_count_ci_lo / (c2.ci_hi + 0E0) AS rf1_ci_lo,
-                    cp.pair_count_ci_hi / (c2.ci_lo + 0E0) AS rf1_ci_hi,    
-                    cp.concept_count / (c1.concept_count + 0E0) AS relative_frequency_2,
-                    cp.pair_count_ci_lo / (c1.ci_hi + 0E0) AS rf2_ci_lo,
-                    cp.pair_count_ci_hi / (c1.ci_lo + 0E0) AS rf2_ci_hi,
-                    log_odds,
-                    log_odds_ci_lo,
-                    log_odds_ci_hi,
-                    c.concept_name AS concept_2_name,
-                    c.domain_id AS concept_2_domain,
-                    c.concept_class_id AS concept_2_class_id,
-                    pc.count AS patient_count
-                FROM cohd.concept_pair_counts cp
-                JOIN cohd.concept_counts c1 ON cp.concept_id_1 = c1.concept_id
-                JOIN cohd.concept_counts c2 ON cp.concept_id_2 = c2.concept_id
-                JOIN cohd.patient_count pc ON cp.dataset_id = pc.dataset_id
-                JOIN cohd.concept c ON cp.concept_id_1 = c.concept_id
-                WHERE cp.dataset_id = %(dataset_id)s
-                    AND c1.dataset_id = %(dataset_id)s
-                    AND c2.dataset_id = %(dataset_id)s
-                    AND cp.concept_id_2 = %(concept_id_1)s
-                    {domain_filter}
-                    {concept_class_filter}
-                    {ln_ratio_filter})) x
-            ORDER BY ABS(ln_ratio) DESC;'''
-        params = {
-            'dataset_id': dataset_id,
-            'concept_id_1': concept_id_1,
-        }
+    return results
 
-        if domain_id is not None and not domain_id == ['']:
-            # Restrict the associated concept by domain
-            domain_filter = 'AND c.domain_id = %(domain_id)s'
-            params['domain_id'] = domain_id
-        else:
-            # Unrestricted domain
-            domain_filter = ''
 
-        # Filter concepts by concept_class
-        if concept_class_id is None or not concept_class_id or concept_class_id == [''] or \
-                concept_class_id.isspace():
-            concept_class_filter = ''
-        else:
-            concept_class_filter = 'AND concept_class_id = %(concept_class_id)s'
-            params['concept_class_id'] = concept_class_id
+def _get_arg_concept_id_list(j, param_name):
+    """ Gets a list of OMOP concept IDs from a JSON request body
 
-        sql = sql.format(domain_filter=domain_filter, concept_class_filter=concept_class_filter,
-                         ln_ratio_filter=ln_ratio_filter)
+    Parameters
+    ----------
+    j: dict from the JSON request body
+    param_name: name of the list parameter
 
-    cur.execute(sql, params)
-    json_return = cur.fetchall()
+    Returns
+    -------
+    list of int concept IDs, or None if the parameter is missing or malformed
+    """
+    concept_ids = j.get(param_name)
+    if concept_ids is None or type(concept_ids) is not list or len(concept_ids) == 0:
+        return None
 
-    # Perform calculations for results
-    for row in json_return:
-        # Confidence interval for obsExpRatio
-        # The CI bounds may hit Inf, which causes issues with JSON serialization. Limit it to 999
-        row['ln_ratio_ci'] = (clip(row['ln_ratio_ci_lo'], JSON_INFINITY_REPLACEMENT), 
-                              clip(row['ln_ratio_ci_hi'], JSON_INFINITY_REPLACEMENT))
+    # Input may be list of ints, strings, or OMOP CURIEs. Convert to ints
+    concept_id_ints = list()
+    for concept_id in concept_ids:
+        if type(concept_id) is str:
+            if concept_id.lower()[:5] == 'omop:':
+                concept_id = concept_id[5:]
+            if not concept_id.strip().isdigit():
+                return None
+            concept_id = int(concept_id.strip())
+        elif type(concept_id) is not int:
+            return None
+        concept_id_ints.append(concept_id)
+    return concept_id_ints
 
-        # Confidence intervals for relative frequencies
-        row['relative_frequency_1_ci'] = row['rf1_ci_lo'], min(row['rf1_ci_hi'], JSON_INFINITY_REPLACEMENT)
-        row['relative_frequency_2_ci'] = row['rf2_ci_lo'], min(row['rf2_ci_hi'], JSON_INFINITY_REPLACEMENT)
 
-        # Chi-square
-        p_value = row['p_value']
-        row['chi_square_p-value'] = max(p_value, MIN_P)
-        row['chi_square_p-value_adjusted'] = max(min(p_value * pair_count, 1.0), MIN_P)  # Bonferonni adjustment
+def query_db_association_pairs(j):
+    """ Associations between every pair of concepts from two lists of concepts
 
-        # Log-odds
-        row['log_odds'] = clip(row['log_odds'], JSON_INFINITY_REPLACEMENT)
-        row['log_odds_ci'] = [clip(row['log_odds_ci_lo'], JSON_INFINITY_REPLACEMENT), 
-                              clip(row['log_odds_ci_hi'], JSON_INFINITY_REPLACEMENT)]
+    Parameters
+    ----------
+    j: dict from the JSON request body with keys concept_ids_1 (list), concept_ids_2 (list), and optionally
+       dataset_id (int)
 
-    cur.close()
-    conn.close()
+    Returns
+    -------
+    {"results": list of results in query_trapi format}, or error message and code
+    """
+    if j is None or type(j) is not dict:
+        return 'Request body should be a JSON object', 400
 
-    json_return = {"results": json_return}
-    return json_return     
+    concept_ids_1 = _get_arg_concept_id_list(j, 'concept_ids_1')
+    if concept_ids_1 is None:
+        return 'concept_ids_1 should be a non-empty list of concept IDs', 400
+    concept_ids_2 = _get_arg_concept_id_list(j, 'concept_ids_2')
+    if concept_ids_2 is None:
+        return 'concept_ids_2 should be a non-empty list of concept IDs', 400
+    if len(concept_ids_1) > PAIRS_MAX_CONCEPT_IDS or len(concept_ids_2) > PAIRS_MAX_CONCEPT_IDS:
+        return f'concept_ids_1 and concept_ids_2 are limited to {PAIRS_MAX_CONCEPT_IDS} concept IDs each', 400
 
+    dataset_id = j.get('dataset_id', DATASET_ID_DEFAULT)
+    if type(dataset_id) is not int:
+        return 'dataset_id should be an integer', 400
 
-def get_pair_concept_count(cur = None, concept_id_list_1 = [], concept_id_list_2 = [], dataset_id = 3,domain_id = None, top_n = 999999):
-    sql = '''
-        SELECT * FROM
-        (
+    results = query_trapi_pairs(concept_ids_1, concept_ids_2, dataset_id=dataset_id)
+    json_return = [row for concept_id in results for row in results[concept_id]]
+    return {"results": json_return}
+
+
+@sql_statements.statement('pair_concept_count')
+def _sql_pair_concept_count(n_ids_1, n_ids_2, domain, bidirectional=False):
+    """ get_pair_concept_count statement
+
+    Parameters
+    ----------
+    n_ids_1: number of placeholders in the %(id_1_i)s IN list
+    n_ids_2: number of placeholders in the %(id_2_i)s IN list, or 0 to not restrict the associated concepts
+    domain: True to filter the associated concepts by %(domain_id)s
+    bidirectional: True to use the bidirectional pair table, which doesn't need the mirrored second branch
+    """
+    sql_1 = '''
             SELECT
                 cp.concept_id_1 as concept_id_1,
                 cp.concept_id_2 as concept_id_2,
                 cp.concept_count as concept_pair_count,
                 c1.concept_count as concept_count_1,
                 c2.concept_count as concept_count_2
-                FROM concept_pair_counts cp
+                FROM {pair_table} cp
                 INNER JOIN concept_counts c1 ON cp.concept_id_1 = c1.concept_id
                 INNER JOIN concept_counts c2 ON cp.concept_id_2 = c2.concept_id
                 INNER JOIN concept con on con.concept_id = cp.concept_id_2
@@ -1767,7 +3439,8 @@ def get_pair_concept_count(cur = None, concept_id_list_1 = [], concept_id_list_2
                 AND c2.dataset_id = %(dataset_id)s
                 {concept_id_filter_1}
                 {domain_filter}
-                GROUP BY concept_id_1, concept_id_2
+                GROUP BY concept_id_1, concept_id_2'''
+    sql_2 = '''
             UNION 
             SELECT
                 cp.concept_id_2 as concept_id_1,
@@ -1784,97 +3457,134 @@ def get_pair_concept_count(cur = None, concept_id_list_1 = [], concept_id_list_2
                 AND c2.dataset_id = %(dataset_id)s
                 {concept_id_filter_2}
                 {domain_filter}
-                GROUP BY concept_id_1, concept_id_2
+                GROUP BY concept_id_1, concept_id_2'''
+    sql = '''
+        SELECT * FROM
+        ({branches}
         ) x
         ORDER BY x.concept_pair_count DESC
-        LIMIT {top_n_filter};
+        LIMIT %(top_n)s;
         '''
+    ids_1 = sql_statements.in_list('id_1', n_ids_1)
+    if n_ids_2 > 0:
+        ids_2 = sql_statements.in_list('id_2', n_ids_2)
+        concept_id_filter_1 = f'AND (cp.concept_id_1 IN ({ids_1}) AND cp.concept_id_2 IN ({ids_2}))'
+        concept_id_filter_2 = f'AND (cp.concept_id_2 IN ({ids_1}) AND cp.concept_id_1 IN ({ids_2}))'
+    else:
+        concept_id_filter_1 = f'AND cp.concept_id_1 IN ({ids_1})'
+        concept_id_filter_2 = f'AND cp.concept_id_2 IN ({ids_1})'
+    domain_filter = 'AND con.domain_id = %(domain_id)s' if domain else ''
+    pair_table = PAIR_TABLE_BIDIRECTIONAL if bidirectional else 'concept_pair_counts'
+    branches = sql_1 if bidirectional else sql_1 + sql_2
+    branches = branches.format(pair_table=pair_table, concept_id_filter_1=concept_id_filter_1,
+                               concept_id_filter_2=concept_id_filter_2, domain_filter=domain_filter)
+    return sql.format(branches=branches)
+
+
+def get_pair_concept_count(cur = None, concept_id_list_1 = [], concept_id_list_2 = [], dataset_id = 3,domain_id = None, top_n = 999999):
     params = {
         'dataset_id': dataset_id,
+        'top_n': int(top_n),
     }
-    concept_id_1 = ','.join([str(c) for c in concept_id_list_1])
+    n_ids_1 = sql_statements.bind_in_list(params, 'id_1', [int(c) for c in concept_id_list_1])
     if len(concept_id_list_2) > 0:
-        concept_id_2 = ','.join([str(c) for c in concept_id_list_2])
-        concept_id_filter_1 = '''
-            AND (
-                (cp.concept_id_1 in ({concept_id_1}) AND cp.concept_id_2 in ({concept_id_2}) )
-            )
-        '''
-        concept_id_filter_2 = '''
-            AND (
-                (cp.concept_id_2 in ({concept_id_1}) AND cp.concept_id_1 in ({concept_id_2}) )
-            )
-        '''
-        concept_id_filter_1 = concept_id_filter_1.format(concept_id_1= concept_id_1, concept_id_2 = concept_id_2)
-        concept_id_filter_2 = concept_id_filter_2.format(concept_id_1= concept_id_1, concept_id_2 = concept_id_2)
+        n_ids_2 = sql_statements.bind_in_list(params, 'id_2', [int(c) for c in concept_id_list_2])
     else:
-        concept_id_filter_1 = '''
-            AND (
-                (cp.concept_id_1 in ({concept_id_1}) )
-            )
-        '''
-        concept_id_filter_2 = '''
-            AND (
-                (cp.concept_id_2 in ({concept_id_1}) )
-            )
-        '''
-        concept_id_filter_1 = concept_id_filter_1.format(concept_id_1 = concept_id_1)
-        concept_id_filter_2 = concept_id_filter_2.format(concept_id_1 = concept_id_1)
+        n_ids_2 = 0
+
     # Filter concepts by domain
-    if domain_id is not None and not domain_id == ['']:
-        domain_filter = 'AND con.domain_id = %(domain_id)s'
+    domain = domain_id is not None and not domain_id == ['']
+    if domain:
         params['domain_id'] = domain_id
-    else:
-        domain_filter = ''
-    
-    sql = sql.format(concept_id_filter_1 = concept_id_filter_1, concept_id_filter_2 = concept_id_filter_2, domain_filter=domain_filter, top_n_filter = top_n)
+
+    sql = sql_statements.get_statement('pair_concept_count', n_ids_1=n_ids_1, n_ids_2=n_ids_2, domain=domain,
+                                       bidirectional=bidirectional_pairs())
     cur.execute(sql, params)
     return cur.fetchall()        
 
 
-def _get_weighted_statistics(cur=None,dataset_id=None,domain_id = None,concept_id_1 = None, pair_count_df = None, json_key = 'jaccard_index'):
-    '''
-    help function.
-    Input 1: original association statistics required
-    Input 2: concept_list in the query for weight calculation (currently only support jaccard index based weight calculation.)
-    return weighted json_key. e.g. ws_jaccard_index. 
-    '''
-    pair_count_df = pair_count_df.copy()
-    concept_list_1_w_df= pd.DataFrame({'concept_id_1':concept_id_1})
-    concept_list_1_w_df['w'] = 1
-
-    # Calculate the weights based on Jaccard index between input concepts
-    pair_count_q1 = pd.DataFrame(get_pair_concept_count(cur=cur,dataset_id=dataset_id,domain_id=domain_id, concept_id_list_1=concept_id_1,concept_id_list_2=concept_id_1))
-    if pair_count_q1.shape[0] > 0:
-        # Sum of Jaccard index
-        pair_count_q1['jaccard_index'] = pair_count_q1['concept_pair_count'] / (pair_count_q1['concept_count_1'] + pair_count_q1['concept_count_2'] - pair_count_q1['concept_pair_count'])
-        pair_count_q1 = pair_count_q1.groupby('concept_id_1')['jaccard_index'].agg('sum').reset_index()
-        concept_list_1_w_df = concept_list_1_w_df.merge(pair_count_q1).reset_index()
-        # 1 + sum(Jaccards)
-        concept_list_1_w_df['w'] = concept_list_1_w_df['w'] + concept_list_1_w_df['jaccard_index']
-    # Weight = 1/(1 + sum(Jaccards))
-    concept_list_1_w_df['w'] = 1/concept_list_1_w_df['w']
-    concept_list_1_w_df = concept_list_1_w_df[['concept_id_1','w']]
-    total_weights = concept_list_1_w_df.w.sum()
-
-    # Multiply the scores by the weights
-    pair_count_df = pair_count_df.merge(concept_list_1_w_df)
-    pair_count_df[json_key] = pair_count_df['w'] * pair_count_df[json_key]
-    pair_count_df = pair_count_df[~pair_count_df['concept_id_2'].isin(concept_id_1)]
-    
-    # Group by concept_id_2. Sum the scores and combine concept_id_1 into a list
-    gb = pair_count_df.groupby('concept_id_2')
-    weighted_stats = gb[json_key].agg('sum')
-    return weighted_stats.reset_index(), total_weights
+def _mcq_weights(concept_ids, pair_counts):
+    """ Weights of the input concepts of a multicurie query. Each input concept is weighted by
+    1 / (1 + sum of its Jaccard indices with the other input concepts), similar to linkage disequilibrium, so that
+    groups of similar input concepts don't dominate the scores.
 
+    Parameters
+    ----------
+    concept_ids: list of input OMOP concept IDs
+    pair_counts: rows of get_pair_concept_count between the input concepts
 
-def _get_ci_scores(r, score_col):
-    if r[score_col][0] > 0:
-        return r[score_col][0]
-    elif r[score_col][1] < 0:
-        return r[score_col][1]
-    else:
-        return 0   
+    Returns
+    -------
+    pandas Series of weights indexed by concept ID. When the input concepts co-occur at all, only the input concepts
+    co-occurring with another input concept are weighted.
+    """
+    pair_counts = pd.DataFrame(pair_counts)
+    if pair_counts.shape[0] == 0:
+        return pd.Series(1.0, index=pd.Index(concept_ids, name='concept_id_1'))
+
+    jaccard = pair_counts['concept_pair_count'] / (pair_counts['concept_count_1'] + pair_counts['concept_count_2'] -
+                                                   pair_counts['concept_pair_count'])
+    jaccard = jaccard.groupby(pair_counts['concept_id_1']).sum()
+    return 1 / (1 + jaccard[jaccard.index.isin(concept_ids)])
+
+
+def _mcq_scores(associations, pair_counts, n_member_ids, score_scaling=DEFAULT_MCQ_SCORE_SCALING):
+    """ Scores the associations of a multicurie query. All steps are vectorized or group-by operations over the
+    associations of all input concepts, so the cost grows linearly with the number of input concepts and associations.
+
+    Parameters
+    ----------
+    associations: list of query_trapi results of all input concepts
+    pair_counts: rows of get_pair_concept_count between the input concepts
+    n_member_ids: number of input IDs in set node
+    score_scaling: linear scaling of ln_ratio_score prior to logistic normalization
+
+    Returns
+    -------
+    (set associations, dict[concept_id_2] = list of single associations)
+    """
+    if not associations:
+        return list(), dict()
+    rows = associations
+    associations = pd.DataFrame(rows)
+
+    # Scorify ln_ratio: the CI bound closest to 0, or 0 if the CI includes 0
+    ci = np.array(associations['ln_ratio_ci'].tolist(), dtype=np.float64).reshape(-1, 2)
+    associations['ln_ratio_score'] = np.where(ci[:, 0] > 0, ci[:, 0], np.where(ci[:, 1] < 0, ci[:, 1], 0.0))
+
+    # Sum the weighted scores of each associated concept that isn't one of the input concepts
+    concept_list_1 = associations['concept_id_1'].unique()
+    weights = _mcq_weights(concept_list_1, pair_counts)
+    weighted = associations[associations['concept_id_1'].isin(weights.index) &
+                            ~associations['concept_id_2'].isin(concept_list_1)]
+    ln_ratio_score = (weighted['ln_ratio_score'] * weighted['concept_id_1'].map(weights)) \
+        .groupby(weighted['concept_id_2']).sum()
+
+    # For TRAPI result score, normalize the score relative to the number of input CURIEs and
+    # scale the score range to [0-1] using a scaled logistic function
+    mcq_score = ln_ratio_score / weights.sum() * len(concept_list_1) / n_member_ids
+    mcq_score = (1 / (1 + np.exp(-np.abs(mcq_score * score_scaling))) - 0.5) * 2
+    weighted_ln_ratio = pd.DataFrame({'ln_ratio_score': ln_ratio_score, 'mcq_score': mcq_score}).reset_index()
+
+    # Collect the single associations of each scored concept in one pass: sort by concept_id_2 (stable, keeping the
+    # order of the input concepts) and slice the records at the group boundaries. The records are copies of the
+    # result dicts, which may be shared with the query_trapi cache.
+    singles = associations[associations['concept_id_2'].isin(ln_ratio_score.index)] \
+        .sort_values('concept_id_2', kind='stable')
+    records = [dict(rows[i], ln_ratio_score=score)
+               for i, score in zip(singles.index.tolist(), singles['ln_ratio_score'].tolist())]
+    group_sizes = singles.groupby('concept_id_2', sort=True).size()
+    bounds = np.concatenate(([0], np.cumsum(group_sizes.values)))
+    single_associations = {int(cid2): records[bounds[i]:bounds[i + 1]] for i, cid2 in enumerate(group_sizes.index)}
+
+    # Extract concept 2 definitions from the first association with each concept
+    columns_c2 = ['dataset_id', 'concept_id_2', 'concept_2_name', 'concept_2_domain', 'concept_2_class_id']
+    concept_2_defs = associations[columns_c2].drop_duplicates('concept_id_2')
+
+    # Merge and sort results, and convert to dict for JSON results
+    set_associations = weighted_ln_ratio.merge(concept_2_defs, on='concept_id_2')
+    set_associations = set_associations.sort_values('ln_ratio_score', ascending=False, kind='stable')
+    return set_associations.to_dict('records'), single_associations
 
 
 @cache.memoize(timeout=86400, unless=_bypass_cache)
@@ -1904,57 +3614,25 @@ def query_trapi_mcq(concept_ids, n_member_ids, score_scaling=DEFAULT_MCQ_SCORE_S
             concept_ids=str(concept_ids)
         )
 
-    # Connect to MYSQL database
-    conn = sql_connection()
-    cur = conn.cursor()
-
     # Get the associations for each of the concepts in the list
     associations = list()
     for concept_id_1 in concept_ids:
         a = query_trapi(concept_id_1=concept_id_1, concept_id_2=None, dataset_id=dataset_id, domain_id=domain_id, 
                         concept_class_id=concept_class_id, ln_ratio_sign=ln_ratio_sign, confidence=confidence, bypass=bypass)
         associations.extend(a['results'])
-    associations = pd.DataFrame(associations)
-
-    # Scorify ln_ratio and log_odds
-    associations['ln_ratio_score'] = associations.apply(_get_ci_scores, axis=1, score_col='ln_ratio_ci')
-    # associations['log_odds_score'] = associations.apply(_get_ci_scores, axis=1, low='log_odds_ci_lo', high='log_odds_ci_hi')
-
-    # Adjust the scores by weights 
-    concept_list_1 = list(set(associations['concept_id_1'].tolist()))
-    weighted_ln_ratio, total_weights = _get_weighted_statistics(cur=cur, dataset_id=dataset_id, domain_id=domain_id, 
-                                                concept_id_1=concept_list_1, pair_count_df=associations, 
-                                                json_key = 'ln_ratio_score')
-    # weighted_log_odds = _get_weighted_statistics(cur=cur, dataset_id=dataset_id, domain_id=domain_id, 
-    #                                             concept_id_1=concept_list_1, pair_count_df=associations, 
-    #                                             json_key = 'log_odds_score')
-
-    # For TRAPI result score, normalize the score relative to the number of input CURIEs and 
-    # scale the score range to [0-1] using a scaled logistic function
-    n_mapped_ids = len(concept_list_1)
-    weighted_ln_ratio['mcq_score'] = weighted_ln_ratio['ln_ratio_score'] / total_weights * n_mapped_ids / n_member_ids    
-    weighted_ln_ratio['mcq_score'] = (1/(1+np.exp(-np.abs(weighted_ln_ratio['mcq_score']*score_scaling)))-0.5) * 2
-
-    # Add list of single associations 
-    single_associations = dict()
-    for i, row in weighted_ln_ratio.iterrows():
-        cid2 = int(row['concept_id_2'])
-        single_associations[cid2] = associations.loc[associations.concept_id_2 == cid2, :].to_dict('records')
-    
-    # Extract concept 2 definitions
-    columns_c2 = ['dataset_id', 'concept_id_2', 'concept_2_name', 'concept_2_domain', 'concept_2_class_id']
-    concept_2_defs = associations[columns_c2].groupby('concept_id_2').agg(lambda x: x.iloc[0])
-    
-    # Merge and sort results, and convert to dict for JSON results
-    set_associations = concept_2_defs.merge(weighted_ln_ratio, on='concept_id_2')
-    # results = results.merge(weighted_log_odds[['concept_id_2', 'log_odds_score']], on='concept_id_2')
-    set_associations = set_associations.sort_values('ln_ratio_score', ascending=False)
-    json_return = set_associations.to_dict('records'), single_associations
+    if not associations:
+        return list(), dict()
 
+    # Get the co-occurrences between the input concepts for the weights
+    concept_list_1 = list({a['concept_id_1'] for a in associations})
+    conn = sql_connection(dataset_id)
+    cur = conn.cursor()
+    pair_counts = get_pair_concept_count(cur=cur, dataset_id=dataset_id, domain_id=domain_id,
+                                         concept_id_list_1=concept_list_1, concept_id_list_2=concept_list_1)
     cur.close()
     conn.close()
 
-    return json_return
+    return _mcq_scores(associations, pair_counts, n_member_ids, score_scaling)
 
 
 def health():
@@ -1994,17 +3672,18 @@ def omop_concept_definition(concept_id):
     -------
     Concept definition, or None
     """
-    response = query_db(service='omop', method='concepts', args={'q': str(concept_id)})
-
-    concept_result = response.get_json()
-    if concept_result is None or 'results' not in concept_result or len(concept_result['results']) != 1:
+    try:
+        concept_id = int(concept_id)
+    except (TypeError, ValueError):
         return None
-    return concept_result['results'][0]
+    return omop_concept_definitions([concept_id]).get(concept_id)
 
 
 def omop_concept_definitions(concept_ids):
     """ Get the OMOP concept definition
 
+    Active concepts are looked up in the in-process concept dictionary. Other concepts are queried from MySQL.
+
     Parameters
     ----------
     concept_ids: iterable of OMOP concept IDs (String or int)
@@ -2013,13 +3692,17 @@ def omop_concept_definitions(concept_ids):
     -------
     dict[concept_ids] = concept definition row
     """
-    concept_defs = dict()
+    concept_ids = [int(c) for c in concept_ids]
     if not concept_ids:
-        return concept_defs
+        return dict()
 
-    q = ','.join(str(c) for c in concept_ids)
-    concept_results = query_db_concepts(q)
+    dictionary = concept_dictionary()
+    concept_defs = dictionary.get_many(concept_ids) if dictionary is not None else dict()
+    missing = [c for c in concept_ids if c not in concept_defs]
+    if not missing:
+        return concept_defs
 
+    concept_results = query_db_concepts(','.join(str(c) for c in missing))
     if concept_results is None or 'results' not in concept_results:
         return concept_defs
 
@@ -2044,8 +3727,75 @@ def query_active_concepts():
     FROM concept_ids
     JOIN concept c ON concept_ids.concept_id = c.concept_id;
     """
-    conn = sql_connection()
-    cur = conn.cursor()
-    cur.execute(sql)
-    results = cur.fetchall()
+    with sql_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(sql)
+            results = cur.fetchall()
     return results
+
+
+def _load_concept_dictionary(version):
+    """ Loads the definitions of all active concepts into a ConceptDictionary """
+    dictionary = ConceptDictionary(storage.active_concepts(), version)
+    logging.info(f'Loaded concept dictionary with {len(dictionary)} concepts (version {version})')
+    return dictionary
+
+
+# In-process dictionary of the active concepts. Reloaded when the dataset stats version changes.
+_concept_dictionary = VersionedIndex('concept dictionary', _load_concept_dictionary, lambda: dataset_stats.version,
+                                     retry_interval=app.config.get('INDEX_LOAD_RETRY_INTERVAL', 300))
+
+
+def concept_dictionary():
+    """ Gets the dictionary of active concepts, loading it on first use and reloading it when the dataset stats
+    version changes. While the dictionary is reloaded, other threads keep using the previous one. If a load fails, the
+    previous dictionary (if any) is used until the load is retried after INDEX_LOAD_RETRY_INTERVAL seconds.
+
+    Returns
+    -------
+    ConceptDictionary, or None if it could not be loaded
+    """
+    return _concept_dictionary.get()
+
+
+def _hierarchy_concept_counts():
+    """ Gets the single concept counts of every dataset, from the co-occurrence store when the dataset has one
+
+    Returns
+    -------
+    dict[dataset_id] = (array of concept_id, array of concept_count)
+    """
+    concept_counts = dict()
+    for dataset_id in dataset_stats.snapshot().patient_counts:
+        store = cooccurrence_store(dataset_id)
+        if store is not None:
+            concept_counts[dataset_id] = (np.asarray(store.concept_ids), np.asarray(store.concept_counts))
+        else:
+            concept_counts[dataset_id] = storage.dataset_concept_counts(dataset_id)
+    return concept_counts
+
+
+def _load_concept_hierarchy(version):
+    """ Loads the concept_ancestor table and the concept counts of all datasets into a ConceptHierarchy """
+    concept_counts = _hierarchy_concept_counts()
+    with sql_connection(DATASET_ID_DEFAULT_HIER) as conn:
+        return load_hierarchy(conn, concept_counts, version)
+
+
+# In-process index of the concept hierarchy. Reloaded when the dataset stats version changes.
+_concept_hierarchy = VersionedIndex('concept hierarchy', _load_concept_hierarchy, lambda: dataset_stats.version,
+                                    retry_interval=app.config.get('INDEX_LOAD_RETRY_INTERVAL', 300))
+
+
+def concept_hierarchy():
+    """ Gets the in-process concept hierarchy index, loading it on first use and reloading it when the dataset stats
+    version changes. While the index is reloaded, other threads keep using the previous one. If a load fails, the
+    previous index (if any) is used until the load is retried after INDEX_LOAD_RETRY_INTERVAL seconds.
+
+    Returns
+    -------
+    ConceptHierarchy, or None if CONCEPT_HIERARCHY_IN_MEMORY is off or the index could not be loaded
+    """
+    if not app.config.get('CONCEPT_HIERARCHY_IN_MEMORY', True):
+        return None
+    return _concept_hierarchy.get()
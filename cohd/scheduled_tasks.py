@@ -4,26 +4,46 @@ import logging
 
 from .biolink_mapper import BiolinkConceptMapper
 from .app import app
+from . import preload
 
 
 def task_build_cache():
     print('Running scheduled task to build cache')
     BiolinkConceptMapper.build_mappings()
 
-# Schedule a task to update the Biolink Mapping cache nightly (all environments)
-scheduler = BackgroundScheduler()
-scheduler.add_job(func=BiolinkConceptMapper.prefetch_mappings, trigger='cron', hour=6)
-
-# Schedule a task to build the cache every first Saturday of the month 
 deployment_env = app.config.get('DEPLOYMENT_ENV', 'dev').lower()
-if deployment_env in ('itrb-ci', 'itrb-test', 'itrb-prod', 'prod'):    
-    scheduler.add_job(func=task_build_cache, trigger='cron', day_of_week='sat', hour=0)    
-    logging.info(f'Background task scheduled to build Biolink mappings (env: {deployment_env})')
+build_cache_scheduled = deployment_env in ('itrb-ci', 'itrb-test', 'itrb-prod', 'prod')
+
+if preload.preforked():
+    # The app is loaded in the uWSGI master and forked, so a scheduler thread started here would not run in the
+    # workers. Use uWSGI's cron instead, which the master coordinates: every worker refreshes its own in-memory
+    # Biolink mappings at the same time, while the cache is built by a single worker.
+    from uwsgidecorators import cron
+
+    @cron(0, 6, -1, -1, -1, target='workers')
+    def _cron_prefetch_mappings(signum):
+        BiolinkConceptMapper.prefetch_mappings()
+
+    if build_cache_scheduled:
+        @cron(0, 0, -1, -1, 6, target='worker')
+        def _cron_build_cache(signum):
+            task_build_cache()
+    scheduler = None
 else:
-    logging.info(f'Background task NOT scheduled to build Biolink mappings (env: {deployment_env})')
+    # Schedule a task to update the Biolink Mapping cache nightly (all environments)
+    scheduler = BackgroundScheduler()
+    scheduler.add_job(func=BiolinkConceptMapper.prefetch_mappings, trigger='cron', hour=6)
+
+    # Schedule a task to build the cache every first Saturday of the month
+    if build_cache_scheduled:
+        scheduler.add_job(func=task_build_cache, trigger='cron', day_of_week='sat', hour=0)
 
-scheduler.start()
+    scheduler.start()
 
+if build_cache_scheduled:
+    logging.info(f'Background task scheduled to build Biolink mappings (env: {deployment_env})')
+else:
+    logging.info(f'Background task NOT scheduled to build Biolink mappings (env: {deployment_env})')
 
 # Registering a shutdown seems to cause UWSGI to have issues shutting down COHD, even with the wait=False option.
 # Since the default job store does not persist jobs anyway, remove this line for now
@@ -0,0 +1,266 @@
+"""
+Columnar snapshot of the COHD serving tables
+
+Exports concept, concept_counts, concept_pair_counts (with the precomputed statistics), and biolink.mappings from MySQL
+into Parquet files with typed columns. The offline jobs (the KGX builder in kgx/, db/precompute_stats/precompute.py,
+and the co-occurrence store builder) read the snapshot instead of running their own long MySQL queries or parsing TSV
+dumps. The per-dataset tables are partitioned by dataset_id:
+    <root>/meta.json
+    <root>/concept/part-0.parquet
+    <root>/biolink_mappings/part-0.parquet
+    <root>/concept_counts/dataset_id=<dataset_id>/part-0.parquet
+    <root>/concept_pair_counts/dataset_id=<dataset_id>/part-0.parquet
+meta.json has the datasets with their patient counts and total pair counts. Each table is streamed with an unbuffered
+cursor (one full scan per table and dataset, without joins) and written one row group per batch, so the export needs
+little memory. Create a snapshot with:
+    python -m cohd.snapshot --out /data/cohd_snapshot/20241030 --mysql_config database.cnf
+The MySQL credentials are read from the option file rather than the command line.
+
+Requires pyarrow, which is only needed by the offline jobs and is imported on first use.
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+from datetime import datetime
+
+import pymysql
+
+# Version of the file layout. Snapshots with a different version are rejected.
+FORMAT_VERSION = 1
+
+# Statistics precomputed in concept_pair_counts (db/precompute_stats/precompute.py)
+PAIR_STAT_COLUMNS = ['p_value', 'ln_ratio', 'ln_ratio_ci_lo', 'ln_ratio_ci_hi', 'log_odds', 'log_odds_ci_lo',
+                     'log_odds_ci_hi', 'pair_count_ci_lo', 'pair_count_ci_hi']
+
+# Exported tables: name -> (source table, partitioned by dataset_id, [(column, type)])
+TABLES = {
+    'concept': ('cohd.concept', False, [
+        ('concept_id', 'int64'), ('concept_name', 'string'), ('domain_id', 'string'), ('vocabulary_id', 'string'),
+        ('concept_class_id', 'string'), ('standard_concept', 'string'), ('concept_code', 'string')]),
+    'biolink_mappings': ('biolink.mappings', False, [
+        ('omop_id', 'int64'), ('biolink_id', 'string'), ('biolink_label', 'string'), ('categories', 'string'),
+        ('provenance', 'string'), ('string_search', 'bool'), ('distance', 'int32'), ('string_similarity', 'float64'),
+        ('preferred', 'bool')]),
+    'concept_counts': ('cohd.concept_counts', True, [
+        ('concept_id', 'int64'), ('concept_count', 'int64'), ('ci_lo', 'float64'), ('ci_hi', 'float64')]),
+    'concept_pair_counts': ('cohd.concept_pair_counts', True, [
+        ('concept_id_1', 'int64'), ('concept_id_2', 'int64'), ('concept_count', 'int64')] +
+        [(c, 'float64') for c in PAIR_STAT_COLUMNS]),
+}
+
+
+def _pyarrow():
+    """ Imports pyarrow and pyarrow.parquet """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError('COHD snapshots require pyarrow (pip install pyarrow)') from e
+    return pyarrow, pyarrow.parquet
+
+
+def _schema(table):
+    """ pyarrow schema of a table """
+    pa, _ = _pyarrow()
+    types = {'int32': pa.int32(), 'int64': pa.int64(), 'float64': pa.float64(), 'string': pa.string(),
+             'bool': pa.bool_()}
+    return pa.schema([(c, types[t]) for c, t in TABLES[table][2]])
+
+
+def _table_path(root, table, dataset_id=None):
+    if TABLES[table][1]:
+        if dataset_id is None:
+            raise ValueError(f'{table} is partitioned by dataset_id')
+        return os.path.join(root, table, f'dataset_id={int(dataset_id)}', 'part-0.parquet')
+    return os.path.join(root, table, 'part-0.parquet')
+
+
+def _export_table(conn, root, table, dataset_id=None, batch_size=1000000):
+    """ Streams a table (or one dataset of a partitioned table) from MySQL into a Parquet file
+
+    Returns
+    -------
+    Number of rows exported
+    """
+    pa, pq = _pyarrow()
+    source, partitioned, columns = TABLES[table]
+    schema = _schema(table)
+    sql = 'SELECT {columns} FROM {source}'.format(columns=', '.join(c for c, _ in columns), source=source)
+    params = None
+    if partitioned:
+        sql += ' WHERE dataset_id = %(dataset_id)s'
+        params = {'dataset_id': dataset_id}
+
+    file = _table_path(root, table, dataset_id)
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    n_rows = 0
+    with pq.ParquetWriter(file, schema, compression='zstd') as writer:
+        with conn.cursor(pymysql.cursors.SSCursor) as cur:
+            cur.execute(sql + ';', params)
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                arrays = [pa.array([None if v is None else (bool(v) if t == 'bool' else v) for v in values],
+                                   type=field.type)
+                          for values, (_, t), field in zip(zip(*rows), columns, schema)]
+                writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+                n_rows += len(rows)
+    logging.info(f'Exported {n_rows} rows of {table}' + (f' (dataset {dataset_id})' if partitioned else ''))
+    return n_rows
+
+
+def export_snapshot(conn, root, dataset_ids=None, batch_size=1000000):
+    """ Exports the serving tables from MySQL into a snapshot directory
+
+    The snapshot is written to a temporary directory, which then replaces root, so readers never see a partially
+    written snapshot.
+
+    Parameters
+    ----------
+    conn: pymysql connection to the COHD database
+    root: snapshot directory
+    dataset_ids: datasets to export (default: all datasets in patient_count)
+    batch_size: number of rows read and written at a time
+    """
+    with conn.cursor(pymysql.cursors.DictCursor) as cur:
+        cur.execute('''SELECT d.dataset_id, d.dataset_name, d.dataset_description, pc.count AS patient_count
+            FROM cohd.dataset d
+            JOIN cohd.patient_count pc ON d.dataset_id = pc.dataset_id;''')
+        datasets = {int(r['dataset_id']): r for r in cur.fetchall()}
+        cur.execute('''SELECT dataset_id, SUM(count) AS count
+            FROM cohd.domain_pair_concept_counts
+            GROUP BY dataset_id;''')
+        total_pair_counts = {int(r['dataset_id']): int(r['count']) for r in cur.fetchall()}
+    if dataset_ids is not None:
+        datasets = {d: datasets[d] for d in dataset_ids}
+
+    tmp_root = f'{root}.building'
+    shutil.rmtree(tmp_root, ignore_errors=True)
+    os.makedirs(tmp_root)
+    n_rows = dict()
+    for table, (_, partitioned, _) in TABLES.items():
+        if partitioned:
+            for dataset_id in datasets:
+                n_rows[f'{table}/{dataset_id}'] = _export_table(conn, tmp_root, table, dataset_id, batch_size)
+        else:
+            n_rows[table] = _export_table(conn, tmp_root, table, batch_size=batch_size)
+
+    meta = {
+        'format_version': FORMAT_VERSION,
+        'created': datetime.now().isoformat(),
+        'datasets': {str(d): {
+            'dataset_name': r['dataset_name'],
+            'dataset_description': r['dataset_description'],
+            'patient_count': int(r['patient_count']),
+            'total_pair_count': total_pair_counts.get(d, 0),
+        } for d, r in datasets.items()},
+        'n_rows': n_rows,
+    }
+    with open(os.path.join(tmp_root, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    # Swap in the new snapshot
+    old_root = f'{root}.old'
+    shutil.rmtree(old_root, ignore_errors=True)
+    if os.path.exists(root):
+        os.rename(root, old_root)
+    os.rename(tmp_root, root)
+    shutil.rmtree(old_root, ignore_errors=True)
+    logging.info(f'Wrote snapshot of datasets {sorted(datasets)} to {root}')
+
+
+class Snapshot:
+    """ Read-only view of a snapshot directory created by export_snapshot """
+
+    def __init__(self, root):
+        """ Constructor
+
+        Parameters
+        ----------
+        root: snapshot directory
+        """
+        self.root = root
+        with open(os.path.join(root, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta.get('format_version') != FORMAT_VERSION:
+            raise ValueError(f'Unsupported snapshot format in {root}: {self.meta.get("format_version")}')
+        self.datasets = {int(d): v for d, v in self.meta['datasets'].items()}
+
+    @property
+    def dataset_ids(self):
+        return sorted(self.datasets)
+
+    def patient_count(self, dataset_id):
+        return self.datasets[int(dataset_id)]['patient_count']
+
+    def total_pair_count(self, dataset_id):
+        return self.datasets[int(dataset_id)]['total_pair_count']
+
+    def read(self, table, dataset_id=None, columns=None):
+        """ Reads a table
+
+        Parameters
+        ----------
+        table: table name (see TABLES)
+        dataset_id: COHD dataset ID, required for the tables partitioned by dataset
+        columns: (optional) columns to read
+
+        Returns
+        -------
+        pyarrow.Table
+        """
+        _, pq = _pyarrow()
+        return pq.read_table(_table_path(self.root, table, dataset_id), columns=columns)
+
+    def iter_batches(self, table, dataset_id=None, columns=None, batch_size=1000000):
+        """ Reads a table in batches
+
+        Parameters
+        ----------
+        table: table name (see TABLES)
+        dataset_id: COHD dataset ID, required for the tables partitioned by dataset
+        columns: (optional) columns to read
+        batch_size: maximum number of rows per batch
+
+        Returns
+        -------
+        Iterator of dicts of numpy arrays, one per column
+        """
+        _, pq = _pyarrow()
+        with pq.ParquetFile(_table_path(self.root, table, dataset_id)) as f:
+            for batch in f.iter_batches(batch_size=batch_size, columns=columns):
+                yield _numpy_columns(batch)
+
+    def columns(self, table, dataset_id=None, columns=None):
+        """ Reads a table as numpy arrays
+
+        Parameters
+        ----------
+        table: table name (see TABLES)
+        dataset_id: COHD dataset ID, required for the tables partitioned by dataset
+        columns: (optional) columns to read
+
+        Returns
+        -------
+        dict of numpy arrays, one per column. Strings are object arrays, and nulls in float columns are NaN.
+        """
+        return _numpy_columns(self.read(table, dataset_id, columns))
+
+
+def _numpy_columns(table):
+    """ Converts a pyarrow Table or RecordBatch to a dict of numpy arrays """
+    return {name: column.to_numpy(zero_copy_only=False) for name, column in zip(table.schema.names, table.columns)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Exports the COHD serving tables into a Parquet snapshot')
+    parser.add_argument('--out', required=True, help='Snapshot directory, e.g., /data/cohd_snapshot/20241030')
+    parser.add_argument('--dataset_id', type=int, nargs='*', help='Datasets to export (default: all)')
+    parser.add_argument('--mysql_config', default='database.cnf', help='MySQL option file')
+    a = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    with pymysql.connect(read_default_file=a.mysql_config, charset='utf8mb4') as connection:
+        export_snapshot(connection, a.out, a.dataset_id)
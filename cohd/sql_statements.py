@@ -0,0 +1,102 @@
+import functools
+
+
+# Smallest number of placeholders in an IN list. IN lists are padded up to a power of two (at least this size) so that
+# lists of similar lengths share one statement text
+IN_LIST_MIN_SIZE = 4
+
+# Registered statement builders, by name
+_builders = dict()
+
+
+def statement(name, maxsize=128):
+    """ Decorator that registers a function building the text of a SQL statement
+
+    The builder's arguments describe the shape of the statement (which filters are present, IN list sizes, etc), never
+    the values of the parameters, which are always bound. The text for each combination of arguments is built once
+    and cached.
+
+    Parameters
+    ----------
+    name: statement name used with get_statement
+    maxsize: maximum number of cached variants of the statement
+    """
+    def decorator(f):
+        if name in _builders:
+            raise ValueError(f'SQL statement {name} is already registered')
+        _builders[name] = functools.lru_cache(maxsize=maxsize)(f)
+        return f
+    return decorator
+
+
+def get_statement(name, **shape):
+    """ Gets the text of a registered SQL statement
+
+    Parameters
+    ----------
+    name: statement name
+    shape: keyword arguments for the statement's builder. Must be hashable.
+
+    Returns
+    -------
+    SQL statement text
+    """
+    return _builders[name](**shape)
+
+
+def in_list_size(n):
+    """ Number of placeholders used for an IN list of n values
+
+    Parameters
+    ----------
+    n: number of values
+
+    Returns
+    -------
+    Smallest power of two that is >= n and >= IN_LIST_MIN_SIZE
+    """
+    size = IN_LIST_MIN_SIZE
+    while size < n:
+        size *= 2
+    return size
+
+
+def in_list(name, size):
+    """ Placeholders for an IN list bound with bind_in_list
+
+    Parameters
+    ----------
+    name: parameter name prefix
+    size: number of placeholders (see in_list_size)
+
+    Returns
+    -------
+    Comma separated placeholders, e.g., "%(name_0)s, %(name_1)s"
+    """
+    return ', '.join(f'%({name}_{i})s' for i in range(size))
+
+
+def bind_in_list(params, name, values):
+    """ Binds the values of an IN list. The list is padded to the bucket size by repeating the last value, which does
+    not change the result of the IN predicate.
+
+    Parameters
+    ----------
+    params: dict of SQL parameters. The IN list parameters are added.
+    name: parameter name prefix
+    values: non-empty list of values
+
+    Returns
+    -------
+    Number of placeholders to build the statement with
+    """
+    size = in_list_size(len(values))
+    for i in range(size):
+        params[f'{name}_{i}'] = values[min(i, len(values) - 1)]
+    return size
+
+
+def clear():
+    """ Clears the cached statement texts """
+    for builder in _builders.values():
+        builder.cache_clear()
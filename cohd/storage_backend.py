@@ -0,0 +1,733 @@
+import argparse
+import csv
+import glob
+import logging
+import math
+import os
+import re
+import sqlite3
+
+import numpy as np
+
+from . import chi_square
+from .cohd_utilities import double_poisson_ci_array, poisson_ci_array
+
+
+class StorageBackend:
+    """
+    Interface to the database that stores the COHD data
+
+    Subclasses provide DB-API connections whose cursors return rows as dicts and accept pymysql-style parameters
+    (%s and %(name)s), so the existing SQL in query_cohd_mysql, cohd_temporal, omop_xref, and biolink_mapper runs
+    unchanged on every backend. The lookups below are written in SQL that is portable across the backends.
+    """
+
+    def connection(self, dataset_id=None, schema='cohd', primary=False):
+        """ Gets a connection. Calling close() on the connection (or leaving a with block) releases it.
+
+        Parameters
+        ----------
+        dataset_id: COHD dataset ID used for routing, or None if the query is not specific to a dataset
+        schema: database schema used for routing
+        primary: True to connect to the primary server, e.g., for writes
+
+        Returns
+        -------
+        DB-API connection with dict cursors
+        """
+        raise NotImplementedError
+
+    def table_exists(self, table_name, schema='cohd'):
+        """ Checks if a table exists
+
+        Parameters
+        ----------
+        table_name: table name
+        schema: database schema
+
+        Returns
+        -------
+        True if the table exists
+        """
+        raise NotImplementedError
+
+    def _fetch_all(self, sql, params=None, dataset_id=None, schema='cohd'):
+        with self.connection(dataset_id=dataset_id, schema=schema) as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql, params)
+                return list(cur.fetchall())
+
+    def concepts(self, concept_ids):
+        """ Gets concept definitions
+
+        Parameters
+        ----------
+        concept_ids: list of OMOP concept IDs (int)
+
+        Returns
+        -------
+        dict[concept_id] = concept definition
+        """
+        concept_ids = [int(c) for c in concept_ids]
+        if not concept_ids:
+            return dict()
+        sql = '''SELECT concept_id, concept_name, domain_id, vocabulary_id, concept_class_id, concept_code
+            FROM cohd.concept
+            WHERE concept_id IN ({ids});'''.format(ids=','.join(['%s'] * len(concept_ids)))
+        return {r['concept_id']: r for r in self._fetch_all(sql, concept_ids)}
+
+    def active_concepts(self):
+        """ Gets the definitions of all concepts with counts in any dataset
+
+        Returns
+        -------
+        List of concept definitions
+        """
+        sql = '''SELECT c.concept_id, c.concept_name, c.domain_id, c.vocabulary_id, c.concept_class_id, c.concept_code
+            FROM (SELECT DISTINCT concept_id FROM cohd.concept_counts) x
+            JOIN cohd.concept c ON x.concept_id = c.concept_id;'''
+        return self._fetch_all(sql)
+
+    def concept_counts(self, dataset_id, concept_ids):
+        """ Gets single concept counts
+
+        Parameters
+        ----------
+        dataset_id: COHD dataset ID
+        concept_ids: list of OMOP concept IDs (int)
+
+        Returns
+        -------
+        dict[concept_id] = concept count
+        """
+        concept_ids = [int(c) for c in concept_ids]
+        if not concept_ids:
+            return dict()
+        sql = '''SELECT concept_id, concept_count
+            FROM cohd.concept_counts
+            WHERE dataset_id = %s AND concept_id IN ({ids});'''.format(ids=','.join(['%s'] * len(concept_ids)))
+        rows = self._fetch_all(sql, [dataset_id] + concept_ids, dataset_id=dataset_id)
+        return {r['concept_id']: int(r['concept_count']) for r in rows}
+
+    def dataset_concept_counts(self, dataset_id):
+        """ Gets the single concept counts of all concepts in a dataset
+
+        Parameters
+        ----------
+        dataset_id: COHD dataset ID
+
+        Returns
+        -------
+        (array of concept_id, array of concept_count)
+        """
+        rows = self._fetch_all('''SELECT concept_id, concept_count
+            FROM cohd.concept_counts
+            WHERE dataset_id = %s;''', [dataset_id], dataset_id=dataset_id)
+        return (np.array([r['concept_id'] for r in rows], dtype=np.int64),
+                np.array([r['concept_count'] for r in rows], dtype=np.int64))
+
+    def pair_stats(self, dataset_id, concept_id_1, concept_id_2):
+        """ Gets the co-occurrence count and precomputed statistics of a pair of concepts
+
+        Parameters
+        ----------
+        dataset_id: COHD dataset ID
+        concept_id_1: OMOP concept ID (int)
+        concept_id_2: OMOP concept ID (int)
+
+        Returns
+        -------
+        concept_pair_counts row (pair stored with concept_id_1 < concept_id_2), or None if the pair has no count
+        """
+        concept_id_1, concept_id_2 = sorted((int(concept_id_1), int(concept_id_2)))
+        sql = '''SELECT *
+            FROM cohd.concept_pair_counts
+            WHERE dataset_id = %s AND concept_id_1 = %s AND concept_id_2 = %s;'''
+        rows = self._fetch_all(sql, [dataset_id, concept_id_1, concept_id_2], dataset_id=dataset_id)
+        return rows[0] if rows else None
+
+    def ancestors(self, concept_id):
+        """ Gets the ancestors of a concept
+
+        Parameters
+        ----------
+        concept_id: OMOP concept ID (int)
+
+        Returns
+        -------
+        List of concept_ancestor rows, nearest ancestors first
+        """
+        sql = '''SELECT ancestor_concept_id, min_levels_of_separation, max_levels_of_separation
+            FROM cohd.concept_ancestor
+            WHERE descendant_concept_id = %s
+            ORDER BY min_levels_of_separation, ancestor_concept_id;'''
+        return self._fetch_all(sql, [int(concept_id)])
+
+    def age_counts(self, dataset_id, concept_id):
+        """ Gets the concept-age distribution of a concept
+
+        Parameters
+        ----------
+        dataset_id: COHD dataset ID
+        concept_id: OMOP concept ID (int)
+
+        Returns
+        -------
+        (binning scheme row, list of counts by bin), or None if the concept has no distribution
+        """
+        params = [dataset_id, int(concept_id)]
+        schemes = self._fetch_all('''SELECT *
+            FROM cohd.concept_age_schemes
+            WHERE dataset_id = %s AND concept_id = %s;''', params, dataset_id=dataset_id)
+        if len(schemes) != 1:
+            return None
+        counts = self._fetch_all('''SELECT count
+            FROM cohd.concept_age_counts
+            WHERE dataset_id = %s AND concept_id = %s
+            ORDER BY bin ASC;''', params, dataset_id=dataset_id)
+        return schemes[0], [r['count'] for r in counts]
+
+    def delta_counts(self, dataset_id, concept_id_1, concept_id_2):
+        """ Gets the distribution of time deltas between two concepts
+
+        Parameters
+        ----------
+        dataset_id: COHD dataset ID
+        concept_id_1: OMOP concept ID (int)
+        concept_id_2: OMOP concept ID (int)
+
+        Returns
+        -------
+        (binning scheme row, list of (bin, count)) with the pair as stored (concept_id_1 < concept_id_2), or None
+        """
+        params = [dataset_id] + sorted((int(concept_id_1), int(concept_id_2)))
+        schemes = self._fetch_all('''SELECT *
+            FROM cohd.delta_schemes
+            WHERE dataset_id = %s AND concept_id_1 = %s AND concept_id_2 = %s;''', params, dataset_id=dataset_id)
+        if len(schemes) != 1:
+            return None
+        counts = self._fetch_all('''SELECT bin, count
+            FROM cohd.delta_counts
+            WHERE dataset_id = %s AND concept_id_1 = %s AND concept_id_2 = %s
+            ORDER BY bin ASC;''', params, dataset_id=dataset_id)
+        return schemes[0], [(r['bin'], r['count']) for r in counts]
+
+    def biolink_mappings(self):
+        """ Gets the OMOP-Biolink mappings
+
+        Returns
+        -------
+        List of biolink.mappings rows with the concept names
+        """
+        sql = '''SELECT m.*, c.concept_name
+            FROM biolink.mappings m
+            JOIN cohd.concept c ON m.omop_id = c.concept_id;'''
+        return self._fetch_all(sql, schema='biolink')
+
+
+class MySqlBackend(StorageBackend):
+    """ MySQL backend using the worker's read routing and connection pools (see query_cohd_mysql.ReadRouter) """
+
+    def __init__(self, router):
+        """ Constructor
+
+        Parameters
+        ----------
+        router: ReadRouter
+        """
+        self.router = router
+
+    def connection(self, dataset_id=None, schema='cohd', primary=False):
+        if primary:
+            return self.router.primary.pool.acquire()
+        return self.router.connection(schema, dataset_id)
+
+    def table_exists(self, table_name, schema='cohd'):
+        sql = '''SELECT COUNT(*) AS count
+            FROM information_schema.tables
+            WHERE table_schema = %(schema)s AND table_name = %(table_name)s;'''
+        rows = self._fetch_all(sql, {'schema': schema, 'table_name': table_name}, schema=schema)
+        return rows[0]['count'] > 0
+
+
+# Converts pymysql parameter markers (%s, %(name)s) and escaped percent signs (%%) to SQLite's
+_re_pymysql_param = re.compile(r'%\((\w+)\)s|%s|%%')
+
+
+# MySQL allows parenthesized SELECTs as UNION operands, SQLite needs them as subqueries: (SELECT ...) UNION (SELECT ...)
+# becomes SELECT * FROM (SELECT ...) UNION SELECT * FROM (SELECT ...)
+_re_union_operand = re.compile(r'(^\s*|\(\s*|\bUNION(?:\s+ALL)?\s*)\(\s*SELECT\b', re.IGNORECASE)
+
+
+def _sqlite_sql(sql):
+    """ Converts a MySQL statement written for pymysql to SQLite """
+    if re.search(r'\bUNION\b', sql, re.IGNORECASE):
+        sql = _re_union_operand.sub(lambda m: m.group(1) + 'SELECT * FROM (SELECT', sql)
+    return _re_pymysql_param.sub(lambda m: f':{m.group(1)}' if m.group(1) else ('?' if m.group(0) == '%s' else '%'),
+                                 sql)
+
+
+def _null_safe(f):
+    """ Wraps a SQL function so that it returns NULL for NULL or invalid arguments, like MySQL """
+    def _f(*args):
+        if any(a is None for a in args):
+            return None
+        try:
+            return f(*args)
+        except (ValueError, ZeroDivisionError, OverflowError):
+            return None
+    return _f
+
+
+def _log(*args):
+    # MySQL's LOG(x) is the natural log, LOG(b, x) is the log base b. SQLite's built-in LOG(x) is base 10.
+    if len(args) == 1:
+        return math.log(args[0])
+    return math.log(args[1], args[0])
+
+
+# MySQL functions used by the COHD SQL that SQLite lacks or defines differently: (name, number of args, function)
+_SQLITE_FUNCTIONS = [
+    ('LOG', 1, _null_safe(_log)),
+    ('LOG', 2, _null_safe(_log)),
+    ('LN', 1, _null_safe(math.log)),
+    ('EXP', 1, _null_safe(math.exp)),
+    ('SQRT', 1, _null_safe(math.sqrt)),
+    ('POW', 2, _null_safe(math.pow)),
+    ('POWER', 2, _null_safe(math.pow)),
+    ('SIGN', 1, _null_safe(lambda x: (x > 0) - (x < 0))),
+    ('LEAST', -1, _null_safe(min)),
+    ('GREATEST', -1, _null_safe(max)),
+    ('CONCAT', -1, _null_safe(lambda *args: ''.join(str(a) for a in args))),
+    ('IF', 3, lambda condition, a, b: a if condition else b),
+]
+
+
+def _dict_row(cursor, row):
+    return {d[0]: v for d, v in zip(cursor.description, row)}
+
+
+class SqliteCursor:
+    """ pymysql DictCursor look-alike over a sqlite3 cursor """
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self._executed = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def execute(self, query, args=None):
+        if args is None:
+            args = ()
+        elif not isinstance(args, dict):
+            args = tuple(args)
+        self._executed = _sqlite_sql(query)
+        self._cursor.execute(self._executed, args)
+        return self._cursor.rowcount
+
+    def executemany(self, query, args):
+        self._cursor.executemany(_sqlite_sql(query), [a if isinstance(a, dict) else tuple(a) for a in args])
+        return self._cursor.rowcount
+
+
+class SqliteConnection:
+    """ pymysql connection look-alike over a sqlite3 connection """
+
+    def __init__(self, conn):
+        self._conn = conn
+        self.open = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def cursor(self, cursor_class=None):
+        # All cursors return dicts. Results are read lazily, like pymysql's unbuffered cursors.
+        return SqliteCursor(self._conn.cursor())
+
+    def ping(self, reconnect=True):
+        pass
+
+    def close(self):
+        if self.open:
+            self.open = False
+            self._conn.close()
+
+
+class SqliteBackend(StorageBackend):
+    """
+    Embedded SQLite backend for running the API against local files, e.g., for load tests and small mirrors
+
+    The database is a directory with one SQLite file per schema (cohd.sqlite, biolink.sqlite, ...), built by
+    load_sqlite(). All of the files are attached to each connection under their schema names. Since cohd is attached
+    first, unqualified table names resolve to the cohd schema, as with the default database of the MySQL connection.
+    A new connection is opened for each use, which is inexpensive for local files.
+    """
+
+    def __init__(self, path):
+        """ Constructor
+
+        Parameters
+        ----------
+        path: directory with the SQLite files
+        """
+        self.path = path
+        schemas = sorted(os.path.splitext(os.path.basename(f))[0] for f in glob.glob(os.path.join(path, '*.sqlite')))
+        if 'cohd' not in schemas:
+            raise FileNotFoundError(f'No cohd.sqlite in {path}')
+        schemas.remove('cohd')
+        self.schemas = ['cohd'] + schemas
+
+    def connection(self, dataset_id=None, schema='cohd', primary=False):
+        conn = sqlite3.connect(':memory:', check_same_thread=False)
+        for s in self.schemas:
+            conn.execute('ATTACH DATABASE ? AS ' + s, (os.path.join(self.path, f'{s}.sqlite'),))
+        for name, n_args, f in _SQLITE_FUNCTIONS:
+            conn.create_function(name, n_args, f, deterministic=True)
+        conn.row_factory = _dict_row
+        return SqliteConnection(conn)
+
+    def table_exists(self, table_name, schema='cohd'):
+        if schema not in self.schemas:
+            return False
+        sql = f'''SELECT COUNT(*) AS count
+            FROM {schema}.sqlite_master
+            WHERE type IN ('table', 'view') AND name = %s;'''
+        return self._fetch_all(sql, [table_name], schema=schema)[0]['count'] > 0
+
+
+# Tables of the SQLite database, matching db/sql/load_cohd_procedures.sql, the statistics added by
+# db/precompute_stats/precompute.py, and db/sql/load_cohd_temporal_data.sql
+_SQLITE_SCHEMA = {
+    'cohd': [
+        '''CREATE TABLE dataset (
+            dataset_id INTEGER PRIMARY KEY,
+            dataset_name TEXT,
+            dataset_description TEXT)''',
+        '''CREATE TABLE patient_count (
+            dataset_id INTEGER PRIMARY KEY,
+            count INTEGER NOT NULL)''',
+        '''CREATE TABLE concept (
+            concept_id INTEGER PRIMARY KEY,
+            concept_name TEXT NOT NULL,
+            domain_id TEXT NOT NULL,
+            vocabulary_id TEXT NOT NULL,
+            concept_class_id TEXT NOT NULL,
+            standard_concept TEXT,
+            concept_code TEXT NOT NULL,
+            valid_start_date TEXT,
+            valid_end_date TEXT,
+            invalid_reason TEXT)''',
+        'CREATE INDEX concept_vocabulary_id ON concept (vocabulary_id, concept_code)',
+        'CREATE INDEX concept_domain ON concept (domain_id)',
+        'CREATE INDEX concept_code ON concept (concept_code)',
+        '''CREATE TABLE concept_relationship (
+            concept_id_1 INTEGER NOT NULL,
+            concept_id_2 INTEGER NOT NULL,
+            relationship_id TEXT NOT NULL,
+            valid_start_date TEXT,
+            valid_end_date TEXT,
+            invalid_reason TEXT,
+            PRIMARY KEY (concept_id_1, concept_id_2, relationship_id))''',
+        'CREATE INDEX concept_relationship_2 ON concept_relationship (concept_id_2)',
+        '''CREATE TABLE concept_ancestor (
+            ancestor_concept_id INTEGER NOT NULL,
+            descendant_concept_id INTEGER NOT NULL,
+            min_levels_of_separation INTEGER NOT NULL,
+            max_levels_of_separation INTEGER NOT NULL,
+            PRIMARY KEY (ancestor_concept_id, descendant_concept_id))''',
+        'CREATE INDEX concept_ancestor_descendant ON concept_ancestor (descendant_concept_id, ancestor_concept_id)',
+        '''CREATE TABLE concept_counts (
+            dataset_id INTEGER NOT NULL,
+            concept_id INTEGER NOT NULL,
+            concept_count INTEGER NOT NULL,
+            ci_lo REAL,
+            ci_hi REAL,
+            PRIMARY KEY (dataset_id, concept_id))''',
+        'CREATE INDEX concept_counts_count ON concept_counts (dataset_id, concept_count)',
+        '''CREATE TABLE concept_pair_counts (
+            dataset_id INTEGER NOT NULL,
+            concept_id_1 INTEGER NOT NULL,
+            concept_id_2 INTEGER NOT NULL,
+            concept_count INTEGER NOT NULL,
+            p_value REAL,
+            pair_count_ci_lo REAL,
+            pair_count_ci_hi REAL,
+            ln_ratio REAL,
+            ln_ratio_ci_lo REAL,
+            ln_ratio_ci_hi REAL,
+            log_odds REAL,
+            log_odds_ci_lo REAL,
+            log_odds_ci_hi REAL,
+            PRIMARY KEY (dataset_id, concept_id_1, concept_id_2))''',
+        'CREATE INDEX concept_id_1_idx ON concept_pair_counts (dataset_id, concept_id_1, concept_count)',
+        'CREATE INDEX concept_id_2_idx ON concept_pair_counts (dataset_id, concept_id_2, concept_count)',
+        '''CREATE TABLE domain_concept_counts (
+            dataset_id INTEGER NOT NULL,
+            domain_id TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (dataset_id, domain_id))''',
+        '''CREATE TABLE domain_pair_concept_counts (
+            dataset_id INTEGER NOT NULL,
+            domain_id_1 TEXT NOT NULL,
+            domain_id_2 TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (dataset_id, domain_id_1, domain_id_2))''',
+        '''CREATE TABLE concept_age_counts (
+            dataset_id INTEGER NOT NULL,
+            concept_id INTEGER NOT NULL,
+            bin INTEGER NOT NULL,
+            count INTEGER NOT NULL)''',
+        '''CREATE TABLE delta_counts (
+            dataset_id INTEGER NOT NULL,
+            concept_id_1 INTEGER NOT NULL,
+            concept_id_2 INTEGER NOT NULL,
+            bin INTEGER NOT NULL,
+            count INTEGER NOT NULL)''',
+        '''CREATE TABLE concept_age_schemes (
+            dataset_id INTEGER NOT NULL,
+            concept_id INTEGER NOT NULL,
+            bin_width INTEGER NOT NULL,
+            bins INTEGER NOT NULL)''',
+        '''CREATE TABLE delta_schemes (
+            dataset_id INTEGER NOT NULL,
+            concept_id_1 INTEGER NOT NULL,
+            concept_id_2 INTEGER NOT NULL,
+            bin_width INTEGER NOT NULL,
+            n INTEGER NOT NULL)''',
+    ],
+    'biolink': [
+        '''CREATE TABLE mappings (
+            omop_id INTEGER PRIMARY KEY,
+            biolink_id TEXT NOT NULL,
+            biolink_label TEXT,
+            categories TEXT NOT NULL,
+            provenance TEXT NOT NULL,
+            string_search INTEGER NOT NULL,
+            distance INTEGER NOT NULL,
+            string_similarity REAL NOT NULL,
+            preferred INTEGER NOT NULL)''',
+        'CREATE INDEX idx_biolink_id ON mappings (biolink_id)',
+    ],
+}
+
+# Same value as used in the TSVs exported for db/sql/load_cohd_data.sql
+NULL_SERIALIZATION = 'NULL'
+
+
+def _read_tsv(path, columns):
+    """ Reads the columns of a tab-separated file with a header line. NULL_SERIALIZATION is read as None. """
+    with open(path, newline='', encoding='utf-8') as f:
+        reader = csv.reader(f, delimiter='\t', quoting=csv.QUOTE_NONE)
+        header = next(reader)
+        indices = [header.index(c) for c in columns]
+        for row in reader:
+            yield tuple(None if row[i] == NULL_SERIALIZATION else row[i] for i in indices)
+
+
+def pair_statistics(count_1, count_2, pair_count, patient_count, confidence=0.99):
+    """ Computes the precomputed statistics of concept_pair_counts, vectorized version of
+    db/precompute_stats/precompute.py:calculations()
+
+    Parameters
+    ----------
+    count_1: array of concept_id_1 counts
+    count_2: array of concept_id_2 counts
+    pair_count: array of pair counts
+    patient_count: number of patients in the dataset
+    confidence: confidence of the CIs
+
+    Returns
+    -------
+    dict of column name -> array
+    """
+    c1 = np.asarray(count_1, dtype=np.float64)
+    c2 = np.asarray(count_2, dtype=np.float64)
+    cp = np.asarray(pair_count, dtype=np.float64)
+    n = float(patient_count)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Chi-square test on the 2x2 table of observed vs expected counts (1 degree of freedom)
+        _, p_value, _ = chi_square.chi_square(cp, c1, c2, n)
+
+        pair_count_ci_lo, pair_count_ci_hi = poisson_ci_array(cp, confidence)
+
+        # ln_ratio CI from the double poisson CI of the pair count
+        ln_ratio = np.log(cp * n / (c1 * c2))
+        lr_lo, lr_hi = double_poisson_ci_array(cp, confidence)
+        ln_ratio_ci_lo = np.log(lr_lo * np.exp(ln_ratio) / cp)
+        ln_ratio_ci_hi = np.log(lr_hi * np.exp(ln_ratio) / cp)
+
+        # Log-odds and 95% CI. Poisson perturbation can make b or c non-positive.
+        a = cp
+        b = c1 - cp
+        c = c2 - cp
+        d = n - c1 - c2 + cp
+        log_odds = np.log((a * d) / (b * c))
+        log_odds_ci = 1.96 * np.sqrt(1 / a + 1 / b + 1 / c + 1 / d)
+        log_odds_ci_lo = log_odds - log_odds_ci
+        log_odds_ci_hi = log_odds + log_odds_ci
+        degenerate = (b <= 0) | (c <= 0)
+        degenerate_value = np.where(a == 0, 0.0, np.inf)
+        log_odds = np.where(degenerate, degenerate_value, log_odds)
+        log_odds_ci_lo = np.where(degenerate, degenerate_value, log_odds_ci_lo)
+        log_odds_ci_hi = np.where(degenerate, degenerate_value, log_odds_ci_hi)
+
+    return {
+        'p_value': p_value,
+        'pair_count_ci_lo': pair_count_ci_lo,
+        'pair_count_ci_hi': pair_count_ci_hi,
+        'ln_ratio': ln_ratio,
+        'ln_ratio_ci_lo': ln_ratio_ci_lo,
+        'ln_ratio_ci_hi': ln_ratio_ci_hi,
+        'log_odds': log_odds,
+        'log_odds_ci_lo': log_odds_ci_lo,
+        'log_odds_ci_hi': log_odds_ci_hi,
+    }
+
+
+def _finite_or_none(x):
+    # MySQL doesn't store Inf or NaN, they are NULL in the COHD database
+    x = float(x)
+    return x if math.isfinite(x) else None
+
+
+def load_sqlite(path, concept_file, datasets, concept_ancestor_file=None, concept_relationship_file=None,
+                biolink_mappings_file=None, confidence=0.99):
+    """ Builds a SQLite database for SqliteBackend from the TSVs loaded by db/sql/load_cohd_data.sql
+
+    The statistics that db/precompute_stats/precompute.py adds to the MySQL database and the domain count metadata
+    tables are computed while loading. Existing files in the directory are replaced.
+
+    Parameters
+    ----------
+    path: output directory
+    concept_file: TSV of the concept table
+    datasets: list of dicts with dataset_name, dataset_description, patient_count, concept_counts_file (TSV of
+              concept_id, concept_count), and pair_counts_file (TSV of concept_id_1, concept_id_2, concept_count)
+    concept_ancestor_file: (optional) TSV of the concept_ancestor table
+    concept_relationship_file: (optional) TSV of the concept_relationship table
+    biolink_mappings_file: (optional) TSV of the biolink.mappings table
+    confidence: confidence of the precomputed CIs
+    """
+    os.makedirs(path, exist_ok=True)
+    for schema, statements in _SQLITE_SCHEMA.items():
+        file = os.path.join(path, f'{schema}.sqlite')
+        if os.path.exists(file):
+            os.remove(file)
+        with sqlite3.connect(file) as conn:
+            for sql in statements:
+                conn.execute(sql)
+
+    conn = sqlite3.connect(os.path.join(path, 'cohd.sqlite'))
+    try:
+        columns = ['concept_id', 'concept_name', 'domain_id', 'vocabulary_id', 'concept_class_id', 'standard_concept',
+                   'concept_code', 'valid_start_date', 'valid_end_date', 'invalid_reason']
+        conn.executemany(f'INSERT INTO concept ({",".join(columns)}) VALUES ({",".join("?" * len(columns))})',
+                         _read_tsv(concept_file, columns))
+        if concept_ancestor_file:
+            columns = ['ancestor_concept_id', 'descendant_concept_id', 'min_levels_of_separation',
+                       'max_levels_of_separation']
+            conn.executemany(f'INSERT INTO concept_ancestor VALUES ({",".join("?" * len(columns))})',
+                             _read_tsv(concept_ancestor_file, columns))
+        if concept_relationship_file:
+            columns = ['concept_id_1', 'concept_id_2', 'relationship_id', 'valid_start_date', 'valid_end_date',
+                       'invalid_reason']
+            conn.executemany(f'INSERT INTO concept_relationship VALUES ({",".join("?" * len(columns))})',
+                             _read_tsv(concept_relationship_file, columns))
+
+        for dataset_id, dataset in enumerate(datasets, start=1):
+            patient_count = int(dataset['patient_count'])
+            conn.execute('INSERT INTO dataset VALUES (?, ?, ?)',
+                         (dataset_id, dataset['dataset_name'], dataset.get('dataset_description')))
+            conn.execute('INSERT INTO patient_count VALUES (?, ?)', (dataset_id, patient_count))
+
+            counts = {int(c): int(n) for c, n in _read_tsv(dataset['concept_counts_file'],
+                                                           ['concept_id', 'concept_count'])}
+            concept_ids = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+            concept_counts = np.fromiter(counts.values(), dtype=np.int64, count=len(counts))
+            ci_lo, ci_hi = poisson_ci_array(concept_counts, confidence)
+            conn.executemany('INSERT INTO concept_counts VALUES (?, ?, ?, ?, ?)',
+                             zip([dataset_id] * len(counts), concept_ids.tolist(), concept_counts.tolist(),
+                                 ci_lo.tolist(), ci_hi.tolist()))
+
+            # Pairs are stored once with concept_id_1 < concept_id_2, and only for concepts with counts
+            pairs = dict()
+            for id_1, id_2, n in _read_tsv(dataset['pair_counts_file'],
+                                           ['concept_id_1', 'concept_id_2', 'concept_count']):
+                id_1, id_2 = sorted((int(id_1), int(id_2)))
+                if id_1 in counts and id_2 in counts:
+                    pairs[(id_1, id_2)] = int(n)
+            ids_1 = [p[0] for p in pairs]
+            ids_2 = [p[1] for p in pairs]
+            pair_counts = list(pairs.values())
+            stats = pair_statistics([counts[c] for c in ids_1], [counts[c] for c in ids_2], pair_counts,
+                                    patient_count, confidence)
+            stat_columns = [[_finite_or_none(x) for x in stats[c]] for c in stats]
+            conn.executemany(f'''INSERT INTO concept_pair_counts (dataset_id, concept_id_1, concept_id_2,
+                concept_count, {",".join(stats)}) VALUES ({",".join("?" * (4 + len(stats)))})''',
+                             zip([dataset_id] * len(pairs), ids_1, ids_2, pair_counts, *stat_columns))
+            logging.info(f'Loaded dataset {dataset_id}: {len(counts)} concepts, {len(pairs)} pairs')
+
+        # Metadata tables, same as create_metadata_tables() in db/sql/load_cohd_procedures.sql
+        conn.execute('''INSERT INTO domain_concept_counts
+            SELECT dataset_id, domain_id, COUNT(domain_id)
+            FROM concept_counts cc
+            JOIN concept ON cc.concept_id = concept.concept_id
+            GROUP BY dataset_id, domain_id''')
+        conn.execute('''INSERT INTO domain_pair_concept_counts
+            SELECT dataset_id, MIN(c1.domain_id, c2.domain_id) AS domain_id_1, MAX(c1.domain_id, c2.domain_id) AS
+                domain_id_2, COUNT(*)
+            FROM concept_pair_counts cpc
+            JOIN concept c1 ON cpc.concept_id_1 = c1.concept_id
+            JOIN concept c2 ON cpc.concept_id_2 = c2.concept_id
+            GROUP BY dataset_id, domain_id_1, domain_id_2''')
+        conn.commit()
+        conn.execute('ANALYZE')
+    finally:
+        conn.close()
+
+    if biolink_mappings_file:
+        columns = ['omop_id', 'biolink_id', 'biolink_label', 'categories', 'provenance', 'string_search', 'distance',
+                   'string_similarity', 'preferred']
+        with sqlite3.connect(os.path.join(path, 'biolink.sqlite')) as conn:
+            conn.executemany(f'INSERT INTO mappings VALUES ({",".join("?" * len(columns))})',
+                             _read_tsv(biolink_mappings_file, columns))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Builds a SQLite database for the COHD API from the TSVs loaded by '
+                                                 'db/sql/load_cohd_data.sql')
+    parser.add_argument('path', help='Output directory (set as SQLITE_DATABASE_DIR in cohd_flask.conf)')
+    parser.add_argument('--concepts', required=True, help='TSV of the concept table')
+    parser.add_argument('--dataset', nargs=4, action='append', required=True,
+                        metavar=('NAME', 'PATIENT_COUNT', 'CONCEPT_COUNTS', 'PAIR_COUNTS'),
+                        help='Dataset name, patient count, and TSVs of the concept and pair counts. Repeat for each '
+                             'dataset, in order of dataset_id.')
+    parser.add_argument('--concept-ancestors', help='TSV of the concept_ancestor table')
+    parser.add_argument('--concept-relationships', help='TSV of the concept_relationship table')
+    parser.add_argument('--biolink-mappings', help='TSV of the biolink.mappings table')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    load_sqlite(args.path, args.concepts,
+                [{'dataset_name': d[0], 'patient_count': d[1], 'concept_counts_file': d[2], 'pair_counts_file': d[3]}
+                 for d in args.dataset],
+                concept_ancestor_file=args.concept_ancestors,
+                concept_relationship_file=args.concept_relationships,
+                biolink_mappings_file=args.biolink_mappings)
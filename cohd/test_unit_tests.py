@@ -2,13 +2,31 @@
 This test module tests some of the utility functions supporting the COHD API
 """
 import numpy as np
+import json
 import numbers
+import tempfile
+import os
+import pymysql
+import pytest
 import requests
+from scipy.stats import poisson
 from time import sleep
 from collections import defaultdict
 
+from . import chi_square
+from . import cohd_temporal
 from . import cohd_utilities
 from . import omop_xref
+from . import concept_dictionary
+from . import concept_hierarchy
+from . import connection_pool
+from . import cooccurrence_store
+from . import dataset_stats
+from . import pair_filter
+from . import query_cohd_mysql
+from . import snapshot
+from . import sql_statements
+from . import storage_backend
 
 
 def _isnumeric(number_list):
@@ -152,6 +170,46 @@ def test_rel_freq_ci():
            _crr(x, (0.4768536681051393, 0.5241738066095472), dp)
 
 
+
+def test_ci_arrays():
+    """ Tests the array versions of the CIs in cohd_utilities against the scalar versions, including counts beyond the
+    lookup tables, non-integer counts, confidence levels without a table, and tables saved to and loaded from a file
+
+    Returns
+    -------
+    No return value. Asserts will be triggered upon failure.
+    """
+    counts = np.array([0, 1, 50, 5000, 12345, 2.5])
+    ln_ratios = np.array([0.5, 1.0, 2.0, -1.0, 5.0, 0.0])
+    base_counts = np.array([10, 10, 500, 20000, 50000, 7])
+    for confidence in [0.99, 0.95, 0.9876]:
+        lo, hi = cohd_utilities.poisson_ci_array(counts, confidence)
+        alpha = 1 - confidence
+        assert np.allclose(lo, np.maximum(poisson.ppf(alpha / 2, counts), 1))
+        assert np.allclose(hi, poisson.ppf(1 - alpha / 2, counts))
+        assert np.allclose(cohd_utilities.double_poisson_ci_array(counts, confidence),
+                           np.array([cohd_utilities.double_poisson_ci(c, confidence) for c in counts]).T)
+
+        lo, hi = cohd_utilities.ln_ratio_ci_array(counts[1:], ln_ratios[1:], confidence, 999)
+        expected = [cohd_utilities.ln_ratio_ci(c, r, confidence, 999) for c, r in zip(counts[1:], ln_ratios[1:])]
+        assert np.allclose(np.array([lo, hi]).T, expected)
+
+        lo, hi = cohd_utilities.rel_freq_ci_array(counts, base_counts, confidence, 999)
+        expected = [cohd_utilities.rel_freq_ci(c, b, confidence, 999) for c, b in zip(counts, base_counts)]
+        assert np.allclose(np.array([lo, hi]).T, expected)
+
+    # A full set of tables falls back to scipy, and saved tables are loaded
+    tables = cohd_utilities.PoissonCiTables(size=100, max_tables=1)
+    assert tables.table(0.99) is not None and tables.table(0.95) is None
+    assert np.allclose(tables.interval(counts, 0.95), cohd_utilities.poisson_ci_array(counts, 0.95))
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, 'poisson_ci.npz')
+        tables.save(path, [0.99])
+        loaded = cohd_utilities.PoissonCiTables(size=100, max_tables=1)
+        loaded.load(path)
+        assert np.array_equal(loaded.table(0.99), tables.table(0.99)) and loaded.table(0.95) is None
+
+
 def test_ci_significance():
     """ Tests cohd_utilities.ci_significance.
     Checks the results with multiple parameters have the expected format and match the expected values.
@@ -1280,3 +1338,1227 @@ def test_xref_best_to():
 
     # Check that the returned mapping was one of the original mappings
     assert x[0] in mappings
+
+
+# ######################################################################################################################
+# This section tests connection_pool.py
+# Note: uses a stand-in connection object instead of the SQL database
+# ######################################################################################################################
+class _FakeConnection:
+    """ Minimal stand-in for a pymysql connection """
+    def __init__(self):
+        self.open = True
+        self.pings = 0
+        self.rollbacks = 0
+
+    def ping(self, reconnect=True):
+        self.pings += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.open = False
+
+
+def test_connection_pool():
+    """ Tests connection_pool.ConnectionPool
+    Checks that connections are reused, that the number of idle connections is capped, that stale connections are
+    pinged, and that closed connections are not handed out again
+
+    Returns
+    -------
+    No return value. Asserts will be triggered upon failure.
+    """
+    created = list()
+
+    def _connect():
+        c = _FakeConnection()
+        created.append(c)
+        return c
+
+    pool = connection_pool.ConnectionPool(_connect, size=1, ping_interval=3600, max_idle=7200)
+
+    # Sequential checkouts reuse the same connection, and open transactions are rolled back on return
+    with pool.connection() as conn:
+        conn_1 = conn._conn
+    with pool.connection() as conn:
+        assert conn._conn is conn_1
+    assert len(created) == 1 and conn_1.rollbacks == 2 and conn_1.open
+
+    # Nested checkouts open a second connection. Only `size` idle connections are retained
+    conn_a = pool.acquire()
+    conn_b = pool.acquire()
+    assert len(created) == 2
+    conn_a.close()
+    conn_b.close()
+    conn_b.close()  # closing twice is a no-op
+    assert sum(c.open for c in created) == 1
+
+    # Idle connections are pinged before reuse
+    pool.ping_interval = -1
+    with pool.connection() as conn:
+        assert conn._conn.pings == 1
+
+    # Connections closed by the server are discarded
+    with pool.connection() as conn:
+        conn._conn.open = False
+    with pool.connection() as conn:
+        assert conn._conn.open
+    assert len(created) == 3
+
+
+# ######################################################################################################################
+# This section tests query_cohd_mysql.py
+# Note: this can only test the functions that don't rely on the SQL database
+# ######################################################################################################################
+def test_orient_trapi_pair_row():
+    """ Tests query_cohd_mysql._orient_trapi_pair_row
+    Checks that pairs stored with the smaller concept ID first are re-oriented with all paired columns swapped
+
+    Returns
+    -------
+    No return value. Asserts will be triggered upon failure.
+    """
+    row = {
+        'concept_id_1': 1, 'concept_id_2': 2,
+        'concept_1_count': 10, 'concept_2_count': 20,
+        'relative_frequency_1': 0.5, 'relative_frequency_2': 0.25,
+        'rf1_ci_lo': 0.4, 'rf1_ci_hi': 0.6, 'rf2_ci_lo': 0.2, 'rf2_ci_hi': 0.3,
+        'concept_1_name': 'a', 'concept_2_name': 'b',
+        'concept_1_domain': 'Condition', 'concept_2_domain': 'Drug',
+        'concept_1_class_id': 'Clinical Finding', 'concept_2_class_id': 'Ingredient',
+        'ln_ratio': 1.5
+    }
+
+    # Unswapped rows keep the target concept's definition only
+    x = query_cohd_mysql._orient_trapi_pair_row(row, swap=False)
+    assert x['concept_id_1'] == 1 and x['concept_id_2'] == 2 and x['concept_2_name'] == 'b'
+    assert 'concept_1_name' not in x and 'concept_1_domain' not in x and 'concept_1_class_id' not in x
+
+    # Swapped rows
+    x = query_cohd_mysql._orient_trapi_pair_row(row, swap=True)
+    assert x['concept_id_1'] == 2 and x['concept_id_2'] == 1
+    assert x['concept_1_count'] == 20 and x['concept_2_count'] == 10
+    assert x['relative_frequency_1'] == 0.25 and x['relative_frequency_2'] == 0.5
+    assert x['rf1_ci_lo'] == 0.2 and x['rf1_ci_hi'] == 0.3 and x['rf2_ci_lo'] == 0.4 and x['rf2_ci_hi'] == 0.6
+    assert x['concept_2_name'] == 'a' and x['concept_2_domain'] == 'Condition'
+    assert x['concept_2_class_id'] == 'Clinical Finding' and x['ln_ratio'] == 1.5
+
+    # The original row is unchanged
+    assert row['concept_id_1'] == 1 and 'concept_1_name' in row
+
+
+def test_get_arg_stream():
+    """ Tests query_cohd_mysql.get_arg_stream
+    Checks the streaming modes recognized from the stream parameter
+
+    Returns
+    -------
+    No return value. Asserts will be triggered upon failure.
+    """
+    assert query_cohd_mysql.get_arg_stream({}) is None
+    assert query_cohd_mysql.get_arg_stream({'stream': ''}) is None
+    assert query_cohd_mysql.get_arg_stream({'stream': 'false'}) is None
+    assert query_cohd_mysql.get_arg_stream({'stream': 'true'}) == 'json'
+    assert query_cohd_mysql.get_arg_stream({'stream': 'JSON'}) == 'json'
+    assert query_cohd_mysql.get_arg_stream({'stream': ' ndjson '}) == 'ndjson'
+
+
+def test_page_args():
+    """ Tests query_cohd_mysql.get_arg_page and the keyset cursor helpers
+    Checks that cursors round-trip and that invalid pagination parameters are rejected
+
+    Returns
+    -------
+    No return value. Asserts will be triggered upon failure.
+    """
+    cursor = query_cohd_mysql.format_page_cursor(0.1 + 0.2, 4196636)
+    assert query_cohd_mysql.parse_page_cursor(cursor) == (0.1 + 0.2, 4196636)
+    assert query_cohd_mysql.parse_page_cursor(query_cohd_mysql.format_page_cursor(277, 19041324)) == (277, 19041324)
+    assert query_cohd_mysql.parse_page_cursor('abc') is None
+    assert query_cohd_mysql.parse_page_cursor('1.5,x') is None
+    assert query_cohd_mysql.parse_page_cursor('nan,1') is None
+
+    page, error = query_cohd_mysql.get_arg_page({'limit': '10', 'min_count': '5', 'cursor': cursor})
+    assert error is None
+    assert page == (10, 5, (0.1 + 0.2, 4196636))
+    page, error = query_cohd_mysql.get_arg_page({})
+    assert error is None and page == (None, None, None)
+    for args in [{'limit': '0'}, {'limit': '-1'}, {'min_count': 'x'}, {'cursor': '1,2,3'}]:
+        page, error = query_cohd_mysql.get_arg_page(args)
+        assert page is None and error is not None
+
+    # next_cursor is only returned for a full page
+    page = query_cohd_mysql.PageArgs(2, None, None)
+    row = {'ln_ratio': 1.25, 'concept_id_2': 313217}
+    assert query_cohd_mysql._next_page_cursor(page, 2, row, 'ln_ratio', 'concept_id_2') == '1.25,313217'
+    assert query_cohd_mysql._next_page_cursor(page, 1, row, 'ln_ratio', 'concept_id_2') is None
+
+
+def test_execution_deadline():
+    """ Tests query_cohd_mysql.execution_deadline and apply_execution_deadline
+    Checks that the MAX_EXECUTION_TIME hint is only added within an execution deadline
+
+    Returns
+    -------
+    No return value. Asserts will be triggered upon failure.
+    """
+    sql = '(SELECT concept_id FROM concept) UNION (SELECT concept_id FROM concept);'
+    assert query_cohd_mysql.apply_execution_deadline(sql) == sql
+
+    with query_cohd_mysql.execution_deadline(10):
+        hinted = query_cohd_mysql.apply_execution_deadline(sql)
+        assert hinted.startswith('(SELECT /*+ MAX_EXECUTION_TIME(')
+        # Only the first SELECT gets the hint
+        assert hinted.count('MAX_EXECUTION_TIME') == 1
+        assert hinted.endswith('UNION (SELECT concept_id FROM concept);')
+    assert query_cohd_mysql.apply_execution_deadline(sql) == sql
+
+    # Statements issued after the deadline are not sent to the server
+    timed_out = False
+    with query_cohd_mysql.execution_deadline(0):
+        try:
+            query_cohd_mysql.apply_execution_deadline(sql)
+        except query_cohd_mysql.QueryTimeoutError:
+            timed_out = True
+    assert timed_out
+
+
+def test_read_router():
+    """ Tests query_cohd_mysql.ReadRouter
+    Checks route lookup by schema and dataset, and failover to the next endpoint when a connection fails
+
+    Returns
+    -------
+    No return value. Asserts will be triggered upon failure.
+    """
+    routes = {
+        'cohd': [{'config_file': 'replica_1.cnf', 'weight': 2}, {'config_file': 'replica_2.cnf'}],
+        ('cohd', 3): [{'config_file': 'hierarchical.cnf'}],
+    }
+    router = query_cohd_mysql.ReadRouter(routes, primary_config_file='primary.cnf', retry_interval=30)
+    assert [e.config_file for e in router.route('cohd', 3)] == ['hierarchical.cnf']
+    assert [e.config_file for e in router.route('cohd', 1)] == ['replica_1.cnf', 'replica_2.cnf']
+    assert [e.config_file for e in router.route('cohd')] == ['replica_1.cnf', 'replica_2.cnf']
+    assert router.route('biolink', 1) == [router.primary]
+
+    # Replica 1 is down. Reads fail over to replica 2 and replica 1 is skipped until the retry interval passes.
+    replica_1, replica_2 = router.route('cohd')
+    attempts = []
+
+    def _fail():
+        attempts.append(replica_1.config_file)
+        raise pymysql.err.OperationalError(2003, 'Can\'t connect to MySQL server')
+
+    def _succeed():
+        attempts.append(replica_2.config_file)
+        return replica_2.config_file
+
+    replica_1.pool.acquire = _fail
+    replica_2.pool.acquire = _succeed
+    for _ in range(5):
+        assert router.connection('cohd', 1) == 'replica_2.cnf'
+    assert attempts.count('replica_1.cnf') <= 1
+    assert replica_1.retry_after > 0 or 'replica_1.cnf' not in attempts
+
+
+def test_single_scan_sql():
+    """ Tests query_cohd_mysql.single_scan_sql
+    Checks that the two-sided UNION of an association query is reduced to a single scan of the bidirectional table
+
+    Returns
+    -------
+    No return value. Asserts will be triggered upon failure.
+    """
+    sql = sql_statements.get_statement('trapi_associations', domain=True, concept_class=False, ln_ratio_sign=0)
+    assert 'UNION' in sql
+    single = query_cohd_mysql.single_scan_sql(sql)
+    assert 'UNION' not in single
+    assert single.count(query_cohd_mysql.PAIR_TABLE_BIDIRECTIONAL) == 1
+    assert single.count('(') == single.count(')')
+
+
+def test_top_prefix():
+    """ Tests query_cohd_mysql._top_prefix
+    Checks that only the merged top associations ranking ahead of every association left out of a truncated group are
+    kept
+
+    Returns
+    -------
+    No return value. Asserts will be triggered upon failure.
+    """
+    def _row(concept_id_2, domain_id, score, group_size):
+        return {'concept_id_2': concept_id_2, 'top_domain_id': domain_id, 'top_concept_class_id': 'Clinical Finding',
+                'top_ln_ratio_sign': 1, 'top_score': score, 'top_group_size': group_size}
+
+    # Condition group is complete, Drug group was truncated after a score of 2.0
+    rows = [_row(1, 'Condition', 5.0, 3), _row(2, 'Drug', 4.0, 10), _row(3, 'Condition', 3.0, 3),
+            _row(4, 'Drug', 2.0, 10), _row(5, 'Condition', 1.0, 3)]
+    prefix, complete = query_cohd_mysql._top_prefix(rows)
+    assert not complete
+    assert [r['concept_id_2'] for r in prefix] == [1, 2, 3, 4]
+
+    # No truncated groups
+    prefix, complete = query_cohd_mysql._top_prefix(rows[:1] + rows[2:3] + rows[4:])
+    assert complete
+    assert [r['concept_id_2'] for r in prefix] == [1, 3, 5]
+
+
+def test_trapi_postprocess():
+    """ Tests query_cohd_mysql._trapi_postprocess and the selection of the top results by TRAPI score
+    Checks the column-oriented derivations against the per-row calculations, and that the top results of each concept
+    are selected like cohd_trapi.sort_cohd_results would rank them
+
+    Returns
+    -------
+    No return value. Asserts will be triggered upon failure.
+    """
+    from .cohd_trapi import score_cohd_result
+
+    def _row(concept_id_1, concept_id_2, ci_lo, ci_hi):
+        return {'concept_id_1': concept_id_1, 'concept_id_2': concept_id_2, 'ln_ratio_ci_lo': ci_lo,
+                'ln_ratio_ci_hi': ci_hi, 'rf1_ci_lo': 0.1, 'rf1_ci_hi': np.inf, 'rf2_ci_lo': 0.2, 'rf2_ci_hi': 0.3,
+                'p_value': 1e-3, 'log_odds': -np.inf, 'log_odds_ci_lo': -np.inf, 'log_odds_ci_hi': 2.0}
+
+    rows = [_row(1, 10, 2.0, np.inf), _row(1, 11, -0.5, 0.5), _row(1, 12, -3.0, -1.5), _row(1, 13, 1.5, 2.0),
+            _row(2, 20, 0.5, 1.0)]
+    query_cohd_mysql._trapi_postprocess(rows, 1e6)
+    r = rows[0]
+    assert r['ln_ratio_ci'] == (2.0, 999) and r['relative_frequency_1_ci'] == (0.1, 999)
+    assert r['relative_frequency_2_ci'] == (0.2, 0.3)
+    assert r['chi_square_p-value'] == 1e-3 and r['chi_square_p-value_adjusted'] == 1.0
+    assert r['log_odds'] == -999 and r['log_odds_ci'] == [-999, 2.0]
+
+    scores = query_cohd_mysql._trapi_scores(*chi_square.columns(rows, ['ln_ratio_ci_lo', 'ln_ratio_ci_hi']))
+    assert scores.tolist() == [score_cohd_result(r) for r in rows]
+
+    # Top 2 of concept 1 (scores 2.0, 0, 1.5, 1.5), with ties of the 2nd row kept
+    keep, complete = query_cohd_mysql._top_by_group(np.array([1, 1, 1, 1, 2]), scores, 2)
+    assert keep.tolist() == [True, False, True, True, True] and complete == {1: False, 2: True}
+    keep, complete = query_cohd_mysql._top_by_group(np.array([1, 1, 1, 1, 2]), scores, 1)
+    assert keep.tolist() == [True, False, False, False, True]
+    assert query_cohd_mysql._top_by_group(np.zeros(0, dtype=np.int64), np.zeros(0), 1)[0].size == 0
+
+    # The rows that are cut off are kept without statistics until the remainder is requested
+    rows = [_row(1, 10, 2.0, np.inf), _row(1, 11, -0.5, 0.5), _row(1, 12, -3.0, -1.5), _row(1, 13, 1.5, 2.0),
+            _row(2, 20, 0.5, 1.0)]
+    results = query_cohd_mysql._trapi_many_results({1: list(), 2: list(), 3: list()}, rows, 1e6, max_results=1)
+    top, complete, remainder = results[1]
+    assert [r['concept_id_2'] for r in top] == [10] and not complete and len(remainder) == 3
+    assert 'ln_ratio_ci' not in rows[1]
+    assert [r['concept_id_2'] for r in remainder.results()] == [11, 12, 13]
+    assert remainder.results()[0]['ln_ratio_ci'] == (-0.5, 0.5)
+    assert results[2][1] and len(results[2][2]) == 0
+    assert results[3][0] == [] and results[3][1]
+
+
+def test_mcq_scores():
+    """ Tests query_cohd_mysql._mcq_scores
+    Checks the Jaccard weights, the weighted sums and logistic normalization, and the single associations of each
+    associated concept
+
+    Returns
+    -------
+    No return value. Asserts will be triggered upon failure.
+    """
+    def _assoc(concept_id_1, concept_id_2, ci_lo, ci_hi):
+        return {'dataset_id': 1, 'concept_id_1': concept_id_1, 'concept_id_2': concept_id_2,
+                'concept_2_name': f'c{concept_id_2}', 'concept_2_domain': 'Condition',
+                'concept_2_class_id': 'Clinical Finding', 'ln_ratio_ci': (ci_lo, ci_hi)}
+
+    # Scores: 1->10: 0.5, 1->11: 0, 2->10: -1, 2->11: 0.2, 3->10: 1. Input concept 2 is not an associated concept.
+    associations = [_assoc(1, 10, 0.5, 1.0), _assoc(1, 11, -1.0, 0.2), _assoc(1, 2, 1.0, 2.0),
+                    _assoc(2, 10, -2.0, -1.0), _assoc(2, 11, 0.2, 0.4), _assoc(3, 10, 1.0, 2.0)]
+    # Jaccard(1, 2) = 10 / (30 + 20 - 10) = 0.25. Concept 3 doesn't co-occur with another input concept.
+    pair_counts = [
+        {'concept_id_1': 1, 'concept_id_2': 2, 'concept_count_1': 30, 'concept_count_2': 20, 'concept_pair_count': 10},
+        {'concept_id_1': 2, 'concept_id_2': 1, 'concept_count_1': 20, 'concept_count_2': 30, 'concept_pair_count': 10},
+    ]
+    set_associations, single_associations = query_cohd_mysql._mcq_scores(associations, pair_counts, 4, 0.75)
+
+    # Weights 1 / (1 + 0.25) = 0.8 for concepts 1 and 2
+    assert [r['concept_id_2'] for r in set_associations] == [11, 10]
+    assert _crr([r['ln_ratio_score'] for r in set_associations], [0.16, -0.4])
+    mcq_score = (1 / (1 + np.exp(-np.abs(-0.4 / 1.6 * 3 / 4 * 0.75))) - 0.5) * 2
+    assert _crr([set_associations[1]['mcq_score']], [mcq_score])
+    assert set_associations[0]['concept_2_name'] == 'c11' and set_associations[0]['dataset_id'] == 1
+
+    assert sorted(single_associations) == [10, 11]
+    assert [r['concept_id_1'] for r in single_associations[10]] == [1, 2, 3]
+    assert [r['ln_ratio_score'] for r in single_associations[10]] == [0.5, -1.0, 1.0]
+    assert 'ln_ratio_score' not in associations[0]
+
+    # Without co-occurrences, all input concepts have weight 1
+    set_associations, _ = query_cohd_mysql._mcq_scores(associations, [], 4, 0.75)
+    assert _crr([r['ln_ratio_score'] for r in set_associations], [0.5, 0.2])
+    assert query_cohd_mysql._mcq_scores([], [], 4) == ([], {})
+
+
+def _trapi_row(concept_id_1, concept_id_2, domain_id, concept_class_id, ln_ratio):
+    """ Association row as returned by the TRAPI association statements """
+    return {'dataset_id': 1, 'concept_id_1': concept_id_1, 'concept_id_2': concept_id_2, 'ln_ratio': ln_ratio,
+            'ln_ratio_ci_lo': ln_ratio - 0.5, 'ln_ratio_ci_hi': ln_ratio + 0.5, 'rf1_ci_lo': 0.1, 'rf1_ci_hi': 0.2,
+            'rf2_ci_lo': 0.3, 'rf2_ci_hi': 0.4, 'p_value': 1e-4, 'log_odds': ln_ratio, 'log_odds_ci_lo': ln_ratio - 1,
+            'log_odds_ci_hi': ln_ratio + 1, 'concept_2_name': f'c{concept_id_2}', 'concept_2_domain': domain_id,
+            'concept_2_class_id': concept_class_id}
+
+
+class _TrapiConnection:
+    """ Stands in for a database connection (and its cursor). Answers the TRAPI association statements from a list of
+    association rows by applying the concept ID and domain-class filters bound as parameters, and records the
+    statements executed.
+    """
+    def __init__(self, rows):
+        self.rows = rows
+        self.statements = list()
+        self._results = list()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def close(self):
+        pass
+
+    def cursor(self, *args):
+        return self
+
+    def execute(self, sql, params=None):
+        params = params or dict()
+        self.statements.append((sql, params))
+        # %(concept_id_1)s in single-concept statements, %(concept_id_0)s, %(concept_id_1)s, ... in IN lists
+        concept_ids = {v for k, v in params.items() if k.startswith('concept_id_') and k[11:].isdigit()}
+        domain_class_pairs = [(v, params.get(k.replace('domain_id', 'concept_class_id')))
+                              for k, v in params.items() if k.startswith('domain_id')]
+        rows = [r for r in self.rows if r['concept_id_1'] in concept_ids and
+                (not domain_class_pairs or any(r['concept_2_domain'] == d and c in (None, r['concept_2_class_id'])
+                                               for d, c in domain_class_pairs))]
+        self._results = [dict(r) for r in sorted(rows, key=lambda r: (r['concept_id_1'], -abs(r['ln_ratio'])))]
+
+    def fetchall(self):
+        return self._results
+
+
+# Domain and concept class of the concepts in _trapi_connection
+_TRAPI_CONCEPTS = {10: ('Condition', 'Clinical Finding'), 20: ('Condition', 'Disorder'), 30: ('Drug', 'Ingredient'),
+                   40: ('Drug', 'Ingredient'), 50: ('Procedure', 'Procedure')}
+
+
+def _trapi_connection(monkeypatch):
+    """ Serves the TRAPI association queries of query_cohd_mysql from a _TrapiConnection over a few associations """
+    rows = list()
+    for concept_id_1, concept_id_2, ln_ratio in [(10, 20, 1.0), (10, 30, -2.0), (10, 40, 0.5), (20, 50, 3.0)]:
+        rows.append(_trapi_row(concept_id_1, concept_id_2, *_TRAPI_CONCEPTS[concept_id_2], ln_ratio))
+        rows.append(_trapi_row(concept_id_2, concept_id_1, *_TRAPI_CONCEPTS[concept_id_1], ln_ratio))
+    conn = _TrapiConnection(rows)
+    monkeypatch.setattr(query_cohd_mysql, 'sql_connection', lambda *args, **kwargs: conn)
+    monkeypatch.setattr(query_cohd_mysql, 'get_total_pair_counts', lambda dataset_id: 1000)
+    monkeypatch.setattr(query_cohd_mysql.dataset_stats, 'patient_count', lambda dataset_id: 100000)
+    monkeypatch.setattr(query_cohd_mysql, 'bidirectional_pairs', lambda: False)
+    return conn
+
+
+def test_query_trapi_many(monkeypatch):
+    """ Tests query_cohd_mysql.query_trapi_many
+    Checks that the associations of several concepts are retrieved with one statement, grouped by input concept, and
+    are the same as querying each concept (and each domain-class pair) with query_trapi
+
+    Returns
+    -------
+    No return value. Asserts will be triggered upon failure.
+    """
+    conn = _trapi_connection(monkeypatch)
+
+    # Concept 60 has no associations
+    many = query_cohd_mysql.query_trapi_many([10, 20, 60], dataset_id=1, bypass=True)
+    assert len(conn.statements) == 1
+    assert sorted(many) == [10, 20, 60] and many[60] == []
+    assert [r['concept_id_2'] for r in many[10]] == [30, 20, 40]
+    assert many[10][0]['ln_ratio_ci'] == (-2.5, -1.5) and many[10][0]['chi_square_p-value_adjusted'] == 0.1
+    for concept_id in [10, 20]:
+        assert many[concept_id] == query_cohd_mysql.query_trapi(concept_id, dataset_id=1, bypass=True)['results']
+
+    # An associated concept is returned once, whichever domain-class pairs it matches
+    pairs = (('Drug', None), ('Condition', 'Disorder'), ('Condition', None))
+    many = query_cohd_mysql.query_trapi_many([10, 20], dataset_id=1, domain_class_pairs=pairs[:2], bypass=True)
+    assert [r['concept_id_2'] for r in many[10]] == [30, 20, 40] and many[20] == []
+    for concept_id in [10, 20]:
+        single = list()
+        for domain_id, concept_class_id in pairs[:2]:
+            single.extend(query_cohd_mysql.query_trapi(concept_id, dataset_id=1, domain_id=domain_id,
+                                                       concept_class_id=concept_class_id, bypass=True)['results'])
+        assert sorted(many[concept_id], key=lambda r: r['concept_id_2']) == \
+               sorted(single, key=lambda r: r['concept_id_2'])
+    many = query_cohd_mysql.query_trapi_many([10], dataset_id=1, domain_class_pairs=pairs, bypass=True)
+    assert [r['concept_id_2'] for r in many[10]] == [30, 20, 40]
+
+    # With max_results, only the top associations of each concept by TRAPI score, and whether they are all of them
+    all_results = query_cohd_mysql.query_trapi_many([10, 20, 60], dataset_id=1, bypass=True)
+    top = query_cohd_mysql.query_trapi_many([10, 20, 60], dataset_id=1, bypass=True, max_results=2)
+    for concept_id in [10, 20, 60]:
+        results, complete, remainder = top[concept_id]
+        assert results == all_results[concept_id][:2] and complete == (len(all_results[concept_id]) <= 2)
+        # The associations left out of the top results
+        assert remainder.results() == all_results[concept_id][2:]
+
+
+# ######################################################################################################################
+# This section tests cohd_trapi_15.py
+# ######################################################################################################################
+def _batch_operation(concept_ids, max_results_per_input=10, max_results=100):
+    """ Gets a CohdTrapi150 set up to run operate_batch for input concepts without Node 2 IDs. Results are recorded in
+    _results without the TRAPI conversion.
+
+    Returns
+    -------
+    CohdTrapi150, or skips the test if the TRAPI module can't be imported
+    """
+    import logging
+    from datetime import datetime
+    try:
+        from .cohd_trapi_15 import CohdTrapi150
+    except Exception as e:
+        # Importing the TRAPI module loads the Biolink model
+        pytest.skip(f'Unable to import the TRAPI module: {e}')
+
+    trapi = CohdTrapi150.__new__(CohdTrapi150)
+    trapi._concept_1_omop_ids = concept_ids
+    trapi._concept_2_omop_ids = None
+    trapi._domain_class_pairs = None
+    trapi._dataset_id = 1
+    trapi._association_direction = 0
+    trapi._confidence_interval = 0.99
+    trapi._bypass_cache = True
+    trapi._max_results_per_input = max_results_per_input
+    trapi._max_results = max_results
+    trapi._time_limit = 60
+    trapi._start_time = datetime.now()
+    trapi._kg_omop_curie_map = {x: f'OMOP:{x}' for x in concept_ids}
+    trapi._log_level = logging.WARNING
+    trapi._logs = list()
+    trapi._criteria = None
+    trapi._cohd_results = list()
+    trapi._results = list()
+    trapi._add_cohd_result = lambda result, criteria: trapi._results.append(result)
+    return trapi
+
+
+def test_operate_batch(monkeypatch):
+    """ Tests CohdTrapi150.operate_batch without Node 2 IDs
+    Checks that the input IDs are queried a chunk of CohdTrapi.batch_query_size IDs at a time, that the results of
+    each input ID are sorted and limited as before, and that an input ID is only queried again when its precomputed
+    top list runs out
+
+    Returns
+    -------
+    No return value. Asserts will be triggered upon failure.
+    """
+    from .cohd_trapi import CohdTrapi, sort_cohd_results
+
+    concept_ids = [1, 2, 3, 4, 5]
+    associations = {concept_id: [_trapi_row(concept_id, 100 * concept_id + i, 'Condition', 'Disorder', x)
+                                 for i, x in enumerate([0.5, 3.0, -2.0])]
+                    for concept_id in concept_ids}
+    for rows in associations.values():
+        query_cohd_mysql._trapi_postprocess(rows, 1000)
+    queried = list()
+
+    def _query_trapi_many(concept_ids, max_results=None, **kwargs):
+        queried.append(list(concept_ids))
+        if max_results is None:
+            return {concept_id: list(associations[concept_id]) for concept_id in concept_ids}
+        results = {concept_id: sort_cohd_results(associations[concept_id]) for concept_id in concept_ids}
+        return {k: (v[:max_results], len(v) <= max_results,
+                    query_cohd_mysql.TrapiRemainder([dict(r) for r in v[max_results:]], 1000))
+                for k, v in results.items()}
+    monkeypatch.setattr(query_cohd_mysql, 'query_trapi_many', _query_trapi_many)
+    monkeypatch.setattr(query_cohd_mysql, 'query_trapi_top', lambda concept_ids, **kwargs: None)
+    monkeypatch.setattr(CohdTrapi, 'batch_query_size', 2)
+
+    trapi = _batch_operation(concept_ids)
+    trapi.operate_batch()
+    assert queried == [[1, 2], [3, 4], [5]]
+    expected = [r for concept_id in concept_ids for r in sort_cohd_results(associations[concept_id])]
+    assert trapi._results == expected
+    assert [r['concept_id_2'] for r in trapi._results[:3]] == [101, 102, 100]
+
+    # Results limits per input ID and in total. The IDs after the total limit is reached are not queried.
+    queried.clear()
+    trapi = _batch_operation(concept_ids, max_results_per_input=2, max_results=5)
+    trapi.operate_batch()
+    # The top 2 results of an ID fill its limit without the check for more results. It continues with the associations
+    # left out of its top results, which were fetched with the batch.
+    assert queried == [[1, 2], [3, 4]]
+    assert [r['concept_id_2'] for r in trapi._results] == [101, 102, 201, 202, 301]
+    assert 'Skipped' in trapi._logs[-1]['message']
+
+    # Precomputed top lists with the top 2 associations of each concept. The IDs are only queried again when their top
+    # list runs out before the results limit is reached.
+    def _query_trapi_top(concept_ids, **kwargs):
+        return {concept_id: (sort_cohd_results(associations[concept_id])[:2], False) for concept_id in concept_ids}
+    monkeypatch.setattr(query_cohd_mysql, 'query_trapi_top', _query_trapi_top)
+    queried.clear()
+    trapi = _batch_operation([1, 2], max_results_per_input=1)
+    trapi.operate_batch()
+    assert queried == []
+    assert [r['concept_id_2'] for r in trapi._results] == [101, 201]
+
+    # The top list of concept 1 is left out by the criteria. Its results continue with the rest of its associations.
+    def _add_cohd_result(result, criteria):
+        if result['concept_id_2'] not in [101, 102]:
+            trapi._results.append(result)
+    trapi = _batch_operation([1, 2], max_results_per_input=1)
+    trapi._add_cohd_result = _add_cohd_result
+    trapi.operate_batch()
+    assert queried == [[1]]
+    assert [r['concept_id_2'] for r in trapi._results] == [100, 201]
+
+
+# ######################################################################################################################
+# This section tests sql_statements.py
+# ######################################################################################################################
+def test_sql_statements():
+    """ Tests sql_statements
+    Checks the IN list buckets and that statement texts are built once per shape
+
+    Returns
+    -------
+    No return value. Asserts will be triggered upon failure.
+    """
+    assert [sql_statements.in_list_size(n) for n in [1, 4, 5, 8, 9, 100]] == [4, 4, 8, 8, 16, 128]
+    assert sql_statements.in_list('id', 2) == '%(id_0)s, %(id_1)s'
+
+    params = dict()
+    assert sql_statements.bind_in_list(params, 'id', [10, 20, 30, 40, 50]) == 8
+    assert [params[f'id_{i}'] for i in range(8)] == [10, 20, 30, 40, 50, 50, 50, 50]
+
+    # Registered TRAPI statements only depend on the shape of the query
+    sql_1 = sql_statements.get_statement('trapi_pairs', n_ids_1=4, n_ids_2=8, ln_ratio_sign=1)
+    sql_2 = sql_statements.get_statement('trapi_pairs', n_ids_1=4, n_ids_2=8, ln_ratio_sign=1)
+    assert sql_1 is sql_2
+    assert '%(id_2_7)s' in sql_1 and '%(id_2_8)s' not in sql_1
+    assert 'AND ln_ratio > 0' in sql_1
+
+
+# ######################################################################################################################
+# This section tests dataset_stats.py
+# ######################################################################################################################
+def test_dataset_stats():
+    """ Tests dataset_stats.DatasetStats
+    Checks that the constants are loaded once, and that the version only changes when a refresh loads new values
+
+    Returns
+    -------
+    No return value. Asserts will be triggered upon failure.
+    """
+    loads = []
+
+    def _load():
+        loads.append(1)
+        return {
+            'patient_counts': {1: 1000 + 10 * (len(loads) // 3)},
+            'total_pair_counts': {1: 6},
+            'domain_counts': {1: (('Condition', 3), ('Drug', 2))},
+            'domain_pair_counts': {1: (('Condition', 'Condition', 2), ('Condition', 'Drug', 4))},
+        }
+
+    stats = dataset_stats.DatasetStats(_load, refresh_interval=None)
+    assert stats.patient_count(1) == 1000
+    assert stats.total_pair_count(1) == 6
+    assert stats.domain_counts(1)[1] == ('Drug', 2)
+    assert stats.patient_count(2) is None and stats.domain_pair_counts(2) == ()
+    assert len(loads) == 1 and stats.version == 1
+
+    # Same values: the version is unchanged
+    stats.refresh()
+    assert stats.version == 1
+
+    # New values: the version is incremented
+    stats.refresh()
+    assert stats.patient_count(1) == 1010
+    assert stats.version == 2
+
+
+def _use_concept_dictionary(monkeypatch, index):
+    """ Serves query_cohd_mysql.concept_dictionary from index """
+    monkeypatch.setattr(query_cohd_mysql, '_concept_dictionary', index)
+    return query_cohd_mysql.concept_dictionary
+
+
+def _use_concept_hierarchy(monkeypatch, index):
+    """ Serves query_cohd_mysql.concept_hierarchy from index """
+    monkeypatch.setitem(query_cohd_mysql.app.config, 'CONCEPT_HIERARCHY_IN_MEMORY', True)
+    monkeypatch.setattr(query_cohd_mysql, '_concept_hierarchy', index)
+    return query_cohd_mysql.concept_hierarchy
+
+
+def _use_age_distributions(monkeypatch, index):
+    """ Serves cohd_temporal.age_distributions of dataset 1 from index """
+    monkeypatch.setitem(cohd_temporal.app.config, 'AGE_DISTRIBUTIONS_IN_MEMORY', True)
+    monkeypatch.setitem(cohd_temporal._age_distributions, 1, index)
+    return lambda: cohd_temporal.age_distributions(1)
+
+
+@pytest.mark.parametrize('use_index', [_use_concept_dictionary, _use_concept_hierarchy, _use_age_distributions])
+def test_versioned_index(monkeypatch, use_index):
+    """ Tests dataset_stats.VersionedIndex through the in-process indexes that use it
+    Checks that the index is reloaded when the version changes, and that a failed load keeps the previous index and is
+    not retried before the retry interval passes
+
+    Returns
+    -------
+    No return value. Asserts will be triggered upon failure.
+    """
+    from types import SimpleNamespace
+
+    version = 1
+    loads = list()
+
+    def _load(v):
+        loads.append(v)
+        if len(loads) == 1 or v == 3:
+            raise ConnectionError('MySQL is down')
+        return SimpleNamespace(version=v)
+
+    index = dataset_stats.VersionedIndex('test index', _load, lambda: version, retry_interval=3600)
+    get = use_index(monkeypatch, index)
+
+    # The failed first load is not retried until the index is cleared
+    assert get() is None
+    assert get() is None and loads == [1]
+    index.clear()
+    assert get().version == 1 and get().version == 1 and loads == [1, 1]
+
+    # Reloaded when the version changes. The previous index is kept when a reload fails.
+    version = 2
+    assert get().version == 2 and loads == [1, 1, 2]
+    version = 3
+    assert get().version == 2 and get().version == 2 and loads == [1, 1, 2, 3]
+
+
+# ######################################################################################################################
+# This section tests cooccurrence_store.py
+# ######################################################################################################################
+def test_cooccurrence_store():
+    """ Tests cooccurrence_store
+    Writes a small store and checks that the associations of a concept match the values computed from the pairs
+
+    Returns
+    -------
+    No return value. Asserts will be triggered upon failure.
+    """
+    concepts = {
+        'concept_id': [30, 10, 20, 40],
+        'concept_count': [300, 100, 200, 400],
+        'ci_lo': [290, 90, 190, 390],
+        'ci_hi': [310, 110, 210, 410],
+        'domain_id': ['Drug', 'Condition', 'Condition', None],
+        'concept_class_id': ['Ingredient', 'Clinical Finding', 'Clinical Finding', None],
+        'concept_name': ['drug', 'condition a', 'condition b', None],
+    }
+    # Each pair is stored once with the smaller concept ID first
+    pairs = {
+        'concept_id_1': [10, 10, 20, 10],
+        'concept_id_2': [20, 30, 30, 40],
+        'concept_count': [50, 20, 60, 5],
+        'p_value': [0.001, 0.5, 0.01, 0.2],
+        'ln_ratio': [1.5, -0.2, 0.7, 0.1],
+        'ln_ratio_ci_lo': [1.2, -0.4, 0.5, -0.1],
+        'ln_ratio_ci_hi': [1.8, 0.0, 0.9, 0.3],
+        'log_odds': [1.6, -0.3, 0.8, 0.1],
+        'log_odds_ci_lo': [1.3, -0.5, 0.6, -0.1],
+        'log_odds_ci_hi': [1.9, -0.1, 1.0, 0.3],
+        'pair_count_ci_lo': [45, 15, 55, 3],
+        'pair_count_ci_hi': [55, 25, 65, 7],
+    }
+    with tempfile.TemporaryDirectory() as root:
+        cooccurrence_store.write_store(os.path.join(root, '1'), 1, 1000, 4, concepts, pairs)
+        store = cooccurrence_store.open_store(root, 1)
+        assert store is not None and cooccurrence_store.open_store(root, 2) is None
+
+        # Concept 30 is stored as concept_id_2 in both of its pairs. Sorted by ABS(ln_ratio) descending.
+        rows = store.associations(30)
+        assert [r['concept_id_2'] for r in rows] == [20, 10]
+        r = rows[0]
+        assert r['concept_id_1'] == 30 and r['concept_1_count'] == 300 and r['concept_2_count'] == 200
+        assert r['concept_pair_count'] == 60 and r['patient_count'] == 1000
+        assert np.isclose(r['expected_count'], 300 * 200 / 1000)
+        assert np.isclose(r['relative_frequency_1'], 60 / 300) and np.isclose(r['relative_frequency_2'], 60 / 200)
+        assert np.isclose(r['rf1_ci_lo'], 55 / 310) and np.isclose(r['rf2_ci_hi'], 65 / 190)
+        assert np.isclose(r['ln_ratio'], 0.7) and np.isclose(r['p_value'], 0.01)
+        assert r['concept_2_name'] == 'condition b' and r['concept_2_domain'] == 'Condition'
+
+        # Filters. Concept 40 is not in the concept table, so it is only returned without concept_2 definitions.
+        assert [r['concept_id_2'] for r in store.associations(10)] == [20, 30]
+        assert [r['concept_id_2'] for r in store.associations(10, domain_class_pairs=[('Drug', None)])] == [30]
+        assert [r['concept_id_2'] for r in store.associations(10, ln_ratio_sign=-1)] == [30]
+        pair_rows = store.associations(10, neighbor_ids=[40], include_concept_2=False)
+        assert len(pair_rows) == 1 and 'concept_2_name' not in pair_rows[0]
+        assert store.associations(99) == []
+
+
+# ######################################################################################################################
+# This section tests concept_dictionary.py
+# ######################################################################################################################
+def test_concept_dictionary():
+    """ Tests concept_dictionary.ConceptDictionary
+    Checks single and batched lookups against the rows the dictionary was built from
+
+    Returns
+    -------
+    No return value. Asserts will be triggered upon failure.
+    """
+    rows = [
+        {'concept_id': 313217, 'concept_name': 'Atrial fibrillation', 'domain_id': 'Condition',
+         'vocabulary_id': 'SNOMED', 'concept_class_id': 'Clinical Finding', 'concept_code': '49436004'},
+        {'concept_id': 1310149, 'concept_name': 'warfarin', 'domain_id': 'Drug', 'vocabulary_id': 'RxNorm',
+         'concept_class_id': 'Ingredient', 'concept_code': '11289'},
+        {'concept_id': 192855, 'concept_name': 'Cancer in situ of urinary bladder', 'domain_id': 'Condition',
+         'vocabulary_id': 'SNOMED', 'concept_class_id': 'Clinical Finding', 'concept_code': '92546004'},
+    ]
+    dictionary = concept_dictionary.ConceptDictionary(rows, version=1)
+    assert len(dictionary) == 3 and dictionary.version == 1
+    assert dictionary.domains == ['Condition', 'Drug']
+    for row in rows:
+        assert dictionary.get(row['concept_id']) == row
+    assert dictionary.get(4) is None and 4 not in dictionary and 1310149 in dictionary
+
+    defs = dictionary.get_many([1310149, 4, 192855])
+    assert set(defs.keys()) == {1310149, 192855}
+    assert defs[1310149]['concept_name'] == 'warfarin' and defs[192855]['concept_code'] == '92546004'
+    assert concept_dictionary.ConceptDictionary([]).get_many([1]) == dict()
+
+
+# ######################################################################################################################
+# This section tests concept_hierarchy.py
+# ######################################################################################################################
+def test_concept_hierarchy():
+    """ Tests concept_hierarchy.ConceptHierarchy
+    Checks the ordering, filters, and count semantics of the conceptAncestors and conceptDescendants SQL queries: a
+    concept with counts only in other datasets is excluded, and a concept without counts in any dataset has count 0
+
+    Returns
+    -------
+    No return value. Asserts will be triggered upon failure.
+    """
+    def _concept(concept_id, vocabulary_id, concept_class_id):
+        return {'concept_id': concept_id, 'concept_name': f'concept {concept_id}', 'domain_id': 'Condition',
+                'vocabulary_id': vocabulary_id, 'concept_class_id': concept_class_id,
+                'concept_code': str(concept_id), 'standard_concept': 'S'}
+
+    concepts = [_concept(1, 'SNOMED', 'Clinical Finding'), _concept(2, 'SNOMED', 'Clinical Finding'),
+                _concept(3, 'SNOMED', 'Clinical Finding'), _concept(4, 'MedDRA', 'PT'),
+                _concept(5, 'SNOMED', 'Disorder')]
+    # (ancestor, descendant, min levels, max levels). Concept 99 is not in the concept table.
+    relationships = [(1, 1, 0, 0), (2, 2, 0, 0), (3, 3, 0, 0), (1, 2, 1, 1), (1, 3, 2, 2), (2, 3, 1, 1), (4, 3, 1, 2),
+                     (5, 3, 3, 3), (99, 3, 1, 1)]
+    counts = {1: ([1, 2, 3], [100, 50, 10]), 2: ([4], [5])}
+    hierarchy = concept_hierarchy.ConceptHierarchy(*zip(*relationships), concepts, counts, version=1)
+    assert len(hierarchy) == 5 and hierarchy.version == 1
+    assert hierarchy.ancestor_ids(3).tolist() == [1, 2, 3, 4, 5]
+    assert hierarchy.descendant_ids(1).tolist() == [1, 2, 3] and hierarchy.ancestor_ids(6).tolist() == []
+
+    ancestors = hierarchy.ancestors(3, 1)
+    assert [r['ancestor_concept_id'] for r in ancestors] == [5, 3, 2, 1]
+    assert [r['concept_count'] for r in ancestors] == [0, 10, 50, 100]
+    assert ancestors[-1] == {'ancestor_concept_id': 1, 'min_levels_of_separation': 2, 'max_levels_of_separation': 2,
+                             'concept_name': 'concept 1', 'domain_id': 'Condition', 'vocabulary_id': 'SNOMED',
+                             'concept_class_id': 'Clinical Finding', 'standard_concept': 'S', 'concept_code': '1',
+                             'concept_count': 100}
+    assert [r['ancestor_concept_id'] for r in hierarchy.ancestors(3, 2)] == [5, 4]
+    assert [r['ancestor_concept_id'] for r in hierarchy.ancestors(3, 2, vocabulary_id='MedDRA')] == [4]
+    assert hierarchy.ancestors(3, 2, vocabulary_id='ICD10CM') == []
+    assert [r['ancestor_concept_id'] for r in hierarchy.ancestors(3, 1, concept_class_id='Disorder')] == [5]
+
+    descendants = hierarchy.descendants(1, 1)
+    assert [(r['descendant_concept_id'], r['concept_count']) for r in descendants] == [(1, 100), (2, 50), (3, 10)]
+    assert hierarchy.descendants(1, 3) == [] and hierarchy.descendants(6, 1) == []
+
+
+# ######################################################################################################################
+# This section tests pair_filter.py
+# ######################################################################################################################
+def test_pair_filter():
+    """ Tests pair_filter.PairFilter
+    Checks that added pairs are always found in either order, that the false positive rate is near its target, and
+    that a saved filter can be opened again
+
+    Returns
+    -------
+    No return value. Asserts will be triggered upon failure.
+    """
+    rng = np.random.default_rng(0)
+    ids_1 = rng.integers(1, 50000000, 20000)
+    ids_2 = rng.integers(1, 50000000, 20000)
+    f = pair_filter.PairFilter.create(len(ids_1), 0.01)
+    f.add(ids_1, ids_2)
+    f.patient_count, f.total_pair_count = 1000, len(ids_1)
+    assert f.n_items == len(ids_1)
+
+    # No false negatives, and the scalar lookup agrees with the vectorized lookup
+    assert f.contains(ids_2, ids_1).all()
+    assert all((b, a) in f for a, b in zip(ids_1[:100], ids_2[:100]))
+    probe_1 = rng.integers(50000000, 100000000, 20000)
+    probe_2 = rng.integers(50000000, 100000000, 20000)
+    found = f.contains(probe_1, probe_2)
+    assert found.mean() < 0.02
+    assert [(a, b) in f for a, b in zip(probe_1[:200], probe_2[:200])] == found[:200].tolist()
+
+    with tempfile.TemporaryDirectory() as root:
+        f.save(root, 1)
+        opened = pair_filter.open_filter(root, 1)
+        assert opened is not None and pair_filter.open_filter(root, 2) is None
+        assert opened.n_hashes == f.n_hashes and opened.n_items == f.n_items
+        assert opened.matches(1000, len(ids_1)) and not opened.matches(1000, len(ids_1) + 1)
+        assert (opened.contains(probe_1, probe_2) == found).all()
+        assert (int(ids_1[0]), int(ids_2[0])) in opened
+
+        # Saving over an open filter swaps in new files and leaves the memory-mapped bits of the open filter intact
+        f.save(root, 1)
+        assert (opened.contains(probe_1, probe_2) == found).all()
+        assert sorted(os.listdir(root)) == ['1.json', '1.npy']
+
+
+def test_pair_filter_dataset_stats(monkeypatch):
+    """ Tests query_cohd_mysql.pair_filter
+    Checks that a pair filter is only used while the dataset stats match the counts it was built from, and that it is
+    checked again when the dataset stats version changes
+
+    Returns
+    -------
+    No return value. Asserts will be triggered upon failure.
+    """
+    counts = {'patient_counts': {1: 1000}, 'total_pair_counts': {1: 2}}
+    stats = dataset_stats.DatasetStats(lambda: dict(counts, domain_counts={}, domain_pair_counts={}),
+                                       refresh_interval=None)
+    monkeypatch.setattr(query_cohd_mysql, 'dataset_stats', stats)
+    monkeypatch.setattr(query_cohd_mysql, '_pair_filters', dict())
+
+    f = pair_filter.PairFilter.create(2, 0.01)
+    f.add([1, 3], [2, 4])
+    f.patient_count, f.total_pair_count = 1000, 2
+    with tempfile.TemporaryDirectory() as root:
+        monkeypatch.setitem(query_cohd_mysql.app.config, 'PAIR_FILTER_DIR', root)
+        f.save(root, 1)
+        assert query_cohd_mysql.pair_filter(1) is not None and query_cohd_mysql.pair_filter(2) is None
+        assert query_cohd_mysql.pair_may_exist(1, 2, 1) and not query_cohd_mysql.pair_may_exist(1, 1, 4)
+
+        # The database is reloaded with more pairs. The stale filter would report the new pairs as absent.
+        counts['total_pair_counts'] = {1: 3}
+        stats.refresh()
+        assert query_cohd_mysql.pair_filter(1) is None
+        assert query_cohd_mysql.pair_may_exist(1, 1, 4)
+
+        # A filter rebuilt for the reloaded database is used once the version changes again
+        f.total_pair_count = 3
+        f.save(root, 1)
+        assert query_cohd_mysql.pair_filter(1) is None
+        counts['patient_counts'] = {1: 1001}
+        f.patient_count = 1001
+        f.save(root, 1)
+        stats.refresh()
+        assert query_cohd_mysql.pair_filter(1) is not None and not query_cohd_mysql.pair_may_exist(1, 1, 4)
+
+
+# ######################################################################################################################
+# This section tests storage_backend.py
+# ######################################################################################################################
+def test_sqlite_backend():
+    """ Tests storage_backend.load_sqlite and SqliteBackend
+    Loads a small database from TSVs, then checks the precomputed statistics and that MySQL-style SQL runs on it
+
+    Returns
+    -------
+    No return value. Asserts will be triggered upon failure.
+    """
+    from scipy.stats import chisquare
+
+    def _write_tsv(path, header, rows):
+        with open(path, 'w') as f:
+            f.write('\t'.join(header) + '\r\n')
+            for row in rows:
+                f.write('\t'.join(str(x) for x in row) + '\r\n')
+
+    with tempfile.TemporaryDirectory() as root:
+        concept_file = os.path.join(root, 'concepts.txt')
+        _write_tsv(concept_file, ['concept_id', 'concept_name', 'domain_id', 'vocabulary_id', 'concept_class_id',
+                                  'standard_concept', 'concept_code', 'valid_start_date', 'valid_end_date',
+                                  'invalid_reason'],
+                   [[10, 'condition a', 'Condition', 'SNOMED', 'Clinical Finding', 'S', 'a', '1970-01-01',
+                     '2099-12-31', 'NULL'],
+                    [20, 'condition b', 'Condition', 'SNOMED', 'Clinical Finding', 'S', 'b', '1970-01-01',
+                     '2099-12-31', 'NULL'],
+                    [30, 'drug', 'Drug', 'RxNorm', 'Ingredient', 'S', 'c', '1970-01-01', '2099-12-31', 'NULL']])
+        counts_file = os.path.join(root, 'concept_counts.txt')
+        _write_tsv(counts_file, ['concept_id', 'concept_count'], [[10, 100], [20, 200], [30, 300]])
+        # Pairs are stored with the smaller concept ID first regardless of the order in the file
+        pairs_file = os.path.join(root, 'concept_pair_counts.txt')
+        _write_tsv(pairs_file, ['concept_id_1', 'concept_id_2', 'concept_count'], [[20, 10, 50], [10, 30, 20]])
+
+        path = os.path.join(root, 'db')
+        storage_backend.load_sqlite(path, concept_file, [{'dataset_name': 'test', 'patient_count': 1000,
+                                                          'concept_counts_file': counts_file,
+                                                          'pair_counts_file': pairs_file}])
+        backend = storage_backend.SqliteBackend(path)
+        assert backend.table_exists('concept_pair_counts') and not backend.table_exists('concept_top_associations')
+        assert backend.concepts([30])[30]['concept_name'] == 'drug'
+        assert backend.concept_counts(1, [10, 20, 99]) == {10: 100, 20: 200}
+        assert backend.age_counts(1, 10) is None
+
+        stats = backend.pair_stats(1, 20, 10)
+        assert stats['concept_id_1'] == 10 and stats['concept_count'] == 50
+        assert np.isclose(stats['ln_ratio'], np.log(50 * 1000 / (100 * 200)))
+        observed = [1000 - 100 - 200 + 50, 100 - 50, 200 - 50, 50]
+        expected = [900 * 800 / 1000, 100 * 800 / 1000, 200 * 900 / 1000, 100 * 200 / 1000]
+        assert np.isclose(stats['p_value'], chisquare(observed, expected, 2).pvalue)
+        assert stats['ln_ratio_ci_lo'] < stats['ln_ratio'] < stats['ln_ratio_ci_hi']
+
+        # pymysql parameters, MySQL functions, and parenthesized UNION operands
+        sql = '''SELECT *
+            FROM ((SELECT concept_id_2 AS concept_id, LOG(concept_count) AS x
+                FROM cohd.concept_pair_counts WHERE concept_id_1 = %(concept_id)s)
+            UNION
+            (SELECT concept_id_1 AS concept_id, LOG(concept_count) AS x
+                FROM cohd.concept_pair_counts WHERE concept_id_2 = %(concept_id)s)) x
+            WHERE GREATEST(concept_id, %(min_id)s) = concept_id
+            ORDER BY concept_id;'''
+        with backend.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql, {'concept_id': 10, 'min_id': 25})
+                rows = cur.fetchall()
+        assert [r['concept_id'] for r in rows] == [30]
+        assert np.isclose(rows[0]['x'], np.log(20))
+
+
+# ######################################################################################################################
+# This section tests snapshot.py
+# ######################################################################################################################
+def test_snapshot():
+    """ Tests snapshot
+    Writes a small snapshot, reads it back with typed columns, and builds a co-occurrence store from it
+
+    Returns
+    -------
+    No return value. Asserts will be triggered upon failure.
+    """
+    pa = pytest.importorskip('pyarrow')
+    pq = pytest.importorskip('pyarrow.parquet')
+
+    tables = {
+        'concept': {
+            'concept_id': [10, 20, 30], 'concept_name': ['condition a', 'condition b', None],
+            'domain_id': ['Condition', 'Condition', 'Drug'], 'vocabulary_id': ['SNOMED', 'SNOMED', 'RxNorm'],
+            'concept_class_id': ['Clinical Finding', 'Clinical Finding', 'Ingredient'],
+            'standard_concept': ['S', 'S', 'S'], 'concept_code': ['1', '2', '3']},
+        'concept_counts': {
+            'concept_id': [10, 20, 30], 'concept_count': [100, 200, 300], 'ci_lo': [90.0, 190.0, 290.0],
+            'ci_hi': [110.0, 210.0, 310.0]},
+        'concept_pair_counts': dict({
+            'concept_id_1': [10, 10], 'concept_id_2': [20, 30], 'concept_count': [50, 20]},
+            **{c: [0.5, None] for c in snapshot.PAIR_STAT_COLUMNS}),
+    }
+    with tempfile.TemporaryDirectory() as root:
+        for table, columns in tables.items():
+            path = snapshot._table_path(root, table, 1 if snapshot.TABLES[table][1] else None)
+            os.makedirs(os.path.dirname(path))
+            pq.write_table(pa.Table.from_pydict(columns, schema=snapshot._schema(table)), path)
+        with open(os.path.join(root, 'meta.json'), 'w') as f:
+            json.dump({'format_version': snapshot.FORMAT_VERSION, 'datasets': {'1': {
+                'dataset_name': 'test', 'dataset_description': '', 'patient_count': 1000, 'total_pair_count': 2}}}, f)
+
+        snap = snapshot.Snapshot(root)
+        assert snap.dataset_ids == [1] and snap.patient_count(1) == 1000 and snap.total_pair_count(1) == 2
+        concepts = snap.columns('concept', columns=['concept_id', 'concept_name'])
+        assert concepts['concept_id'].dtype == np.int64 and concepts['concept_name'][2] is None
+        pairs = snap.columns('concept_pair_counts', 1)
+        assert pairs['p_value'][0] == 0.5 and np.isnan(pairs['p_value'][1])
+        batches = list(snap.iter_batches('concept_pair_counts', 1, columns=['concept_id_2'], batch_size=1))
+        assert [b['concept_id_2'].tolist() for b in batches] == [[20], [30]]
+        with pytest.raises(ValueError):
+            snap.columns('concept_counts')
+
+        cooccurrence_store.build_store_from_snapshot(snap, 1, os.path.join(root, 'store', '1'))
+        store = cooccurrence_store.open_store(os.path.join(root, 'store'), 1)
+        rows = store.associations(20)
+        assert len(rows) == 1 and rows[0]['concept_id_2'] == 10 and rows[0]['concept_2_name'] == 'condition a'
+
+
+# ######################################################################################################################
+# This section tests chi_square.py
+# ######################################################################################################################
+def test_chi_square():
+    """ Tests chi_square
+    Checks the vectorized chi-square against scipy.stats.chisquare on each pair's observed and expected tables
+
+    Returns
+    -------
+    No return value. Asserts will be triggered upon failure.
+    """
+    from scipy.stats import chisquare
+
+    pts = 1000.0
+    c1 = np.array([100, 100, 300, 50])
+    c2 = np.array([200, 900, 300, 60])
+    cpc = np.array([50, 90, 30, 11])
+    statistic, p, p_adjusted = chi_square.chi_square(cpc, c1, c2, pts, n_concept_pairs=10, min_p=1e-12)
+    for i in range(len(cpc)):
+        o = [pts - c1[i] - c2[i] + cpc[i], c1[i] - cpc[i], c2[i] - cpc[i], cpc[i]]
+        e = [(pts - c1[i]) * (pts - c2[i]) / pts, c1[i] * (pts - c2[i]) / pts, c2[i] * (pts - c1[i]) / pts,
+             c1[i] * c2[i] / pts]
+        cs = chisquare(o, e, 2)
+        assert np.isclose(statistic[i], cs.statistic)
+        assert np.isclose(p[i], max(cs.pvalue, 1e-12))
+        assert np.isclose(p_adjusted[i], max(min(cs.pvalue * 10, 1.0), 1e-12))
+
+    # From dict cursor rows, with the contingency table cells
+    rows = [{'concept_pair_count': 50, 'concept_count_1': 100, 'concept_count_2': 200, 'patient_count': 1000}]
+    cells, statistic_rows, _, _ = chi_square.chi_square_rows(rows)
+    assert [c.tolist() for c in cells] == [[750], [50], [150], [50]]
+    assert np.isclose(statistic_rows[0], statistic[0])
+
+    r = query_cohd_mysql._chi_square_rows([dict(rows[0], dataset_id=1, concept_id_1=1, concept_id_2=2)], 10,
+                                          include_concept_2=False)[0]
+    assert r['n'] == 1000 and r['n_c1'] == 100 and r['n_~c1_~c2'] == 750 and r['n_c1_c2'] == 50
+    assert np.isclose(r['chi_square'], statistic[0]) and np.isclose(r['adj_p-value'], min(r['p-value'] * 10, 1.0))
+    assert query_cohd_mysql._chi_square_rows([], 10) == []
+
+
+# ######################################################################################################################
+# This section tests cohd_temporal.py
+# ######################################################################################################################
+def test_temporal_binning():
+    """ Tests the array-based rebinning and confidence intervals of cohd_temporal
+    Checks small examples by hand, and that stacks of counts give the same results as each row
+
+    Returns
+    -------
+    No return value. Asserts will be triggered upon failure.
+    """
+    # Age counts: suppressed counts (1) are estimated (5) and the last bin includes the leftover bins
+    cac = cohd_temporal.AgeCounts(4, 1, 'c', 100, [1, 2, 3, 4, 5, 6, 7], 1)
+    assert cac.convert_bin_scheme(2).counts.tolist() == [7, 7, 11, 7]
+    assert cac.convert_bin_scheme(4).counts.tolist() == [14, 18]
+    assert cac.convert_bin_scheme(2, new_bins=2).counts.tolist() == [7, 25]
+    assert cac.convert_bin_scheme(4, new_bins=3).counts.tolist() == [14, 18, 0]
+
+    # Delta counts: the 0-day bin isn't grouped and the outermost bins include the leftover bins
+    counts = [1, 2, 3, 4, 5, 100, 6, 7, 8, 9, 10]
+    dc = cohd_temporal.DeltaCounts(4, 1, 2, 'a', 'b', 10, 20, 5, counts, 1, 5)
+    assert dc.convert_bin_scheme(2).counts.tolist() == [1, 5, 9, 100, 13, 17, 10]
+    assert dc.convert_bin_scheme(2, 2).counts.tolist() == [6, 9, 100, 13, 27]
+    assert dc.convert_bin_scheme(8, 1).counts.tolist() == [15, 100, 40]
+
+    # Stacks of counts give the same results as each row
+    rng = np.random.default_rng(0)
+    stack = rng.integers(0, 50, (6, 11))
+    assert (cohd_temporal.rebin_age_counts(stack, 3) ==
+            [cohd_temporal.rebin_age_counts(row, 3) for row in stack]).all()
+    assert (cohd_temporal.rebin_delta_counts(stack, 5, 2, 2) ==
+            [cohd_temporal.rebin_delta_counts(row, 5, 2, 2) for row in stack]).all()
+    deltas = [cohd_temporal.DeltaCounts(4, i, 2, 'a', 'b', 10, 20, 5, row, 1, 5) for i, row in enumerate(stack)]
+    deltas.append(cohd_temporal.DeltaCounts(4, 9, 2, 'a', 'b', 10, 20, 5, [3, 4, 5, 6, 7], 2, 2))
+    converted = cohd_temporal.convert_delta_bin_schemes(deltas, 4, 1)
+    assert [d.counts.tolist() for d in converted] == [d.convert_bin_scheme(4, 1).counts.tolist() for d in deltas]
+    assert all(d.bin_width == 4 and d.n == 1 for d in converted)
+
+    # Confidence intervals of a stack are the same as poisson.interval of each count
+    cis = cohd_temporal.poisson_intervals(stack)
+    assert cis.shape == (6, 11, 2)
+    assert all(tuple(cis[i, j]) == poisson.interval(0.99, stack[i, j]) for i in range(6) for j in range(11))
+    results = cohd_temporal.convert_to_dict_results(deltas)
+    assert [r['confidence_interval'] for r in results] == \
+        [d.convert_to_dict_results()['confidence_interval'] for d in deltas]
+
+    # Jaccard similarity of a stack of distributions
+    d = np.array([[0.2, 0.8], [0.5, 0.5]])
+    assert _crr(cohd_temporal.jaccard_similarity(d, np.array([0.5, 0.5])), [0.7 / 1.3, 1.0])
+
+
+def test_bootstrap_delta_distribution():
+    """ Tests cohd_temporal.bootstrap_delta_distribution
+    Checks that the chunked simulations are reproducible with a seed and match a per-iteration loop with the same
+    random draws
+
+    Returns
+    -------
+    No return value. Asserts will be triggered upon failure.
+    """
+    deltas = [cohd_temporal.DeltaCounts(4, i, 2, 'a', 'b', 100 * (i + 1), 50, 5, counts, 4, 3)
+              for i, counts in enumerate([[0, 5, 9, 40, 20, 3, 1], [2, 2, 8, 60, 10, 6, 0], [1, 0, 3, 25, 7, 9, 2]])]
+    dist = cohd_temporal.bootstrap_delta_distribution(deltas, iterations=500, seed=42)
+    assert dist.shape == (5, 7) and (np.diff(dist, axis=0) >= 0).all()
+
+    # Same seed, different chunk sizes
+    assert (dist == cohd_temporal.bootstrap_delta_distribution(deltas, iterations=500, seed=42, chunk_elements=10)).all()
+
+    # Same draws as one delta and one Poisson call per iteration
+    rng = np.random.default_rng(42)
+    resampled = rng.integers(0, len(deltas), size=500)
+    sims = [rng.poisson(deltas[i].counts) / float(deltas[i].source_concept_count) for i in resampled]
+    assert np.allclose(dist, np.percentile(sims, q=[2.5, 25, 50, 75, 97.5], axis=0))
+
+    # With a single delta, the modes only differ by the scaling
+    counts = cohd_temporal.bootstrap_delta_distribution(deltas[1:2], mode='counts', iterations=500, seed=1)
+    relative = cohd_temporal.bootstrap_delta_distribution(deltas[1:2], mode='relative_target', iterations=500, seed=1)
+    assert np.allclose(counts / 50.0, relative)
+    assert cohd_temporal.bootstrap_delta_distribution([], iterations=10) is None
+
+
+def test_age_distributions():
+    """ Tests cohd_temporal.AgeDistributions
+    Checks the suppression estimates, conversions to larger bin widths, and the vectorized similarity search against
+    the AgeCounts calculations
+
+    Returns
+    -------
+    No return value. Asserts will be triggered upon failure.
+    """
+    concepts = [
+        (10, 'a', 'Condition', 'Clinical Finding', 100, 1, [10, 20, 30, 40]),
+        (11, 'b', 'Condition', 'Clinical Finding', 1000, 1, [100, 200, 300, 400]),
+        (12, 'c', 'Drug', 'Ingredient', 100, 2, [40, 60]),
+        (13, 'd', 'Condition', 'Clinical Finding', 20, 1, [1, 1, 10, 8]),  # suppressed counts > 5%
+        (14, 'e', 'Condition', 'Clinical Finding', 100, 1, [1, 29, 30, 40]),
+    ]
+    distributions = cohd_temporal.AgeDistributions(4, concepts)
+    assert len(distributions) == 5
+
+    m1 = distributions.matrix(1)
+    assert distributions.concept_ids[m1.positions].tolist() == [10, 11, 14]
+    assert m1.counts[2].tolist() == [1, 29, 30, 40]
+    assert np.allclose(m1.distributions[2], [0.05, 0.29, 0.3, 0.4])
+    m2 = distributions.matrix(2)
+    assert distributions.concept_ids[m2.positions].tolist() == [10, 11, 12, 14]
+    assert m2.counts[3].tolist() == [34, 70]
+    assert distributions.matrix(32).counts[0].tolist() == [100]
+
+    # Similarities at bin width 1 and to the larger bin widths, same as comparing AgeCounts
+    coi = cohd_temporal.AgeCounts(4, 10, 'a', 100, [10, 20, 30, 40], 1)
+    coi_distributions = {bw: coi.convert_bin_scheme(bw).counts / 100.0 for bw in [1, 2, 4]}
+    similar = distributions.similar(10, 1, coi_distributions, 0.0)
+    rows, similarities = similar[1]
+    assert distributions.concept_ids[m1.positions[rows]].tolist() == [11, 14]
+    assert _crr(similarities, [cohd_temporal.jaccard_similarity(np.array([100, 200, 300, 400]) / 1000.0,
+                                                                 coi_distributions[1]), 0.95 / 1.09])
+    rows, similarities = similar[2]
+    assert distributions.concept_ids[m2.positions[rows]].tolist() == [12]
+    assert _crr(similarities, [0.9 / 1.1])
+    assert 4 not in similar
+
+    # Threshold and domain filters
+    assert [bw for bw in distributions.similar(10, 1, coi_distributions, 0.85)] == [1]
+    assert list(distributions.similar(10, 1, coi_distributions, 0.0, domain_id='Drug')) == [2]
+    assert distributions.similar(10, 1, coi_distributions, 0.0, domain_id='Device') == {}
+
+    # Concepts with a smaller bin width are compared at the concept of interest's bin width
+    coi = cohd_temporal.AgeCounts(4, 12, 'c', 100, [40, 60], 2)
+    rows, _ = distributions.similar(12, 2, {2: coi.counts / 100.0}, 0.0)[2]
+    assert distributions.concept_ids[m2.positions[rows]].tolist() == [10, 11, 14]
+    cac = distributions.age_counts(2, rows[2])
+    assert cac.concept_id == 14 and cac.bin_width == 2 and cac.counts.tolist() == [34, 70]
+
+    order = list(cohd_temporal._descending_order(np.array([0.2, 0.9, 0.5, 0.9, 0.1, 0.7]), 2))
+    assert order == [1, 3, 5, 2, 0, 4]
@@ -1,16 +1,28 @@
 # This code pasted together from prototyping notebook. Untested.
 from getpass import getpass
 from datetime import datetime
+import argparse
 from collections import namedtuple
+import os
 import sys
 import logging
 
 import numpy as np
 import pandas as pd
-from scipy.stats import poisson, chisquare
+from scipy.stats import poisson
 from sqlalchemy import create_engine
 import mysql.connector
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from cohd import chi_square
+from cohd.snapshot import Snapshot
+
+# Optionally, read the counts from a snapshot of the serving tables (see cohd/snapshot.py) instead of querying MySQL.
+# The results are still written to MySQL.
+parser = argparse.ArgumentParser(description='Precomputes the COHD statistics')
+parser.add_argument('--snapshot', help='Read the counts from this snapshot directory instead of MySQL')
+args = parser.parse_args()
+snapshot = Snapshot(args.snapshot) if args.snapshot else None
 
 logFormatter = logging.Formatter("%(asctime)s %(levelname)s %(module)s:%(lineno)d: %(message)s")
 rootLogger = logging.getLogger()
@@ -186,22 +198,19 @@ def chi(c1, c2, cpc, pts):
 
     Returns
     -------
-    chi-square -value (unadjusted)
+    chi-square -value (unadjusted). Arrays if the counts are arrays.
     """
-    neg = pts - c1 - c2 + cpc
-    # Create the observed and expected RxC tables and perform chi-square
-    o = [neg, c1 - cpc, c2 - cpc, cpc]
-    e = [(pts - c1) * (pts - c2) / pts, c1 * (pts - c2) / pts, c2 * (pts - c1) / pts, c1 * c2 / pts]
-    cs = chisquare(o, e, 2)
-    return cs.pvalue
+    _, p, _ = chi_square.chi_square(cpc, c1, c2, pts)
+    return p
 
 
-def calculations(count_1, count_2, pair_count, patient_count):
+def calculations(count_1, count_2, pair_count, patient_count, p=None):
     count_1 = float(count_1)
     count_2 = float(count_2)
     pair_count = float(pair_count)
     patient_count = float(patient_count)
-    p = chi(count_1, count_2, pair_count, patient_count)
+    if p is None:
+        p = float(chi(count_1, count_2, pair_count, patient_count))
     pair_count_ci = poisson_ci(pair_count, confidence=0.99)
     ln_ratio = np.log(pair_count * patient_count / (count_1 * count_2))
     lr_ci = ln_ratio_ci(pair_count, ln_ratio, confidence=0.99)
@@ -228,7 +237,11 @@ CONFIDENCE = 0.99
 dataset_ids = [1, 2, 3, 4]
 for dataset_id in dataset_ids:
     t1 = datetime.now()
-    cur_fetch = conn.exec_driver_sql(sql_fetch, {'dataset_id': dataset_id})
+    if snapshot is not None:
+        counts = snapshot.columns('concept_counts', dataset_id, ['concept_id', 'concept_count'])
+        cur_fetch = zip(counts['concept_id'].tolist(), counts['concept_count'].tolist())
+    else:
+        cur_fetch = conn.exec_driver_sql(sql_fetch, {'dataset_id': dataset_id})
     count = 0
     params_list = list()
     for row in cur_fetch:
@@ -293,7 +306,51 @@ cur_update = connection.cursor(prepared=True)
 
 n_rows_dataset = [15927195, 32788901, 197683321, 56848043]
 datasets = [2, 4]
+
+def precompute_from_snapshot(dataset_id):
+    """ Computes the pair statistics of a dataset from the snapshot, one batch of pairs at a time, and writes the pairs
+    that don't have statistics yet to MySQL """
+    patient_count = float(snapshot.patient_count(dataset_id))
+    counts = snapshot.columns('concept_counts', dataset_id, ['concept_id', 'concept_count'])
+    counts = dict(zip(counts['concept_id'].tolist(), counts['concept_count'].tolist()))
+    n_rows = snapshot.meta['n_rows'][f'concept_pair_counts/{dataset_id}']
+    logging.info(f'######## dataset_id {dataset_id}  - {n_rows} rows ########')
+
+    n_b = 0
+    t1 = datetime.now()
+    for batch in snapshot.iter_batches('concept_pair_counts', dataset_id,
+                                       ['concept_id_1', 'concept_id_2', 'concept_count', 'p_value'], batch_size=100000):
+        # Chi-square for the whole batch at once
+        count_1 = np.array([counts[c] for c in batch['concept_id_1'].tolist()], dtype=np.float64)
+        count_2 = np.array([counts[c] for c in batch['concept_id_2'].tolist()], dtype=np.float64)
+        p_values = chi(count_1, count_2, batch['concept_count'], patient_count)
+
+        sql_params = list()
+        for concept_id_1, concept_id_2, c1, c2, pair_count, p_value, p in zip(
+                batch['concept_id_1'].tolist(), batch['concept_id_2'].tolist(), count_1.tolist(), count_2.tolist(),
+                batch['concept_count'].tolist(), batch['p_value'].tolist(), p_values.tolist()):
+            if not np.isnan(p_value):
+                # Already computed
+                continue
+            cc = calculations(c1, c2, pair_count, patient_count, p)
+            sql_params.append((cc.p_value, cc.pair_count_ci[0], cc.pair_count_ci[1],
+                               cc.ln_ratio, cc.ln_ratio_ci[0], cc.ln_ratio_ci[1],
+                               cc.log_odds, cc.log_odds_ci[0], cc.log_odds_ci[1],
+                               dataset_id, concept_id_1, concept_id_2))
+        cur_update.executemany(sql_update, sql_params)
+        connection.commit()
+
+        n_b += len(batch['concept_id_1'])
+        duration = (datetime.now() - t1).total_seconds() / 60 / 60
+        est_remain = (n_rows - n_b) / (n_b / duration) if duration > 0 else 0
+        logging.info(f'{n_b} ({n_b / n_rows * 100}%) - {duration:0.1f} hours - {est_remain:0.1f} hours remaining')
+
+
 for dataset_id in datasets:
+    if snapshot is not None:
+        precompute_from_snapshot(dataset_id)
+        continue
+
     n_rows = n_rows_dataset[dataset_id - 1]
     logging.info(f'######## dataset_id {dataset_id}  - {n_rows} rows ########')
 
@@ -0,0 +1,45 @@
+-- Creates concept_pair_counts_bidir, which stores every row of concept_pair_counts in both orientations:
+-- (concept_id_1, concept_id_2) and (concept_id_2, concept_id_1). All pairs of a concept are then reachable through a
+-- single range scan of the clustered primary key (dataset_id, concept_id_1, ...), so the API can look up all
+-- associations of a concept without the two-sided UNION.
+--
+-- Run after the data has been loaded, the iatrogenic codes deleted, and the statistics precomputed
+-- (db/precompute_stats/precompute.py). The API detects the table automatically. The table is built under a temporary
+-- name and renamed at the end, so the API never sees a partially built table. Re-run after reloading
+-- concept_pair_counts. To revert to the original layout, drop concept_pair_counts_bidir.
+--
+-- Doubles the storage of concept_pair_counts.
+
+USE cohd;
+
+DROP TABLE IF EXISTS concept_pair_counts_bidir_build;
+
+CREATE TABLE concept_pair_counts_bidir_build LIKE concept_pair_counts;
+
+-- Drop the secondary indices copied from concept_pair_counts, the bidirectional table only needs one
+ALTER TABLE concept_pair_counts_bidir_build
+  DROP INDEX concept_id_1_idx,
+  DROP INDEX concept_id_2_idx;
+
+-- Stored orientation
+INSERT INTO concept_pair_counts_bidir_build
+SELECT * FROM concept_pair_counts;
+
+-- Mirrored orientation. All of the precomputed statistics are symmetric in the two concepts.
+INSERT INTO concept_pair_counts_bidir_build (dataset_id, concept_id_1, concept_id_2, concept_count,
+    p_value, pair_count_ci_lo, pair_count_ci_hi, ln_ratio, ln_ratio_ci_lo, ln_ratio_ci_hi,
+    log_odds, log_odds_ci_lo, log_odds_ci_hi)
+SELECT dataset_id, concept_id_2, concept_id_1, concept_count,
+    p_value, pair_count_ci_lo, pair_count_ci_hi, ln_ratio, ln_ratio_ci_lo, ln_ratio_ci_hi,
+    log_odds, log_odds_ci_lo, log_odds_ci_hi
+FROM concept_pair_counts;
+
+-- Top pairs of a concept by count without a sort
+ALTER TABLE concept_pair_counts_bidir_build
+  ADD INDEX concept_count_idx (dataset_id ASC, concept_id_1 ASC, concept_count DESC);
+
+ANALYZE TABLE concept_pair_counts_bidir_build;
+
+-- Swap in the new table
+DROP TABLE IF EXISTS concept_pair_counts_bidir;
+RENAME TABLE concept_pair_counts_bidir_build TO concept_pair_counts_bidir;
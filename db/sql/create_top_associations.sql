@@ -0,0 +1,66 @@
+-- Creates concept_top_associations, which lists the top associations of each concept by TRAPI score within each
+-- group of (dataset_id, concept_id_1, associated concept's domain_id and concept_class_id, SIGN(ln_ratio)). The TRAPI
+-- score is the ln_ratio CI bound closest to zero, or 0 if the CI spans 0 (see cohd_trapi.score_cohd_result).
+-- group_size is the number of associations in the group, so the API can tell whether a group was truncated. The
+-- top associations for any combination of domains, classes, and ln_ratio sign are found by merging the lists of the
+-- matching groups.
+--
+-- Run after the data has been loaded, the iatrogenic codes deleted, and the statistics precomputed
+-- (db/precompute_stats/precompute.py). The API detects the table automatically and falls back to the full
+-- association queries when the top lists of a concept run out before the TRAPI results limit is reached. The table
+-- is built under a temporary name and renamed at the end. Re-run after reloading concept_pair_counts.
+
+USE cohd;
+
+-- Number of associations kept per group. Keep well above the TRAPI default max_results_per_input (50), since results
+-- can be filtered out while building the TRAPI response.
+SET @top_k = 300;
+
+DROP TABLE IF EXISTS concept_top_associations_build;
+
+CREATE TABLE concept_top_associations_build (
+  dataset_id INT NOT NULL,
+  concept_id_1 INT NOT NULL,
+  domain_id VARCHAR(20) NOT NULL,
+  concept_class_id VARCHAR(20) NOT NULL,
+  ln_ratio_sign TINYINT NOT NULL,
+  rank_in_group INT NOT NULL,
+  concept_id_2 INT NOT NULL,
+  score DOUBLE NOT NULL,
+  group_size INT NOT NULL,
+  PRIMARY KEY (dataset_id, concept_id_1, domain_id, concept_class_id, ln_ratio_sign, rank_in_group));
+
+INSERT INTO concept_top_associations_build
+SELECT dataset_id, concept_id_1, domain_id, concept_class_id, ln_ratio_sign, rank_in_group, concept_id_2, score,
+    group_size
+FROM
+    (SELECT p.*,
+        ROW_NUMBER() OVER w AS rank_in_group,
+        COUNT(*) OVER (PARTITION BY dataset_id, concept_id_1, domain_id, concept_class_id, ln_ratio_sign) AS group_size
+    FROM
+        -- Each pair is stored once in concept_pair_counts, list it for both concepts
+        ((SELECT cp.dataset_id, cp.concept_id_1, cp.concept_id_2, c.domain_id, c.concept_class_id,
+            COALESCE(SIGN(cp.ln_ratio), 0) AS ln_ratio_sign,
+            CASE WHEN cp.ln_ratio_ci_lo > 0 THEN cp.ln_ratio_ci_lo
+                WHEN cp.ln_ratio_ci_hi < 0 THEN -cp.ln_ratio_ci_hi
+                ELSE 0 END AS score
+        FROM concept_pair_counts cp
+        JOIN concept c ON cp.concept_id_2 = c.concept_id)
+        UNION ALL
+        (SELECT cp.dataset_id, cp.concept_id_2 AS concept_id_1, cp.concept_id_1 AS concept_id_2, c.domain_id,
+            c.concept_class_id,
+            COALESCE(SIGN(cp.ln_ratio), 0) AS ln_ratio_sign,
+            CASE WHEN cp.ln_ratio_ci_lo > 0 THEN cp.ln_ratio_ci_lo
+                WHEN cp.ln_ratio_ci_hi < 0 THEN -cp.ln_ratio_ci_hi
+                ELSE 0 END AS score
+        FROM concept_pair_counts cp
+        JOIN concept c ON cp.concept_id_1 = c.concept_id)) p
+    WINDOW w AS (PARTITION BY dataset_id, concept_id_1, domain_id, concept_class_id, ln_ratio_sign
+        ORDER BY score DESC, concept_id_2 ASC)) ranked
+WHERE rank_in_group <= @top_k;
+
+ANALYZE TABLE concept_top_associations_build;
+
+-- Swap in the new table
+DROP TABLE IF EXISTS concept_top_associations;
+RENAME TABLE concept_top_associations_build TO concept_top_associations;
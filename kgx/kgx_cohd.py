@@ -3,20 +3,17 @@ import json
 from datetime import datetime
 import os
 from os import path
+import sys
 import logging
 
 import numpy as np
-from scipy.stats import poisson, chisquare
+from scipy.stats import poisson
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..'))
+from cohd import chi_square as cohd_chi_square
+from cohd.snapshot import Snapshot
 
 
-N_PATIENTS = {
-    1: 1790431,
-    3: 1731858
-}
-N_CONCEPT_PAIRS = {
-    1: 15927195,
-    3: 197683321
-}
 THRESHOLD_COUNT = 10
 CONFIDENCE = 0.99  # Confidence interval level
 LN_RATIO_THRESHOLD = 1.0
@@ -27,15 +24,18 @@ INFORES_ID = 'infores:cohd'
 KNOWLEDGE_LEVEL = 'statistical_association'
 AGENT_TYPE = 'data_analysis_pipeline'
 
-# Input data dir and files
-DIR_DATA = '20241030'  
-files_count_data = [
-    'counts_ds1.tsv',
-    'counts_cd.tsv',
-    'counts_dc.tsv',
-    'counts_dd.tsv',
-    'counts_dp.tsv',
-    'counts_pd.tsv'
+# Input snapshot dir (see cohd/snapshot.py)
+DIR_SNAPSHOT = '20241030'
+# Edge partitions: (name, dataset ID, (domain 1, domain 2)). Reproduces COHD TRAPI default behavior of using dataset 3
+# (5-year hierarchical) whenever drugs are involved, otherwise dataset 1 (5-year non-hierarchical). A domain pair of
+# None selects all pairs without a Drug concept.
+edge_partitions = [
+    ('ds1', 1, None),
+    ('cd', 3, ('Condition', 'Drug')),
+    ('dc', 3, ('Drug', 'Condition')),
+    ('dd', 3, ('Drug', 'Drug')),
+    ('dp', 3, ('Drug', 'Procedure')),
+    ('pd', 3, ('Procedure', 'Drug'))
 ]
 
 # Create output dir with today's date
@@ -201,20 +201,18 @@ def chi_square(cpc, c1, c2, pts, n_concept_pairs, min_p=MIN_P):
 
     Params
     ------
-    cpc: concept-pair count
-    c1: count for concept 1
-    c2: count for concept 2
+    cpc: concept-pair counts (array)
+    c1: counts for concept 1 (array)
+    c2: counts for concept 2 (array)
     pts: total population size
     n_concept_pairs: number of pairs of concepts in dataset
     min_p: minimum p-value to return 
+
+    Returns
+    -------
+    (p-values, Bonferonni p-values) arrays
     """
-    neg = pts - c1 - c2 + cpc
-    # Create the observed and expected RxC tables and perform chi-square
-    o = [neg, c1 - cpc, c2 - cpc, cpc]
-    e = [(pts - c1) * (pts - c2) / pts, c1 * (pts - c2) / pts, c2 * (pts - c1) / pts, c1 * c2 / pts]
-    cs = chisquare(o, e, 2)
-    p = max(cs.pvalue, min_p)
-    p_bonferonni = max(min(cs.pvalue * n_concept_pairs, 1.0), min_p)  # Bonferonni adjustment
+    _, p, p_bonferonni = cohd_chi_square.chi_square(cpc, c1, c2, pts, n_concept_pairs, min_p)
     return p, p_bonferonni
 
     
@@ -233,84 +231,124 @@ def clip(x, clip):
     # return min(max(x, -clip), clip)
     return -clip if x < -clip else clip if x > clip else x    
 
+
+def partition_pairs(dataset_id, domain_pair):
+    """ Iterates over the mapped concept pairs of an edge partition
+
+    Params
+    ------
+    dataset_id: COHD dataset ID
+    domain_pair: (domain 1, domain 2), or None for all pairs without a Drug concept
+
+    Returns
+    -------
+    Iterator of (concept 1, concept 2, count 1, count 2, pair count, chi-square p-value, Bonferonni p-value)
+    """
+    n_patients = snapshot.patient_count(dataset_id)
+    n_concept_pairs = snapshot.total_pair_count(dataset_id)
+    counts = snapshot.columns('concept_counts', dataset_id, ['concept_id', 'concept_count'])
+    counts = dict(zip(counts['concept_id'].tolist(), counts['concept_count'].tolist()))
+    for batch in snapshot.iter_batches('concept_pair_counts', dataset_id,
+                                       ['concept_id_1', 'concept_id_2', 'concept_count']):
+        pairs = list()
+        for omop_id_1, omop_id_2, count_pair in zip(batch['concept_id_1'].tolist(), batch['concept_id_2'].tolist(),
+                                                    batch['concept_count'].tolist()):
+            if omop_id_1 not in mappings or omop_id_2 not in mappings:
+                continue
+            domain_1 = omop_concepts[omop_id_1]['domain']
+            domain_2 = omop_concepts[omop_id_2]['domain']
+            if domain_pair is None:
+                if domain_1 == 'Drug' or domain_2 == 'Drug':
+                    continue
+            elif (domain_1, domain_2) != domain_pair:
+                continue
+            count_1 = counts.get(omop_id_1)
+            count_2 = counts.get(omop_id_2)
+            if count_1 is None or count_2 is None:
+                continue
+            pairs.append((omop_id_1, omop_id_2, count_1, count_2, count_pair))
+
+        # Chi-square for the whole batch at once
+        if pairs:
+            _, _, c1, c2, cp = np.array(pairs, dtype=np.float64).T
+            p, p_bonferonni = chi_square(cp, c1, c2, n_patients, n_concept_pairs)
+            for pair, p_pair, p_bonferonni_pair in zip(pairs, p.tolist(), p_bonferonni.tolist()):
+                yield pair + (p_pair, p_bonferonni_pair)
+
+
+snapshot = Snapshot(DIR_SNAPSHOT)
+
 # Read OMOP concep definitions
 omop_concepts = dict()
-with open(path.join(DIR_DATA, 'concepts.tsv'), 'r', encoding='utf-8') as f_concepts:
-    # skip header line
-    f_concepts.readline()
-    while line := f_concepts.readline():
-        line_split = line.strip().split('\t')
-        if len(line_split) == 2:
-            # For some reason, many Read (vocabulary) concepts don't have concept_name. Give it a fake name
-            line_split.append("Error: Read vocabulary concept missing concept_name")
-        omop_id, domain_id, concept_name = line_split
-        omop_concepts[int(omop_id)] = {
-            'id': 'OMOP:' + omop_id,
-            'name': concept_name,
-            'domain': domain_id
-        }
+concepts = snapshot.columns('concept', columns=['concept_id', 'domain_id', 'concept_name'])
+for omop_id, domain_id, concept_name in zip(concepts['concept_id'].tolist(), concepts['domain_id'].tolist(),
+                                            concepts['concept_name'].tolist()):
+    if concept_name is None:
+        # For some reason, many Read (vocabulary) concepts don't have concept_name. Give it a fake name
+        concept_name = "Error: Read vocabulary concept missing concept_name"
+    omop_concepts[omop_id] = {
+        'id': f'OMOP:{omop_id}',
+        'name': concept_name,
+        'domain': domain_id
+    }
+del concepts
 
 # Read Biolink mappings into a dict and create KG nodes
 mappings = dict()
 nodes = dict()
-with open(path.join(DIR_DATA, 'mappings.tsv'), 'r') as f_mappings:
-    # skip header line
-    f_mappings.readline()
-    
-    while line := f_mappings.readline():
-        row = line.strip().split('\t')
-        omop_id, biolink_id, biolink_label, categories = row[:4]
-        omop_id = int(omop_id)
-
-        omop_concept = omop_concepts.get(omop_id)
-        if omop_concept is not None:            
-            mappings[omop_id] = biolink_id        
-
-            # Create KG Node         
-            attributes = [
-                {
-                    "attribute_source": INFORES_ID,
-                    "attribute_type_id": "EDAM:data_0954",
-                    "attributes": [
-                        {
-                            "attribute_source": "infores:omop-ohdsi",
-                            "attribute_type_id": "EDAM:data_1087",
-                            "original_attribute_name": "concept_id",
-                            "value": omop_concept["id"],
-                            "value_type_id": "EDAM:data_1087",
-                            "value_url": f"https://athena.ohdsi.org/search-terms/terms/{omop_id}"
-                        },
-                        {
-                            "attribute_source": "infores:omop-ohdsi",
-                            "attribute_type_id": "EDAM:data_2339",
-                            "original_attribute_name": "concept_name",
-                            "value": omop_concept["name"],
-                            "value_type_id": "EDAM:data_2339"
-                        },
-                        {
-                            "attribute_source": "infores:omop-ohdsi",
-                            "attribute_type_id": "EDAM:data_0967",
-                            "original_attribute_name": "domain",
-                            "value": omop_concept["domain"],
-                            "value_type_id": "EDAM:data_0967"
-                        }
-                    ],
-                    "original_attribute_name": "Database cross-mapping",
-                    "value": "(OMOP:2313993)-[OMOP Map]-(CPT:93976)",
-                    "value_type_id": "EDAM:data_0954"
-                }
-            ]
-            nodes[biolink_id] = {
-                "id": biolink_id,
-                "name": biolink_label,
-                "categories": json.loads(categories),
-                "attributes": [json.dumps(a) for a in attributes]
+biolink_mappings = snapshot.columns('biolink_mappings', columns=['omop_id', 'biolink_id', 'biolink_label', 'categories'])
+for omop_id, biolink_id, biolink_label, categories in zip(
+        biolink_mappings['omop_id'].tolist(), biolink_mappings['biolink_id'].tolist(),
+        biolink_mappings['biolink_label'].tolist(), biolink_mappings['categories'].tolist()):
+    omop_concept = omop_concepts.get(omop_id)
+    if omop_concept is not None:            
+        mappings[omop_id] = biolink_id        
+
+        # Create KG Node         
+        attributes = [
+            {
+                "attribute_source": INFORES_ID,
+                "attribute_type_id": "EDAM:data_0954",
+                "attributes": [
+                    {
+                        "attribute_source": "infores:omop-ohdsi",
+                        "attribute_type_id": "EDAM:data_1087",
+                        "original_attribute_name": "concept_id",
+                        "value": omop_concept["id"],
+                        "value_type_id": "EDAM:data_1087",
+                        "value_url": f"https://athena.ohdsi.org/search-terms/terms/{omop_id}"
+                    },
+                    {
+                        "attribute_source": "infores:omop-ohdsi",
+                        "attribute_type_id": "EDAM:data_2339",
+                        "original_attribute_name": "concept_name",
+                        "value": omop_concept["name"],
+                        "value_type_id": "EDAM:data_2339"
+                    },
+                    {
+                        "attribute_source": "infores:omop-ohdsi",
+                        "attribute_type_id": "EDAM:data_0967",
+                        "original_attribute_name": "domain",
+                        "value": omop_concept["domain"],
+                        "value_type_id": "EDAM:data_0967"
+                    }
+                ],
+                "original_attribute_name": "Database cross-mapping",
+                "value": "(OMOP:2313993)-[OMOP Map]-(CPT:93976)",
+                "value_type_id": "EDAM:data_0954"
             }
-        else:
-            # No definition for concept
-            logging.warning(f"No OMOP concept definition found for {line}")
-            continue
-        
+        ]
+        nodes[biolink_id] = {
+            "id": biolink_id,
+            "name": biolink_label,
+            "categories": json.loads(categories),
+            "attributes": [json.dumps(a) for a in attributes]
+        }
+    else:
+        # No definition for concept
+        logging.warning(f"No OMOP concept definition found for {omop_id} ({biolink_id})")
+        continue
+    
 
 t1 = datetime.now()
 
@@ -321,406 +359,395 @@ log_odds_values = list()
 log_odds_max_counter = 0
 
 with open(path.join(dir_output, 'cohd_edges.jsonl'), 'w') as f_edges:
-    for file_count_data in files_count_data:
-        logging.info(f'Processing file {file_count_data}')
+    for partition_name, dataset_id, domain_pair in edge_partitions:
+        logging.info(f'Processing partition {partition_name}')
         count_edges_file = 0
+        n_patients = snapshot.patient_count(dataset_id)
+
+        for omop_id_1, omop_id_2, count_1, count_2, count_pair, p, p_bonferonni in partition_pairs(dataset_id,
+                                                                                               domain_pair):
+            count_lines += 1
+            if (count_lines % 1000000) == 0:
+                logging.info(f'{count_lines} pairs processed')
 
-        with open(path.join(DIR_DATA, file_count_data), 'r') as f_counts:
-            # skip header line
-            f_counts.readline()
+            biolink_id_1 = mappings[omop_id_1]
+            biolink_id_2 = mappings[omop_id_2]
             
-            while line := f_counts.readline():
-                count_lines += 1                
-                if (count_lines % 1000000) == 0:
-                    logging.info(f'{count_lines} lines processed')
-
-                omop_id_1, omop_id_2, count_1, count_2, count_pair, dataset_id = [int(x) for x in line.strip().split('\t')]
-                count_1 = count_1
-                count_2 = count_2
-                count_pair = count_pair
-                biolink_id_1 = mappings[omop_id_1]
-                biolink_id_2 = mappings[omop_id_2]
-                n_patients = N_PATIENTS[dataset_id]
-                n_concept_pairs = N_CONCEPT_PAIRS[dataset_id]
-                
-                if count_1 <= THRESHOLD_COUNT or count_2 <= THRESHOLD_COUNT or count_pair <= THRESHOLD_COUNT:
-                    continue
+            if count_1 <= THRESHOLD_COUNT or count_2 <= THRESHOLD_COUNT or count_pair <= THRESHOLD_COUNT:
+                continue
 
-                # calculate ln_ratio
-                count_expected = count_1 * count_2 / (n_patients)
-                lnr = np.log(count_pair * n_patients / (count_1 * count_2))
-                lnr_ci = ln_ratio_ci(count_pair, lnr, CONFIDENCE, JSON_INFINITY_REPLACEMENT)
+            # calculate ln_ratio
+            count_expected = count_1 * count_2 / (n_patients)
+            lnr = np.log(count_pair * n_patients / (count_1 * count_2))
+            lnr_ci = ln_ratio_ci(count_pair, lnr, CONFIDENCE, JSON_INFINITY_REPLACEMENT)
+            
+            if lnr_ci[0] > LN_RATIO_THRESHOLD or lnr_ci[1] < -LN_RATIO_THRESHOLD:
+                count_edges_file += 1
+
+                # calculate relative frequency
+                rf1 = count_pair / count_1
+                rf1_ci = rel_freq_ci(count_pair, count_1, CONFIDENCE, JSON_INFINITY_REPLACEMENT)
+                rf2 = count_pair / count_2
+                rf2_ci = rel_freq_ci(count_pair, count_2, CONFIDENCE, JSON_INFINITY_REPLACEMENT)
+
+                # calculate log-odds
+                lo, lo_ci = log_odds(count_1, count_2, count_pair, n_patients, JSON_INFINITY_REPLACEMENT)
+                log_odds_values.append(lo)
                 
-                if lnr_ci[0] > LN_RATIO_THRESHOLD or lnr_ci[1] < -LN_RATIO_THRESHOLD:
-                    count_edges_file += 1
-
-                    # calculate relative frequency
-                    rf1 = count_pair / count_1
-                    rf1_ci = rel_freq_ci(count_pair, count_1, CONFIDENCE, JSON_INFINITY_REPLACEMENT)
-                    rf2 = count_pair / count_2
-                    rf2_ci = rel_freq_ci(count_pair, count_2, CONFIDENCE, JSON_INFINITY_REPLACEMENT)
-
-                    # calculate chi-square
-                    p, p_bonferonni = chi_square(count_pair, count_1, count_2, n_patients, n_concept_pairs)
-                    
-                    # calculate log-odds
-                    lo, lo_ci = log_odds(count_1, count_2, count_pair, n_patients, JSON_INFINITY_REPLACEMENT)
-                    log_odds_values.append(lo)
-                    
-                    # Checking log-odds for max values
-                    if abs(lo) > JSON_INFINITY_REPLACEMENT or abs(lo_ci[0]) > JSON_INFINITY_REPLACEMENT or abs(lo_ci[1]) > JSON_INFINITY_REPLACEMENT:
-                        logging.warning(f'log odds greater than {JSON_INFINITY_REPLACEMENT}')
-                    if lo == JSON_INFINITY_REPLACEMENT:
-                        log_odds_max_counter += 1
-
-                    # Convention: subj <-> concept 1; obj <-> concept 2
-                    curie_subj = biolink_id_1
-                    curie_obj = biolink_id_2
-                    count_subj_value = count_1
-                    count_obj_value = count_2
-                    count_study_value = f"{curie_subj}: {count_subj_value}; {curie_obj}: {count_obj_value}; pair: {count_pair}"
-                    chi_study_value = f"p-value: {p:.2e}; Bonferonni p-value: {p_bonferonni:.2e}"
-                    oefr_study_value = f"{lnr:.3f} [{lnr_ci[0]:.3f}, {lnr_ci[1]:.3f}]"
-                    rel_freq_subj_value = rf1
-                    rel_freq_subj_ci_value = rf1_ci
-                    rel_freq_obj_value = rf2
-                    rel_freq_obj_ci_value = rf2_ci
-                    rel_freq_study_value = f"Relative to {curie_subj}: {rel_freq_subj_value:.3f} [{rel_freq_subj_ci_value[0]:.3f}, {rel_freq_subj_ci_value[1]:.3f}]; " \
-                                        f"Relative to {curie_obj}: {rel_freq_obj_value:.3f} [{rel_freq_obj_ci_value[0]:.3f}, {rel_freq_obj_ci_value[1]:.3f}]"
-                    log_odds_study_value = f"{lo:.3f} [{lo_ci[0]:.3f}, {lo_ci[1]:.3f}]"
-                    score = lnr_ci[0] if lnr > 0 else -lnr_ci[1]
-
-                    # Build attributes
-                    attributes = [
-                        {
-                            "attribute_source": INFORES_ID,
-                            "attribute_type_id": "biolink:knowledge_level",
-                            "value": "statistical_association"
-                        },
-                        {
-                            "attribute_source": INFORES_ID,
-                            "attribute_type_id": "biolink:agent_type",
-                            "value": "data_analysis_pipeline"
-                        },
-                        {
-                            "attribute_source": INFORES_ID,
-                            "attribute_type_id": "biolink:has_supporting_study_result",
-                            "description": "A study result describing the initial count of concepts",
-                            "value": count_study_value,
-                            "value_type_id": "biolink:ConceptCountAnalysisResult",
-                            'value_url': 'https://github.com/NCATSTranslator/Translator-All/wiki/COHD-KP',
-                            "attributes": [
-                                {
-                                    'attribute_type_id': 'biolink:concept_pair_count',
-                                    'original_attribute_name': 'concept_pair_count',
-                                    'value': count_pair,
-                                    'value_type_id': 'EDAM:data_0006',  # Data
-                                    'attribute_source': INFORES_ID,
-                                    'description': 'Observed concept count between the pair of subject and object nodes'
-                                },
-                                {
-                                    'attribute_type_id': 'biolink:concept_count_subject',
-                                    'original_attribute_name': 'concept_count_subject',
-                                    'value': count_subj_value,
-                                    'value_type_id': 'EDAM:data_0006',  # Data
-                                    'attribute_source': INFORES_ID,
-                                    'description': f'Observed concept count of the subject node ({curie_subj})'
-                                },
-                                {
-                                    'attribute_type_id': 'biolink:concept_count_object',
-                                    'original_attribute_name': 'concept_count_object',
-                                    'value': count_obj_value,
-                                    'value_type_id': 'EDAM:data_0006',  # Data
-                                    'attribute_source': INFORES_ID,
-                                    'description': f'Observed concept count of the object node ({curie_obj})'
-                                },
-                                {
-                                    'attribute_type_id': 'biolink:dataset_count',
-                                    'original_attribute_name': 'patient_count',
-                                    'value': n_patients,
-                                    'value_type_id': 'EDAM:data_0006',  # Data
-                                    'attribute_source': INFORES_ID,
-                                    'description': 'Number of patients in the COHD dataset'
-                                },
-                                {
-                                    'attribute_type_id': 'biolink:supporting_data_set', 
-                                    'original_attribute_name': 'dataset_id',
-                                    'value': f"COHD:dataset_{dataset_id}",
-                                    'value_type_id': 'EDAM:data_1048',  # Database ID
-                                    'attribute_source': INFORES_ID,
-                                    'description': f'Dataset ID within COHD'
-                                },
-                                # Knowledge Level
-                                {
-                                    'attribute_type_id': 'biolink:knowledge_level',  
-                                    'value': KNOWLEDGE_LEVEL,
-                                    'attribute_source': INFORES_ID
-                                },
-                                # Agent Type
-                                {
-                                    'attribute_type_id': 'biolink:agent_type',  
-                                    'value': AGENT_TYPE,
-                                    'attribute_source': INFORES_ID
-                                }
-                            ]
-                        },
-                        {
-                            "attribute_source": INFORES_ID,
-                            "attribute_type_id": "biolink:has_supporting_study_result",
-                            "description": "A study result describing a chi-squared analysis on a single pair of concepts",
-                            "value": chi_study_value,
-                            "value_type_id": "biolink:ChiSquaredAnalysisResult",
-                            'value_url': 'https://github.com/NCATSTranslator/Translator-All/wiki/COHD-KP',
-                            "attributes": [
-                                {
-                                    'attribute_type_id': 'biolink:unadjusted_p_value',
-                                    'original_attribute_name': 'p-value',
-                                    'value': p,
-                                    'value_type_id': 'EDAM:data_1669',  # P-value
-                                    'attribute_source': INFORES_ID,
-                                    'value_url': 'http://edamontology.org/data_1669',
-                                    'description': 'Chi-square p-value, unadjusted.'
-                                },
-                                {
-                                    'attribute_type_id': 'biolink:bonferonni_adjusted_p_value',
-                                    'original_attribute_name': 'p-value adjusted',
-                                    'value': p_bonferonni,
-                                    'value_type_id': 'EDAM:data_1669',  # P-value
-                                    'attribute_source': INFORES_ID,
-                                    'value_url': 'http://edamontology.org/data_1669',
-                                    'description': 'Chi-square p-value, Bonferonni adjusted by number of pairs of concepts.'
-                                },
-                                {
-                                    'attribute_type_id': 'biolink:supporting_data_set',  # Database ID
-                                    'original_attribute_name': 'dataset_id',
-                                    'value': f"COHD:dataset_{dataset_id}",
-                                    'value_type_id': 'EDAM:data_1048',  # Database ID
-                                    'attribute_source': INFORES_ID,
-                                    'description': f'Dataset ID within COHD'
-                                },
-                                # Knowledge Level
-                                {
-                                    'attribute_type_id': 'biolink:knowledge_level',  
-                                    'value': KNOWLEDGE_LEVEL,
-                                    'attribute_source': INFORES_ID
-                                },
-                                # Agent Type
-                                {
-                                    'attribute_type_id': 'biolink:agent_type',  
-                                    'value': AGENT_TYPE,
-                                    'attribute_source': INFORES_ID
-                                }
-                            ]
-                        },
-                        {
-                            "attribute_source": INFORES_ID,
-                            "attribute_type_id": "biolink:has_supporting_study_result",
-                            "description": "A study result describing an observed-expected frequency anaylsis on a single pair of concepts",
-                            "value": oefr_study_value,
-                            "value_type_id": "biolink:ObservedExpectedFrequencyAnalysisResult",
-                            'value_url': 'https://github.com/NCATSTranslator/Translator-All/wiki/COHD-KP',
-                            "attributes": [
-                                {
-                                    'attribute_type_id': 'biolink:expected_count',
-                                    'original_attribute_name': 'expected_count',
-                                    'value': count_expected,
-                                    'value_type_id': 'EDAM:operation_3438',
-                                    'attribute_source': INFORES_ID,
-                                    'description': 'Calculated expected count of concept pair.'
-                                },
-                                {
-                                    'attribute_type_id': 'biolink:ln_ratio',
-                                    'original_attribute_name': 'ln_ratio',
-                                    'value': lnr,
-                                    'value_type_id': 'EDAM:data_1772',  # Score
-                                    'attribute_source': INFORES_ID,
-                                    'description': 'Observed-expected frequency ratio.'
-                                },
-                                {
-                                    'attribute_type_id': 'biolink:ln_ratio_confidence_interval',
-                                    'original_attribute_name': 'ln_ratio_confidence_interval',
-                                    'value': lnr_ci,
-                                    'value_type_id': 'EDAM:data_0951',  # Statistical estimate score
-                                    'attribute_source': INFORES_ID,
-                                    'description': f'Observed-expected frequency ratio {CONFIDENCE*100}% confidence interval'
-                                },
-                                {
-                                    'attribute_type_id': 'biolink:supporting_data_set',  # Database ID
-                                    'original_attribute_name': 'dataset_id',
-                                    'value': f"COHD:dataset_{dataset_id}",
-                                    'value_type_id': 'EDAM:data_1048',  # Database ID
-                                    'attribute_source': INFORES_ID,
-                                    'description': f'Dataset ID within COHD'
-                                },
-                                # Knowledge Level
-                                {
-                                    'attribute_type_id': 'biolink:knowledge_level',  
-                                    'value': KNOWLEDGE_LEVEL,
-                                    'attribute_source': INFORES_ID
-                                },
-                                # Agent Type
-                                {
-                                    'attribute_type_id': 'biolink:agent_type',  
-                                    'value': AGENT_TYPE,
-                                    'attribute_source': INFORES_ID
-                                }
-                            ]
-                        },
-                        {
-                            "attribute_source": INFORES_ID,
-                            "attribute_type_id": "biolink:has_supporting_study_result",
-                            "description": "A study result describing a relative frequency anaylsis on a single pair of concepts",
-                            "value": rel_freq_study_value,
-                            "value_type_id": "biolink:RelativeFrequencyAnalysisResult",
-                            'value_url': 'https://github.com/NCATSTranslator/Translator-All/wiki/COHD-KP',
-                            "attributes": [
-                                {
-                                    'attribute_type_id': 'biolink:relative_frequency_subject',
-                                    'original_attribute_name': 'relative_frequency_subject',
-                                    'value': rel_freq_subj_value,
-                                    'value_type_id': 'EDAM:data_1772',  # Score
-                                    'attribute_source': INFORES_ID,
-                                    'description': f'Relative frequency, relative to the subject node ({curie_subj}).'
-                                },
-                                {
-                                    'attribute_type_id': 'biolink:relative_frequency_subject_confidence_interval',
-                                    'original_attribute_name': 'relative_freq_subject_confidence_interval',
-                                    'value': rel_freq_subj_ci_value,
-                                    'value_type_id': 'EDAM:data_0951',  # Statistical estimate score
-                                    'attribute_source': INFORES_ID,
-                                    'description': f'Relative frequency (subject) {CONFIDENCE*100}% confidence interval'
-                                },
-                                {
-                                    'attribute_type_id': 'biolink:relative_frequency_object',
-                                    'original_attribute_name': 'relative_frequency_object',
-                                    'value': rel_freq_obj_value,
-                                    'value_type_id': 'EDAM:data_1772',  # Score
-                                    'attribute_source': INFORES_ID,
-                                    'description': f'Relative frequency, relative to the object node ({curie_obj}).'
-                                },
-                                {
-                                    'attribute_type_id': 'biolink:relative_frequency_object_confidence_interval',
-                                    'original_attribute_name': 'relative_freq_object_confidence_interval',
-                                    'value': rel_freq_obj_ci_value,
-                                    'value_type_id': 'EDAM:data_0951',  # Statistical estimate score
-                                    'attribute_source': INFORES_ID,
-                                    'description': f'Relative frequency (object) {CONFIDENCE*100}% confidence interval'
-                                },
-                                {
-                                    'attribute_type_id': 'biolink:supporting_data_set',  # Database ID
-                                    'original_attribute_name': 'dataset_id',
-                                    'value': f"COHD:dataset_{dataset_id}",
-                                    'value_type_id': 'EDAM:data_1048',  # Database ID
-                                    'attribute_source': INFORES_ID,
-                                    'description': f'Dataset ID within COHD'
-                                },
-                                # Knowledge Level
-                                {
-                                    'attribute_type_id': 'biolink:knowledge_level',  
-                                    'value': KNOWLEDGE_LEVEL,
-                                    'attribute_source': INFORES_ID
-                                },
-                                # Agent Type
-                                {
-                                    'attribute_type_id': 'biolink:agent_type',  
-                                    'value': AGENT_TYPE,
-                                    'attribute_source': INFORES_ID
-                                }
-                            ]
-                        },
-                        {
-                            "attribute_source": INFORES_ID,
-                            "attribute_type_id": "biolink:has_supporting_study_result",
-                            "description": "A study result describing a log-odds anaylsis on a single pair of concepts",
-                            "value": log_odds_study_value,
-                            "value_type_id": "biolink:LogOddsAnalysisResult",
-                            'value_url': 'https://github.com/NCATSTranslator/Translator-All/wiki/COHD-KP',
-                            "attributes": [
-                                {
-                                    'attribute_type_id': 'biolink:log_odds_ratio',
-                                    'original_attribute_name': 'log_odds',
-                                    'value': lo,
-                                    'value_type_id': 'EDAM:data_1772',  # Score
-                                    'attribute_source': INFORES_ID,
-                                    'description': 'Natural logarithm of the odds-ratio'
-                                },
-                                {
-                                    'attribute_type_id': 'biolink:log_odds_ratio_95_ci',
-                                    'original_attribute_name': 'log_odds_ci',
-                                    'value': lo_ci,
-                                    'value_type_id': 'EDAM:data_0951',  # Statistical estimate score
-                                    'attribute_source': INFORES_ID,
-                                    'description': f'Log-odds 95% confidence interval'
-                                },
-                                {
-                                    'attribute_type_id': 'biolink:total_sample_size',
-                                    'original_attribute_name': 'concept_pair_count',
-                                    'value': count_pair,
-                                    'value_type_id': 'EDAM:data_0006',  # Data
-                                    'attribute_source': INFORES_ID,
-                                    'description': 'Observed concept count between the pair of subject and object nodes'
-                                },
-                                {
-                                    'attribute_type_id': 'biolink:supporting_data_set',  # Database ID
-                                    'original_attribute_name': 'dataset_id',
-                                    'value': f"COHD:dataset_{dataset_id}",
-                                    'value_type_id': 'EDAM:data_1048',  # Database ID
-                                    'attribute_source': INFORES_ID,
-                                    'description': f'Dataset ID within COHD'
-                                },
-                                # Knowledge Level
-                                {
-                                    'attribute_type_id': 'biolink:knowledge_level',  
-                                    'value': KNOWLEDGE_LEVEL,
-                                    'attribute_source': INFORES_ID
-                                },
-                                # Agent Type
-                                {
-                                    'attribute_type_id': 'biolink:agent_type',  
-                                    'value': AGENT_TYPE,
-                                    'attribute_source': INFORES_ID
-                                }
-                            ]
-                        }
-                    ]
-                    # Convert attributes to JSON strings
-                    attributes = [json.dumps(a) for a in attributes]
-                    
-                    predicate = 'biolink:positively_correlated_with' if lo_ci[0] > 0 else 'biolink:negatively_correlated_with'    
-                    edge = {
-                        'subject': biolink_id_1,
-                        'object': biolink_id_2,
-                        'predicate': predicate,
-                        'score': score,
-                        'attributes': attributes,
-                        'sources': [
+                # Checking log-odds for max values
+                if abs(lo) > JSON_INFINITY_REPLACEMENT or abs(lo_ci[0]) > JSON_INFINITY_REPLACEMENT or abs(lo_ci[1]) > JSON_INFINITY_REPLACEMENT:
+                    logging.warning(f'log odds greater than {JSON_INFINITY_REPLACEMENT}')
+                if lo == JSON_INFINITY_REPLACEMENT:
+                    log_odds_max_counter += 1
+
+                # Convention: subj <-> concept 1; obj <-> concept 2
+                curie_subj = biolink_id_1
+                curie_obj = biolink_id_2
+                count_subj_value = count_1
+                count_obj_value = count_2
+                count_study_value = f"{curie_subj}: {count_subj_value}; {curie_obj}: {count_obj_value}; pair: {count_pair}"
+                chi_study_value = f"p-value: {p:.2e}; Bonferonni p-value: {p_bonferonni:.2e}"
+                oefr_study_value = f"{lnr:.3f} [{lnr_ci[0]:.3f}, {lnr_ci[1]:.3f}]"
+                rel_freq_subj_value = rf1
+                rel_freq_subj_ci_value = rf1_ci
+                rel_freq_obj_value = rf2
+                rel_freq_obj_ci_value = rf2_ci
+                rel_freq_study_value = f"Relative to {curie_subj}: {rel_freq_subj_value:.3f} [{rel_freq_subj_ci_value[0]:.3f}, {rel_freq_subj_ci_value[1]:.3f}]; " \
+                                    f"Relative to {curie_obj}: {rel_freq_obj_value:.3f} [{rel_freq_obj_ci_value[0]:.3f}, {rel_freq_obj_ci_value[1]:.3f}]"
+                log_odds_study_value = f"{lo:.3f} [{lo_ci[0]:.3f}, {lo_ci[1]:.3f}]"
+                score = lnr_ci[0] if lnr > 0 else -lnr_ci[1]
+
+                # Build attributes
+                attributes = [
+                    {
+                        "attribute_source": INFORES_ID,
+                        "attribute_type_id": "biolink:knowledge_level",
+                        "value": "statistical_association"
+                    },
+                    {
+                        "attribute_source": INFORES_ID,
+                        "attribute_type_id": "biolink:agent_type",
+                        "value": "data_analysis_pipeline"
+                    },
+                    {
+                        "attribute_source": INFORES_ID,
+                        "attribute_type_id": "biolink:has_supporting_study_result",
+                        "description": "A study result describing the initial count of concepts",
+                        "value": count_study_value,
+                        "value_type_id": "biolink:ConceptCountAnalysisResult",
+                        'value_url': 'https://github.com/NCATSTranslator/Translator-All/wiki/COHD-KP',
+                        "attributes": [
+                            {
+                                'attribute_type_id': 'biolink:concept_pair_count',
+                                'original_attribute_name': 'concept_pair_count',
+                                'value': count_pair,
+                                'value_type_id': 'EDAM:data_0006',  # Data
+                                'attribute_source': INFORES_ID,
+                                'description': 'Observed concept count between the pair of subject and object nodes'
+                            },
+                            {
+                                'attribute_type_id': 'biolink:concept_count_subject',
+                                'original_attribute_name': 'concept_count_subject',
+                                'value': count_subj_value,
+                                'value_type_id': 'EDAM:data_0006',  # Data
+                                'attribute_source': INFORES_ID,
+                                'description': f'Observed concept count of the subject node ({curie_subj})'
+                            },
+                            {
+                                'attribute_type_id': 'biolink:concept_count_object',
+                                'original_attribute_name': 'concept_count_object',
+                                'value': count_obj_value,
+                                'value_type_id': 'EDAM:data_0006',  # Data
+                                'attribute_source': INFORES_ID,
+                                'description': f'Observed concept count of the object node ({curie_obj})'
+                            },
+                            {
+                                'attribute_type_id': 'biolink:dataset_count',
+                                'original_attribute_name': 'patient_count',
+                                'value': n_patients,
+                                'value_type_id': 'EDAM:data_0006',  # Data
+                                'attribute_source': INFORES_ID,
+                                'description': 'Number of patients in the COHD dataset'
+                            },
+                            {
+                                'attribute_type_id': 'biolink:supporting_data_set', 
+                                'original_attribute_name': 'dataset_id',
+                                'value': f"COHD:dataset_{dataset_id}",
+                                'value_type_id': 'EDAM:data_1048',  # Database ID
+                                'attribute_source': INFORES_ID,
+                                'description': f'Dataset ID within COHD'
+                            },
+                            # Knowledge Level
+                            {
+                                'attribute_type_id': 'biolink:knowledge_level',  
+                                'value': KNOWLEDGE_LEVEL,
+                                'attribute_source': INFORES_ID
+                            },
+                            # Agent Type
+                            {
+                                'attribute_type_id': 'biolink:agent_type',  
+                                'value': AGENT_TYPE,
+                                'attribute_source': INFORES_ID
+                            }
+                        ]
+                    },
+                    {
+                        "attribute_source": INFORES_ID,
+                        "attribute_type_id": "biolink:has_supporting_study_result",
+                        "description": "A study result describing a chi-squared analysis on a single pair of concepts",
+                        "value": chi_study_value,
+                        "value_type_id": "biolink:ChiSquaredAnalysisResult",
+                        'value_url': 'https://github.com/NCATSTranslator/Translator-All/wiki/COHD-KP',
+                        "attributes": [
+                            {
+                                'attribute_type_id': 'biolink:unadjusted_p_value',
+                                'original_attribute_name': 'p-value',
+                                'value': p,
+                                'value_type_id': 'EDAM:data_1669',  # P-value
+                                'attribute_source': INFORES_ID,
+                                'value_url': 'http://edamontology.org/data_1669',
+                                'description': 'Chi-square p-value, unadjusted.'
+                            },
+                            {
+                                'attribute_type_id': 'biolink:bonferonni_adjusted_p_value',
+                                'original_attribute_name': 'p-value adjusted',
+                                'value': p_bonferonni,
+                                'value_type_id': 'EDAM:data_1669',  # P-value
+                                'attribute_source': INFORES_ID,
+                                'value_url': 'http://edamontology.org/data_1669',
+                                'description': 'Chi-square p-value, Bonferonni adjusted by number of pairs of concepts.'
+                            },
+                            {
+                                'attribute_type_id': 'biolink:supporting_data_set',  # Database ID
+                                'original_attribute_name': 'dataset_id',
+                                'value': f"COHD:dataset_{dataset_id}",
+                                'value_type_id': 'EDAM:data_1048',  # Database ID
+                                'attribute_source': INFORES_ID,
+                                'description': f'Dataset ID within COHD'
+                            },
+                            # Knowledge Level
+                            {
+                                'attribute_type_id': 'biolink:knowledge_level',  
+                                'value': KNOWLEDGE_LEVEL,
+                                'attribute_source': INFORES_ID
+                            },
+                            # Agent Type
+                            {
+                                'attribute_type_id': 'biolink:agent_type',  
+                                'value': AGENT_TYPE,
+                                'attribute_source': INFORES_ID
+                            }
+                        ]
+                    },
+                    {
+                        "attribute_source": INFORES_ID,
+                        "attribute_type_id": "biolink:has_supporting_study_result",
+                        "description": "A study result describing an observed-expected frequency anaylsis on a single pair of concepts",
+                        "value": oefr_study_value,
+                        "value_type_id": "biolink:ObservedExpectedFrequencyAnalysisResult",
+                        'value_url': 'https://github.com/NCATSTranslator/Translator-All/wiki/COHD-KP',
+                        "attributes": [
                             {
-                                "resource_id": "infores:columbia-cdw-ehr-data",
-                                "resource_role": "supporting_data_source"
+                                'attribute_type_id': 'biolink:expected_count',
+                                'original_attribute_name': 'expected_count',
+                                'value': count_expected,
+                                'value_type_id': 'EDAM:operation_3438',
+                                'attribute_source': INFORES_ID,
+                                'description': 'Calculated expected count of concept pair.'
                             },
                             {
-                                "resource_id": INFORES_ID,
-                                "resource_role": "primary_knowledge_source",
-                                "upstream_resource_ids": [
-                                    "infores:columbia-cdw-ehr-data"
-                                ]
+                                'attribute_type_id': 'biolink:ln_ratio',
+                                'original_attribute_name': 'ln_ratio',
+                                'value': lnr,
+                                'value_type_id': 'EDAM:data_1772',  # Score
+                                'attribute_source': INFORES_ID,
+                                'description': 'Observed-expected frequency ratio.'
+                            },
+                            {
+                                'attribute_type_id': 'biolink:ln_ratio_confidence_interval',
+                                'original_attribute_name': 'ln_ratio_confidence_interval',
+                                'value': lnr_ci,
+                                'value_type_id': 'EDAM:data_0951',  # Statistical estimate score
+                                'attribute_source': INFORES_ID,
+                                'description': f'Observed-expected frequency ratio {CONFIDENCE*100}% confidence interval'
+                            },
+                            {
+                                'attribute_type_id': 'biolink:supporting_data_set',  # Database ID
+                                'original_attribute_name': 'dataset_id',
+                                'value': f"COHD:dataset_{dataset_id}",
+                                'value_type_id': 'EDAM:data_1048',  # Database ID
+                                'attribute_source': INFORES_ID,
+                                'description': f'Dataset ID within COHD'
+                            },
+                            # Knowledge Level
+                            {
+                                'attribute_type_id': 'biolink:knowledge_level',  
+                                'value': KNOWLEDGE_LEVEL,
+                                'attribute_source': INFORES_ID
+                            },
+                            # Agent Type
+                            {
+                                'attribute_type_id': 'biolink:agent_type',  
+                                'value': AGENT_TYPE,
+                                'attribute_source': INFORES_ID
+                            }
+                        ]
+                    },
+                    {
+                        "attribute_source": INFORES_ID,
+                        "attribute_type_id": "biolink:has_supporting_study_result",
+                        "description": "A study result describing a relative frequency anaylsis on a single pair of concepts",
+                        "value": rel_freq_study_value,
+                        "value_type_id": "biolink:RelativeFrequencyAnalysisResult",
+                        'value_url': 'https://github.com/NCATSTranslator/Translator-All/wiki/COHD-KP',
+                        "attributes": [
+                            {
+                                'attribute_type_id': 'biolink:relative_frequency_subject',
+                                'original_attribute_name': 'relative_frequency_subject',
+                                'value': rel_freq_subj_value,
+                                'value_type_id': 'EDAM:data_1772',  # Score
+                                'attribute_source': INFORES_ID,
+                                'description': f'Relative frequency, relative to the subject node ({curie_subj}).'
+                            },
+                            {
+                                'attribute_type_id': 'biolink:relative_frequency_subject_confidence_interval',
+                                'original_attribute_name': 'relative_freq_subject_confidence_interval',
+                                'value': rel_freq_subj_ci_value,
+                                'value_type_id': 'EDAM:data_0951',  # Statistical estimate score
+                                'attribute_source': INFORES_ID,
+                                'description': f'Relative frequency (subject) {CONFIDENCE*100}% confidence interval'
+                            },
+                            {
+                                'attribute_type_id': 'biolink:relative_frequency_object',
+                                'original_attribute_name': 'relative_frequency_object',
+                                'value': rel_freq_obj_value,
+                                'value_type_id': 'EDAM:data_1772',  # Score
+                                'attribute_source': INFORES_ID,
+                                'description': f'Relative frequency, relative to the object node ({curie_obj}).'
+                            },
+                            {
+                                'attribute_type_id': 'biolink:relative_frequency_object_confidence_interval',
+                                'original_attribute_name': 'relative_freq_object_confidence_interval',
+                                'value': rel_freq_obj_ci_value,
+                                'value_type_id': 'EDAM:data_0951',  # Statistical estimate score
+                                'attribute_source': INFORES_ID,
+                                'description': f'Relative frequency (object) {CONFIDENCE*100}% confidence interval'
+                            },
+                            {
+                                'attribute_type_id': 'biolink:supporting_data_set',  # Database ID
+                                'original_attribute_name': 'dataset_id',
+                                'value': f"COHD:dataset_{dataset_id}",
+                                'value_type_id': 'EDAM:data_1048',  # Database ID
+                                'attribute_source': INFORES_ID,
+                                'description': f'Dataset ID within COHD'
+                            },
+                            # Knowledge Level
+                            {
+                                'attribute_type_id': 'biolink:knowledge_level',  
+                                'value': KNOWLEDGE_LEVEL,
+                                'attribute_source': INFORES_ID
+                            },
+                            # Agent Type
+                            {
+                                'attribute_type_id': 'biolink:agent_type',  
+                                'value': AGENT_TYPE,
+                                'attribute_source': INFORES_ID
+                            }
+                        ]
+                    },
+                    {
+                        "attribute_source": INFORES_ID,
+                        "attribute_type_id": "biolink:has_supporting_study_result",
+                        "description": "A study result describing a log-odds anaylsis on a single pair of concepts",
+                        "value": log_odds_study_value,
+                        "value_type_id": "biolink:LogOddsAnalysisResult",
+                        'value_url': 'https://github.com/NCATSTranslator/Translator-All/wiki/COHD-KP',
+                        "attributes": [
+                            {
+                                'attribute_type_id': 'biolink:log_odds_ratio',
+                                'original_attribute_name': 'log_odds',
+                                'value': lo,
+                                'value_type_id': 'EDAM:data_1772',  # Score
+                                'attribute_source': INFORES_ID,
+                                'description': 'Natural logarithm of the odds-ratio'
+                            },
+                            {
+                                'attribute_type_id': 'biolink:log_odds_ratio_95_ci',
+                                'original_attribute_name': 'log_odds_ci',
+                                'value': lo_ci,
+                                'value_type_id': 'EDAM:data_0951',  # Statistical estimate score
+                                'attribute_source': INFORES_ID,
+                                'description': f'Log-odds 95% confidence interval'
+                            },
+                            {
+                                'attribute_type_id': 'biolink:total_sample_size',
+                                'original_attribute_name': 'concept_pair_count',
+                                'value': count_pair,
+                                'value_type_id': 'EDAM:data_0006',  # Data
+                                'attribute_source': INFORES_ID,
+                                'description': 'Observed concept count between the pair of subject and object nodes'
+                            },
+                            {
+                                'attribute_type_id': 'biolink:supporting_data_set',  # Database ID
+                                'original_attribute_name': 'dataset_id',
+                                'value': f"COHD:dataset_{dataset_id}",
+                                'value_type_id': 'EDAM:data_1048',  # Database ID
+                                'attribute_source': INFORES_ID,
+                                'description': f'Dataset ID within COHD'
+                            },
+                            # Knowledge Level
+                            {
+                                'attribute_type_id': 'biolink:knowledge_level',  
+                                'value': KNOWLEDGE_LEVEL,
+                                'attribute_source': INFORES_ID
+                            },
+                            # Agent Type
+                            {
+                                'attribute_type_id': 'biolink:agent_type',  
+                                'value': AGENT_TYPE,
+                                'attribute_source': INFORES_ID
                             }
                         ]
                     }
-                    f_edges.write(json.dumps(edge) + '\n')
+                ]
+                # Convert attributes to JSON strings
+                attributes = [json.dumps(a) for a in attributes]
+                
+                predicate = 'biolink:positively_correlated_with' if lo_ci[0] > 0 else 'biolink:negatively_correlated_with'    
+                edge = {
+                    'subject': biolink_id_1,
+                    'object': biolink_id_2,
+                    'predicate': predicate,
+                    'score': score,
+                    'attributes': attributes,
+                    'sources': [
+                        {
+                            "resource_id": "infores:columbia-cdw-ehr-data",
+                            "resource_role": "supporting_data_source"
+                        },
+                        {
+                            "resource_id": INFORES_ID,
+                            "resource_role": "primary_knowledge_source",
+                            "upstream_resource_ids": [
+                                "infores:columbia-cdw-ehr-data"
+                            ]
+                        }
+                    ]
+                }
+                f_edges.write(json.dumps(edge) + '\n')
 
-                    # Keep track of which nodes seen
-                    node_counter[biolink_id_1] += 1
-                    node_counter[biolink_id_2] += 1    
+                # Keep track of which nodes seen
+                node_counter[biolink_id_1] += 1
+                node_counter[biolink_id_2] += 1    
 
-                    if EARLY_STOPPING and (count_edges_file >= EARLY_STOPPING):
-                        logging.info('Early stopping')
-                        break
-            
-            logging.info(f'{count_edges_file} edges created from file')
-            count_edges_total += count_edges_file
+                if EARLY_STOPPING and (count_edges_file >= EARLY_STOPPING):
+                    logging.info('Early stopping')
+                    break
+        
+        logging.info(f'{count_edges_file} edges created from partition')
+        count_edges_total += count_edges_file
 
-            
+        
 with open(path.join(dir_output, 'cohd_nodes.jsonl'), 'w') as f_nodes:
     for node_id in node_counter:
         f_nodes.write(json.dumps(nodes[node_id]) + '\n')